@@ -70,6 +70,22 @@ class GitHubRepository(Base):
     return True if instance else False
 
 
+class ImportedRepository(Base):
+  """A record of a GitHub repository which has been completely imported.
+
+  Contentfiles are imported in multiple transactions, so the presence of a
+  repository in the repositories table does not imply that all of its
+  contentfiles have been imported. A row is added to this table in the same
+  transaction as the last of a repository's contentfiles.
+  """
+  __tablename__ = 'imported_repositories'
+
+  clone_from_url: str = sql.Column(sql.String(1024), sql.ForeignKey(
+      'repositories.clone_from_url'), primary_key=True)
+  date_imported: datetime.datetime = sql.Column(
+      sql.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+
 class ContentFile(Base):
   """A single content file record."""
   __tablename__ = 'contentfiles'
@@ -150,3 +166,30 @@ class ContentFiles(sqlutil.Database):
 
   def __init__(self, url: str):
     super(ContentFiles, self).__init__(url, Base)
+
+  @staticmethod
+  def GetImportedCloneFromUrls(session: orm.session.Session) -> typing.Set[str]:
+    """Return the clone URLs of the repositories which have been imported.
+
+    Databases created before the imported_repositories table existed imported
+    each repository in a single transaction, so the first time that this is
+    called on such a database, every repository is marked as imported.
+
+    Args:
+      session: A database session.
+
+    Returns:
+      A set of clone URLs.
+    """
+    backfilled = session.query(Meta).filter(
+        Meta.key == 'imported_repositories_backfilled').first()
+    if not backfilled:
+      session.execute(ImportedRepository.__table__.insert().from_select(
+          ['clone_from_url', 'date_imported'],
+          sql.select([GitHubRepository.clone_from_url,
+                      sql.func.current_timestamp()]).where(
+              ~GitHubRepository.clone_from_url.in_(
+                  sql.select([ImportedRepository.clone_from_url])))))
+      session.add(Meta(key='imported_repositories_backfilled', value='1'))
+      session.commit()
+    return {url for url, in session.query(ImportedRepository.clone_from_url)}
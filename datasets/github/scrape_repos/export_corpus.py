@@ -1,7 +1,13 @@
-"""Export ContentFiles to a directory."""
+"""Export ContentFiles to a directory or tar archive."""
 import binascii
+import collections
+import io
+import multiprocessing
 import os
 import pathlib
+import tarfile
+import typing
+from concurrent import futures
 
 import humanize
 from absl import app
@@ -20,37 +26,213 @@ flags.DEFINE_string('clone_list', None,
                     'The path to a LanguageCloneList file.')
 flags.DEFINE_string('export_path', None,
                     'The root directory to export files to.')
+flags.DEFINE_enum('export_source', 'index', ['index', 'database'],
+                  'Export contentfiles from the index directories or from the '
+                  'contentfiles databases.')
+flags.DEFINE_enum('export_format', 'directory', ['directory', 'tar'],
+                  'Export each language to a directory of files, or to a '
+                  '.tar.bz2 archive which can be used as a CLgen '
+                  'local_tar_archive.')
+flags.DEFINE_integer('export_threads', 8,
+                     'The number of threads writing files to a directory.')
+
+# The (hex sha256, text) tuple of an exported contentfile.
+ExportedContentFile = typing.Tuple[str, str]
+
+
+class DirectoryExporter(object):
+  """Write contentfiles to a directory of <sha256>.txt files.
+
+  Files are written by a pool of threads. Contentfiles which are already in
+  the directory are not written again.
+  """
+
+  def __init__(self, export_path: pathlib.Path, num_threads: int = 8):
+    self.export_path = export_path
+    self.exported: typing.Set[str] = {
+      name[:-len('.txt')] for name in os.listdir(export_path)
+      if name.endswith('.txt')}
+    self._executor = futures.ThreadPoolExecutor(num_threads)
+    self._max_pending = 4 * num_threads
+    self._pending = collections.deque()
+
+  @staticmethod
+  def _WriteFile(path: pathlib.Path, text: str) -> None:
+    tmp_path = path.parent / f'.{path.name}.tmp'
+    with open(tmp_path, 'w') as f:
+      f.write(text)
+    os.rename(tmp_path, path)
+
+  def Write(self, sha256_hex: str, text: str) -> None:
+    """Write a contentfile."""
+    self.exported.add(sha256_hex)
+    # Bound the number of texts held in memory by pending writes.
+    while len(self._pending) >= self._max_pending:
+      self._pending.popleft().result()
+    self._pending.append(self._executor.submit(
+        self._WriteFile, self.export_path / f'{sha256_hex}.txt', text))
+
+  def __enter__(self) -> 'DirectoryExporter':
+    return self
+
+  def __exit__(self, *args) -> None:
+    self._executor.shutdown(wait=True)
+    # Propagate any write errors.
+    for future in self._pending:
+      future.result()
+
+
+class TarExporter(object):
+  """Write contentfiles to a bzip2-compressed tar archive of <sha256>.txt files.
+
+  The archive is created from scratch, so only duplicates within a single
+  export are skipped.
+  """
+
+  def __init__(self, archive_path: pathlib.Path):
+    self.archive_path = archive_path
+    self.exported: typing.Set[str] = set()
+    self._tmp_path = archive_path.parent / f'.{archive_path.name}.tmp'
+    self._tar = tarfile.open(self._tmp_path, 'w:bz2')
+
+  def Write(self, sha256_hex: str, text: str) -> None:
+    """Write a contentfile."""
+    self.exported.add(sha256_hex)
+    data = text.encode('utf-8')
+    info = tarfile.TarInfo(f'{sha256_hex}.txt')
+    info.size = len(data)
+    self._tar.addfile(info, io.BytesIO(data))
+
+  def __enter__(self) -> 'TarExporter':
+    return self
+
+  def __exit__(self, exc_type, *args) -> None:
+    self._tar.close()
+    if exc_type:
+      os.unlink(self._tmp_path)
+    else:
+      os.rename(self._tmp_path, self.archive_path)
+
+
+Exporter = typing.Union[DirectoryExporter, TarExporter]
+
+
+def ContentFilesFromDatabase(session: orm.session.Session,
+                             exported: typing.Set[str],
+                             batch_size: int = 1000
+                             ) -> typing.Iterator[ExportedContentFile]:
+  """Read the contentfiles in a database which have not been exported.
+
+  The hashes of all contentfiles are first streamed from a server-side
+  cursor, then the texts of those which have not been exported are read in
+  batches, so that texts which are not needed are never loaded.
+
+  Args:
+    session: A database session.
+    exported: The hex sha256s of contentfiles which have been exported.
+    batch_size: The number of texts to read per query.
+
+  Returns:
+    An iterator of (hex sha256, text) tuples.
+  """
+  ids_to_export = []
+  seen = set()
+  query = session.query(contentfiles.ContentFile.id,
+                        contentfiles.ContentFile.sha256).execution_options(
+      stream_results=True).yield_per(100000)
+  for id_, sha256 in query:
+    sha256_hex = binascii.hexlify(sha256).decode('utf-8')
+    if sha256_hex not in exported and sha256_hex not in seen:
+      seen.add(sha256_hex)
+      ids_to_export.append(id_)
+  logging.info('Exporting %s contentfiles (%s already exported) ...',
+               humanize.intcomma(len(ids_to_export)),
+               humanize.intcomma(len(exported)))
+
+  for i in range(0, len(ids_to_export), batch_size):
+    query = session.query(contentfiles.ContentFile.sha256,
+                          contentfiles.ContentFile.text).filter(
+        contentfiles.ContentFile.id.in_(ids_to_export[i:i + batch_size]))
+    for sha256, text in query:
+      yield binascii.hexlify(sha256).decode('utf-8'), text
+
+
+def _ContentFileFromIndexFile(
+    path: str) -> typing.Optional[ExportedContentFile]:
+  """Read a ContentFile proto from an index file."""
+  try:
+    contentfile = pbutil.FromFile(pathlib.Path(path),
+                                  scrape_repos_pb2.ContentFile())
+  except pbutil.DecodeError:
+    return None
+  return binascii.hexlify(contentfile.sha256).decode('utf-8'), contentfile.text
+
+
+def ContentFilesFromIndex(
+    index_path: pathlib.Path, exported: typing.Set[str],
+    pool: typing.Optional[multiprocessing.Pool] = None
+) -> typing.Iterator[ExportedContentFile]:
+  """Read the contentfiles in an index directory which have not been exported.
+
+  Index files are named by the hex sha256 of their contentfile, so files which
+  have been exported are skipped without being parsed.
+
+  Args:
+    index_path: The root of the index directory.
+    exported: The hex sha256s of contentfiles which have been exported.
+    pool: A multiprocessing pool to parse index files on. If not provided, the
+      files are parsed in this process.
+
+  Returns:
+    An iterator of (hex sha256, text) tuples.
+  """
+  paths = []
+  for subdir, dirs, files in os.walk(index_path):
+    for file in files:
+      if file.endswith('.pbtxt') and file[:-len('.pbtxt')] not in exported:
+        paths.append(os.path.join(subdir, file))
+  logging.info('Exporting %s index files (%s already exported) ...',
+               humanize.intcomma(len(paths)), humanize.intcomma(len(exported)))
+  if pool:
+    results = pool.imap_unordered(_ContentFileFromIndexFile, paths,
+                                  chunksize=64)
+  else:
+    results = (_ContentFileFromIndexFile(path) for path in paths)
+  return (result for result in results if result)
+
+
+def Export(contentfiles_to_export: typing.Iterable[ExportedContentFile],
+           exporter: Exporter) -> int:
+  """Export contentfiles, skipping those which have already been exported.
+
+  Args:
+    contentfiles_to_export: An iterator of (hex sha256, text) tuples.
+    exporter: The exporter to write to.
+
+  Returns:
+    The number of contentfiles exported.
+  """
+  count = 0
+  for sha256_hex, text in contentfiles_to_export:
+    if sha256_hex not in exporter.exported:
+      exporter.Write(sha256_hex, text)
+      count += 1
+  return count
 
 
 def ExportDatabase(session: orm.session.Session,
                    export_path: pathlib.Path) -> None:
   """Export the contents of a database to a directory."""
-  query = session.query(contentfiles.ContentFile)
-  logging.info('Exporting %s files to %s ...', humanize.intcomma(query.count()),
-               export_path)
-  for contentfile in query:
-    path = export_path / (contentfile.sha256_hex + '.txt')
-    logging.debug(path)
-    with open(path, 'w') as f:
-      f.write(contentfile.text)
+  with DirectoryExporter(export_path, FLAGS.export_threads) as exporter:
+    Export(ContentFilesFromDatabase(session, exporter.exported), exporter)
 
 
 def ExportIndex(index_path: pathlib.Path, export_path: pathlib.Path) -> None:
   """Export the contents of an index directory to a directory."""
-  contentfile = scrape_repos_pb2.ContentFile()
-  for subdir, dirs, files in os.walk(index_path):
-    for file in files:
-      if file.endswith('.pbtxt'):
-        try:
-          pbutil.FromFile(pathlib.Path(os.path.join(subdir, file)), contentfile)
-          sha256 = binascii.hexlify(contentfile.sha256).decode('utf-8')
-          out_path = export_path / (sha256 + '.txt')
-          if not out_path.is_file():
-            with open(out_path, 'w') as f:
-              f.write(contentfile.text)
-              logging.debug(out_path)
-        except pbutil.DecodeError:
-          pass
+  with multiprocessing.Pool() as pool:
+    with DirectoryExporter(export_path, FLAGS.export_threads) as exporter:
+      Export(ContentFilesFromIndex(index_path, exporter.exported, pool),
+             exporter)
 
 
 def main(argv):
@@ -69,21 +251,37 @@ def main(argv):
   export_path = pathlib.Path(FLAGS.export_path)
   export_path.mkdir(parents=True, exist_ok=True)
 
-  # To export from contentfiles database.
-  # for language in clone_list.language:
-  #   d = pathlib.Path(language.destination_directory)
-  #   d = d.parent / (str(d.name) + '.db')
-  #   db = contentfiles.ContentFiles(d)
-  #   with db.Session() as session:
-  #     (export_path / language.language).mkdir(exist_ok=True)
-  #     ExportDatabase(session, export_path / language.language)
-
-  # To export from index directory.
-  for language in clone_list.language:
-    index_path = pathlib.Path(language.destination_directory + '.index')
-    if index_path.is_dir():
-      (export_path / language.language).mkdir(exist_ok=True)
-      ExportIndex(index_path, export_path / language.language)
+  with multiprocessing.Pool() as pool:
+    for language in clone_list.language:
+      if FLAGS.export_source == 'database':
+        d = pathlib.Path(language.destination_directory)
+        d = d.parent / (str(d.name) + '.db')
+        if not d.is_file():
+          continue
+        db = contentfiles.ContentFiles(f'sqlite:///{d}')
+      else:
+        index_path = pathlib.Path(language.destination_directory + '.index')
+        if not index_path.is_dir():
+          continue
+
+      if FLAGS.export_format == 'tar':
+        exporter = TarExporter(export_path / f'{language.language}.tar.bz2')
+      else:
+        (export_path / language.language).mkdir(exist_ok=True)
+        exporter = DirectoryExporter(export_path / language.language,
+                                     FLAGS.export_threads)
+
+      with exporter:
+        if FLAGS.export_source == 'database':
+          with db.Session() as session:
+            count = Export(ContentFilesFromDatabase(session, exporter.exported),
+                           exporter)
+        else:
+          count = Export(
+              ContentFilesFromIndex(index_path, exporter.exported, pool),
+              exporter)
+      logging.info('Exported %s %s contentfiles', humanize.intcomma(count),
+                   language.language)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,121 @@
+"""Unit tests for //datasets/github/scrape_repos/export_corpus.py."""
+import binascii
+import hashlib
+import pathlib
+import sys
+import tarfile
+import tempfile
+import typing
+
+import pytest
+from absl import app
+from absl import flags
+
+from datasets.github.scrape_repos import contentfiles
+from datasets.github.scrape_repos import export_corpus
+from datasets.github.scrape_repos.proto import scrape_repos_pb2
+from labm8 import pbutil
+
+
+FLAGS = flags.FLAGS
+
+
+@pytest.fixture(scope='function')
+def tempdir() -> pathlib.Path:
+  with tempfile.TemporaryDirectory(prefix='phd_') as d:
+    yield pathlib.Path(d)
+
+
+def _ContentFile(relpath: str, text: str) -> scrape_repos_pb2.ContentFile:
+  return scrape_repos_pb2.ContentFile(
+      clone_from_url='https://repo', relpath=relpath,
+      sha256=hashlib.sha256(text.encode('utf-8')).digest(),
+      charcount=len(text), linecount=1, text=text)
+
+
+def _Sha256Hex(text: str) -> str:
+  return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+@pytest.fixture(scope='function')
+def test_db(tempdir: pathlib.Path) -> contentfiles.ContentFiles:
+  db = contentfiles.ContentFiles(f'sqlite:///{tempdir}/test.db')
+  with db.Session(commit=True) as session:
+    repo = contentfiles.GitHubRepository.FromProto(
+        scrape_repos_pb2.GitHubRepoMetadata(clone_from_url='https://repo'))
+    repo.language = 'c'
+    session.add(repo)
+    session.add_all([
+      contentfiles.ContentFile.FromProto(_ContentFile('a', 'a')),
+      contentfiles.ContentFile.FromProto(_ContentFile('b', 'b')),
+      contentfiles.ContentFile.FromProto(_ContentFile('c', 'a')),
+    ])
+  yield db
+
+
+def _ReadDirectory(path: pathlib.Path) -> typing.Dict[str, str]:
+  texts = {}
+  for file in path.iterdir():
+    with open(file) as f:
+      texts[file.name] = f.read()
+  return texts
+
+
+def test_ExportDatabase_deduplicates(test_db: contentfiles.ContentFiles,
+                                     tempdir: pathlib.Path):
+  """Test that duplicate contentfiles are exported once."""
+  (tempdir / 'export').mkdir()
+  with test_db.Session() as session:
+    export_corpus.ExportDatabase(session, tempdir / 'export')
+  assert _ReadDirectory(tempdir / 'export') == {
+    f'{_Sha256Hex("a")}.txt': 'a',
+    f'{_Sha256Hex("b")}.txt': 'b',
+  }
+
+
+def test_ContentFilesFromDatabase_skips_exported(
+    test_db: contentfiles.ContentFiles):
+  """Test that exported contentfiles are not read."""
+  with test_db.Session() as session:
+    assert list(export_corpus.ContentFilesFromDatabase(
+        session, {_Sha256Hex('a')}, batch_size=1)) == [(_Sha256Hex('b'), 'b')]
+
+
+def test_ExportIndex(tempdir: pathlib.Path):
+  """Test exporting an index directory."""
+  (tempdir / 'index' / 'repo').mkdir(parents=True)
+  (tempdir / 'export').mkdir()
+  for text in ['a', 'b']:
+    contentfile = _ContentFile(text, text)
+    pbutil.ToFile(contentfile, tempdir / 'index' / 'repo' / (
+        binascii.hexlify(contentfile.sha256).decode('utf-8') + '.pbtxt'))
+  with open(tempdir / 'export' / f'{_Sha256Hex("a")}.txt', 'w') as f:
+    f.write('already exported')
+  export_corpus.ExportIndex(tempdir / 'index', tempdir / 'export')
+  assert _ReadDirectory(tempdir / 'export') == {
+    f'{_Sha256Hex("a")}.txt': 'already exported',
+    f'{_Sha256Hex("b")}.txt': 'b',
+  }
+
+
+def test_TarExporter(tempdir: pathlib.Path):
+  """Test exporting to a tar archive."""
+  with export_corpus.TarExporter(tempdir / 'c.tar.bz2') as exporter:
+    assert export_corpus.Export(
+        [('a', 'A'), ('b', 'B'), ('a', 'A')], exporter) == 2
+  with tarfile.open(tempdir / 'c.tar.bz2') as tar:
+    assert sorted(tar.getnames()) == ['a.txt', 'b.txt']
+    assert tar.extractfile('a.txt').read() == b'A'
+  assert [f.name for f in tempdir.iterdir()] == ['c.tar.bz2']
+
+
+def main(argv: typing.List[str]):
+  """Main entry point."""
+  if len(argv) > 1:
+    raise app.UsageError("Unknown arguments: '{}'.".format(' '.join(argv[1:])))
+  sys.exit(pytest.main([__file__, '-vv']))
+
+
+if __name__ == '__main__':
+  flags.FLAGS(['argv[0]', '-v=1'])
+  app.run(main)
@@ -22,6 +22,17 @@ FLAGS = flags.FLAGS
 
 IndexProgress = collections.namedtuple('IndexProgress', ['i', 'n'])
 
+# The paths of all files in the repo being indexed, relative to the clone
+# directory. This is set once per worker process by _InitIndexWorker(), rather
+# than being sent with every job.
+_ALL_FILES_RELPATHS: typing.List[str] = []
+
+
+def _InitIndexWorker(all_files_relpaths: typing.List[str]) -> None:
+  """Initialize an index worker process for a repo."""
+  global _ALL_FILES_RELPATHS
+  _ALL_FILES_RELPATHS = all_files_relpaths
+
 
 class GitHubRepo(object):
   """Representation of a GitHub repo."""
@@ -63,18 +74,18 @@ class GitHubRepo(object):
 
   def Index(self,
             indexers: typing.List[scrape_repos_pb2.ContentFilesImporterConfig],
-            pool: multiprocessing.Pool,
+            processes: int,
             i: IndexProgress = None) -> 'GitHubRepo':
     """Index the repo."""
     if self.IsCloned() and not self.IsIndexed():
       self.index_dir.mkdir(parents=True, exist_ok=True)
       for indexer in indexers:
-        self._IndexPattern(indexer, pool, i)
+        self._IndexPattern(indexer, processes, i)
       (self.index_dir / 'DONE.txt').touch()
     return self
 
   def _IndexPattern(self, indexer: scrape_repos_pb2.ContentFilesImporterConfig,
-                    pool: multiprocessing.Pool,
+                    processes: int,
                     i: IndexProgress) -> 'GitHubRepo':
     """Index the repo."""
     pattern = indexer.source_code_pattern
@@ -101,14 +112,15 @@ class GitHubRepo(object):
           clone_from_url=self.meta.clone_from_url,
           clone_dir=str(self.clone_dir),
           abspath=p,
-          all_files_relpaths=all_files_relpaths,
           preprocessors=indexer.preprocessor,
           index_dir=str(self.index_dir),
       ) for p in paths
     )
     progress_bar = progressbar.ProgressBar(max_value=len(paths))
-    for _ in progress_bar(pool.imap_unordered(IndexContentFiles, jobs)):
-      pass
+    with multiprocessing.Pool(processes, initializer=_InitIndexWorker,
+                              initargs=(all_files_relpaths,)) as pool:
+      for _ in progress_bar(pool.imap_unordered(IndexContentFiles, jobs)):
+        pass
 
   def ContentFiles(self) -> typing.Iterable[scrape_repos_pb2.ContentFile]:
     """Return an iterator over all contentfiles in the repo."""
@@ -124,7 +136,7 @@ def IndexContentFiles(job: scrape_repos_pb2.ImportWorker) -> None:
   relpath = job.abspath[len(str(job.clone_dir)) + 1:]
   try:
     texts = preprocessors.Preprocess(pathlib.Path(job.clone_dir), relpath,
-                                     job.all_files_relpaths, job.preprocessors)
+                                     _ALL_FILES_RELPATHS, job.preprocessors)
     for i, text in enumerate(texts):
       sha256 = hashlib.sha256(text.encode('utf-8'))
       proto = scrape_repos_pb2.ContentFile(
@@ -1,5 +1,4 @@
 """Unit tests for //datasets/github/scrape_repos/github_repo.py."""
-import multiprocessing
 import pathlib
 import sys
 import tempfile
@@ -69,7 +68,7 @@ def test_GitHubRepo_Index_not_cloned(test_repo: github_repo.GitHubRepo):
         source_code_pattern='.*\\.java',
         preprocessor=["datasets.github.scrape_repos.preprocessors."
                       "extractors:JavaMethods"]),
-  ], multiprocessing.Pool(1))
+  ], 1)
   assert not test_repo.IsIndexed()
 
 
@@ -100,7 +99,7 @@ public class B {
         source_code_pattern='.*\\.java',
         preprocessor=["datasets.github.scrape_repos.preprocessors."
                       "extractors:JavaMethods"]),
-  ], multiprocessing.Pool(1))
+  ], 1)
   assert test_repo.index_dir.is_dir()
 
   assert (test_repo.index_dir / 'DONE.txt').is_file()
@@ -123,7 +122,7 @@ def test_GitHubRepo_Index_index_dir_paths(tempdir: pathlib.Path):
         source_code_pattern='.*\\.java',
         preprocessor=["datasets.github.scrape_repos.preprocessors."
                       "extractors:JavaMethods"]),
-  ], multiprocessing.Pool(1))
+  ], 1)
   assert (tempdir / 'java.index').is_dir()
   assert (tempdir / 'java.index' / 'Foo_Bar').is_dir()
 
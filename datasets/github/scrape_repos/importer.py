@@ -4,7 +4,7 @@ import multiprocessing
 import os
 import pathlib
 import random
-import subprocess
+import re
 import typing
 
 import humanize
@@ -16,7 +16,6 @@ from sqlalchemy import orm
 
 from datasets.github.scrape_repos import contentfiles
 from datasets.github.scrape_repos.preprocessors import preprocessors
-from datasets.github.scrape_repos.preprocessors import public
 from datasets.github.scrape_repos.proto import scrape_repos_pb2
 from labm8 import pbutil
 
@@ -24,129 +23,261 @@ from labm8 import pbutil
 FLAGS = flags.FLAGS
 flags.DEFINE_integer('processes', os.cpu_count(),
                      'The number of simultaneous processes.')
+flags.DEFINE_integer('repos_per_job', 16,
+                     'The number of repos imported by each worker job.')
+flags.DEFINE_integer('contentfiles_per_transaction', 5000,
+                     'The maximum number of contentfiles written in a single '
+                     'database transaction.')
 
 flags.DEFINE_string('clone_list', None, 'The path to a LanguageCloneList file.')
 
+# The clone URLs of repos which have already been imported, and the importers
+# to run. These are set once per worker process by _InitImportWorker(), rather
+# than being sent with every job.
+_IMPORTED_CLONE_FROM_URLS: typing.Set[str] = set()
+_IMPORTERS: typing.List[scrape_repos_pb2.ContentFilesImporterConfig] = []
 
-def ShouldImportRepo(session: orm.session.Session,
-                     metafile: pathlib.Path) -> bool:
+
+class ImportedRepo(typing.NamedTuple):
+  """The result of importing a repo."""
+  # The columns of the GitHubRepository row.
+  repository: typing.Dict[str, typing.Any]
+  # The columns of the ContentFile rows.
+  contentfiles: typing.List[typing.Dict[str, typing.Any]]
+
+
+def _InitImportWorker(
+    imported_clone_from_urls: typing.Set[str],
+    importers: typing.List[scrape_repos_pb2.ContentFilesImporterConfig]
+) -> None:
+  """Initialize an import worker process."""
+  global _IMPORTED_CLONE_FROM_URLS
+  global _IMPORTERS
+  _IMPORTED_CLONE_FROM_URLS = imported_clone_from_urls
+  _IMPORTERS = importers
+
+
+def GetRepoFilesRelativePaths(clone_dir: pathlib.Path) -> typing.List[str]:
+  """Get relative paths to all files in a repo, excluding the .git directory.
+
+  Args:
+    clone_dir: The root of the repo.
+
+  Returns:
+    A sorted list of paths relative to clone_dir.
+  """
+  relpaths = []
+  for root, dirs, files in os.walk(clone_dir):
+    dirs[:] = [d for d in dirs if d != '.git']
+    relroot = os.path.relpath(root, clone_dir)
+    for file in files:
+      if os.path.isfile(os.path.join(root, file)):
+        relpaths.append(file if relroot == '.' else f'{relroot}/{file}')
+  return sorted(relpaths)
+
+
+def ShouldImportRepo(metafile: pathlib.Path,
+                     imported_clone_from_urls: typing.Set[str]
+                     ) -> typing.Optional[scrape_repos_pb2.GitHubRepoMetadata]:
   """Determine if the repository described by a metafile should be imported.
 
   A repository should be imported iff:
     * The metafile is a valid GitHubRepoMetadata proto.
     * The clone directory specified in the metafile appears to be a github repo.
-    * The repo does not exist in the contentfiles database.
+    * The repo has not been imported.
+
+  Returns:
+    The repo metadata if the repo should be imported, else None.
   """
   if not (metafile.is_file() and pbutil.ProtoIsReadable(
       metafile, scrape_repos_pb2.GitHubRepoMetadata())):
-    return False
+    return None
   meta = pbutil.FromFile(metafile, scrape_repos_pb2.GitHubRepoMetadata())
+  if meta.clone_from_url in imported_clone_from_urls:
+    return None
   clone_dir = metafile.parent / f'{meta.owner}_{meta.name}'
   if not (clone_dir / '.git').is_dir():
-    return False
-  return not contentfiles.GitHubRepository.IsInDatabase(session, meta)
-
-
-def ImportWorker(
-    job: scrape_repos_pb2.ImportWorker
-) -> typing.List[contentfiles.ContentFile]:
-  """Import a content file."""
-  relpath = job.abspath[len(str(job.clone_dir)) + 1:]
-  outputs: typing.List[contentfiles.ContentFile] = []
-  try:
-    texts = preprocessors.Preprocess(pathlib.Path(job.clone_dir), relpath,
-                                     job.all_files_relpaths, job.preprocessors)
-    for i, text in enumerate(texts):
-      sha256 = hashlib.sha256(text.encode('utf-8'))
-      outputs.append(contentfiles.ContentFile(
-          clone_from_url=job.clone_from_url,
-          relpath=relpath, artifact_index=i,
-          sha256=sha256.digest(), charcount=len(text),
-          linecount=len(text.split('\n')), text=text))
-  except UnicodeDecodeError:
-    logging.warning('Failed to decode %s', relpath)
-  return outputs
-
-
-def ImportRepo(session: orm.session.Session,
-               language: scrape_repos_pb2.LanguageToClone,
-               metafile: pathlib.Path,
-               pool: multiprocessing.Pool) -> None:
+    return None
+  return meta
+
+
+def ImportRepo(
+    metafile: pathlib.Path, meta: scrape_repos_pb2.GitHubRepoMetadata,
+    importers: typing.List[scrape_repos_pb2.ContentFilesImporterConfig]
+) -> typing.List[typing.Dict[str, typing.Any]]:
   """Import contentfiles from repository.
 
   Args:
-    session: A database session to import to.
-    language: The language specification for the repo.
     metafile: The repo metafile.
-    pool: A multiprocessing pool.
+    meta: The repo metadata.
+    importers: The importers to run.
+
+  Returns:
+    A list of ContentFile columns.
   """
-  meta = pbutil.FromFile(metafile, scrape_repos_pb2.GitHubRepoMetadata())
   clone_dir = metafile.parent / f'{meta.owner}_{meta.name}'
-  repo = contentfiles.GitHubRepository.GetOrAdd(session, meta)
-  repo.language = language.language
-
-  for importer in language.importer:
-    if not importer.source_code_pattern:
-      logging.error('No source_code_pattern specified! Stopping now.')
-      return
-
-    pat = importer.source_code_pattern
-    pat = f'{clone_dir}/{pat[1:]}' if pat[0] == '^' else f'{clone_dir}/{pat}'
-    cmd = ['find', str(clone_dir), '-type', 'f', '-regex', pat, '-not',
-           '-path', '*/.git/*']
-    logging.debug('$ %s', ' '.join(cmd))
-    paths = subprocess.check_output(
-        cmd, universal_newlines=True).rstrip().split('\n')
-    if len(paths) == 1 and not paths[0]:
-      logging.debug('No files to import from %s', clone_dir)
-      return
-    logging.info("Importing %s '%s' files from %s ...",
-                 humanize.intcomma(len(paths)),
-                 importer.source_code_pattern, clone_dir)
-    all_files_relpaths = public.GetAllFilesRelativePaths(clone_dir)
-    jobs = [
-      scrape_repos_pb2.ImportWorker(
-          clone_from_url=meta.clone_from_url,
-          clone_dir=str(clone_dir),
-          abspath=p,
-          all_files_relpaths=all_files_relpaths,
-          preprocessors=importer.preprocessor,
-      ) for p in paths
-    ]
-    bar = progressbar.ProgressBar(max_value=len(jobs))
-    for outputs in bar(pool.imap_unordered(ImportWorker, jobs)):
-      for output in outputs:
-        session.add(output)
+  all_files_relpaths = GetRepoFilesRelativePaths(clone_dir)
+  rows = []
+  for importer in importers:
+    pattern = re.compile(importer.source_code_pattern.lstrip('^'))
+    for relpath in all_files_relpaths:
+      if not pattern.fullmatch(relpath):
+        continue
+      try:
+        texts = preprocessors.Preprocess(clone_dir, relpath, all_files_relpaths,
+                                         importer.preprocessor)
+      except UnicodeDecodeError:
+        logging.warning('Failed to decode %s', relpath)
+        continue
+      for i, text in enumerate(texts):
+        rows.append({
+          'clone_from_url': meta.clone_from_url,
+          'relpath': relpath,
+          'artifact_index': i,
+          'sha256': hashlib.sha256(text.encode('utf-8')).digest(),
+          'charcount': len(text),
+          'linecount': len(text.split('\n')),
+          'text': text,
+        })
+  return rows
+
+
+def ImportWorker(metafiles: typing.List[pathlib.Path]
+                 ) -> typing.List[ImportedRepo]:
+  """Import a batch of repos."""
+  imported_repos = []
+  for metafile in metafiles:
+    meta = ShouldImportRepo(metafile, _IMPORTED_CLONE_FROM_URLS)
+    if meta:
+      imported_repos.append(ImportedRepo(
+          repository=contentfiles.GitHubRepository._GetArgsFromProto(meta),
+          contentfiles=ImportRepo(metafile, meta, _IMPORTERS)))
+  return imported_repos
 
 
 def ImportFromLanguage(db: contentfiles.ContentFiles,
                        language: scrape_repos_pb2.LanguageToClone,
-                       pool: multiprocessing.Pool) -> None:
+                       processes: int,
+                       repos_per_job: typing.Optional[int] = None,
+                       contentfiles_per_transaction: typing.Optional[
+                         int] = None) -> None:
   """Import contentfiles from a language specification.
 
+  Repos are imported in batches by a pool of worker processes, and the
+  contentfiles are written in bounded transactions. A repo is only marked as
+  imported once all of its contentfiles have been written, so an interrupted
+  import can be resumed by running it again.
+
   Args:
     db: The database to import to.
     language: The language to import.
-    pool: A multiprocessing pool.
+    processes: The number of worker processes.
+    repos_per_job: The number of repos imported by each worker job. Defaults
+      to --repos_per_job.
+    contentfiles_per_transaction: The maximum number of contentfiles written in
+      a transaction. Defaults to --contentfiles_per_transaction.
 
   Raises:
-    ValueError: If importer field not set.
+    ValueError: If importer field not set, or an importer has no
+      source_code_pattern.
   """
   if not language.importer:
     raise ValueError('LanguageToClone.importer field not set')
+  if not all(importer.source_code_pattern for importer in language.importer):
+    raise ValueError('ContentFilesImporterConfig.source_code_pattern not set')
+  repos_per_job = repos_per_job or FLAGS.repos_per_job
+  contentfiles_per_transaction = (contentfiles_per_transaction or
+                                  FLAGS.contentfiles_per_transaction)
+
+  destination_directory = pathlib.Path(language.destination_directory)
+  metafiles = [f for f in destination_directory.iterdir()
+               if f.name.endswith('.pbtxt')]
+  random.shuffle(metafiles)
+  jobs = [metafiles[i:i + repos_per_job]
+          for i in range(0, len(metafiles), repos_per_job)]
+
+  with db.Session(commit=True) as session:
+    imported_clone_from_urls = db.GetImportedCloneFromUrls(session)
+    repository_clone_from_urls = {url for url, in session.query(
+        contentfiles.GitHubRepository.clone_from_url)}
+    logging.info('Importing %s %s repos (%s already imported) ...',
+                 humanize.intcomma(len(metafiles)),
+                 language.language.capitalize(),
+                 humanize.intcomma(len(imported_clone_from_urls)))
+
+    repo_count = 0
+    contentfile_count = 0
+    uncommitted_count = 0
+    bar = progressbar.ProgressBar(max_value=len(jobs))
+    with multiprocessing.Pool(
+        processes, initializer=_InitImportWorker,
+        initargs=(imported_clone_from_urls, list(language.importer))) as pool:
+      for imported_repos in bar(pool.imap_unordered(ImportWorker, jobs)):
+        for repo in imported_repos:
+          repo.repository['language'] = language.language
+          uncommitted_count = _AddImportedRepo(
+              session, repo, repository_clone_from_urls, uncommitted_count,
+              contentfiles_per_transaction)
+          repo_count += 1
+          contentfile_count += len(repo.contentfiles)
+          if uncommitted_count >= contentfiles_per_transaction:
+            session.commit()
+            uncommitted_count = 0
+
+  logging.info('Imported %s contentfiles from %s repos',
+               humanize.intcomma(contentfile_count),
+               humanize.intcomma(repo_count))
+
+
+def _AddImportedRepo(session: orm.session.Session, repo: ImportedRepo,
+                     repository_clone_from_urls: typing.Set[str],
+                     uncommitted_count: int,
+                     contentfiles_per_transaction: int) -> int:
+  """Write an imported repo to the database.
+
+  The contentfiles are inserted in bulk, and the session is committed whenever
+  the number of uncommitted contentfiles reaches contentfiles_per_transaction.
+  The repo is marked as imported after its last contentfile is inserted.
+
+  Args:
+    session: A database session.
+    repo: The imported repo.
+    repository_clone_from_urls: The clone URLs in the repositories table. This
+      is updated with the repo's URL.
+    uncommitted_count: The number of contentfiles in the session which have not
+      been committed.
+    contentfiles_per_transaction: The maximum number of contentfiles to write
+      in a transaction.
+
+  Returns:
+    The number of contentfiles in the session which have not been committed.
+  """
+  clone_from_url = repo.repository['clone_from_url']
+  if clone_from_url in repository_clone_from_urls:
+    # The repo was partially imported by a previous run. Discard its
+    # contentfiles and start again.
+    session.query(contentfiles.ContentFile).filter(
+        contentfiles.ContentFile.clone_from_url == clone_from_url).delete(
+        synchronize_session=False)
+  else:
+    session.execute(contentfiles.GitHubRepository.__table__.insert(),
+                    [repo.repository])
+    repository_clone_from_urls.add(clone_from_url)
+
+  rows = repo.contentfiles
+  while rows:
+    if uncommitted_count >= contentfiles_per_transaction:
+      session.commit()
+      uncommitted_count = 0
+    chunk_size = contentfiles_per_transaction - uncommitted_count
+    session.execute(contentfiles.ContentFile.__table__.insert(),
+                    rows[:chunk_size])
+    uncommitted_count += len(rows[:chunk_size])
+    rows = rows[chunk_size:]
 
-  with db.Session() as session:
-    repos_to_import = [pathlib.Path(language.destination_directory / f) for f in
-                       pathlib.Path(language.destination_directory).iterdir() if
-                       ShouldImportRepo(session, pathlib.Path(
-                           language.destination_directory / f))]
-  random.shuffle(repos_to_import)
-  logging.info('Importing %s %s repos ...',
-               humanize.intcomma(len(repos_to_import)),
-               language.language.capitalize())
-  for metafile in repos_to_import:
-    with db.Session(commit=True) as session:
-      ImportRepo(session, language, metafile, pool)
+  session.execute(contentfiles.ImportedRepository.__table__.insert(),
+                  [{'clone_from_url': clone_from_url}])
+  return uncommitted_count
 
 
 def main(argv):
@@ -165,13 +296,12 @@ def main(argv):
     for importer in language.importer:
       [preprocessors.GetPreprocessorFunction(p) for p in importer.preprocessor]
 
-  pool = multiprocessing.Pool(FLAGS.processes)
   for language in clone_list.language:
     d = pathlib.Path(language.destination_directory)
     d = d.parent / (str(d.name) + '.db')
     db = contentfiles.ContentFiles(f'sqlite:///{d}')
     if pathlib.Path(language.destination_directory).is_dir():
-      ImportFromLanguage(db, language, pool)
+      ImportFromLanguage(db, language, FLAGS.processes)
 
 
 if __name__ == '__main__':
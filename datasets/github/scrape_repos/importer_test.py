@@ -1,5 +1,4 @@
 """Unit tests for //datasets/github/scrape_repos/importer.py."""
-import multiprocessing
 import pathlib
 import sys
 import tempfile
@@ -11,6 +10,7 @@ from absl import flags
 
 from datasets.github.scrape_repos import contentfiles
 from datasets.github.scrape_repos import importer
+from datasets.github.scrape_repos.preprocessors import public
 from datasets.github.scrape_repos.proto import scrape_repos_pb2
 from labm8 import pbutil
 
@@ -38,7 +38,7 @@ def test_ImportFromLanguage_no_importer(test_db: contentfiles.ContentFiles,
       destination_directory=str(tempdir),
       importer=[])
   with pytest.raises(ValueError):
-    importer.ImportFromLanguage(test_db, language, multiprocessing.Pool(1))
+    importer.ImportFromLanguage(test_db, language, 1)
 
 
 def test_ImportFromLanguage_Java_repo(test_db: contentfiles.ContentFiles,
@@ -82,7 +82,7 @@ public class B {
                           "extractors:JavaMethods"]),
       ]
   )
-  importer.ImportFromLanguage(test_db, language, multiprocessing.Pool(1))
+  importer.ImportFromLanguage(test_db, language, 1)
   with test_db.Session() as session:
     query = session.query(contentfiles.ContentFile)
     assert query.count() == 2
@@ -93,6 +93,107 @@ public class B {
     }
 
 
+@public.dataset_preprocessor
+def MockPreprocessor(
+    import_root: pathlib.Path, file_relpath: str,
+    text: str, all_file_relpaths: typing.List[str]) -> typing.List[str]:
+  """A mock preprocessor which returns one text per line."""
+  del import_root
+  del file_relpath
+  del all_file_relpaths
+  return text.split('\n')
+
+
+def _MakeRepo(root: pathlib.Path, name: str, num_files: int) -> None:
+  """Create a repo with num_files two-line files."""
+  pbutil.ToFile(scrape_repos_pb2.GitHubRepoMetadata(
+      owner='Owner', name=name, clone_from_url=f'https://{name}'),
+      root / f'Owner_{name}.pbtxt')
+  (root / f'Owner_{name}' / '.git').mkdir(parents=True)
+  (root / f'Owner_{name}' / 'src').mkdir(parents=True)
+  for i in range(num_files):
+    with open(root / f'Owner_{name}' / 'src' / f'{i}.txt', 'w') as f:
+      f.write(f'{name}\n{i}')
+  with open(root / f'Owner_{name}' / '.git' / 'a.txt', 'w') as f:
+    f.write('Not imported.')
+
+
+def _MockLanguage(tempdir: pathlib.Path
+                  ) -> scrape_repos_pb2.LanguageToClone:
+  return scrape_repos_pb2.LanguageToClone(
+      language='foolang',
+      query=[],
+      destination_directory=str(tempdir),
+      importer=[
+        scrape_repos_pb2.ContentFilesImporterConfig(
+            source_code_pattern='.*\\.txt',
+            preprocessor=['datasets.github.scrape_repos.importer_test:'
+                          'MockPreprocessor']),
+      ]
+  )
+
+
+def test_ImportFromLanguage_many_repos(test_db: contentfiles.ContentFiles,
+                                       tempdir: pathlib.Path):
+  """Test importing multiple batches of repos in small transactions."""
+  for i in range(10):
+    _MakeRepo(tempdir, f'Repo{i}', i)
+  importer.ImportFromLanguage(test_db, _MockLanguage(tempdir), 2,
+                              repos_per_job=3, contentfiles_per_transaction=4)
+  with test_db.Session() as session:
+    assert session.query(contentfiles.GitHubRepository).count() == 10
+    assert session.query(contentfiles.ImportedRepository).count() == 10
+    assert session.query(contentfiles.ContentFile).count() == 2 * sum(
+        range(10))
+    assert session.query(contentfiles.GitHubRepository.language).distinct(
+    ).one() == ('foolang',)
+
+
+def test_ImportFromLanguage_skips_imported_repos(
+    test_db: contentfiles.ContentFiles, tempdir: pathlib.Path):
+  """Test that imported repos are not imported again."""
+  _MakeRepo(tempdir, 'A', 2)
+  importer.ImportFromLanguage(test_db, _MockLanguage(tempdir), 1)
+  with open(tempdir / 'Owner_A' / 'src' / '2.txt', 'w') as f:
+    f.write('new file')
+  importer.ImportFromLanguage(test_db, _MockLanguage(tempdir), 1)
+  with test_db.Session() as session:
+    assert session.query(contentfiles.ContentFile).count() == 4
+
+
+def test_ImportFromLanguage_resumes_partial_import(
+    test_db: contentfiles.ContentFiles, tempdir: pathlib.Path):
+  """Test that a partially imported repo is imported again."""
+  _MakeRepo(tempdir, 'A', 2)
+  with test_db.Session(commit=True) as session:
+    test_db.GetImportedCloneFromUrls(session)
+    repo = contentfiles.GitHubRepository.FromProto(
+        scrape_repos_pb2.GitHubRepoMetadata(
+            owner='Owner', name='A', clone_from_url='https://A'))
+    repo.language = 'foolang'
+    session.add(repo)
+    session.add(contentfiles.ContentFile(
+        clone_from_url='https://A', relpath='src/0.txt', artifact_index=0,
+        sha256=b'0', charcount=0, linecount=0, text=''))
+  importer.ImportFromLanguage(test_db, _MockLanguage(tempdir), 1)
+  with test_db.Session() as session:
+    assert session.query(contentfiles.ImportedRepository).count() == 1
+    assert {cf.text for cf in session.query(contentfiles.ContentFile)} == {
+      'A', '0', '1'}
+
+
+def test_GetImportedCloneFromUrls_backfill(test_db: contentfiles.ContentFiles):
+  """Test that repos imported by an older importer are marked as imported."""
+  with test_db.Session(commit=True) as session:
+    repo = contentfiles.GitHubRepository.FromProto(
+        scrape_repos_pb2.GitHubRepoMetadata(
+            owner='Owner', name='A', clone_from_url='https://A'))
+    repo.language = 'foolang'
+    session.add(repo)
+  with test_db.Session() as session:
+    assert test_db.GetImportedCloneFromUrls(session) == {'https://A'}
+
+
 def main(argv: typing.List[str]):
   """Main entry point."""
   if len(argv) > 1:
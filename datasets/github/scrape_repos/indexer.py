@@ -1,5 +1,4 @@
 """Index ContentFiles from cloned GitHub repos."""
-import multiprocessing
 import os
 import pathlib
 import random
@@ -25,12 +24,12 @@ flags.DEFINE_string(
 
 
 def ImportFromLanguage(language: scrape_repos_pb2.LanguageToClone,
-                       pool: multiprocessing.Pool) -> None:
+                       processes: int) -> None:
   """Import contentfiles from a language specification.
 
   Args:
     language: The language to import.
-    pool: A multiprocessing pool.
+    processes: The number of worker processes.
 
   Raises:
     ValueError: If importer field not set.
@@ -54,7 +53,7 @@ def ImportFromLanguage(language: scrape_repos_pb2.LanguageToClone,
                humanize.intcomma(num_repos),
                language.language.capitalize())
   for i, repo in enumerate(repos_to_import):
-    repo.Index(list(language.importer), pool,
+    repo.Index(list(language.importer), processes,
                github_repo.IndexProgress(num_pruned + i, num_repos))
 
 
@@ -74,9 +73,8 @@ def main(argv):
     for importer in language.importer:
       [preprocessors.GetPreprocessorFunction(p) for p in importer.preprocessor]
 
-  pool = multiprocessing.Pool(FLAGS.indexer_processes)
   for language in clone_list.language:
-    ImportFromLanguage(language, pool)
+    ImportFromLanguage(language, FLAGS.indexer_processes)
 
 
 if __name__ == '__main__':
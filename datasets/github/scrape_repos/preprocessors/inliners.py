@@ -1,5 +1,6 @@
 """Preprocessors to inline includes."""
 import collections
+import functools
 import pathlib
 import re
 import sys
@@ -108,7 +109,7 @@ def _InlineCSyntax(import_root: pathlib.Path, file_relpath: str,
 
   return InlineHeaders(
       import_root, file_relpath, text,
-      inline_candidate_relpaths=set(all_file_relpaths),
+      include_index=GetIncludeIndex(all_file_relpaths),
       already_inlined_relpaths=set(),
       blacklist=blacklist,
       find_includes=FindIncludes,
@@ -120,7 +121,7 @@ def _InlineCSyntax(import_root: pathlib.Path, file_relpath: str,
 def InlineHeaders(import_root: pathlib.Path,
                   file_relpath: str,
                   text: str,
-                  inline_candidate_relpaths: typing.Set[str],
+                  include_index: 'IncludeIndex',
                   already_inlined_relpaths: typing.Set[str],
                   blacklist: typing.Set[str],
                   find_includes: typing.Callable[[str], typing.List[str]],
@@ -133,8 +134,8 @@ def InlineHeaders(import_root: pathlib.Path,
     import_root: The root directory to search for included files.
     file_relpath: The path of the file to process, relative to import_root.
     text: The text of the target file to inline the headers of.
-    inline_candidate_relpaths: Paths to all files which are candidates for
-      inlining, relative to import_root.
+    include_index: An index of all files which are candidates for inlining,
+      relative to import_root.
     already_inlined_relpaths: Paths to files which have already been inlined.
       Files are never inlined twice. Duplicate inlines are always discarded.
     blacklist: A set of files to exclude from inlining.
@@ -155,7 +156,6 @@ def InlineHeaders(import_root: pathlib.Path,
     The path with as many included files inlined as possible.
   """
   logging.debug('Inlining: %s.', file_relpath)
-  inline_candidate_relpaths.remove(file_relpath)
   already_inlined_relpaths.add(file_relpath)
   output = []
 
@@ -166,24 +166,19 @@ def InlineHeaders(import_root: pathlib.Path,
       continue
 
     for include in includes:
-      already_inlined_match = FindCandidateInclude(
-          include, file_relpath, already_inlined_relpaths,
-          exact_matches_only=True)
-      if already_inlined_match.confidence == 100:
+      if include in already_inlined_relpaths:
         output.append(format_line_comment(
-            f"Skipping already inlined file: '{already_inlined_match}'."))
+            f"Skipping already inlined file: '{include}'."))
         continue
 
-      blacklist_match = FindCandidateInclude(include, file_relpath, blacklist,
-                                             exact_matches_only=True)
-      if blacklist_match.confidence == 100:
+      if include in blacklist:
         output.append(format_line_comment(
             f"Preserving blacklisted include: '{include}'."))
         output.append(format_include(include))
         continue
 
       candidate_match = FindCandidateInclude(
-          include, file_relpath, inline_candidate_relpaths)
+          include, file_relpath, include_index, already_inlined_relpaths)
       if candidate_match.confidence:
         output.append(format_line_comment(
             f"Found candidate include for: "
@@ -192,8 +187,7 @@ def InlineHeaders(import_root: pathlib.Path,
         with open(import_root / candidate_match.path) as f:
           candidate_text = f.read()
         output.append(InlineHeaders(
-            import_root, candidate_match.path, candidate_text,
-            inline_candidate_relpaths,
+            import_root, candidate_match.path, candidate_text, include_index,
             already_inlined_relpaths, blacklist, find_includes, format_include,
             format_line_comment, discard_unmatched_headers))
         continue
@@ -214,37 +208,116 @@ FuzzyIncludeMatch = collections.namedtuple(
     'FuzzyIncludeMatch', ['path', 'confidence'])
 
 
+class IncludeIndex(object):
+  """An index of the files which may be resolved by an include.
+
+  An include 'foo/bar.h' may be resolved by any file whose path ends with the
+  components 'foo/bar.h'. To find these files without scanning every path, the
+  index is a trie of path components in reverse order. The first level of the
+  trie buckets files by their basename, and every node stores the paths of the
+  files which end with the components leading to it.
+  """
+
+  def __init__(self, relpaths: typing.Iterable[str]):
+    self.relpaths = set(relpaths)
+    # Every node is a tuple of (children, paths), where children is a map from
+    # path component to node, and paths is a list of file paths.
+    self._root = ({}, [])
+    for relpath in sorted(self.relpaths):
+      node = self._root
+      for component in reversed(relpath.split('/')):
+        node = node[0].setdefault(component, ({}, []))
+        node[1].append(relpath)
+
+  def __len__(self) -> int:
+    return len(self.relpaths)
+
+  def __contains__(self, relpath: str) -> bool:
+    return relpath in self.relpaths
+
+  def FindSuffixMatches(self, include: str) -> typing.List[str]:
+    """Return the paths of the files which end with the components of include.
+
+    Args:
+      include: The path of an include, e.g. 'foo/bar.h'.
+
+    Returns:
+      A sorted list of paths.
+    """
+    node = self._root
+    for component in reversed(include.split('/')):
+      if component in {'', '.'}:
+        continue
+      if component not in node[0]:
+        return []
+      node = node[0][component]
+    return node[1] if node is not self._root else []
+
+
+# A tuple of the most recently indexed list of paths, and its index.
+_INCLUDE_INDEX_CACHE = (None, None)
+
+
+def GetIncludeIndex(all_file_relpaths: typing.List[str]) -> IncludeIndex:
+  """Return an include index for a list of paths.
+
+  The index is cached for as long as the same list object is passed in, so
+  that the index for a repo is built once per process rather than once for
+  every file in the repo.
+
+  Args:
+    all_file_relpaths: A list of all paths within the current scope.
+
+  Returns:
+    An IncludeIndex instance.
+  """
+  global _INCLUDE_INDEX_CACHE
+  cached_relpaths, index = _INCLUDE_INDEX_CACHE
+  if cached_relpaths is not all_file_relpaths:
+    index = IncludeIndex(all_file_relpaths)
+    _INCLUDE_INDEX_CACHE = (all_file_relpaths, index)
+  return index
+
+
+@functools.lru_cache(maxsize=4096)
+def _FuzzyExtract(query: str, choices: typing.Tuple[str, ...]
+                  ) -> typing.List[typing.Tuple[str, int]]:
+  """Memoized fuzzy matching of a query against choices."""
+  return process.extract(query, choices)
+
+
 def FindCandidateInclude(
     include_match: str, current_file_relpath: str,
-    candidate_relpaths: typing.Set[str],
-    exact_matches_only: bool = False) -> FuzzyIncludeMatch:
+    include_index: IncludeIndex,
+    excluded_relpaths: typing.Set[str] = frozenset()) -> FuzzyIncludeMatch:
   """Find and return the most likely included file.
 
   Args:
     include_match: The path of the file to find a candidate include for.
     current_file_relpath: The path of the file we're currently processing.
-    candidate_relpaths: The set of files to consider for matching.
-    exact_matches_only: If True, do no fuzzy matching of possible candidates.
+    include_index: The index of files to consider for matching.
+    excluded_relpaths: A set of paths in the index which may not be matched.
 
   Returns:
     A FuzzyIncludeMatch instance. If no suitable candidate was found, the path
     will be an empty string, and the confidence will be 0.0. Else, the path
-    is the member of candidate_relpaths which is most likely, and the confidence
+    is the member of include_index which is most likely, and the confidence
     is an integer between between 0 and 100, where 100 indicates a perfect
     match.
   """
-  if include_match in candidate_relpaths:
+  if include_match in include_index and include_match not in excluded_relpaths:
     return FuzzyIncludeMatch(include_match, 100)
 
-  # A list of files with the same basename as include match's basename
-  candidate_matches = [
-    x for x in candidate_relpaths if x.endswith(include_match)]
-  if candidate_matches and not exact_matches_only:
+  # A list of files whose paths end with the include.
+  candidate_matches = tuple(
+      x for x in include_index.FindSuffixMatches(include_match)
+      if x not in excluded_relpaths)
+  if candidate_matches:
     # Fuzzy match to find the most likely include.
     choices = (
-        process.extract(include_match, candidate_matches) +
-        process.extract(pathlib.Path(current_file_relpath).name,
-                        candidate_matches)
+        _FuzzyExtract(include_match, candidate_matches) +
+        _FuzzyExtract(pathlib.Path(current_file_relpath).name,
+                      candidate_matches)
     )
     return FuzzyIncludeMatch(*max(choices, key=lambda x: x[1]))
   else:
@@ -131,6 +131,21 @@ int main(int argc, char** argv) { return 0; }
   ])
 
 
+def test_CxxHeaders_header_included_twice(tempdir: pathlib.Path):
+  """CxxHeaders() inlines a header only once."""
+  src = """
+#include "foo.h"
+#include "foo.h"
+"""
+  MakeFile(tempdir, 'a', src)
+  MakeFile(tempdir, 'foo.h', '#define FOO')
+  assert inliners.CxxHeaders(tempdir, 'a', src, ['a', 'foo.h']) == ["""
+// [InlineHeaders] Found candidate include for: 'foo.h' -> 'foo.h' (100% confidence).
+#define FOO
+// [InlineHeaders] Skipping already inlined file: 'foo.h'.
+"""]
+
+
 # CxxHeadersDiscardUnknown() tests.
 
 
@@ -149,6 +164,41 @@ int main(int argc, char** argv) { return 0; }
 """]
 
 
+# IncludeIndex tests.
+
+
+def test_IncludeIndex_FindSuffixMatches():
+  """Test that files are matched by path components."""
+  index = inliners.IncludeIndex(
+      ['a/foo.h', 'b/a/foo.h', 'b/xa/foo.h', 'foo.h', 'barfoo.h'])
+  assert index.FindSuffixMatches('foo.h') == [
+    'a/foo.h', 'b/a/foo.h', 'b/xa/foo.h', 'foo.h']
+  assert index.FindSuffixMatches('a/foo.h') == ['a/foo.h', 'b/a/foo.h']
+  assert index.FindSuffixMatches('./a/foo.h') == ['a/foo.h', 'b/a/foo.h']
+  assert index.FindSuffixMatches('c/foo.h') == []
+  assert index.FindSuffixMatches('') == []
+
+
+def test_GetIncludeIndex_cached():
+  """Test that the index is cached for the same list of paths."""
+  relpaths = ['a/foo.h']
+  assert inliners.GetIncludeIndex(relpaths) is inliners.GetIncludeIndex(
+      relpaths)
+  assert inliners.GetIncludeIndex(relpaths) is not inliners.GetIncludeIndex(
+      ['a/foo.h'])
+
+
+def test_FindCandidateInclude_excluded_relpaths():
+  """Test that excluded paths are not matched."""
+  index = inliners.IncludeIndex(['a/foo.h', 'b/foo.h'])
+  assert inliners.FindCandidateInclude(
+      'a/foo.h', 'c.c', index) == inliners.FuzzyIncludeMatch('a/foo.h', 100)
+  assert inliners.FindCandidateInclude(
+      'foo.h', 'c.c', index, {'a/foo.h'}).path == 'b/foo.h'
+  assert not inliners.FindCandidateInclude(
+      'foo.h', 'c.c', index, {'a/foo.h', 'b/foo.h'}).confidence
+
+
 # GetLibCxxHeaders() tests.
 
 def test_GetLibCxxHeaders():
@@ -12,11 +12,16 @@ from labm8 import labtypes
 
 FLAGS = flags.FLAGS
 
+flags.DEFINE_integer(
+    'series_chunk_size', 10000,
+    'The maximum number of measurements in a Series message sent from an '
+    'importer process.')
+
 # An inbox importer is a function that takes a path to a directory (the inbox)
-# and a Queue. When called, the function places a SeriesCollection proto on the
-# queue.
-InboxImporter = typing.Callable[
-  [pathlib.Path, multiprocessing.Queue], me_pb2.SeriesCollection]
+# and a Queue. When called, the function places zero or more Series protos on
+# the queue, followed by None to signal that it is done. Use
+# PutSeriesCollectionOnQueue() to do this.
+InboxImporter = typing.Callable[[pathlib.Path, multiprocessing.Queue], None]
 
 
 class ImporterError(EnvironmentError):
@@ -93,3 +98,44 @@ def MergeSeriesCollections(
   ]
   return me_pb2.SeriesCollection(
       series=sorted(concatenated_series, key=lambda s: s.name))
+
+
+def SeriesChunks(series_collection: me_pb2.SeriesCollection,
+                 chunk_size: int) -> typing.Iterator[me_pb2.Series]:
+  """Split the series of a SeriesCollection into bounded chunks.
+
+  Args:
+    series_collection: The SeriesCollection to split.
+    chunk_size: The maximum number of measurements in a chunk.
+
+  Returns:
+    An iterator of Series messages, each containing at most chunk_size
+    measurements. The measurements of a series are sorted by date, so that the
+    chunks of a series are in date order. Series without measurements are
+    omitted.
+  """
+  for series in series_collection.series:
+    measurements = sorted(series.measurement,
+                          key=lambda m: m.ms_since_unix_epoch)
+    for i in range(0, len(measurements), chunk_size):
+      chunk = me_pb2.Series(family=series.family, name=series.name,
+                            unit=series.unit)
+      chunk.measurement.extend(measurements[i:i + chunk_size])
+      yield chunk
+
+
+def PutSeriesCollectionOnQueue(series_collection: me_pb2.SeriesCollection,
+                               queue: multiprocessing.Queue) -> None:
+  """Send a SeriesCollection from an inbox importer process.
+
+  Rather than sending the entire collection as a single message, the series
+  are sent as chunks of at most --series_chunk_size measurements, followed by
+  None.
+
+  Args:
+    series_collection: The SeriesCollection to send.
+    queue: The queue to put the chunks on.
+  """
+  for chunk in SeriesChunks(series_collection, FLAGS.series_chunk_size):
+    queue.put(chunk)
+  queue.put(None)
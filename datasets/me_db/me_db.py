@@ -12,6 +12,7 @@ import time
 import typing
 
 import humanize
+import numpy as np
 import sqlalchemy as sql
 from absl import app
 from absl import flags
@@ -40,7 +41,7 @@ Base = declarative.declarative_base()
 
 # The list of inbox importers. An inbox importer is a function that takes a
 # path to a directory (the inbox) and a Queue. The function, when called, must
-# place a single SeriesCollection proto on the queue.
+# place zero or more Series protos on the queue, followed by None.
 INBOX_IMPORTERS: typing.List[importers.InboxImporter] = [
   health_kit.ProcessInboxToQueue,
   life_cycle.ProcessInboxToQueue,
@@ -69,10 +70,178 @@ class Measurement(Base):
   unit: str = sql.Column(sql.String(512), nullable=False)
   source: str = sql.Column(sql.String(512), nullable=False)
 
+  __table_args__ = (
+    sql.Index('ix_measurements_family_series_date', 'family', 'series', 'date',
+              mysql_length={'family': 128, 'series': 128}),
+    sql.Index('ix_measurements_family_series_group_date', 'family', 'series',
+              'group', 'date',
+              mysql_length={'family': 128, 'series': 128, 'group': 128}),
+  )
+
   def __repr__(self):
     return f"{self.family}:{self.series} {self.value} {self.unit} {self.date}"
 
 
+# The periods over which measurements are rolled up.
+ROLLUP_PERIODS = ('day', 'week', 'month')
+
+
+def RollupPeriodStart(period: str,
+                      date: datetime.datetime) -> datetime.datetime:
+  """Get the start of the rollup period containing a date.
+
+  Weeks start on Monday.
+
+  Args:
+    period: One of ROLLUP_PERIODS.
+    date: The date.
+
+  Returns:
+    The date at the start of the period.
+
+  Raises:
+    ValueError: If the period is not recognized.
+  """
+  day = datetime.datetime(date.year, date.month, date.day)
+  if period == 'day':
+    return day
+  elif period == 'week':
+    return day - datetime.timedelta(days=day.weekday())
+  elif period == 'month':
+    return day.replace(day=1)
+  raise ValueError(f"Unknown rollup period '{period}'")
+
+
+class Rollup(Base):
+  """The rollups table.
+
+  A row aggregates the measurements of a (family, series, group) over a day,
+  week, or month. Rollups are updated as measurements are imported.
+  """
+  __tablename__ = 'rollups'
+
+  id: int = sql.Column(sql.Integer, primary_key=True)
+
+  period: str = sql.Column(sql.String(16), nullable=False)
+  family: str = sql.Column(sql.String(512), nullable=False)
+  series: str = sql.Column(sql.String(512), nullable=False)
+  group: str = sql.Column(sql.String(512), nullable=False)
+  start_date: datetime.datetime = sql.Column(sql.DateTime, nullable=False)
+  count: int = sql.Column(sql.Integer, nullable=False)
+  sum: int = sql.Column(sql.BigInteger, nullable=False)
+  min: int = sql.Column(sql.BigInteger, nullable=False)
+  max: int = sql.Column(sql.BigInteger, nullable=False)
+
+  __table_args__ = (
+    sql.Index('ix_rollups_period_family_series_group_start_date', 'period',
+              'family', 'series', 'group', 'start_date', unique=True,
+              mysql_length={'family': 128, 'series': 128, 'group': 128}),
+  )
+
+
+class RollupArrays(typing.NamedTuple):
+  """The rollups of a series over a date range, one element per period."""
+  start_dates: np.ndarray
+  count: np.ndarray
+  sum: np.ndarray
+  min: np.ndarray
+  max: np.ndarray
+
+
+# A (period, family, series, group, start_date) tuple.
+_RollupKey = typing.Tuple[str, str, str, str, datetime.datetime]
+
+
+def _AggregateRollups(rows: typing.Iterable[typing.Dict[str, object]],
+                      aggregates: typing.Dict[_RollupKey, typing.List[int]]
+                      ) -> None:
+  """Accumulate [count, sum, min, max] aggregates of measurements rows."""
+  for row in rows:
+    value = row['value']
+    for period in ROLLUP_PERIODS:
+      key = (period, row['family'], row['series'], row['group'],
+             RollupPeriodStart(period, row['date']))
+      aggregate = aggregates.get(key)
+      if aggregate:
+        aggregate[0] += 1
+        aggregate[1] += value
+        aggregate[2] = min(aggregate[2], value)
+        aggregate[3] = max(aggregate[3], value)
+      else:
+        aggregates[key] = [1, value, value, value]
+
+
+def _RollupMapping(key: _RollupKey,
+                   aggregate: typing.List[int]) -> typing.Dict[str, object]:
+  period, family, series, group, start_date = key
+  count, sum_, min_, max_ = aggregate
+  return {
+    'period': period, 'family': family, 'series': series, 'group': group,
+    'start_date': start_date, 'count': count, 'sum': sum_, 'min': min_,
+    'max': max_,
+  }
+
+
+def UpdateRollups(session: sqlutil.Session,
+                  rows: typing.List[typing.Dict[str, object]]) -> None:
+  """Add new measurements rows to the rollups.
+
+  Args:
+    session: A database session.
+    rows: The measurements rows which have been inserted.
+  """
+  aggregates = {}
+  _AggregateRollups(rows, aggregates)
+
+  # Fetch the existing rollups of each (period, family, series) in one query.
+  series_aggregates = {}
+  for key, aggregate in aggregates.items():
+    series_aggregates.setdefault(key[:3], {})[key[3:]] = aggregate
+
+  new_rollups = []
+  for (period, family, series), group_aggregates in series_aggregates.items():
+    start_dates = [start_date for _, start_date in group_aggregates]
+    existing = {
+      (rollup.group, rollup.start_date): rollup
+      for rollup in session.query(Rollup).filter(
+          Rollup.period == period, Rollup.family == family,
+          Rollup.series == series, Rollup.start_date >= min(start_dates),
+          Rollup.start_date <= max(start_dates))
+    }
+    for (group, start_date), aggregate in group_aggregates.items():
+      rollup = existing.get((group, start_date))
+      if rollup:
+        rollup.count += aggregate[0]
+        rollup.sum += aggregate[1]
+        rollup.min = min(rollup.min, aggregate[2])
+        rollup.max = max(rollup.max, aggregate[3])
+      else:
+        new_rollups.append(_RollupMapping(
+            (period, family, series, group, start_date), aggregate))
+
+  if new_rollups:
+    session.bulk_insert_mappings(Rollup, new_rollups)
+
+
+class HighWaterMark(Base):
+  """The high-water marks table.
+
+  A row records the date of the most recent measurement imported for a
+  (source, family, series) tuple. Measurements which are older than the high-
+  water mark are assumed to have been imported already.
+  """
+  __tablename__ = 'high_water_marks'
+
+  source: str = sql.Column(sql.String(512), primary_key=True)
+  family: str = sql.Column(sql.String(512), primary_key=True)
+  series: str = sql.Column(sql.String(512), primary_key=True)
+  ms_since_unix_epoch: int = sql.Column(sql.BigInteger, nullable=False)
+
+
+# A (source, family, series) tuple.
+_HighWaterMarkKey = typing.Tuple[str, str, str]
+
+
 def MeasurementsFromSeries(series: me_pb2.Series) -> typing.List[Measurement]:
   """Create a list of measurements from a me.Series proto."""
   return [
@@ -87,6 +256,21 @@ def MeasurementsFromSeries(series: me_pb2.Series) -> typing.List[Measurement]:
     for m in series.measurement]
 
 
+def _MeasurementRow(series: me_pb2.Series,
+                    measurement: me_pb2.Measurement) -> typing.Dict[str, object]:
+  """Create a measurements table row from a me.Measurement proto."""
+  return {
+    'series': series.name,
+    'date': labdate.DatetimeFromMillisecondsTimestamp(
+        measurement.ms_since_unix_epoch),
+    'family': series.family,
+    'group': measurement.group,
+    'value': measurement.value,
+    'unit': series.unit,
+    'source': measurement.source,
+  }
+
+
 class Database(sqlutil.Database):
 
   def __init__(self, url: str):
@@ -103,12 +287,164 @@ class Database(sqlutil.Database):
                    humanize.intcomma(len(series.measurement)), series.family,
                    series.name)
       session.add_all(MeasurementsFromSeries(series))
+      UpdateRollups(session, [_MeasurementRow(series, m)
+                              for m in series.measurement])
     return num_measurements
 
+  @staticmethod
+  def GetHighWaterMarks(
+      session: sqlutil.Session) -> typing.Dict[_HighWaterMarkKey, int]:
+    """Get the high-water marks of all imported series.
+
+    If the high-water marks table is empty but there are measurements, e.g.
+    for a database created before high-water marks were recorded, the table is
+    first populated from the measurements.
+
+    Args:
+      session: A database session.
+
+    Returns:
+      A map from (source, family, series) tuples to milliseconds since the
+      epoch.
+    """
+    if not session.query(HighWaterMark).first():
+      query = session.query(Measurement.source, Measurement.family,
+                            Measurement.series,
+                            sql.func.max(Measurement.date)) \
+        .group_by(Measurement.source, Measurement.family, Measurement.series)
+      session.bulk_insert_mappings(HighWaterMark, [{
+        'source': source,
+        'family': family,
+        'series': series,
+        'ms_since_unix_epoch': labdate.MillisecondsTimestamp(date),
+      } for source, family, series, date in query])
+
+    return {
+      (hwm.source, hwm.family, hwm.series): hwm.ms_since_unix_epoch
+      for hwm in session.query(HighWaterMark)
+    }
+
+  @staticmethod
+  def AddSeries(session: sqlutil.Session, series: me_pb2.Series,
+                high_water_marks: typing.Dict[_HighWaterMarkKey, int]) -> int:
+    """Import the new measurements of a series.
+
+    Measurements which are older than the high-water mark of their source are
+    skipped. Measurements at the high-water mark are inserted only if an
+    identical measurement does not already exist, so importing the same
+    series twice is a no-op. The high-water marks are updated in place, so
+    the chunks of a series must be imported in date order, as sent by
+    importers.PutSeriesCollectionOnQueue().
+
+    Args:
+      session: A database session.
+      series: The series to import.
+      high_water_marks: The current high-water marks, as returned by
+        GetHighWaterMarks().
+
+    Returns:
+      The number of measurements inserted.
+    """
+    rows = []
+    new_high_water_marks = {}
+    for measurement in series.measurement:
+      key = (measurement.source, series.family, series.name)
+      high_water_mark = high_water_marks.get(key, -1)
+      if measurement.ms_since_unix_epoch < high_water_mark:
+        continue
+      row = _MeasurementRow(series, measurement)
+      if (measurement.ms_since_unix_epoch == high_water_mark and
+          session.query(Measurement.id).filter_by(**row).first()):
+        continue
+      rows.append(row)
+      new_high_water_marks[key] = max(new_high_water_marks.get(key, -1),
+                                      measurement.ms_since_unix_epoch)
+
+    if rows:
+      session.execute(Measurement.__table__.insert(), rows)
+      UpdateRollups(session, rows)
+
+    for key, ms_since_unix_epoch in new_high_water_marks.items():
+      if ms_since_unix_epoch <= high_water_marks.get(key, -1):
+        continue
+      session.merge(HighWaterMark(source=key[0], family=key[1], series=key[2],
+                                  ms_since_unix_epoch=ms_since_unix_epoch))
+      high_water_marks[key] = ms_since_unix_epoch
+
+    return len(rows)
+
+  @staticmethod
+  def RebuildRollups(session: sqlutil.Session) -> None:
+    """Recompute the rollups table from the measurements table.
+
+    Args:
+      session: A database session.
+    """
+    session.query(Rollup).delete()
+    aggregates = {}
+    columns = [Measurement.family, Measurement.series, Measurement.group,
+               Measurement.date, Measurement.value]
+    _AggregateRollups(({
+      'family': family, 'series': series, 'group': group, 'date': date,
+      'value': value,
+    } for family, series, group, date, value in
+        session.query(*columns).yield_per(100000)), aggregates)
+    session.bulk_insert_mappings(Rollup, [
+      _RollupMapping(key, aggregate) for key, aggregate in aggregates.items()
+    ])
+    logging.info('Rebuilt %s rollups', humanize.intcomma(len(aggregates)))
+
+  def GetRollups(self, period: str, family: str, series: str,
+                 start_date: datetime.datetime, end_date: datetime.datetime,
+                 group: typing.Optional[str] = None) -> RollupArrays:
+    """Get the rollups of a series over a date range.
+
+    Args:
+      period: One of ROLLUP_PERIODS.
+      family: The name of the family.
+      series: The name of the series.
+      start_date: The start of the date range. The period containing this
+        date is included.
+      end_date: The end of the date range, exclusive.
+      group: If set, only this group is included. Else the rollups of all
+        groups in the series are combined.
+
+    Returns:
+      A RollupArrays tuple, ordered by date. Periods without measurements are
+      omitted.
+
+    Raises:
+      ValueError: If the period is not recognized.
+    """
+    start_date = RollupPeriodStart(period, start_date)
+    with self.Session() as session:
+      query = session.query(
+          Rollup.start_date, sql.func.sum(Rollup.count),
+          sql.func.sum(Rollup.sum), sql.func.min(Rollup.min),
+          sql.func.max(Rollup.max)) \
+        .filter(Rollup.period == period, Rollup.family == family,
+                Rollup.series == series, Rollup.start_date >= start_date,
+                Rollup.start_date < end_date)
+      if group is not None:
+        query = query.filter(Rollup.group == group)
+      rows = query.group_by(Rollup.start_date).order_by(Rollup.start_date).all()
+
+    start_dates, counts, sums, mins, maxs = zip(*rows) if rows else [[]] * 5
+    return RollupArrays(
+        start_dates=np.array(start_dates, dtype='datetime64[ms]'),
+        count=np.array(counts, dtype=np.int64),
+        sum=np.array(sums, dtype=np.int64),
+        min=np.array(mins, dtype=np.int64),
+        max=np.array(maxs, dtype=np.int64))
+
   def ImportMeasurementsFromInboxImporters(
       self, inbox: pathlib.Path, inbox_importers: typing.Iterator[
         importers.InboxImporter] = INBOX_IMPORTERS):
-    """Import and commit measurements from inbox directory."""
+    """Import and commit new measurements from inbox directory.
+
+    Each importer runs in a separate process, sending chunks of series which
+    are imported, and committed, as they arrive.
+    """
     start_time = time.time()
     queue = multiprocessing.Queue()
 
@@ -120,18 +456,40 @@ class Database(sqlutil.Database):
       processes.append(process)
     logging.info('Started %d importer processes', len(processes))
 
-    # Get the results of each process as it finishes.
+    with self.Session(commit=True) as session:
+      high_water_marks = self.GetHighWaterMarks(session)
+      # Build the rollups of databases created before rollups were recorded.
+      if (session.query(Measurement.id).first() and
+          not session.query(Rollup.id).first()):
+        self.RebuildRollups(session)
+
+    # Import series chunks until every process has finished.
     num_measurements = 0
-    for _ in range(len(processes)):
-      series_collections = queue.get()
+    num_new_measurements = 0
+    num_running = len(processes)
+    while num_running:
+      series = queue.get()
+      if series is None:
+        num_running -= 1
+        continue
+      num_measurements += len(series.measurement)
       with self.Session(commit=True) as session:
-        num_measurements += self.AddSeriesCollection(
-            session, series_collections)
+        num_new = self.AddSeries(session, series, high_water_marks)
+      num_new_measurements += num_new
+      logging.info('Imported %s new of %s %s:%s measurements',
+                   humanize.intcomma(num_new),
+                   humanize.intcomma(len(series.measurement)), series.family,
+                   series.name)
+
+    for process in processes:
+      process.join()
 
     duration_seconds = time.time() - start_time
-    logging.info('Processed %s records in %.3f seconds (%.2f rows per second)',
+    logging.info('Processed %s records in %.3f seconds (%.2f rows per second), '
+                 'of which %s were new',
                  humanize.intcomma(num_measurements), duration_seconds,
-                 num_measurements / duration_seconds)
+                 num_measurements / duration_seconds,
+                 humanize.intcomma(num_new_measurements))
 
 
 def main(argv):
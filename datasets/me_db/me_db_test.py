@@ -0,0 +1,194 @@
+"""Unit tests for //datasets/me_db."""
+import datetime
+import multiprocessing
+import pathlib
+import sys
+import tempfile
+import typing
+
+import numpy as np
+import pytest
+from absl import app
+from absl import flags
+
+from datasets.me_db import importers
+from datasets.me_db import me_db
+from datasets.me_db import me_pb2
+from labm8 import labdate
+
+
+FLAGS = flags.FLAGS
+
+
+def _SeriesCollection(dates: typing.List[int]) -> me_pb2.SeriesCollection:
+  """Create a series collection with one measurement per date."""
+  return me_pb2.SeriesCollection(series=[
+    me_pb2.Series(family='Fitness', name='Steps', unit='count', measurement=[
+      me_pb2.Measurement(ms_since_unix_epoch=date, value=date // 1000,
+                         group='default', source='Test')
+      for date in dates
+    ])
+  ])
+
+
+# Inbox importers which send a fixed set of measurements. The dates are in
+# reverse order to test that chunks are sorted by date.
+def _ImportFirstDates(inbox: pathlib.Path, queue: multiprocessing.Queue):
+  del inbox
+  importers.PutSeriesCollectionOnQueue(
+      _SeriesCollection(list(reversed(range(1000, 6000, 1000)))), queue)
+
+
+def _ImportAllDates(inbox: pathlib.Path, queue: multiprocessing.Queue):
+  del inbox
+  importers.PutSeriesCollectionOnQueue(
+      _SeriesCollection(list(reversed(range(1000, 11000, 1000)))), queue)
+
+
+@pytest.fixture(scope='function')
+def db() -> me_db.Database:
+  with tempfile.TemporaryDirectory(prefix='phd_') as d:
+    yield me_db.Database(f'sqlite:///{d}/me.db')
+
+
+def _MeasurementsCount(db: me_db.Database) -> int:
+  with db.Session() as s:
+    return s.query(me_db.Measurement).count()
+
+
+def test_SeriesChunks():
+  """Test that series are split into sorted, bounded chunks."""
+  chunks = list(importers.SeriesChunks(
+      _SeriesCollection([5000, 3000, 1000, 4000, 2000]), 2))
+  assert [len(c.measurement) for c in chunks] == [2, 2, 1]
+  assert [m.ms_since_unix_epoch for c in chunks for m in c.measurement] == [
+    1000, 2000, 3000, 4000, 5000]
+  assert all(c.name == 'Steps' for c in chunks)
+
+
+def test_ImportMeasurementsFromInboxImporters_idempotent(
+    db: me_db.Database, tmpdir):
+  """Test that importing the same measurements twice is a no-op."""
+  db.ImportMeasurementsFromInboxImporters(
+      pathlib.Path(tmpdir), [_ImportFirstDates])
+  assert _MeasurementsCount(db) == 5
+  db.ImportMeasurementsFromInboxImporters(
+      pathlib.Path(tmpdir), [_ImportFirstDates])
+  assert _MeasurementsCount(db) == 5
+
+
+def test_ImportMeasurementsFromInboxImporters_incremental(
+    db: me_db.Database, tmpdir):
+  """Test that only new measurements are imported."""
+  series_chunk_size = FLAGS.series_chunk_size
+  FLAGS.series_chunk_size = 3
+  try:
+    db.ImportMeasurementsFromInboxImporters(
+        pathlib.Path(tmpdir), [_ImportFirstDates])
+    db.ImportMeasurementsFromInboxImporters(
+        pathlib.Path(tmpdir), [_ImportAllDates])
+  finally:
+    FLAGS.series_chunk_size = series_chunk_size
+  assert _MeasurementsCount(db) == 10
+  with db.Session() as s:
+    assert s.query(me_db.HighWaterMark).one().ms_since_unix_epoch == 10000
+
+
+def test_GetHighWaterMarks_populates_from_measurements(db: me_db.Database):
+  """Test that high-water marks are derived from existing measurements."""
+  with db.Session(commit=True) as s:
+    db.AddSeriesCollection(s, _SeriesCollection([1000, 2000]))
+  with db.Session(commit=True) as s:
+    assert db.GetHighWaterMarks(s) == {('Test', 'Fitness', 'Steps'): 2000}
+
+
+def test_RollupPeriodStart():
+  """Test the start dates of rollup periods."""
+  date = datetime.datetime(2018, 6, 14, 13, 30)  # A Thursday.
+  assert me_db.RollupPeriodStart('day', date) == datetime.datetime(2018, 6, 14)
+  assert me_db.RollupPeriodStart('week', date) == datetime.datetime(2018, 6, 11)
+  assert me_db.RollupPeriodStart('month', date) == datetime.datetime(2018, 6, 1)
+  with pytest.raises(ValueError):
+    me_db.RollupPeriodStart('year', date)
+
+
+def _DaysSeriesCollection() -> me_pb2.SeriesCollection:
+  """Create a series collection with two measurements per day in June."""
+  start = datetime.datetime(2018, 6, 1, 12)
+  return me_pb2.SeriesCollection(series=[
+    me_pb2.Series(family='Fitness', name='Steps', unit='count', measurement=[
+      me_pb2.Measurement(
+          ms_since_unix_epoch=labdate.MillisecondsTimestamp(
+              start + datetime.timedelta(days=i // 2)),
+          value=i, group='a' if i % 2 else 'b', source='Test')
+      for i in range(60)
+    ])
+  ])
+
+
+def test_GetRollups(db: me_db.Database):
+  """Test rollup values for a month of measurements."""
+  with db.Session(commit=True) as s:
+    db.AddSeries(s, _DaysSeriesCollection().series[0], {})
+
+  days = db.GetRollups('day', 'Fitness', 'Steps',
+                       datetime.datetime(2018, 6, 2),
+                       datetime.datetime(2018, 6, 4))
+  assert list(days.start_dates) == [np.datetime64('2018-06-02'),
+                                    np.datetime64('2018-06-03')]
+  assert list(days.count) == [2, 2]
+  assert list(days.sum) == [2 + 3, 4 + 5]
+  assert list(days.min) == [2, 4]
+  assert list(days.max) == [3, 5]
+
+  month = db.GetRollups('month', 'Fitness', 'Steps',
+                        datetime.datetime(2018, 6, 15),
+                        datetime.datetime(2018, 7, 1), group='a')
+  assert list(month.count) == [30]
+  assert list(month.sum) == [sum(range(1, 60, 2))]
+
+
+def test_UpdateRollups_incremental(db: me_db.Database):
+  """Test that rollups are updated by subsequent imports."""
+  series = _DaysSeriesCollection().series[0]
+  first, second = me_pb2.Series(), me_pb2.Series()
+  first.CopyFrom(series)
+  del first.measurement[30:]
+  second.CopyFrom(series)
+  del second.measurement[:30]
+  with db.Session(commit=True) as s:
+    db.AddSeries(s, first, {})
+  with db.Session(commit=True) as s:
+    db.AddSeries(s, second, {})
+
+  weeks = db.GetRollups('week', 'Fitness', 'Steps',
+                        datetime.datetime(2018, 1, 1),
+                        datetime.datetime(2019, 1, 1))
+  assert weeks.count.sum() == 60
+  assert weeks.sum.sum() == sum(range(60))
+  with db.Session(commit=True) as s:
+    db.RebuildRollups(s)
+  rebuilt = db.GetRollups('week', 'Fitness', 'Steps',
+                          datetime.datetime(2018, 1, 1),
+                          datetime.datetime(2019, 1, 1))
+  assert list(rebuilt.sum) == list(weeks.sum)
+
+
+def test_GetRollups_empty(db: me_db.Database):
+  """Test that an empty range returns empty arrays."""
+  rollups = db.GetRollups('day', 'Fitness', 'Steps',
+                          datetime.datetime(2018, 1, 1),
+                          datetime.datetime(2019, 1, 1))
+  assert not rollups.count.size
+
+
+def main(argv: typing.List[str]):
+  """Main entry point."""
+  if len(argv) > 1:
+    raise app.UsageError("Unknown arguments: '{}'.".format(' '.join(argv[1:])))
+  sys.exit(pytest.main([__file__, '-vv']))
+
+
+if __name__ == '__main__':
+  flags.FLAGS(['argv[0]', '-v=1'])
+  app.run(main)
@@ -70,7 +70,7 @@ def ProcessInbox(inbox: pathlib.Path) -> me_pb2.SeriesCollection:
 
 
 def ProcessInboxToQueue(inbox: pathlib.Path, queue: multiprocessing.Queue):
-  queue.put(ProcessInbox(inbox))
+  importers.PutSeriesCollectionOnQueue(ProcessInbox(inbox), queue)
 
 
 def main(argv: typing.List[str]):
@@ -1,14 +1,19 @@
 """OpenCL feature extraction."""
 import csv
+import hashlib
 import os
+import pathlib
 import re
 import sys
+import tempfile
+import typing
 from collections import OrderedDict
-from io import StringIO, open
+from io import open
 from subprocess import PIPE, Popen
 from typing import List, TextIO
 
 import numpy as np
+from absl import logging
 
 from deeplearning.clgen import errors
 from labm8 import bazelutil
@@ -30,6 +35,17 @@ if _LIBCLANG_SO.is_file() and _LIBLTO_SO.is_file():
   CLGEN_FEATURES_ENV['LD_PRELOAD'] = f'{_LIBCLANG_SO}:{_LIBLTO_SO}'
 
 
+# The names of the features of a kernel, in the order that they are printed by
+# opencl_kernel_features. F2 is coalesced/mem, and F4 is comp/mem.
+FEATURE_NAMES = ['comp', 'rational', 'mem', 'localmem', 'coalesced', 'atomic',
+                 'F2', 'F4']
+
+# The type of arrays returned by FeatureExtractor. There is a row for each
+# kernel. 'source' is the index of the source which contains the kernel.
+FEATURES_DTYPE = np.dtype([('source', np.int64), ('kernel', object)] +
+                          [(name, np.float64) for name in FEATURE_NAMES])
+
+
 class FeatureExtractionError(errors.CLgenError):
   """ Thrown in case feature extraction fails """
   pass
@@ -56,7 +72,152 @@ def _is_good_features(line: str, stderr: str) -> bool:
   return False
 
 
-def to_np_arrays(paths: List[str], **kwargs):
+# A kernel's name and feature values.
+_KernelFeatures = typing.Tuple[str, float, float, float, float, float, float,
+                               float, float]
+
+
+class FeatureExtractor(object):
+  """Extract the features of many OpenCL sources.
+
+  Sources are processed in batches, with a single opencl_kernel_features
+  process per batch, rather than a process per source. Results are cached by
+  the sha256 of the source, so repeated sources are extracted only once.
+  """
+
+  def __init__(self, use_shim: bool = False, batch_size: int = 512,
+               cache: typing.Optional[typing.MutableMapping[
+                 str, typing.List[_KernelFeatures]]] = None):
+    """Constructor.
+
+    Args:
+      use_shim: Inject the shim header.
+      batch_size: The maximum number of sources per opencl_kernel_features
+        process.
+      cache: A mapping to cache the features of sources in, keyed by source
+        hash. The features of a source which failed to compile are cached as
+        None. If not provided, an in-memory cache is used.
+    """
+    self.use_shim = use_shim
+    self.batch_size = batch_size
+    self.cache = {} if cache is None else cache
+
+  def _CacheKey(self, src: str) -> str:
+    return hashlib.sha256(
+        f'{int(self.use_shim)}:{src}'.encode('utf-8')).hexdigest()
+
+  def Extract(self, srcs: typing.List[str],
+              fatal_errors: bool = False) -> np.ndarray:
+    """Extract the features of kernels in OpenCL sources.
+
+    Args:
+      srcs: A list of OpenCL sources.
+      fatal_errors: If true, raise an error if any source fails to compile.
+
+    Returns:
+      An array of type FEATURES_DTYPE with a row for every kernel. Sources
+      which fail to compile have no rows.
+
+    Raises:
+      FeatureExtractionError: If fatal_errors is true and a source fails to
+        compile.
+    """
+    keys = [self._CacheKey(src) for src in srcs]
+    # Extract each uncached source once, even if it is repeated.
+    uncached = {}
+    for src, key in zip(srcs, keys):
+      if key not in self.cache and key not in uncached:
+        uncached[key] = src
+    uncached_keys = list(uncached.keys())
+    for i in range(0, len(uncached_keys), self.batch_size):
+      batch_keys = uncached_keys[i:i + self.batch_size]
+      results = self._ExtractBatch([uncached[key] for key in batch_keys])
+      for key, result in zip(batch_keys, results):
+        self.cache[key] = result
+
+    failed = [i for i, key in enumerate(keys) if self.cache[key] is None]
+    if failed:
+      logging.warning('Failed to extract features from %d of %d sources',
+                      len(failed), len(srcs))
+      if fatal_errors:
+        raise FeatureExtractionError(
+            f'Failed to extract features from sources {failed}')
+
+    rows = [(i,) + kernel for i, key in enumerate(keys)
+            for kernel in (self.cache[key] or [])]
+    return np.array(rows, dtype=FEATURES_DTYPE)
+
+  def ExtractFromPaths(self, paths: typing.List[typing.Union[str,
+                                                             pathlib.Path]],
+                       fatal_errors: bool = False) -> np.ndarray:
+    """Extract the features of kernels in OpenCL files.
+
+    Returns:
+      An array of type FEATURES_DTYPE, where 'source' is an index into paths.
+    """
+    srcs = []
+    for path in paths:
+      with open(path) as f:
+        srcs.append(f.read())
+    return self.Extract(srcs, fatal_errors=fatal_errors)
+
+  def _ExtractBatch(self, srcs: typing.List[str]
+                    ) -> typing.List[typing.Optional[typing.List[
+    _KernelFeatures]]]:
+    """Run opencl_kernel_features on a batch of sources.
+
+    Compiler errors are attributed to sources by file name. If the process
+    crashes, or an error cannot be attributed, the batch is split in two and
+    each half is retried, until the failing sources are isolated.
+
+    Returns:
+      A list of the kernel features of each source, or None if the source
+      failed to compile.
+    """
+    with tempfile.TemporaryDirectory(prefix='clgen_features_') as d:
+      paths = []
+      for i, src in enumerate(srcs):
+        path = os.path.join(d, f'{i}.cl')
+        with open(path, 'w') as f:
+          f.write(src)
+        paths.append(path)
+      cmd = [str(CLGEN_FEATURES)] + [
+        '-extra-arg=' + x for x in _shim_args(use_shim=self.use_shim)] + paths
+      process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                      env=CLGEN_FEATURES_ENV)
+      stdout, stderr = process.communicate()
+    stdout, stderr = stdout.decode('utf-8'), stderr.decode('utf-8')
+
+    if len(srcs) == 1:
+      if process.returncode or ' error: ' in stderr:
+        return [None]
+      errors_by_file = set()
+    else:
+      errors_by_file = set(int(match.group(1)) for match in re.finditer(
+          r'/(\d+)\.cl:\d+:\d+: (?:fatal )?error: ', stderr))
+      num_errors = len(re.findall(' error: ', stderr))
+      num_attributed_errors = len(re.findall(
+          r'\.cl:\d+:\d+: (?:fatal )?error: ', stderr))
+      if process.returncode or num_errors > num_attributed_errors:
+        mid = len(srcs) // 2
+        return (self._ExtractBatch(srcs[:mid]) +
+                self._ExtractBatch(srcs[mid:]))
+
+    results = [[] for _ in srcs]
+    # The first line is the CSV header.
+    for line in stdout.split('\n')[1:]:
+      row = line.split(',')
+      if not _is_features(row):
+        continue
+      i = int(row[0][:-len('.cl')])
+      results[i].append((row[1],) + tuple(float(x) for x in row[2:]))
+    for i in errors_by_file:
+      results[i] = None
+    return results
+
+
+def to_np_arrays(paths: List[str], use_shim: bool = False,
+                 fatal_errors: bool = False, **kwargs):
   """
   Returns a list of numpy arrays for features in kernels in files.
 
@@ -64,30 +225,23 @@ def to_np_arrays(paths: List[str], **kwargs):
   ----------
   path : List[str]
       List of file paths.
+  use_shim : bool, optional
+      Inject shim header.
+  fatal_errors : bool, optional
+      Raise an error if any file fails to compile.
   **kwargs
-      Arguments to features()
+      Unused. Accepted for compatibility with the arguments of features().
 
   Raises
   ------
   FeatureExtractionError
       In case feature extraction fails.
   """
-
-  def _process_file(path: str, **kwargs):
-    buf = StringIO()
-    features(path=path, file=buf, **kwargs)
-    ret = buf.getvalue()
-    try:
-      # last line is empty:
-      lines = ret.split('\n')[:-1]
-      # first two cols are ignored (path and kernel names):
-      parse = lambda l: np.array([float(x) for x in l.split(',')[2:]])
-      return [parse(line) for line in lines]
-    except IndexError:
-      raise FeatureExtractionError
-
-  flatten = lambda l: [item for sublist in l for item in sublist]
-  return flatten([_process_file(path, **kwargs) for path in paths])
+  del kwargs
+  kernels = FeatureExtractor(use_shim=use_shim).ExtractFromPaths(
+      paths, fatal_errors=fatal_errors)
+  return [np.array([kernel[name] for name in FEATURE_NAMES], dtype=np.float64)
+          for kernel in kernels]
 
 
 # FIXME(polyglot): Add support for multiple languages.
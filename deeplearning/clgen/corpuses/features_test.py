@@ -0,0 +1,98 @@
+"""Unit tests for //deeplearning/clgen/corpuses/features.py."""
+import pathlib
+import sys
+import tempfile
+
+import numpy as np
+import pytest
+from absl import app
+
+from deeplearning.clgen.corpuses import features
+
+
+KERNEL_A = """\
+kernel void A(global float* a, global float* b) {
+  a[get_global_id(0)] = b[get_global_id(0)] * 2.0f;
+}
+"""
+
+KERNEL_B = """\
+kernel void B(global int* a) {
+  a[get_global_id(0)] += 1;
+}
+"""
+
+BAD_KERNEL = "kernel void C(global int* a) { undefined_function(a); }"
+
+
+def test_FeatureExtractor_Extract():
+  extractor = features.FeatureExtractor()
+  kernels = extractor.Extract([KERNEL_A, KERNEL_B])
+  assert kernels.dtype == features.FEATURES_DTYPE
+  assert list(kernels['source']) == [0, 1]
+  assert list(kernels['kernel']) == ['A', 'B']
+  assert kernels[0]['mem'] == 2
+
+
+def test_FeatureExtractor_Extract_multiple_kernels_per_source():
+  kernels = features.FeatureExtractor().Extract([KERNEL_A + KERNEL_B])
+  assert list(kernels['source']) == [0, 0]
+  assert list(kernels['kernel']) == ['A', 'B']
+
+
+def test_FeatureExtractor_Extract_compiler_error():
+  """Test that a source which fails to compile is ignored within a batch."""
+  kernels = features.FeatureExtractor().Extract(
+      [KERNEL_A, BAD_KERNEL, KERNEL_B])
+  assert list(kernels['source']) == [0, 2]
+
+
+def test_FeatureExtractor_Extract_fatal_errors():
+  with pytest.raises(features.FeatureExtractionError):
+    features.FeatureExtractor().Extract([KERNEL_A, BAD_KERNEL],
+                                        fatal_errors=True)
+
+
+def test_FeatureExtractor_Extract_batches():
+  """Test that results do not depend on the batch size."""
+  srcs = [KERNEL_A, BAD_KERNEL, KERNEL_B] * 3
+  batched = features.FeatureExtractor(batch_size=2).Extract(srcs)
+  unbatched = features.FeatureExtractor(batch_size=100).Extract(srcs)
+  np.testing.assert_array_equal(batched, unbatched)
+
+
+def test_FeatureExtractor_cache():
+  cache = {}
+  extractor = features.FeatureExtractor(cache=cache)
+  extractor.Extract([KERNEL_A, KERNEL_A, BAD_KERNEL])
+  assert len(cache) == 2
+  # Results are read from the cache.
+  extractor.cache = {k: [('X', 0, 0, 0, 0, 0, 0, 0, 0)] for k in cache}
+  assert list(extractor.Extract([KERNEL_A])['kernel']) == ['X']
+
+
+def test_to_np_arrays():
+  with tempfile.TemporaryDirectory() as d:
+    paths = [pathlib.Path(d) / 'a.cl', pathlib.Path(d) / 'b.cl']
+    paths[0].write_text(KERNEL_A)
+    paths[1].write_text(KERNEL_B)
+    arrays = features.to_np_arrays([str(p) for p in paths])
+  assert len(arrays) == 2
+  assert arrays[0].shape == (len(features.FEATURE_NAMES),)
+
+
+def test_benchmark_FeatureExtractor_Extract(benchmark):
+  """Benchmark extracting the features of 100 uncached sources."""
+  srcs = [KERNEL_A.replace('2.0f', f'{i}.0f') for i in range(100)]
+  benchmark(lambda: features.FeatureExtractor().Extract(srcs))
+
+
+def main(argv):
+  """Main entry point."""
+  if len(argv) > 1:
+    raise app.UsageError('Unrecognized command line flags.')
+  sys.exit(pytest.main([__file__, '-v']))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,529 @@
+"""Import Testcase and Result protos to the datastore in bulk.
+
+Testcase.GetOrAdd() and Result.GetOrAdd() resolve every string, option, and
+set member of a proto with its own query, so importing protos one at a time
+costs dozens of round trips per proto. A BulkImporter instead resolves a batch
+of protos table by table: the rows which a batch requires from a table are
+looked up with one query per few hundred keys, and the rows which are missing
+are inserted with a single multi-row INSERT. The rows written are the same as
+those written by GetOrAdd().
+
+ImportTestcaseFiles() and ImportResultFiles() parse proto files in parallel
+worker processes, import them in batches, and commit each batch before
+deleting its files, so that a file is never deleted unless its contents are
+durably stored.
+"""
+import collections
+import functools
+import hashlib
+import multiprocessing.pool
+import pathlib
+import typing
+
+import humanize
+from absl import flags
+from absl import logging
+
+import deeplearning.deepsmith.client
+import deeplearning.deepsmith.generator
+import deeplearning.deepsmith.harness
+import deeplearning.deepsmith.profiling_event
+import deeplearning.deepsmith.result
+import deeplearning.deepsmith.testbed
+import deeplearning.deepsmith.testcase
+import deeplearning.deepsmith.toolchain
+from deeplearning.deepsmith import db
+from deeplearning.deepsmith.proto import deepsmith_pb2
+from labm8 import labdate
+from labm8 import pbutil
+
+
+FLAGS = flags.FLAGS
+
+# The maximum number of keys in a single IN clause. SQLite limits the number of
+# parameters of a statement to 999.
+_MAX_KEYS_PER_QUERY = 250
+
+# A lookup key, a tuple of column values which identify a row.
+_Key = typing.Tuple[typing.Any, ...]
+
+
+def _Chunks(values: typing.List[typing.Any],
+            size: int) -> typing.Iterator[typing.List[typing.Any]]:
+  for i in range(0, len(values), size):
+    yield values[i:i + size]
+
+
+class BulkImporter(object):
+  """Add Testcase and Result protos to a datastore in batches.
+
+  The IDs of resolved rows are cached for the lifetime of the importer, so
+  strings and options which are shared across batches are only looked up
+  once. The cache may refer to uncommitted rows, so an importer must be
+  discarded if its session is rolled back.
+  """
+
+  def __init__(self, session: db.session_t):
+    self.session = session
+    # A map from table to a map from lookup key to row ID.
+    self._ids: typing.Dict[db.Table, typing.Dict[_Key, int]] = (
+      collections.defaultdict(dict))
+    # A map from set table to the IDs of sets whose members are all stored.
+    self._sets: typing.Dict[db.Table, typing.Set[bytes]] = (
+      collections.defaultdict(set))
+    # A map from harness ID to compression dictionary.
+    self._dictionaries: typing.Dict[
+      int, deeplearning.deepsmith.result.ResultOutputDictionary] = {}
+
+  def _SelectIds(self, table: db.Table, key_columns: typing.List[str],
+                 keys: typing.List[_Key]) -> typing.Dict[_Key, int]:
+    """Look up the IDs of the rows with the given keys."""
+    ids = {}
+    columns = [getattr(table, column) for column in key_columns]
+    for chunk in _Chunks(keys, _MAX_KEYS_PER_QUERY):
+      query = self.session.query(table.id, *columns)
+      # Filter each column by the values in the chunk, which selects a
+      # superset of the requested keys, and discard the extra rows below.
+      for column, values in zip(columns, zip(*chunk)):
+        query = query.filter(column.in_(set(values)))
+      wanted = set(chunk)
+      for row in query:
+        key = tuple(row[1:])
+        if key in wanted:
+          ids[key] = row[0]
+    return ids
+
+  def _GetOrAddIds(
+      self, table: db.Table, key_columns: typing.List[str],
+      rows: typing.Dict[_Key, typing.Dict[str, typing.Any]]
+  ) -> typing.Tuple[typing.Dict[_Key, int], typing.Set[_Key]]:
+    """Look up the IDs of rows, inserting the rows which do not exist.
+
+    Args:
+      table: The table.
+      key_columns: The names of the columns which identify a row.
+      rows: A map from key to the column values of a row. The key must be the
+        values of the key_columns, in order.
+
+    Returns:
+      A map from key to row ID, and the set of keys which were inserted.
+    """
+    cache = self._ids[table]
+    missing = [key for key in rows if key not in cache]
+    inserted = set()
+    if missing:
+      found = self._SelectIds(table, key_columns, missing)
+      cache.update(found)
+      inserted = {key for key in missing if key not in found}
+      if inserted:
+        self.session.execute(table.__table__.insert(),
+                             [rows[key] for key in inserted])
+        cache.update(self._SelectIds(table, key_columns, list(inserted)))
+    return {key: cache[key] for key in rows}, inserted
+
+  def _StringIds(self, table: db.StringTable,
+                 strings: typing.Iterable[str]) -> typing.Dict[str, int]:
+    """Look up the IDs of strings in a string table, adding missing strings.
+
+    Raises:
+      StringTooLongError: If a string is too long for the table.
+    """
+    rows = {}
+    for string in strings:
+      if len(string) > table.maxlen:
+        raise db.StringTooLongError(table, string, table.maxlen)
+      rows[(string,)] = {'string': string}
+    ids, _ = self._GetOrAddIds(table, ['string'], rows)
+    return {key[0]: id_ for key, id_ in ids.items()}
+
+  def _AddSetMembers(self, table: db.Table, member_column: str,
+                     sets: typing.Dict[bytes, typing.Set[int]]) -> None:
+    """Add the rows of sets to a set table, skipping those which exist."""
+    known = self._sets[table]
+    set_ids = [set_id for set_id in sets if set_id not in known]
+    if not set_ids:
+      return
+    existing = set()
+    member = getattr(table, member_column)
+    for chunk in _Chunks(set_ids, _MAX_KEYS_PER_QUERY):
+      existing.update(self.session.query(table.id, member).filter(
+          table.id.in_(chunk)))
+    rows = [{'id': set_id, member_column: member_id}
+            for set_id in set_ids for member_id in sets[set_id]
+            if (set_id, member_id) not in existing]
+    if rows:
+      self.session.execute(table.__table__.insert(), rows)
+    known.update(set_ids)
+
+  def _OptSetIds(
+      self, optsets: typing.List[typing.Mapping[str, str]],
+      opt_table: db.Table, set_table: db.Table, member_column: str,
+      name_table: db.StringTable,
+      value_ids: typing.Callable[[typing.Set[str]], typing.Dict[str, int]]
+  ) -> typing.List[bytes]:
+    """Resolve sets of <name, value> options, adding missing rows.
+
+    Args:
+      optsets: The option maps to resolve.
+      opt_table: The table of <name_id, value_id> pairs.
+      set_table: The table which groups pairs into sets.
+      member_column: The name of the pair column of the set table.
+      name_table: The string table of option names.
+      value_ids: A function which resolves option values to IDs.
+
+    Returns:
+      The ID of each option set.
+    """
+    name_ids = self._StringIds(
+        name_table, {name for opts in optsets for name in opts})
+    values = value_ids({value for opts in optsets for value in opts.values()})
+    pairs = {}
+    for opts in optsets:
+      for name, value in opts.items():
+        key = (name_ids[name], values[value])
+        pairs[key] = {'name_id': key[0], 'value_id': key[1]}
+    opt_ids, _ = self._GetOrAddIds(opt_table, ['name_id', 'value_id'], pairs)
+
+    set_ids = []
+    sets = {}
+    for opts in optsets:
+      set_id = db.OptSetId(opts)
+      set_ids.append(set_id)
+      sets[set_id] = {opt_ids[(name_ids[name], values[value])]
+                      for name, value in opts.items()}
+    self._AddSetMembers(set_table, member_column, sets)
+    return set_ids
+
+  def _ProtoIds(self, table: db.Table,
+                protos: typing.List[pbutil.ProtocolBuffer]) -> typing.List[int]:
+    """Resolve protos using the table's GetOrAdd() method.
+
+    This is used for generators, harnesses, and testbeds, of which a batch
+    contains only a few distinct values, so each distinct proto is resolved
+    once.
+    """
+    cache = self._ids[table]
+    keys = [(proto.SerializeToString(deterministic=True),) for proto in protos]
+    missing = {}
+    for key, proto in zip(keys, protos):
+      if key not in cache:
+        missing[key] = table.GetOrAdd(self.session, proto)
+    if missing:
+      self.session.flush()
+      for key, instance in missing.items():
+        cache[key] = instance.id
+    return [cache[key] for key in keys]
+
+  def _TestcaseInputValueIds(
+      self, strings: typing.Iterable[str]) -> typing.Dict[str, int]:
+    rows = {}
+    strings_by_md5 = {}
+    for string in strings:
+      md5 = hashlib.md5(string.encode('utf-8')).digest()
+      strings_by_md5[md5] = string
+      rows[(md5,)] = {'md5': md5, 'charcount': len(string),
+                      'linecount': string.count('\n'), 'string': string}
+    ids, _ = self._GetOrAddIds(
+        deeplearning.deepsmith.testcase.TestcaseInputValue, ['md5'], rows)
+    return {strings_by_md5[key[0]]: id_ for key, id_ in ids.items()}
+
+  def _ResultOutputValueIds(
+      self, strings: typing.Iterable[str],
+      harness_ids: typing.Dict[str, int]) -> typing.Dict[str, int]:
+    """Resolve result output values, adding missing values.
+
+    If --compress_result_outputs is set, missing values are compressed with
+    the dictionary of the harness of the first result which produced them,
+    and are added one at a time by ResultOutputValue.GetOrAdd().
+    """
+    table = deeplearning.deepsmith.result.ResultOutputValue
+    rows = {}
+    strings_by_md5 = {}
+    for string in strings:
+      values = table.ColumnValues(string)
+      strings_by_md5[values['original_md5']] = string
+      rows[(values['original_md5'],)] = values
+
+    if not FLAGS.compress_result_outputs:
+      ids, _ = self._GetOrAddIds(table, ['original_md5'], rows)
+      return {strings_by_md5[key[0]]: id_ for key, id_ in ids.items()}
+
+    cache = self._ids[table]
+    missing = [key for key in rows if key not in cache]
+    cache.update(self._SelectIds(table, ['original_md5'], missing))
+    added = {}
+    for key in missing:
+      if key not in cache:
+        string = strings_by_md5[key[0]]
+        added[key] = table.GetOrAdd(
+            self.session, string, compress=True,
+            dictionary=self._Dictionary(harness_ids[string]))
+    if added:
+      self.session.flush()
+      for key, value in added.items():
+        cache[key] = value.id
+    return {strings_by_md5[key[0]]: cache[key] for key in rows}
+
+  def _Dictionary(self, harness_id: int) -> typing.Optional[
+    deeplearning.deepsmith.result.ResultOutputDictionary]:
+    if harness_id not in self._dictionaries:
+      table = deeplearning.deepsmith.result.ResultOutputDictionary
+      self._dictionaries[harness_id] = self.session.query(table).filter(
+          table.harness_id == harness_id).first()
+    return self._dictionaries[harness_id]
+
+  def _AddProfilingEvents(
+      self, table: db.Table, owner_column: str,
+      events: typing.List[typing.Tuple[int, deepsmith_pb2.ProfilingEvent]]
+  ) -> None:
+    """Add the profiling events of new testcases or results.
+
+    Args:
+      table: The profiling event table.
+      owner_column: The name of the testcase or result ID column.
+      events: A list of <owner ID, event> tuples.
+    """
+    if not events:
+      return
+    client_ids = self._StringIds(deeplearning.deepsmith.client.Client,
+                                 {event.client for _, event in events})
+    type_ids = self._StringIds(
+        deeplearning.deepsmith.profiling_event.ProfilingEventType,
+        {event.type for _, event in events})
+    now = labdate.GetUtcMillisecondsNow()
+    rows = {}
+    for owner_id, event in events:
+      key = (owner_id, client_ids[event.client], type_ids[event.type])
+      # As with GetOrAdd(), only the first of duplicate events is added.
+      rows.setdefault(key, {
+        owner_column: owner_id,
+        'client_id': key[1],
+        'type_id': key[2],
+        'duration_ms': event.duration_ms,
+        'event_start': labdate.DatetimeFromMillisecondsTimestamp(
+            event.event_start_epoch_ms),
+        'date_added': now,
+      })
+    self.session.execute(table.__table__.insert(), list(rows.values()))
+
+  def AddTestcases(
+      self, protos: typing.List[deepsmith_pb2.Testcase]) -> typing.List[int]:
+    """Add testcases, skipping those which already exist.
+
+    As with Testcase.GetOrAdd(), a testcase exists if every field other than
+    its profiling events matches, and profiling events are only added for new
+    testcases.
+
+    Args:
+      protos: The testcases to add.
+
+    Returns:
+      The ID of each testcase.
+
+    Raises:
+      StringTooLongError: If a string is too long for its column.
+    """
+    testcase = deeplearning.deepsmith.testcase
+    toolchain_ids = self._StringIds(deeplearning.deepsmith.toolchain.Toolchain,
+                                    {proto.toolchain for proto in protos})
+    generator_ids = self._ProtoIds(deeplearning.deepsmith.generator.Generator,
+                                   [proto.generator for proto in protos])
+    harness_ids = self._ProtoIds(deeplearning.deepsmith.harness.Harness,
+                                 [proto.harness for proto in protos])
+    inputset_ids = self._OptSetIds(
+        [proto.inputs for proto in protos], testcase.TestcaseInput,
+        testcase.TestcaseInputSet, 'input_id', testcase.TestcaseInputName,
+        self._TestcaseInputValueIds)
+    invariant_optset_ids = self._OptSetIds(
+        [proto.invariant_opts for proto in protos],
+        testcase.TestcaseInvariantOpt, testcase.TestcaseInvariantOptSet,
+        'invariant_opt_id', testcase.TestcaseInvariantOptName,
+        functools.partial(self._StringIds, testcase.TestcaseInvariantOptValue))
+
+    key_columns = ['toolchain_id', 'generator_id', 'harness_id', 'inputset_id',
+                   'invariant_optset_id']
+    keys = [
+      (toolchain_ids[proto.toolchain], generator_id, harness_id, inputset_id,
+       invariant_optset_id)
+      for proto, generator_id, harness_id, inputset_id, invariant_optset_id in
+      zip(protos, generator_ids, harness_ids, inputset_ids,
+          invariant_optset_ids)]
+    ids, inserted = self._GetOrAddIds(
+        testcase.Testcase, key_columns,
+        {key: dict(zip(key_columns, key)) for key in keys})
+
+    events = []
+    for key, proto in zip(keys, protos):
+      if key in inserted:
+        # Only the first of duplicate testcases in the batch adds its events.
+        inserted.remove(key)
+        events += [(ids[key], event) for event in proto.profiling_events]
+    self._AddProfilingEvents(
+        deeplearning.deepsmith.profiling_event.TestcaseProfilingEvent,
+        'testcase_id', events)
+    return [ids[key] for key in keys]
+
+  def AddResults(
+      self, protos: typing.List[deepsmith_pb2.Result]) -> typing.List[int]:
+    """Add results, skipping those which already exist.
+
+    As with Result.GetOrAdd(), a result exists if there is a result for the
+    same testcase and testbed, and the outputs of existing results are not
+    compared.
+
+    Args:
+      protos: The results to add.
+
+    Returns:
+      The ID of each result.
+
+    Raises:
+      StringTooLongError: If a string is too long for its column.
+    """
+    result = deeplearning.deepsmith.result
+    testcase_ids = self.AddTestcases([proto.testcase for proto in protos])
+    testbed_ids = self._ProtoIds(deeplearning.deepsmith.testbed.Testbed,
+                                 [proto.testbed for proto in protos])
+    keys = list(zip(testcase_ids, testbed_ids))
+
+    # Resolve the outputs of only the first proto of each new result.
+    cache = self._ids[result.Result]
+    existing = self._SelectIds(
+        result.Result, ['testcase_id', 'testbed_id'],
+        list({key for key in keys if key not in cache}))
+    cache.update(existing)
+    new = collections.OrderedDict()
+    for key, proto in zip(keys, protos):
+      if key not in cache and key not in new:
+        new[key] = proto
+
+    if new:
+      harness_ids = {}
+      new_protos = list(new.values())
+      protos_harness_ids = self._ProtoIds(
+          deeplearning.deepsmith.harness.Harness,
+          [proto.testcase.harness for proto in new_protos])
+      for proto, harness_id in zip(new_protos, protos_harness_ids):
+        for value in proto.outputs.values():
+          harness_ids.setdefault(value, harness_id)
+      outputset_ids = self._OptSetIds(
+          [proto.outputs for proto in new_protos], result.ResultOutput,
+          result.ResultOutputSet, 'output_id', result.ResultOutputName,
+          functools.partial(self._ResultOutputValueIds,
+                            harness_ids=harness_ids))
+      rows = {
+        key: {'testcase_id': key[0], 'testbed_id': key[1],
+              'returncode': proto.returncode, 'outputset_id': outputset_id,
+              'outcome_num': proto.outcome}
+        for (key, proto), outputset_id in zip(new.items(), outputset_ids)}
+      ids, _ = self._GetOrAddIds(result.Result, ['testcase_id', 'testbed_id'],
+                                 rows)
+      self._AddProfilingEvents(
+          deeplearning.deepsmith.profiling_event.ResultProfilingEvent,
+          'result_id', [(ids[key], event) for key, proto in new.items()
+                        for event in proto.profiling_events])
+    return [cache[key] for key in keys]
+
+
+def _ReadProtoFile(
+    message_type: typing.Type[pbutil.ProtocolBuffer], path: pathlib.Path
+) -> typing.Tuple[pathlib.Path, typing.Optional[pbutil.ProtocolBuffer]]:
+  """Read a proto file, returning None if it cannot be decoded."""
+  try:
+    return path, pbutil.FromFile(path, message_type())
+  except pbutil.DecodeError as e:
+    logging.error('Failed to read %s: %s', path, e)
+    return path, None
+
+
+def _ImportFiles(
+    session: db.session_t, paths: typing.List[pathlib.Path],
+    message_type: typing.Type[pbutil.ProtocolBuffer],
+    add: typing.Callable[[BulkImporter, typing.List[pbutil.ProtocolBuffer]],
+                         typing.List[int]],
+    batch_size: int, delete_after_import: bool,
+    pool: typing.Optional[multiprocessing.pool.Pool]) -> int:
+  """Import proto files in committed batches."""
+  importer = BulkImporter(session)
+  read = functools.partial(_ReadProtoFile, message_type)
+  if pool:
+    results = pool.imap(read, paths, chunksize=16)
+  else:
+    results = (read(path) for path in paths)
+
+  count = 0
+  batch = []
+
+  def ImportBatch():
+    batch_paths = [path for path, proto in batch if proto]
+    add(importer, [proto for _, proto in batch if proto])
+    session.commit()
+    # Files are deleted only after their batch has been committed.
+    if delete_after_import:
+      for path in batch_paths:
+        path.unlink()
+    batch.clear()
+    return len(batch_paths)
+
+  for path, proto in results:
+    batch.append((path, proto))
+    if len(batch) >= batch_size:
+      count += ImportBatch()
+      logging.info('Imported %s of %s %s protos', humanize.intcomma(count),
+                   humanize.intcomma(len(paths)),
+                   message_type.DESCRIPTOR.name)
+  if batch:
+    count += ImportBatch()
+  return count
+
+
+def ImportTestcaseFiles(
+    session: db.session_t, paths: typing.List[pathlib.Path],
+    batch_size: int = 1000, delete_after_import: bool = False,
+    pool: typing.Optional[multiprocessing.pool.Pool] = None) -> int:
+  """Import Testcase proto files.
+
+  Each batch of files is committed before the next batch is imported. Files
+  which cannot be decoded are logged and skipped, and are never deleted.
+
+  Args:
+    session: A database session.
+    paths: The paths of Testcase protos.
+    batch_size: The number of protos to import per transaction.
+    delete_after_import: If True, delete the files of each batch once it has
+      been committed.
+    pool: A multiprocessing pool to parse files on. If not provided, files are
+      parsed in this process.
+
+  Returns:
+    The number of protos imported.
+  """
+  return _ImportFiles(session, paths, deepsmith_pb2.Testcase,
+                      BulkImporter.AddTestcases, batch_size,
+                      delete_after_import, pool)
+
+
+def ImportResultFiles(
+    session: db.session_t, paths: typing.List[pathlib.Path],
+    batch_size: int = 1000, delete_after_import: bool = False,
+    pool: typing.Optional[multiprocessing.pool.Pool] = None) -> int:
+  """Import Result proto files.
+
+  Each batch of files is committed before the next batch is imported. Files
+  which cannot be decoded are logged and skipped, and are never deleted.
+
+  Args:
+    session: A database session.
+    paths: The paths of Result protos.
+    batch_size: The number of protos to import per transaction.
+    delete_after_import: If True, delete the files of each batch once it has
+      been committed.
+    pool: A multiprocessing pool to parse files on. If not provided, files are
+      parsed in this process.
+
+  Returns:
+    The number of protos imported.
+  """
+  return _ImportFiles(session, paths, deepsmith_pb2.Result,
+                      BulkImporter.AddResults, batch_size, delete_after_import,
+                      pool)
@@ -0,0 +1,219 @@
+"""Tests for //deeplearning/deepsmith:bulk_import."""
+import multiprocessing
+import pathlib
+import random
+import sys
+import tempfile
+
+import pytest
+from absl import app
+from absl import flags
+
+import deeplearning.deepsmith.profiling_event
+import deeplearning.deepsmith.result
+import deeplearning.deepsmith.testcase
+from deeplearning.deepsmith import bulk_import
+from deeplearning.deepsmith.proto import deepsmith_pb2
+from labm8 import pbutil
+
+
+FLAGS = flags.FLAGS
+
+
+@pytest.fixture(scope='function')
+def tempdir() -> pathlib.Path:
+  with tempfile.TemporaryDirectory() as d:
+    yield pathlib.Path(d)
+
+
+def _Testcase(i: int) -> deepsmith_pb2.Testcase:
+  return deepsmith_pb2.Testcase(
+      toolchain='opencl',
+      generator=deepsmith_pb2.Generator(name='clgen', opts={'model': 'a'}),
+      harness=deepsmith_pb2.Harness(name='cldrive', opts={'timeout': '60'}),
+      inputs={'src': f'kernel void A{i}() {{}}', 'gsize': '1,1,1'},
+      invariant_opts={'interpreter': 'none'},
+      profiling_events=[
+        deepsmith_pb2.ProfilingEvent(client='localhost', type='generation',
+                                     duration_ms=i,
+                                     event_start_epoch_ms=1123123123),
+      ])
+
+
+def _Result(i: int, testbed_name: str = 'clang') -> deepsmith_pb2.Result:
+  return deepsmith_pb2.Result(
+      testcase=_Testcase(i),
+      testbed=deepsmith_pb2.Testbed(toolchain='opencl', name=testbed_name,
+                                    opts={'platform': 'cpu'}),
+      returncode=i % 2,
+      outputs={'stdout': f'output {i}', 'stderr': ''},
+      profiling_events=[
+        deepsmith_pb2.ProfilingEvent(client='localhost', type='exec',
+                                     duration_ms=i,
+                                     event_start_epoch_ms=1123123123),
+      ],
+      outcome=deepsmith_pb2.Result.PASS)
+
+
+def test_BulkImporter_AddTestcases_ToProto_equivalence(session):
+  """Test that imported testcases can be read back."""
+  protos = [_Testcase(i) for i in range(3)]
+  ids = bulk_import.BulkImporter(session).AddTestcases(protos)
+  session.commit()
+  assert len(set(ids)) == 3
+  for id_, proto in zip(ids, protos):
+    testcase = session.query(deeplearning.deepsmith.testcase.Testcase).filter(
+        deeplearning.deepsmith.testcase.Testcase.id == id_).one()
+    assert testcase.ToProto() == proto
+
+
+def test_BulkImporter_AddTestcases_GetOrAdd_equivalence(session):
+  """Test that bulk imported testcases are found by GetOrAdd()."""
+  ids = bulk_import.BulkImporter(session).AddTestcases(
+      [_Testcase(i) for i in range(3)])
+  session.commit()
+  for i, id_ in enumerate(ids):
+    testcase = deeplearning.deepsmith.testcase.Testcase.GetOrAdd(
+        session, _Testcase(i))
+    assert testcase.id == id_
+  # A testcase added by GetOrAdd() is found by the bulk importer.
+  testcase = deeplearning.deepsmith.testcase.Testcase.GetOrAdd(
+      session, _Testcase(10))
+  session.commit()
+  assert bulk_import.BulkImporter(session).AddTestcases(
+      [_Testcase(10)]) == [testcase.id]
+  assert session.query(deeplearning.deepsmith.testcase.Testcase).count() == 4
+
+
+def test_BulkImporter_AddTestcases_duplicates(session):
+  """Test that duplicate testcases only add the events of the first."""
+  first = _Testcase(0)
+  second = _Testcase(0)
+  second.profiling_events[0].duration_ms = -1
+  importer = bulk_import.BulkImporter(session)
+  assert len(set(importer.AddTestcases([first, second]))) == 1
+  assert len(set(importer.AddTestcases([second]))) == 1
+  session.commit()
+  assert session.query(deeplearning.deepsmith.testcase.Testcase).count() == 1
+  events = session.query(
+      deeplearning.deepsmith.profiling_event.TestcaseProfilingEvent).all()
+  assert [event.duration_ms for event in events] == [0]
+
+
+def test_BulkImporter_AddTestcases_shared_sets(session):
+  """Test that set members are not duplicated across batches."""
+  importer = bulk_import.BulkImporter(session)
+  importer.AddTestcases([_Testcase(0)])
+  bulk_import.BulkImporter(session).AddTestcases([_Testcase(1)])
+  session.commit()
+  assert session.query(
+      deeplearning.deepsmith.testcase.TestcaseInvariantOptSet).count() == 1
+  # Two inputsets, which share the 'gsize' input.
+  assert session.query(
+      deeplearning.deepsmith.testcase.TestcaseInputSet).count() == 4
+  assert session.query(
+      deeplearning.deepsmith.testcase.TestcaseInput).count() == 3
+
+
+def test_BulkImporter_AddResults_ToProto_equivalence(session):
+  """Test that imported results can be read back."""
+  protos = [_Result(i) for i in range(3)] + [_Result(0, testbed_name='gcc')]
+  ids = bulk_import.BulkImporter(session).AddResults(protos)
+  session.commit()
+  assert len(set(ids)) == 4
+  for id_, proto in zip(ids, protos):
+    result = session.query(deeplearning.deepsmith.result.Result).filter(
+        deeplearning.deepsmith.result.Result.id == id_).one()
+    assert result.ToProto() == proto
+  assert session.query(deeplearning.deepsmith.testcase.Testcase).count() == 3
+
+
+def test_BulkImporter_AddResults_existing_ignored(session):
+  """Test that results for an existing testcase and testbed are ignored."""
+  result = deeplearning.deepsmith.result.Result.GetOrAdd(session, _Result(0))
+  session.commit()
+  proto = _Result(0)
+  proto.outputs['stdout'] = 'different'
+  assert bulk_import.BulkImporter(session).AddResults([proto]) == [result.id]
+  session.commit()
+  assert session.query(deeplearning.deepsmith.result.Result).count() == 1
+  assert result.outputs['stdout'] == 'output 0'
+
+
+def test_BulkImporter_AddResults_compressed(session):
+  FLAGS.compress_result_outputs = True
+  try:
+    ids = bulk_import.BulkImporter(session).AddResults(
+        [_Result(0), _Result(1)])
+    session.commit()
+  finally:
+    FLAGS.compress_result_outputs = False
+  for i, id_ in enumerate(ids):
+    result = session.query(deeplearning.deepsmith.result.Result).filter(
+        deeplearning.deepsmith.result.Result.id == id_).one()
+    assert result.outputs == {'stdout': f'output {i}', 'stderr': ''}
+    assert all(output.value.truncated_value is None
+               for output in result.outputset)
+
+
+def test_ImportResultFiles_delete_after_import(session, tempdir):
+  """Test that imported files are deleted, and unreadable files are not."""
+  for i in range(5):
+    pbutil.ToFile(_Result(i), tempdir / f'{i}.pbtxt')
+  (tempdir / 'invalid.pbtxt').write_text('not a proto')
+  paths = sorted(tempdir.iterdir())
+  with multiprocessing.Pool(2) as pool:
+    count = bulk_import.ImportResultFiles(
+        session, paths, batch_size=2, delete_after_import=True, pool=pool)
+  assert count == 5
+  assert [p.name for p in tempdir.iterdir()] == ['invalid.pbtxt']
+  assert session.query(deeplearning.deepsmith.result.Result).count() == 5
+
+
+def test_ImportTestcaseFiles_failed_batch_not_deleted(session, tempdir):
+  """Test that the files of a batch which fails to import are kept."""
+  pbutil.ToFile(_Testcase(0), tempdir / '0.pbtxt')
+  proto = _Testcase(1)
+  proto.toolchain = 'x' * 10000
+  pbutil.ToFile(proto, tempdir / '1.pbtxt')
+  with pytest.raises(Exception):
+    bulk_import.ImportTestcaseFiles(session, sorted(tempdir.iterdir()),
+                                    delete_after_import=True)
+  assert len(list(tempdir.iterdir())) == 2
+
+
+def _RandomTestcase() -> deepsmith_pb2.Testcase:
+  proto = _Testcase(0)
+  proto.inputs['src'] = str(random.random())
+  return proto
+
+
+def test_benchmark_BulkImporter_AddTestcases(session, benchmark):
+  """Benchmark importing a batch of 100 new testcases."""
+  importer = bulk_import.BulkImporter(session)
+  benchmark(lambda: importer.AddTestcases(
+      [_RandomTestcase() for _ in range(100)]))
+
+
+def test_benchmark_Testcase_GetOrAdd(session, benchmark):
+  """Benchmark adding 100 new testcases one at a time, for comparison."""
+
+  def Benchmark():
+    for _ in range(100):
+      deeplearning.deepsmith.testcase.Testcase.GetOrAdd(
+          session, _RandomTestcase())
+    session.flush()
+
+  benchmark(Benchmark)
+
+
+def main(argv):
+  """Main entry point."""
+  if len(argv) > 1:
+    raise app.UsageError("Unknown arguments: '{}'.".format(' '.join(argv[1:])))
+  sys.exit(pytest.main([__file__, '-vv']))
+
+
+if __name__ == '__main__':
+  flags.FLAGS(['argv[0]'])
+  app.run(main)
@@ -1,16 +1,14 @@
 """A command-line interface for importing protos to the datastore."""
+import multiprocessing
 import pathlib
-import time
+import typing
 
-import progressbar
 from absl import app
 from absl import flags
 from absl import logging
 
-import deeplearning.deepsmith.result
-import deeplearning.deepsmith.testcase
+from deeplearning.deepsmith import bulk_import
 from deeplearning.deepsmith import datastore
-from deeplearning.deepsmith import db
 
 
 FLAGS = flags.FLAGS
@@ -21,87 +19,45 @@ flags.DEFINE_list('testcases', [], 'Testcase proto paths to import')
 flags.DEFINE_string('testcases_dir', None,
                     'Directory containing testcase protos')
 flags.DEFINE_bool('delete_after_import', False,
-                  'Delete the proto files after importing.')
+                  'Delete the proto files in --results_dir and '
+                  '--testcases_dir after they have been committed.')
+flags.DEFINE_integer('import_batch_size', 1000,
+                     'The number of protos to import per transaction.')
+flags.DEFINE_integer('import_processes', multiprocessing.cpu_count(),
+                     'The number of processes to parse proto files on.')
 
 
-def ImportResultsFromDirectory(session: db.session_t,
-                               results_dir: pathlib.Path) -> None:
-  """Import Results from a directory of protos.
-
-  Args:
-    session: A database session.
-    results_dir: Directory containing (only) Result protos.
-  """
-  files_to_delete = []
-  last_commit_time = time.time()
-  if not results_dir.is_dir():
-    logging.fatal('directory %s does not exist', results_dir)
-  for path in progressbar.ProgressBar()(results_dir.iterdir()):
-    deeplearning.deepsmith.result.Result.FromFile(session, path)
-    files_to_delete.append(path)
-    logging.info('Imported result %s', path)
-    if time.time() - last_commit_time > 10:
-      session.commit()
-      if FLAGS.delete_after_import:
-        for path in files_to_delete:
-          path.unlink()
-      files_to_delete = []
-      last_commit_time = time.time()
-      logging.info('Committed database')
-  session.commit()
-  if FLAGS.delete_after_import:
-    for path in files_to_delete:
-      path.unlink()
-
-
-def ImportTestcasesFromDirectory(session: db.session_t,
-                                 testcases_dir: pathlib.Path) -> None:
-  """Import Testcases from a directory of protos.
-
-  Args:
-    session: A database session.
-    testcases_dir: Directory containing (only) Testcase protos.
-  """
-  files_to_delete = []
-  last_commit_time = time.time()
-  if not testcases_dir.is_dir():
-    logging.fatal('directory %s does not exist', testcases_dir)
-  for path in progressbar.ProgressBar()(testcases_dir.iterdir()):
-    deeplearning.deepsmith.testcase.Testcase.FromFile(session, path)
-    files_to_delete.append(path)
-    logging.info('Imported testcase %s', path)
-    if time.time() - last_commit_time > 10:
-      session.commit()
-      if FLAGS.delete_after_import:
-        for path in files_to_delete:
-          path.unlink()
-      files_to_delete = []
-      last_commit_time = time.time()
-      logging.info('Committed database')
-  session.commit()
-  if FLAGS.delete_after_import:
-    for path in files_to_delete:
-      path.unlink()
+def _DirectoryPaths(directory: pathlib.Path) -> typing.List[pathlib.Path]:
+  if not directory.is_dir():
+    logging.fatal('directory %s does not exist', directory)
+  return sorted(directory.iterdir())
 
 
 def main(argv):
   del argv
   ds = datastore.DataStore.FromFlags()
-  with ds.Session(commit=True) as session:
-    last_commit_time = time.time()
-    for path in FLAGS.results:
-      deeplearning.deepsmith.result.Result.FromFile(session, pathlib.Path(path))
-      if time.time() - last_commit_time > 10:
-        session.commit()
-        last_commit_time = time.time()
-    if FLAGS.results_dir:
-      ImportResultsFromDirectory(session, pathlib.Path(FLAGS.results_dir))
-    for path in FLAGS.testcases:
-      deeplearning.deepsmith.testcase.Testcase.FromFile(
-          session, pathlib.Path(path))
-    session.commit()
-    if FLAGS.testcases_dir:
-      ImportTestcasesFromDirectory(session, pathlib.Path(FLAGS.testcases_dir))
+  with multiprocessing.Pool(FLAGS.import_processes) as pool:
+    with ds.Session() as session:
+      if FLAGS.results:
+        bulk_import.ImportResultFiles(
+            session, [pathlib.Path(path) for path in FLAGS.results],
+            batch_size=FLAGS.import_batch_size, pool=pool)
+      if FLAGS.results_dir:
+        count = bulk_import.ImportResultFiles(
+            session, _DirectoryPaths(pathlib.Path(FLAGS.results_dir)),
+            batch_size=FLAGS.import_batch_size,
+            delete_after_import=FLAGS.delete_after_import, pool=pool)
+        logging.info('Imported %d results', count)
+      if FLAGS.testcases:
+        bulk_import.ImportTestcaseFiles(
+            session, [pathlib.Path(path) for path in FLAGS.testcases],
+            batch_size=FLAGS.import_batch_size, pool=pool)
+      if FLAGS.testcases_dir:
+        count = bulk_import.ImportTestcaseFiles(
+            session, _DirectoryPaths(pathlib.Path(FLAGS.testcases_dir)),
+            batch_size=FLAGS.import_batch_size,
+            delete_after_import=FLAGS.delete_after_import, pool=pool)
+        logging.info('Imported %d testcases', count)
 
 
 if __name__ == '__main__':
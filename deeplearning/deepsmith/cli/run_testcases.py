@@ -1,5 +1,7 @@
-import collections
+import threading
+import time
 import typing
+from concurrent import futures
 
 from absl import app
 from absl import flags
@@ -29,6 +31,9 @@ flags.DEFINE_integer(
 flags.DEFINE_integer(
     'harness_batch_size', 100,
     'The number of results to collect in each batch.')
+flags.DEFINE_integer(
+    'num_concurrent_testbeds', 1,
+    'The number of testbeds to run testcases on concurrently.')
 
 
 def GetHarnessCapabilities(
@@ -41,13 +46,28 @@ def GetHarnessCapabilities(
   return response
 
 
-def GetNumberOfResultsForTestbed(
+def GetNumberOfTestcases(
     datastore_stub: datastore_pb2_grpc.DataStoreServiceStub,
     harness: deepsmith_pb2.Harness,
-    testbed: deepsmith_pb2.Testbed) -> int:
-  request = services.BuildDefaultRequest(datastore_pb2.GetResultsRequest)
+    testbed: deepsmith_pb2.Testbed,
+    include_testcases_with_results: bool = True) -> int:
+  """Return the number of testcases for a harness and testbed.
+
+  Args:
+    datastore_stub: The datastore service.
+    harness: The harness of the testcases.
+    testbed: The testbed.
+    include_testcases_with_results: If False, only testcases which do not
+      have a result on the testbed are counted.
+
+  Returns:
+    The number of testcases.
+  """
+  request = services.BuildDefaultRequest(datastore_pb2.GetTestcasesRequest)
   request.return_total_matching_count = True
-  request.return_results = False
+  request.return_testcases = False
+  request.include_testcases_with_results = include_testcases_with_results
+  request.include_testcases_with_pending_results = True
   request.toolchain = testbed.toolchain
   request.harness.CopyFrom(harness)
   request.testbed.CopyFrom(testbed)
@@ -56,36 +76,41 @@ def GetNumberOfResultsForTestbed(
   return response.total_matching_count
 
 
-def GetNumberOfTestcases(
+def GetNumberOfResultsForTestbed(
     datastore_stub: datastore_pb2_grpc.DataStoreServiceStub,
     harness: deepsmith_pb2.Harness,
     testbed: deepsmith_pb2.Testbed) -> int:
-  request = services.BuildDefaultRequest(datastore_pb2.GetTestcasesRequest)
-  request.return_total_matching_count = True
-  request.return_testcases = False
-  request.mark_pending_results = False
-  request.include_testcases_with_results = True
-  request.include_testcases_with_pending_results = True
-  request.toolchain = testbed.toolchain
-  request.harness.CopyFrom(harness)
-  response = datastore_stub.GetTestcases(request)
-  services.AssertResponseStatus(response.status)
-  return response.total_matching_count
+  """Return the number of testcases with results on a testbed."""
+  return (GetNumberOfTestcases(datastore_stub, harness, testbed) -
+          GetNumberOfTestcases(datastore_stub, harness, testbed,
+                               include_testcases_with_results=False))
+
+
+def GetNumberOfResultsToCollect(
+    datastore_stub: datastore_pb2_grpc.DataStoreServiceStub,
+    harness: deepsmith_pb2.Harness,
+    testbed: deepsmith_pb2.Testbed,
+    target_total_results: int) -> typing.Optional[int]:
+  """Return the number of results left to collect for a testbed.
+
+  Returns:
+    The number of results, or None if results should be collected for all
+    testcases.
+  """
+  if target_total_results < 0:
+    return None
+  total_testcases = GetNumberOfTestcases(datastore_stub, harness, testbed)
+  testcases_without_results = GetNumberOfTestcases(
+      datastore_stub, harness, testbed, include_testcases_with_results=False)
+  total_results = total_testcases - testcases_without_results
+  return max(min(target_total_results, total_testcases) - total_results, 0)
 
 
 def GetTestcasesToRun(
     datastore_stub: datastore_pb2_grpc.DataStoreServiceStub,
     harness: deepsmith_pb2.Harness,
     testbed: deepsmith_pb2.Testbed,
-    target_total_results: int,
     batch_size: int) -> typing.List[deepsmith_pb2.Testcase]:
-  if target_total_results >= 0:
-    total_results = GetNumberOfResultsForTestbed(
-        datastore_stub, harness, testbed)
-    total_testcases = GetNumberOfTestcases(
-        datastore_stub, harness, testbed)
-    batch_size = min(batch_size, total_results - total_testcases)
-
   request = services.BuildDefaultRequest(datastore_pb2.GetTestcasesRequest)
   request.toolchain = testbed.toolchain
   request.harness.CopyFrom(harness)
@@ -115,10 +140,100 @@ def SubmitResults(
     results: typing.List[deepsmith_pb2.Result]) -> None:
   request = services.BuildDefaultRequest(datastore_pb2.SubmitResultsRequest)
   request.results.extend(results)
-  response = datastore_stub.SubmitTestcases(request)
+  response = datastore_stub.SubmitResults(request)
   services.AssertResponseStatus(response.status)
 
 
+class HarnessUtilization(object):
+  """The time spent running testcases, as a fraction of wall time."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.busy_seconds = 0
+    self.wall_seconds = 0
+    self.num_results = 0
+
+  def Update(self, busy_seconds: float, wall_seconds: float,
+             num_results: int) -> None:
+    with self._lock:
+      self.busy_seconds += busy_seconds
+      self.wall_seconds += wall_seconds
+      self.num_results += num_results
+
+  @property
+  def ratio(self) -> float:
+    return self.busy_seconds / self.wall_seconds if self.wall_seconds else 0
+
+
+def RunTestcasesOnTestbed(
+    datastore_stub: datastore_pb2_grpc.DataStoreServiceStub,
+    harness_stub: harness_pb2_grpc.HarnessServiceStub,
+    harness: deepsmith_pb2.Harness,
+    testbed: deepsmith_pb2.Testbed,
+    target_total_results: int,
+    batch_size: int,
+    utilization: HarnessUtilization) -> None:
+  """Run testcases on a testbed until there are none left to run.
+
+  The next batch of testcases is requested while the current batch runs,
+  and results are submitted in the background while the next batch runs.
+  The datastore marks testcases pending on the testbed as it returns them,
+  so a prefetched batch never overlaps with the batch being run. The number
+  of results left to collect is requested once and then tracked locally.
+  """
+  start_time = time.time()
+  busy_seconds = 0
+  num_results = 0
+  remaining = GetNumberOfResultsToCollect(
+      datastore_stub, harness, testbed, target_total_results)
+
+  def NextBatch() -> typing.Optional[typing.Tuple[futures.Future, int]]:
+    nonlocal remaining
+    n = batch_size if remaining is None else min(batch_size, remaining)
+    if n <= 0:
+      return None
+    if remaining is not None:
+      remaining -= n
+    return executor.submit(
+        GetTestcasesToRun, datastore_stub, harness, testbed, n), n
+
+  with futures.ThreadPoolExecutor(max_workers=2) as executor:
+    next_batch = NextBatch()
+    submission = None
+    while next_batch:
+      batch, n = next_batch
+      testcases = batch.result()
+      logging.info(
+          'Received %d testcases to execute on %s', len(testcases),
+          testbed.name)
+      if not testcases:
+        break
+      # Return the count of any testcases requested but not received.
+      if remaining is not None:
+        remaining += n - len(testcases)
+      next_batch = NextBatch()
+
+      run_start_time = time.time()
+      results = RunTestcases(harness_stub, testbed, testcases)
+      busy_seconds += time.time() - run_start_time
+      num_results += len(results)
+
+      # Wait for the previous batch to be submitted before queuing the next,
+      # so that at most one batch of results is in flight.
+      if submission:
+        submission.result()
+      submission = executor.submit(SubmitResults, datastore_stub, results)
+    if submission:
+      submission.result()
+
+  wall_seconds = time.time() - start_time
+  utilization.Update(busy_seconds, wall_seconds, num_results)
+  logging.info(
+      'Collected %d results on %s in %.1f s, harness utilization %.1f%%',
+      num_results, testbed.name, wall_seconds,
+      100 * busy_seconds / wall_seconds if wall_seconds else 0)
+
+
 def main(argv):
   if len(argv) > 1:
     raise app.UsageError('Unrecognized arguments')
@@ -134,28 +249,24 @@ def main(argv):
   harness_stub = services.GetServiceStub(
       harness_config, harness_pb2_grpc.HarnessServiceStub)
 
-  target_total_results = FLAGS.target_total_results
-  harness_batch_size = FLAGS.harness_batch_size
+  if FLAGS.num_concurrent_testbeds <= 0:
+    raise app.UsageError('--num_concurrent_testbeds must be positive')
   capabilities = GetHarnessCapabilities(harness_stub)
-  testbeds = collections.deque(capabilities.testbeds)
-  if testbeds:
+  if capabilities.testbeds:
     logging.info('%d testbeds: %s', len(capabilities.testbeds),
                  ', '.join(x.name for x in capabilities.testbeds))
-    while testbeds:
-      testbed = testbeds.popleft()
-      testcases = GetTestcasesToRun(
-          datastore_stub, capabilities.harness, testbed, target_total_results,
-          harness_batch_size)
-      logging.info(
-          'Received %d testcases to execute on %s', len(testcases),
-          testbed.name)
-      if testcases:
-        results = RunTestcases(harness_stub, testbed, testcases)
-        SubmitResults(datastore_stub, results)
-        # If there are testcases to run, then we add it back to the testbeds
-        # queue, as there may be more.
-        testbeds.append(testbed)
-    logging.info('done')
+    utilization = HarnessUtilization()
+    with futures.ThreadPoolExecutor(
+        max_workers=FLAGS.num_concurrent_testbeds) as executor:
+      jobs = [executor.submit(
+          RunTestcasesOnTestbed, datastore_stub, harness_stub,
+          capabilities.harness, testbed, FLAGS.target_total_results,
+          FLAGS.harness_batch_size, utilization)
+        for testbed in capabilities.testbeds]
+      for job in futures.as_completed(jobs):
+        job.result()
+    logging.info('done. Collected %d results, harness utilization %.1f%%',
+                 utilization.num_results, 100 * utilization.ratio)
   else:
     logging.warning('No testbeds, nothing to do!')
 
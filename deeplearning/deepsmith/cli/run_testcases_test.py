@@ -0,0 +1,139 @@
+"""Tests for //deeplearning/deepsmith/cli:run_testcases."""
+import pathlib
+import sys
+import tempfile
+import threading
+
+import pytest
+from absl import app
+from absl import flags
+
+import deeplearning.deepsmith.result
+from deeplearning.deepsmith import datastore
+from deeplearning.deepsmith import services
+from deeplearning.deepsmith.cli import run_testcases
+from deeplearning.deepsmith.proto import datastore_pb2
+from deeplearning.deepsmith.proto import deepsmith_pb2
+from deeplearning.deepsmith.proto import harness_pb2
+
+
+FLAGS = flags.FLAGS
+
+HARNESS = deepsmith_pb2.Harness(name='harness')
+TESTBED = deepsmith_pb2.Testbed(toolchain='cpp', name='clang')
+
+
+@pytest.fixture(scope='function')
+def ds() -> datastore.DataStore:
+  """Create a file-backed SQLite datastore for testing.
+
+  Testcases are prefetched on a separate thread, which would not share an
+  in-memory database.
+  """
+  with tempfile.TemporaryDirectory(prefix='phd_deepsmith_') as d:
+    yield datastore.DataStore(datastore_pb2.DataStore(
+        testonly=True, sqlite=datastore_pb2.DataStore.Sqlite(
+            path=str(pathlib.Path(d) / 'datastore.db'))))
+
+
+class DataStoreStub(object):
+  """A datastore service stub which calls a DataStore directly."""
+
+  def __init__(self, ds: datastore.DataStore):
+    self.ds = ds
+
+  def GetTestcases(self, request: datastore_pb2.GetTestcasesRequest
+                   ) -> datastore_pb2.GetTestcasesResponse:
+    response = services.BuildDefaultResponse(
+        datastore_pb2.GetTestcasesResponse)
+    self.ds.GetTestcases(request, response)
+    return response
+
+  def SubmitResults(self, request: datastore_pb2.SubmitResultsRequest
+                    ) -> datastore_pb2.SubmitResultsResponse:
+    with self.ds.Session(commit=True) as session:
+      for result in request.results:
+        deeplearning.deepsmith.result.Result.GetOrAdd(session, result)
+    return services.BuildDefaultResponse(datastore_pb2.SubmitResultsResponse)
+
+
+class HarnessStub(object):
+  """A harness service stub which records the testcases it runs."""
+
+  def __init__(self):
+    self.srcs = []
+    self._lock = threading.Lock()
+
+  def RunTestcases(self, request: harness_pb2.RunTestcasesRequest
+                   ) -> harness_pb2.RunTestcasesResponse:
+    response = services.BuildDefaultResponse(harness_pb2.RunTestcasesResponse)
+    with self._lock:
+      self.srcs += [testcase.inputs['src'] for testcase in request.testcases]
+    response.results.extend([
+      deepsmith_pb2.Result(testcase=testcase, testbed=request.testbed,
+                           returncode=0, outcome=deepsmith_pb2.Result.PASS)
+      for testcase in request.testcases])
+    return response
+
+
+def _Testcase(i: int) -> deepsmith_pb2.Testcase:
+  return deepsmith_pb2.Testcase(
+      toolchain='cpp', generator=deepsmith_pb2.Generator(name='generator'),
+      harness=HARNESS, inputs={'src': f'int main() {{ return {i}; }}'})
+
+
+def _AddTestcases(ds: datastore.DataStore, n: int) -> None:
+  ds.SubmitTestcases(datastore_pb2.SubmitTestcasesRequest(
+      testcases=[_Testcase(i) for i in range(n)]),
+      datastore_pb2.SubmitTestcasesResponse())
+
+
+def _RunTestcases(ds: datastore.DataStore, harness_stub: HarnessStub,
+                  target_total_results: int) -> None:
+  run_testcases.RunTestcasesOnTestbed(
+      DataStoreStub(ds), harness_stub, HARNESS, TESTBED, target_total_results,
+      batch_size=3, utilization=run_testcases.HarnessUtilization())
+
+
+def test_RunTestcasesOnTestbed_all_testcases(ds):
+  """Test that every testcase is run once."""
+  _AddTestcases(ds, 10)
+  harness_stub = HarnessStub()
+  _RunTestcases(ds, harness_stub, target_total_results=-1)
+  assert sorted(harness_stub.srcs) == sorted(
+      _Testcase(i).inputs['src'] for i in range(10))
+
+
+def test_RunTestcasesOnTestbed_target_total_results(ds):
+  """Test that results are collected until the target is reached."""
+  _AddTestcases(ds, 10)
+  harness_stub = HarnessStub()
+  _RunTestcases(ds, harness_stub, target_total_results=4)
+  assert len(harness_stub.srcs) == 4
+  assert len(set(harness_stub.srcs)) == 4
+  # Existing results count towards the target.
+  _RunTestcases(ds, harness_stub, target_total_results=8)
+  assert len(set(harness_stub.srcs)) == 8
+  assert run_testcases.GetNumberOfResultsForTestbed(
+      DataStoreStub(ds), HARNESS, TESTBED) == 8
+
+
+def test_RunTestcasesOnTestbed_target_exceeds_testcases(ds):
+  """Test a target which is larger than the number of testcases."""
+  _AddTestcases(ds, 5)
+  harness_stub = HarnessStub()
+  _RunTestcases(ds, harness_stub, target_total_results=100)
+  assert len(harness_stub.srcs) == 5
+  assert len(set(harness_stub.srcs)) == 5
+
+
+def main(argv):
+  """Main entry point."""
+  if len(argv) > 1:
+    raise app.UsageError("Unknown arguments: '{}'.".format(' '.join(argv[1:])))
+  sys.exit(pytest.main([__file__, '-vv']))
+
+
+if __name__ == '__main__':
+  flags.FLAGS(['argv[0]'])
+  app.run(main)
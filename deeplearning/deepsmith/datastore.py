@@ -1,8 +1,13 @@
 """The datastore acts as the bridge between the RPC frontend and the db backend.
 """
 import contextlib
+import datetime
 import pathlib
+import threading
+import time
+import typing
 
+import sqlalchemy as sql
 from absl import flags
 from absl import logging
 from sqlalchemy import orm
@@ -13,23 +18,52 @@ import deeplearning.deepsmith.harness
 import deeplearning.deepsmith.result
 import deeplearning.deepsmith.testbed
 import deeplearning.deepsmith.testcase
-import deeplearning.deepsmith.testcase
 import deeplearning.deepsmith.toolchain
-import labm8.sqlutil
 from deeplearning.deepsmith import db
 from deeplearning.deepsmith.proto import datastore_pb2
 from deeplearning.deepsmith.proto import deepsmith_pb2
+from labm8 import labdate
 from labm8 import pbutil
 
 
 FLAGS = flags.FLAGS
 
+flags.DEFINE_integer(
+    'datastore_count_cache_seconds', 60,
+    'The maximum age of a cached testcase count returned for requests which '
+    'set approximate_total_matching_count.')
+flags.DEFINE_integer(
+    'datastore_pending_result_seconds', 3600,
+    'The number of seconds that a testcase issued to a testbed in '
+    'mark_results_pending is withheld from further requests for that testbed, '
+    'while its result is awaited.')
+
 
 class InvalidRequest(ValueError):
   """Exception raised if request cannot be served."""
   pass
 
 
+def _SelectIdByNameAndOpts(
+    session: db.session_t, table,
+    proto: typing.Union[deepsmith_pb2.Generator, deepsmith_pb2.Harness]
+) -> typing.Optional[int]:
+  """Look up the ID of a generator or harness, without adding it.
+
+  Args:
+    session: A database session.
+    table: The Generator or Harness table.
+    proto: The generator or harness to look up.
+
+  Returns:
+    The ID, or None if there is no such row.
+  """
+  row = session.query(table.id).filter(
+      table.name == proto.name,
+      table.optset_id == db.OptSetId(proto.opts)).first()
+  return row.id if row else None
+
+
 class DataStore(object):
   """ The centralized data store. """
 
@@ -39,6 +73,9 @@ class DataStore(object):
     db.Table.metadata.create_all(self._engine)
     db.Table.metadata.bind = self._engine
     self._make_session = orm.sessionmaker(bind=self._engine)
+    # A map from serialized request filters to <timestamp, count> tuples.
+    self._count_cache: typing.Dict[bytes, typing.Tuple[float, int]] = {}
+    self._count_cache_lock = threading.Lock()
 
   @classmethod
   def FromFile(cls, path: pathlib.Path) -> 'DataStore':
@@ -120,90 +157,174 @@ class DataStore(object):
     """
     deeplearning.deepsmith.testcase.Testcase.GetOrAdd(session, proto)
 
-  def _BuildTestcaseRequestQuery(self, session, request) -> db.query_t:
-    def _FilterToolchainGeneratorHarness(q):
-      if request.HasField('toolchain'):
-        toolchain = labm8.sqlutil.GetOrAdd(session,
-                                           deeplearning.deepsmith.toolchain.Toolchain,
-                                           name=request.toolchain)
-        if not toolchain:
-          raise LookupError
-        q = q.filter(
-            deeplearning.deepsmith.testcase.Testcase.toolchain_id == toolchain.id)
-
-      # Filter by generator.
-      if request.HasField('generator'):
-        generator = session.query(
-            deeplearning.deepsmith.generator.Generator).filter(
-            deeplearning.deepsmith.generator.Generator.name ==
-            request.generator.name,
-            deeplearning.deepsmith.generator.Generator.version ==
-            request.generator.version).first()
-        if not generator:
-          raise LookupError
-        q = q.filter(
-            deeplearning.deepsmith.testcase.Testcase.generator_id == generator.id)
-
-      # Filter by generator.
-      if request.has_harness:
-        harness = session.query(deeplearning.deepsmith.harness.Harness).filter(
-            deeplearning.deepsmith.harness.Harness.name == request.harness.name,
-            deeplearning.deepsmith.harness.Harness.version ==
-            request.harness.version).first()
-        if not harness:
-          raise LookupError
-        q = q.filter(
-            deeplearning.deepsmith.testcase.Testcase.harnessid == harness.id)
-
-      return q
-
-    q = session.query(deeplearning.deepsmith.testcase.Testcase)
-    q = _FilterToolchainGeneratorHarness(q)
-
-    testbed_id = None
+  def _BuildTestcaseRequestQuery(
+      self, session: db.session_t,
+      request: datastore_pb2.GetTestcasesRequest) -> db.query_t:
+    """Build the query for the testcases matching a request.
+
+    Testcases which already have results or unexpired pending results on the
+    requested testbed are excluded using NOT EXISTS anti-joins, which are
+    served by the unique (testcase_id, testbed_id) indexes of the results and
+    pending_results tables. The query is ordered by testcase ID, so that it
+    can be paginated by ID.
+
+    Args:
+      session: A database session.
+      request: The request.
+
+    Returns:
+      A query.
+    """
+    Testcase = deeplearning.deepsmith.testcase.Testcase
+
+    q = session.query(Testcase)
+
+    if request.HasField('toolchain'):
+      toolchain = deeplearning.deepsmith.toolchain.Toolchain.GetOrAdd(
+          session, request.toolchain)
+      q = q.filter(Testcase.toolchain_id == toolchain.id)
+
+    # Generators and harnesses are looked up without being added, since a
+    # read-only request should not modify the database. If there is no such
+    # generator or harness, then no testcases match.
+    if request.HasField('generator'):
+      generator_id = _SelectIdByNameAndOpts(
+          session, deeplearning.deepsmith.generator.Generator,
+          request.generator)
+      q = q.filter(Testcase.generator_id == generator_id
+                   if generator_id is not None else sql.false())
+
+    if request.HasField('harness'):
+      harness_id = _SelectIdByNameAndOpts(
+          session, deeplearning.deepsmith.harness.Harness, request.harness)
+      q = q.filter(Testcase.harness_id == harness_id
+                   if harness_id is not None else sql.false())
+
     if request.HasField('testbed'):
-      toolchain = labm8.sqlutil.GetOrAdd(session,
-                                         deeplearning.deepsmith.toolchain.Toolchain,
-                                         name=request.testbed)
-      testbed = labm8.sqlutil.GetOrAdd(session,
-                                       deeplearning.deepsmith.testbed.Testbed,
-                                       toolchain=toolchain,
-                                       name=request.testbed.toolchain,
-                                       version=request.testbed.version)
-      testbed_id = testbed.id
-
-    if testbed_id and not request.include_testcases_with_results:
-      q2 = session.query(deeplearning.deepsmith.result.Result.testcase_id).join(
-          deeplearning.deepsmith.testcase.Testcase).filter(
-          deeplearning.deepsmith.result.Result.testbed_id == testbed_id)
-      q2 = _FilterToolchainGeneratorHarness(q2)
-      q = q.filter(~deeplearning.deepsmith.testcase.Testcase.id.in_(q2))
-
-    if testbed_id and not request.include_testcases_with_pending_results:
-      q2 = session.query(
-          deeplearning.deepsmith.result.PendingResult.testcase_id).join(
-          deeplearning.deepsmith.testcase.Testcase).filter(
-          deeplearning.deepsmith.result.PendingResult.testbed_id == testbed_id)
-      q2 = _FilterToolchainGeneratorHarness(q2)
-      q = q.filter(~deeplearning.deepsmith.testcase.Testcase.id.in_(q2))
-
-    return q
+      testbed = deeplearning.deepsmith.testbed.Testbed.GetOrAdd(
+          session, request.testbed)
+      session.flush()
+
+      if not request.include_testcases_with_results:
+        Result = deeplearning.deepsmith.result.Result
+        q = q.filter(~sql.exists().where(sql.and_(
+            Result.testcase_id == Testcase.id,
+            Result.testbed_id == testbed.id)))
+
+      if not request.include_testcases_with_pending_results:
+        PendingResult = deeplearning.deepsmith.result.PendingResult
+        q = q.filter(~sql.exists().where(sql.and_(
+            PendingResult.testcase_id == Testcase.id,
+            PendingResult.testbed_id == testbed.id,
+            PendingResult.deadline > labdate.GetUtcMillisecondsNow())))
+
+    return q.order_by(Testcase.id)
+
+  def _CountTestcases(self, q: db.query_t,
+                      request: datastore_pb2.GetTestcasesRequest) -> int:
+    """Count the testcases matching a request.
+
+    If the request permits an approximate count, a count cached from an
+    earlier request with the same filters is returned, provided that it is
+    less than --datastore_count_cache_seconds old.
+
+    Args:
+      q: The query returned by _BuildTestcaseRequestQuery().
+      request: The request.
+
+    Returns:
+      The number of matching testcases.
+    """
+    if not request.approximate_total_matching_count:
+      return q.order_by(None).count()
+
+    # The cache key is the request with everything but the filters cleared.
+    key = datastore_pb2.GetTestcasesRequest()
+    key.CopyFrom(request)
+    for field in ('status', 'return_testcases', 'mark_results_pending',
+                  'max_num_testcases_to_return', 'return_total_matching_count',
+                  'page_token', 'approximate_total_matching_count'):
+      key.ClearField(field)
+    key = key.SerializeToString(deterministic=True)
+
+    now = time.time()
+    with self._count_cache_lock:
+      cached = self._count_cache.get(key)
+    if cached and now - cached[0] < FLAGS.datastore_count_cache_seconds:
+      return cached[1]
+
+    count = q.order_by(None).count()
+    with self._count_cache_lock:
+      self._count_cache[key] = (now, count)
+    return count
+
+  def _MarkResultsPending(
+      self, session: db.session_t,
+      testcases: typing.List[deeplearning.deepsmith.testcase.Testcase],
+      testbeds: typing.List[deepsmith_pb2.Testbed]) -> None:
+    """Record that testcases have been issued to testbeds.
+
+    A pending result is created for each testcase and testbed, with a deadline
+    of --datastore_pending_result_seconds from now. Expired pending results of
+    reissued testcases are renewed.
+
+    Args:
+      session: A database session.
+      testcases: The testcases which were issued.
+      testbeds: The testbeds which the testcases were issued to.
+    """
+    PendingResult = deeplearning.deepsmith.result.PendingResult
+    deadline = labdate.GetUtcMillisecondsNow() + datetime.timedelta(
+        seconds=FLAGS.datastore_pending_result_seconds)
+    testcase_ids = [testcase.id for testcase in testcases]
+    for proto in testbeds:
+      testbed = deeplearning.deepsmith.testbed.Testbed.GetOrAdd(session, proto)
+      session.flush()
+      expired = {pending.testcase_id: pending for pending in session.query(
+          PendingResult).filter(PendingResult.testbed_id == testbed.id,
+                                PendingResult.testcase_id.in_(testcase_ids))}
+      for testcase_id in testcase_ids:
+        if testcase_id in expired:
+          expired[testcase_id].deadline = deadline
+        else:
+          session.add(PendingResult(testcase_id=testcase_id,
+                                    testbed_id=testbed.id, deadline=deadline))
 
   def GetTestcases(self, request: datastore_pb2.GetTestcasesRequest,
                    response: datastore_pb2.GetTestcasesResponse) -> None:
-    """Request testcases."""
-    with self.Session(commit=False) as session:
-      # Validate request parameters.
-      if request.max_num_testcases < 1:
-        raise InvalidRequest(
-            f'max_num_testcases must be >= 1, not {request.max_num_testcases}')
+    """Request testcases.
+
+    Testcases are returned in order of ID. If the number of testcases returned
+    is max_num_testcases_to_return, response.next_page_token is set, and may
+    be used as the page_token of a subsequent request to continue from the
+    last testcase returned.
+
+    The returned testcases are marked pending on each testbed in
+    request.mark_results_pending, so that they are not returned again for
+    those testbeds until their results are received or the pending results
+    expire.
+    """
+    # Validate request parameters.
+    if request.max_num_testcases_to_return < 1:
+      raise InvalidRequest(
+          f'max_num_testcases_to_return must be >= 1, not '
+          f'{request.max_num_testcases_to_return}')
 
+    with self.Session(commit=bool(request.mark_results_pending)) as session:
       q = self._BuildTestcaseRequestQuery(session, request)
-      q.limit(request.max_num_testcases)
 
       if request.return_testcases:
-        response.testcases = [testcase.ToProto() for testcase in q]
+        page = q
+        if request.page_token:
+          page = page.filter(
+              deeplearning.deepsmith.testcase.Testcase.id > request.page_token)
+        testcases = page.limit(request.max_num_testcases_to_return).all()
+        response.testcases.extend(testcase.ToProto() for testcase in testcases)
+        if request.mark_results_pending:
+          self._MarkResultsPending(session, testcases,
+                                   request.mark_results_pending)
+        if len(testcases) == request.max_num_testcases_to_return:
+          response.next_page_token = testcases[-1].id
 
       if request.return_total_matching_count:
-        q2 = self._BuildTestcaseRequestQuery(session, request)
-        response.total_matching_count = q2.count()
+        response.total_matching_count = self._CountTestcases(q, request)
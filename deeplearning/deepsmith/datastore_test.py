@@ -0,0 +1,183 @@
+"""Tests for //deeplearning/deepsmith:datastore."""
+import sys
+
+import pytest
+from absl import app
+from absl import flags
+
+import deeplearning.deepsmith.generator
+import deeplearning.deepsmith.harness
+import deeplearning.deepsmith.result
+from deeplearning.deepsmith import datastore
+from deeplearning.deepsmith.proto import datastore_pb2
+from deeplearning.deepsmith.proto import deepsmith_pb2
+
+
+FLAGS = flags.FLAGS
+
+
+def _Testcase(i: int) -> deepsmith_pb2.Testcase:
+  return deepsmith_pb2.Testcase(
+      toolchain='cpp',
+      generator=deepsmith_pb2.Generator(name='generator'),
+      harness=deepsmith_pb2.Harness(name='harness'),
+      inputs={'src': f'int main() {{ return {i}; }}'},
+  )
+
+
+def _Testbed() -> deepsmith_pb2.Testbed:
+  return deepsmith_pb2.Testbed(toolchain='cpp', name='clang')
+
+
+def _AddTestcases(ds: datastore.DataStore, n: int) -> None:
+  request = datastore_pb2.SubmitTestcasesRequest(
+      testcases=[_Testcase(i) for i in range(n)])
+  ds.SubmitTestcases(request, datastore_pb2.SubmitTestcasesResponse())
+
+
+def _AddResult(ds: datastore.DataStore, i: int) -> None:
+  with ds.Session(commit=True) as session:
+    deeplearning.deepsmith.result.Result.GetOrAdd(
+        session, deepsmith_pb2.Result(
+            testcase=_Testcase(i),
+            testbed=_Testbed(),
+            returncode=0,
+            outputs={'stdout': str(i)},
+            outcome=deepsmith_pb2.Result.PASS,
+        ))
+
+
+def _Request(**kwargs) -> datastore_pb2.GetTestcasesRequest:
+  return datastore_pb2.GetTestcasesRequest(
+      toolchain='cpp',
+      harness=deepsmith_pb2.Harness(name='harness'),
+      testbed=_Testbed(),
+      **kwargs)
+
+
+def _GetTestcases(ds: datastore.DataStore,
+                  request: datastore_pb2.GetTestcasesRequest
+                  ) -> datastore_pb2.GetTestcasesResponse:
+  response = datastore_pb2.GetTestcasesResponse()
+  ds.GetTestcases(request, response)
+  return response
+
+
+def test_GetTestcases_invalid_max_num_testcases_to_return(ds):
+  with pytest.raises(datastore.InvalidRequest):
+    _GetTestcases(ds, _Request(max_num_testcases_to_return=0))
+
+
+def test_GetTestcases_limit(ds):
+  _AddTestcases(ds, 5)
+  response = _GetTestcases(ds, _Request(max_num_testcases_to_return=2))
+  assert len(response.testcases) == 2
+  assert response.next_page_token
+
+
+def test_GetTestcases_pagination(ds):
+  _AddTestcases(ds, 5)
+  request = _Request(max_num_testcases_to_return=2)
+  srcs = []
+  while True:
+    response = _GetTestcases(ds, request)
+    srcs += [testcase.inputs['src'] for testcase in response.testcases]
+    if not response.next_page_token:
+      break
+    request.page_token = response.next_page_token
+  assert sorted(srcs) == sorted(_Testcase(i).inputs['src'] for i in range(5))
+
+
+def test_GetTestcases_excludes_testcases_with_results(ds):
+  _AddTestcases(ds, 3)
+  _AddResult(ds, 1)
+  response = _GetTestcases(ds, _Request(return_total_matching_count=True))
+  assert response.total_matching_count == 2
+  assert _Testcase(1).inputs['src'] not in [
+    testcase.inputs['src'] for testcase in response.testcases]
+
+
+def test_GetTestcases_include_testcases_with_results(ds):
+  _AddTestcases(ds, 3)
+  _AddResult(ds, 1)
+  response = _GetTestcases(ds, _Request(
+      return_total_matching_count=True, include_testcases_with_results=True))
+  assert response.total_matching_count == 3
+  assert len(response.testcases) == 3
+
+
+def test_GetTestcases_approximate_total_matching_count(ds):
+  _AddTestcases(ds, 3)
+  request = _Request(return_testcases=False, return_total_matching_count=True,
+                     approximate_total_matching_count=True)
+  assert _GetTestcases(ds, request).total_matching_count == 3
+  _AddResult(ds, 1)
+  # The cached count is returned.
+  assert _GetTestcases(ds, request).total_matching_count == 3
+  request.approximate_total_matching_count = False
+  assert _GetTestcases(ds, request).total_matching_count == 2
+
+
+def test_GetTestcases_mark_results_pending(ds):
+  """Test that testcases marked pending are not returned again."""
+  _AddTestcases(ds, 3)
+  first = _GetTestcases(ds, _Request(max_num_testcases_to_return=2,
+                                     mark_results_pending=[_Testbed()]))
+  second = _GetTestcases(ds, _Request(mark_results_pending=[_Testbed()]))
+  assert len(first.testcases) == 2
+  assert len(second.testcases) == 1
+  assert second.testcases[0] not in first.testcases
+  response = _GetTestcases(ds, _Request(
+      include_testcases_with_pending_results=True))
+  assert len(response.testcases) == 3
+  with ds.Session() as session:
+    assert session.query(
+        deeplearning.deepsmith.result.PendingResult).count() == 3
+
+
+def test_GetTestcases_expired_pending_results(ds):
+  """Test that testcases are reissued once their pending results expire."""
+  _AddTestcases(ds, 2)
+  FLAGS.datastore_pending_result_seconds = -1
+  try:
+    _GetTestcases(ds, _Request(mark_results_pending=[_Testbed()]))
+  finally:
+    FLAGS.datastore_pending_result_seconds = 3600
+  response = _GetTestcases(ds, _Request(mark_results_pending=[_Testbed()]))
+  assert len(response.testcases) == 2
+  # The expired pending results were renewed.
+  assert len(_GetTestcases(ds, _Request()).testcases) == 0
+
+
+def test_GetTestcases_unknown_harness(ds):
+  """Test that a request for an unknown harness does not add it."""
+  _AddTestcases(ds, 3)
+  request = _Request(return_total_matching_count=True)
+  request.harness.name = 'unknown'
+  request.generator.name = 'unknown'
+  response = _GetTestcases(ds, request)
+  assert response.total_matching_count == 0
+  assert not response.testcases
+  with ds.Session() as session:
+    assert session.query(deeplearning.deepsmith.harness.Harness).count() == 1
+    assert session.query(
+        deeplearning.deepsmith.generator.Generator).count() == 1
+
+
+def test_benchmark_GetTestcases(ds, benchmark):
+  _AddTestcases(ds, 1000)
+  for i in range(0, 1000, 2):
+    _AddResult(ds, i)
+  request = _Request(max_num_testcases_to_return=100,
+                     return_total_matching_count=True)
+  response = benchmark(_GetTestcases, ds, request)
+  assert response.total_matching_count == 500
+
+
+def main(argv):  # pylint: disable=missing-docstring
+  del argv
+  sys.exit(pytest.main([__file__, '-v']))
+
+
+if __name__ == '__main__':
+  app.run(main)
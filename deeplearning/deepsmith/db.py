@@ -1,7 +1,9 @@
 """Database backend.
 """
 import datetime
+import hashlib
 import pathlib
+import typing
 
 import sqlalchemy as sql
 from absl import flags
@@ -48,6 +50,23 @@ class InvalidInputError(ValueError):
   pass
 
 
+def OptSetId(opts: typing.Mapping[str, str]) -> bytes:
+  """Compute the ID of a set of options.
+
+  The ID is the MD5 of the <name, value> pairs, in order of name.
+
+  Args:
+    opts: A map from option name to value.
+
+  Returns:
+    An MD5 digest.
+  """
+  md5 = hashlib.md5()
+  for name in sorted(opts):
+    md5.update((name + opts[name]).encode('utf-8'))
+  return md5.digest()
+
+
 class StringTooLongError(ValueError):
   def __init__(self, column_name: str, string: str, max_len: int):
     self.column_name = column_name
@@ -0,0 +1,176 @@
+"""Vectorized differential testing of (testcase x testbed) result matrices.
+
+Results are represented as a pair of matrices with one row per testcase and
+one column per testbed: an outcome matrix of Result.Outcome values, and an
+output matrix of integer output hashes. Missing results are marked with
+MISSING in both matrices.
+"""
+import typing
+
+import numpy as np
+
+from deeplearning.deepsmith.difftests import difftests
+from deeplearning.deepsmith.proto import deepsmith_pb2
+
+
+# The value of a missing result in outcome and output matrices.
+MISSING = -1
+
+# The number of Result.Outcome values.
+_NUM_OUTCOMES = len(deepsmith_pb2.Result.Outcome.values())
+
+
+class _OutputsAreEqualPlaceholder(difftests.OutputsEqualityTest):
+  """An outputs equality test which is always true.
+
+  This is used to build the outcome table, in which the PASS/PASS entry is
+  resolved by comparing output hashes.
+  """
+
+  def __call__(self, results: typing.List[deepsmith_pb2.Result]) -> bool:
+    return True
+
+
+def _GoldStandardOutcomeTable() -> np.ndarray:
+  """Tabulate GoldStandardDiffTester.DiffTestOne() for every outcome pair.
+
+  Returns:
+    An array of shape (num outcomes, num outcomes), indexed by the gold
+    standard outcome and the result outcome.
+  """
+  tester = difftests.GoldStandardDiffTester(_OutputsAreEqualPlaceholder())
+  table = np.zeros((_NUM_OUTCOMES, _NUM_OUTCOMES), dtype=np.int32)
+  for gs_outcome in range(_NUM_OUTCOMES):
+    for outcome in range(_NUM_OUTCOMES):
+      table[gs_outcome, outcome] = tester.DiffTestOne(
+          deepsmith_pb2.Result(outcome=gs_outcome),
+          deepsmith_pb2.Result(outcome=outcome))
+  return table
+
+
+_GOLD_STANDARD_OUTCOME_TABLE = _GoldStandardOutcomeTable()
+
+
+def ResultMatrices(testcase_ids: np.ndarray, testbed_ids: np.ndarray,
+                   *values: np.ndarray) -> typing.List[np.ndarray]:
+  """Build (testcase x testbed) matrices from flat arrays of results.
+
+  Args:
+    testcase_ids: The testcase of each result.
+    testbed_ids: The testbed of each result.
+    values: Integer arrays of per-result values, e.g. outcomes and output
+      hashes.
+
+  Returns:
+    A list of the unique testcase IDs (the matrix rows), the unique testbed
+    IDs (the matrix columns), and one matrix for each of the values arrays.
+  """
+  testcases, rows = np.unique(testcase_ids, return_inverse=True)
+  testbeds, cols = np.unique(testbed_ids, return_inverse=True)
+  matrices = []
+  for value in values:
+    value_matrix = np.full((len(testcases), len(testbeds)), MISSING,
+                           dtype=np.int64)
+    value_matrix[rows, cols] = value
+    matrices.append(value_matrix)
+  return [testcases, testbeds] + matrices
+
+
+def MajorityVote(matrix: np.ndarray
+                 ) -> typing.Tuple[np.ndarray, np.ndarray]:
+  """Find the most common value of each row of a matrix.
+
+  Missing values are ignored. Ties are broken in favour of the smallest
+  value.
+
+  Args:
+    matrix: A matrix of integer values.
+
+  Returns:
+    A tuple of two arrays with one element per row: the majority value, and
+    the number of times it occurs. Rows without values have majority value
+    MISSING and size 0.
+  """
+  num_rows = matrix.shape[0]
+  rows, cols = np.nonzero(matrix != MISSING)
+  values = matrix[rows, cols]
+
+  # Count the occurrences of each unique (row, value) pair.
+  order = np.lexsort((values, rows))
+  rows, values = rows[order], values[order]
+  is_start = np.ones(len(rows), dtype=np.bool_)
+  is_start[1:] = (rows[1:] != rows[:-1]) | (values[1:] != values[:-1])
+  starts = np.flatnonzero(is_start)
+  counts = np.diff(np.append(starts, len(rows)))
+  rows, values = rows[starts], values[starts]
+
+  # Select the most frequent, then smallest, value of each row.
+  order = np.lexsort((values, -counts, rows))
+  rows, values, counts = rows[order], values[order], counts[order]
+  first = np.ones(len(rows), dtype=np.bool_)
+  first[1:] = rows[1:] != rows[:-1]
+
+  majority = np.full(num_rows, MISSING, dtype=matrix.dtype)
+  majority_size = np.zeros(num_rows, dtype=np.int32)
+  majority[rows[first]] = values[first]
+  majority_size[rows[first]] = counts[first]
+  return majority, majority_size
+
+
+def GoldStandardDiffTest(gs_outcomes: np.ndarray, gs_outputs: np.ndarray,
+                         outcome_matrix: np.ndarray,
+                         output_matrix: np.ndarray) -> np.ndarray:
+  """Difftest a matrix of results against a gold standard per row.
+
+  This is equivalent to calling GoldStandardDiffTester.DiffTestOne() for
+  every result, where outputs are equal iff their hashes are equal.
+
+  Args:
+    gs_outcomes: The gold standard outcome of each row.
+    gs_outputs: The gold standard output hash of each row.
+    outcome_matrix: The outcome matrix.
+    output_matrix: The output matrix.
+
+  Returns:
+    A matrix of DifferentialTest.Outcome values. Missing results, and rows
+    with a missing gold standard, are DifferentialTest.UNKNOWN.
+  """
+  gs_outcomes = gs_outcomes[:, np.newaxis]
+  missing = (outcome_matrix == MISSING) | (gs_outcomes == MISSING)
+  difftest_outcomes = _GOLD_STANDARD_OUTCOME_TABLE[
+    np.where(missing, 0, gs_outcomes), np.where(missing, 0, outcome_matrix)]
+
+  wrong_output = ((gs_outcomes == deepsmith_pb2.Result.PASS) &
+                  (outcome_matrix == deepsmith_pb2.Result.PASS) &
+                  (output_matrix != gs_outputs[:, np.newaxis]))
+  difftest_outcomes[wrong_output] = (
+    deepsmith_pb2.DifferentialTest.ANOMALOUS_WRONG_OUTPUT)
+  difftest_outcomes[missing] = deepsmith_pb2.DifferentialTest.UNKNOWN
+  return difftest_outcomes
+
+
+def MajorityDiffTest(outcome_matrix: np.ndarray, output_matrix: np.ndarray,
+                     min_majority_size: int = 1) -> np.ndarray:
+  """Difftest a matrix of results against the majority of each row.
+
+  The majority outcome of each row is used as the gold standard outcome, and
+  the majority output of the results with that outcome as the gold standard
+  output.
+
+  Args:
+    outcome_matrix: The outcome matrix.
+    output_matrix: The output matrix.
+    min_majority_size: Rows with fewer results with the majority outcome than
+      this are not difftested.
+
+  Returns:
+    A matrix of DifferentialTest.Outcome values. Missing results, and rows
+    without a large enough majority, are DifferentialTest.UNKNOWN.
+  """
+  majority_outcomes, majority_sizes = MajorityVote(outcome_matrix)
+  majority_outcomes[majority_sizes < min_majority_size] = MISSING
+  majority_outputs, _ = MajorityVote(np.where(
+      outcome_matrix == majority_outcomes[:, np.newaxis], output_matrix,
+      MISSING))
+  return GoldStandardDiffTest(majority_outcomes, majority_outputs,
+                              outcome_matrix, output_matrix)
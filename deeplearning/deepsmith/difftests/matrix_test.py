@@ -0,0 +1,118 @@
+"""Unit tests for //deeplearning/deepsmith/difftests/matrix.py."""
+import sys
+
+import numpy as np
+import pytest
+from absl import app
+from absl import flags
+
+import deeplearning.deepsmith.difftests.difftests
+from deeplearning.deepsmith.difftests import matrix
+from deeplearning.deepsmith.proto import deepsmith_pb2
+
+
+FLAGS = flags.FLAGS
+
+DiffTest = deepsmith_pb2.DifferentialTest
+Result = deepsmith_pb2.Result
+
+
+def test_ResultMatrices():
+  testcases, testbeds, outcomes, outputs = matrix.ResultMatrices(
+      np.array([5, 5, 7]), np.array([1, 2, 2]),
+      np.array([Result.PASS, Result.BUILD_FAILURE, Result.PASS]),
+      np.array([10, 20, 30]))
+  assert testcases.tolist() == [5, 7]
+  assert testbeds.tolist() == [1, 2]
+  assert outcomes.tolist() == [
+    [Result.PASS, Result.BUILD_FAILURE],
+    [matrix.MISSING, Result.PASS],
+  ]
+  assert outputs.tolist() == [[10, 20], [matrix.MISSING, 30]]
+
+
+def test_MajorityVote():
+  majority, majority_size = matrix.MajorityVote(np.array([
+    [1, 1, 6, 6, matrix.MISSING],
+    [6, 6, 6, 1, matrix.MISSING],
+    [matrix.MISSING, matrix.MISSING, matrix.MISSING, matrix.MISSING,
+     matrix.MISSING],
+    [3, 2, 2, 3, 5],
+  ]))
+  # Ties are broken in favour of the smallest value.
+  assert majority.tolist() == [1, 6, matrix.MISSING, 2]
+  assert majority_size.tolist() == [2, 3, 0, 2]
+
+
+def test_GoldStandardDiffTest_equivalent_to_DiffTestOne():
+  """Test that every pair of outcomes matches GoldStandardDiffTester."""
+  dt = deeplearning.deepsmith.difftests.difftests.GoldStandardDiffTester(
+      deeplearning.deepsmith.difftests.difftests.NamedOutputIsEqual('stdout'))
+  outcomes = Result.Outcome.values()
+  gs_outcomes = np.array(outcomes)
+  outcome_matrix = np.tile(outcomes, (len(outcomes), 1))
+  for output in ('a', 'b'):
+    difftests = matrix.GoldStandardDiffTest(
+        gs_outcomes, np.zeros(len(outcomes)), outcome_matrix,
+        np.full(outcome_matrix.shape, 0 if output == 'a' else 1))
+    for i, gs_outcome in enumerate(outcomes):
+      for j, outcome in enumerate(outcomes):
+        assert difftests[i, j] == dt.DiffTestOne(
+            Result(outcome=gs_outcome, outputs={'stdout': 'a'}),
+            Result(outcome=outcome, outputs={'stdout': output}))
+
+
+def test_GoldStandardDiffTest_missing():
+  difftests = matrix.GoldStandardDiffTest(
+      np.array([Result.PASS, matrix.MISSING]), np.array([0, 0]),
+      np.array([[matrix.MISSING, Result.PASS], [Result.PASS, Result.PASS]]),
+      np.array([[matrix.MISSING, 0], [0, 0]]))
+  assert difftests.tolist() == [
+    [DiffTest.UNKNOWN, DiffTest.PASS],
+    [DiffTest.UNKNOWN, DiffTest.UNKNOWN],
+  ]
+
+
+def test_MajorityDiffTest():
+  difftests = matrix.MajorityDiffTest(
+      np.array([
+        [Result.PASS, Result.PASS, Result.PASS, Result.RUNTIME_CRASH],
+        [Result.BUILD_FAILURE, Result.BUILD_FAILURE, Result.PASS,
+         Result.BUILD_CRASH],
+      ]),
+      np.array([
+        [1, 1, 2, 3],
+        [0, 0, 4, 0],
+      ]))
+  assert difftests.tolist() == [
+    [DiffTest.PASS, DiffTest.PASS, DiffTest.ANOMALOUS_WRONG_OUTPUT,
+     DiffTest.ANOMALOUS_RUNTIME_CRASH],
+    [DiffTest.PASS, DiffTest.PASS, DiffTest.ANOMALOUS_BUILD_PASS,
+     DiffTest.ANOMALOUS_BUILD_FAILURE],
+  ]
+
+
+def test_MajorityDiffTest_min_majority_size():
+  difftests = matrix.MajorityDiffTest(
+      np.array([[Result.PASS, Result.PASS, Result.RUNTIME_CRASH]]),
+      np.array([[1, 1, 0]]), min_majority_size=3)
+  assert difftests.tolist() == [
+    [DiffTest.UNKNOWN, DiffTest.UNKNOWN, DiffTest.UNKNOWN]]
+
+
+def test_benchmark_MajorityDiffTest(benchmark):
+  outcomes = np.random.randint(0, 7, (10000, 20))
+  outputs = np.random.randint(0, 3, (10000, 20))
+  benchmark(matrix.MajorityDiffTest, outcomes, outputs)
+
+
+def main(argv):
+  """Main entry point."""
+  if len(argv) > 1:
+    raise app.UsageError("Unknown arguments: '{}'.".format(' '.join(argv[1:])))
+  sys.exit(pytest.main([__file__, '-vv']))
+
+
+if __name__ == '__main__':
+  flags.FLAGS(['argv[0]', '-v=1'])
+  app.run(main)
@@ -1,7 +1,6 @@
 """This file defines the testcase generator."""
 import binascii
 import datetime
-import hashlib
 import typing
 
 import sqlalchemy as sql
@@ -87,12 +86,10 @@ class Generator(db.Table):
   def GetOrAdd(cls, session: db.session_t,
                proto: deepsmith_pb2.Generator) -> 'Generator':
 
-    # Build the list of options, and md5sum the key value strings.
+    # Build the list of options.
     opts = []
-    md5 = hashlib.md5()
     for proto_opt_name in sorted(proto.opts):
       proto_opt_value = proto.opts[proto_opt_name]
-      md5.update((proto_opt_name + proto_opt_value).encode('utf-8'))
       opt = labm8.sqlutil.GetOrAdd(session, GeneratorOpt,
                                    name=GeneratorOptName.GetOrAdd(
                                        session,
@@ -103,7 +100,7 @@ class Generator(db.Table):
       opts.append(opt)
 
     # Create optset table entries.
-    optset_id = md5.digest()
+    optset_id = db.OptSetId(proto.opts)
     for opt in opts:
       labm8.sqlutil.GetOrAdd(session, GeneratorOptSet, id=optset_id,
                              opt=opt)
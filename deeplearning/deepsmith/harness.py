@@ -1,7 +1,6 @@
 """This file implements the testcase harness."""
 import binascii
 import datetime
-import hashlib
 import typing
 
 import sqlalchemy as sql
@@ -88,12 +87,10 @@ class Harness(db.Table):
   def GetOrAdd(cls, session: db.session_t,
                proto: deepsmith_pb2.Harness) -> 'Harness':
 
-    # Build the list of options, and md5sum the key value strings.
+    # Build the list of options.
     opts = []
-    md5 = hashlib.md5()
     for proto_opt_name in sorted(proto.opts):
       proto_opt_value = proto.opts[proto_opt_name]
-      md5.update((proto_opt_name + proto_opt_value).encode('utf-8'))
       opt = labm8.sqlutil.GetOrAdd(session, HarnessOpt,
                                    name=HarnessOptName.GetOrAdd(session,
                                                                 proto_opt_name),
@@ -103,7 +100,7 @@ class Harness(db.Table):
       opts.append(opt)
 
     # Create optset table entries.
-    optset_id = md5.digest()
+    optset_id = db.OptSetId(proto.opts)
     for opt in opts:
       labm8.sqlutil.GetOrAdd(session, HarnessOptSet, id=optset_id,
                              opt=opt)
@@ -4,11 +4,15 @@ import datetime
 import hashlib
 import pathlib
 import typing
+import zlib
 
 import sqlalchemy as sql
+import zstandard
+from absl import flags
 from sqlalchemy import orm
 from sqlalchemy.dialects import mysql
 
+import deeplearning.deepsmith.harness
 import deeplearning.deepsmith.testbed
 import deeplearning.deepsmith.testcase
 import labm8.sqlutil
@@ -18,12 +22,21 @@ from deeplearning.deepsmith.proto import deepsmith_pb2
 from labm8 import labdate, pbutil
 
 
+FLAGS = flags.FLAGS
+
+flags.DEFINE_bool(
+    'compress_result_outputs', False,
+    'If set, new result output values are stored as zstd-compressed, '
+    'deduplicated chunks.')
+
 # The index types for tables defined in this file.
 _ResultId = sql.Integer
 _ResultOutputSetId = sql.Binary(16).with_variant(mysql.BINARY(16), 'mysql')
 _ResultOutputId = sql.Integer
 _ResultOutputNameId = db.StringTable.id_t
 _ResultOutputValueId = sql.Integer
+_ResultOutputChunkId = sql.Integer
+_ResultOutputDictionaryId = sql.Integer
 
 
 class Result(db.Table):
@@ -76,7 +89,7 @@ class Result(db.Table):
     Returns:
       A map of result outputs.
     """
-    return {output.name.string: output.value.truncated_value for output in
+    return {output.name.string: output.value.string for output in
             self.outputset}
 
   def SetProto(self, proto: deepsmith_pb2.Result) -> deepsmith_pb2.Result:
@@ -92,7 +105,7 @@ class Result(db.Table):
     self.testbed.SetProto(proto.testbed)
     proto.returncode = self.returncode
     for output in self.outputset:
-      proto.outputs[output.name.string] = output.value.truncated_value
+      proto.outputs[output.name.string] = output.value.string
     for event in self.profiling_events:
       event_proto = proto.profiling_events.add()
       event.SetProto(event_proto)
@@ -123,6 +136,12 @@ class Result(db.Table):
     if result:
       return result
 
+    compress = FLAGS.compress_result_outputs
+    dictionary = None
+    if compress:
+      dictionary = session.query(ResultOutputDictionary).filter(
+          ResultOutputDictionary.harness == testcase.harness).first()
+
     # Build the list of outputs, and md5sum the key value strings.
     outputs = []
     md5 = hashlib.md5()
@@ -132,7 +151,9 @@ class Result(db.Table):
       output = labm8.sqlutil.GetOrAdd(
           session, ResultOutput,
           name=ResultOutputName.GetOrAdd(session, string=proto_output_name),
-          value=ResultOutputValue.GetOrAdd(session, string=proto_output_value))
+          value=ResultOutputValue.GetOrAdd(
+              session, string=proto_output_value, compress=compress,
+              dictionary=dictionary))
       outputs.append(output)
 
     # Create output set table entries.
@@ -268,6 +289,12 @@ class ResultOutputName(db.StringTable):
 
 
 class ResultOutputValue(db.Table):
+  """The value of a result output.
+
+  Values are stored either as text in the truncated_value column, or, if
+  compressed, as an ordered list of zstd-compressed chunks. The string
+  property returns the value regardless of how it is stored.
+  """
   id_t = _ResultOutputValueId
   __tablename__ = 'result_output_values'
 
@@ -285,9 +312,17 @@ class ResultOutputValue(db.Table):
       index=True, unique=True)
   original_linecount = sql.Column(sql.Integer, nullable=False)
   original_charcount = sql.Column(sql.Integer, nullable=False)
+  # NULL if the value is compressed. Databases created before values could
+  # be compressed have a NOT NULL column, which create_all() does not change.
+  # They must be altered before compressed values are stored:
+  #   MySQL:      ALTER TABLE result_output_values
+  #                 MODIFY truncated_value TEXT(128000) NULL;
+  #   PostgreSQL: ALTER TABLE result_output_values
+  #                 ALTER COLUMN truncated_value DROP NOT NULL;
+  # SQLite cannot alter a column, so the table must be copied into a new one.
   truncated_value: str = sql.Column(
       sql.UnicodeText().with_variant(sql.UnicodeText(max_len), 'mysql'),
-      nullable=False)
+      nullable=True)
   truncated: bool = sql.Column(sql.Boolean, nullable=False)
   truncated_md5: bytes = sql.Column(
       sql.Binary(16).with_variant(mysql.BINARY(16), 'mysql'), nullable=False)
@@ -297,17 +332,30 @@ class ResultOutputValue(db.Table):
   # Relationships.
   outputs: typing.List[ResultOutput] = orm.relationship(ResultOutput,
                                                         back_populates='value')
+  chunks: typing.List['ResultOutputValueChunk'] = orm.relationship(
+      'ResultOutputValueChunk', order_by='ResultOutputValueChunk.position')
+
+  @property
+  def string(self) -> str:
+    """Get the (possibly truncated) value.
+
+    Returns:
+      The value, decompressed if required.
+    """
+    if self.truncated_value is not None:
+      return self.truncated_value
+    return b''.join(
+        chunk.chunk.Decompress() for chunk in self.chunks).decode('utf-8')
 
   @classmethod
-  def GetOrAdd(cls, session: db.session_t, string: str) -> 'ResultOutputValue':
-    """Instantiate a ResultOutputValue entry from a string.
+  def ColumnValues(cls, string: str) -> typing.Dict[str, typing.Any]:
+    """Compute the column values of an uncompressed entry for a string.
 
     Args:
-      session: A database session.
       string: The string.
 
     Returns:
-      A ResultOutputValue instance.
+      A map from column name to value.
     """
     original_charcount = len(string)
     original_linecount = string.count('\n')
@@ -328,19 +376,278 @@ class ResultOutputValue(db.Table):
       truncated_md5 = original_md5
       truncated_linecount = original_linecount
       truncated_charcount = original_charcount
-    return labm8.sqlutil.GetOrAdd(
-        session, cls,
-        original_md5=original_md5,
-        original_linecount=original_linecount,
-        original_charcount=original_charcount,
-        truncated=True if original_charcount > cls.max_len else False,
-        truncated_value=truncated,
-        truncated_md5=truncated_md5,
-        truncated_linecount=truncated_linecount,
-        truncated_charcount=truncated_charcount, )
+    return {
+      'original_md5': original_md5,
+      'original_linecount': original_linecount,
+      'original_charcount': original_charcount,
+      'truncated': True if original_charcount > cls.max_len else False,
+      'truncated_value': truncated,
+      'truncated_md5': truncated_md5,
+      'truncated_linecount': truncated_linecount,
+      'truncated_charcount': truncated_charcount,
+    }
+
+  @classmethod
+  def GetOrAdd(cls, session: db.session_t, string: str,
+               compress: bool = False,
+               dictionary: typing.Optional['ResultOutputDictionary'] = None
+               ) -> 'ResultOutputValue':
+    """Instantiate a ResultOutputValue entry from a string.
+
+    Args:
+      session: A database session.
+      string: The string.
+      compress: If True, a new value is stored as compressed chunks, else as
+        text. Existing values are returned regardless of how they are stored.
+      dictionary: The dictionary to compress new chunks with, if any.
+
+    Returns:
+      A ResultOutputValue instance.
+    """
+    values = cls.ColumnValues(string)
+    # The original MD5 is unique, so an existing value is found by it alone,
+    # whether it is stored as text or as compressed chunks.
+    value = session.query(cls).filter(
+        cls.original_md5 == values['original_md5']).first()
+    if value:
+      return value
+
+    if not compress:
+      value = cls(**values)
+      session.add(value)
+      return value
+
+    truncated = values.pop('truncated_value')
+    value = cls(
+        truncated_value=None,
+        chunks=[
+          ResultOutputValueChunk(
+              position=i,
+              chunk=ResultOutputChunk.GetOrAdd(session, data, dictionary))
+          for i, data in enumerate(SplitIntoChunks(truncated.encode('utf-8')))
+        ],
+        **values)
+    session.add(value)
+    return value
 
   def __repr__(self):
-    return self.truncated_value[:50] or ''
+    return self.string[:50] or ''
+
+
+class ResultOutputValueChunk(db.Table):
+  """The position of a chunk within a result output value."""
+  __tablename__ = 'result_output_value_chunks'
+
+  # Columns.
+  value_id: int = sql.Column(_ResultOutputValueId,
+                             sql.ForeignKey('result_output_values.id'),
+                             nullable=False)
+  position: int = sql.Column(sql.Integer, nullable=False)
+  chunk_id: int = sql.Column(_ResultOutputChunkId,
+                             sql.ForeignKey('result_output_chunks.id'),
+                             nullable=False)
+
+  # Relationships.
+  chunk: 'ResultOutputChunk' = orm.relationship('ResultOutputChunk')
+
+  # Constraints.
+  __table_args__ = (
+    sql.PrimaryKeyConstraint('value_id', 'position',
+                             name='unique_result_output_value_chunk'),)
+
+
+class ResultOutputChunk(db.Table):
+  """A zstd-compressed chunk of result output.
+
+  Chunks are identified by the MD5 of their uncompressed data, so a chunk
+  which is shared by many output values is stored once.
+  """
+  id_t = _ResultOutputChunkId
+  __tablename__ = 'result_output_chunks'
+
+  # Columns.
+  id: int = sql.Column(id_t, primary_key=True)
+  md5: bytes = sql.Column(
+      sql.Binary(16).with_variant(mysql.BINARY(16), 'mysql'), nullable=False,
+      index=True, unique=True)
+  # The dictionary used to compress the data, if any.
+  dictionary_id: int = sql.Column(
+      _ResultOutputDictionaryId,
+      sql.ForeignKey('result_output_dictionaries.id'), nullable=True)
+  data: bytes = sql.Column(
+      sql.LargeBinary().with_variant(mysql.MEDIUMBLOB(), 'mysql'),
+      nullable=False)
+
+  # Relationships.
+  dictionary: 'ResultOutputDictionary' = orm.relationship(
+      'ResultOutputDictionary')
+
+  def Decompress(self) -> bytes:
+    """Get the uncompressed data.
+
+    Returns:
+      The chunk data.
+    """
+    return _GetDecompressor(self.dictionary).decompress(self.data)
+
+  @classmethod
+  def GetOrAdd(
+      cls, session: db.session_t, data: bytes,
+      dictionary: typing.Optional['ResultOutputDictionary'] = None
+  ) -> 'ResultOutputChunk':
+    """Instantiate a ResultOutputChunk entry from uncompressed data.
+
+    Args:
+      session: A database session.
+      data: The uncompressed data.
+      dictionary: The dictionary to compress the data with, if any.
+
+    Returns:
+      A ResultOutputChunk instance.
+    """
+    md5 = hashlib.md5(data).digest()
+    chunk = session.query(cls).filter(cls.md5 == md5).first()
+    if chunk:
+      return chunk
+    chunk = cls(md5=md5, dictionary=dictionary,
+                data=_GetCompressor(dictionary).compress(data))
+    session.add(chunk)
+    return chunk
+
+
+class ResultOutputDictionary(db.Table):
+  """A zstd compression dictionary for the outputs of a harness."""
+  id_t = _ResultOutputDictionaryId
+  __tablename__ = 'result_output_dictionaries'
+
+  # Columns.
+  id: int = sql.Column(id_t, primary_key=True)
+  date_added: datetime.datetime = sql.Column(
+      sql.DateTime().with_variant(mysql.DATETIME(fsp=3), 'mysql'),
+      nullable=False,
+      default=labdate.GetUtcMillisecondsNow)
+  # NULL if the dictionary has been replaced, but is still needed to
+  # decompress existing chunks.
+  harness_id: int = sql.Column(deeplearning.deepsmith.harness.Harness.id_t,
+                               sql.ForeignKey('harnesses.id'), nullable=True,
+                               unique=True)
+  data: bytes = sql.Column(
+      sql.LargeBinary().with_variant(mysql.MEDIUMBLOB(), 'mysql'),
+      nullable=False)
+
+  # Relationships.
+  harness: deeplearning.deepsmith.harness.Harness = orm.relationship('Harness')
+
+  # The zstd dictionary, built from data on first use.
+  _compression_dict: typing.Optional[zstandard.ZstdCompressionDict] = None
+
+  @property
+  def compression_dict(self) -> zstandard.ZstdCompressionDict:
+    """Get the zstd dictionary.
+
+    The dictionary is prepared for compression once per instance, and is
+    read-only, so it may be shared by compressors in different threads.
+
+    Returns:
+      A ZstdCompressionDict instance.
+    """
+    if self._compression_dict is None:
+      compression_dict = zstandard.ZstdCompressionDict(self.data)
+      compression_dict.precompute_compress(level=_COMPRESSION_LEVEL)
+      self._compression_dict = compression_dict
+    return self._compression_dict
+
+  @classmethod
+  def Train(cls, session: db.session_t,
+            harness: deeplearning.deepsmith.harness.Harness,
+            samples: typing.List[str],
+            dict_size: int = 112640) -> 'ResultOutputDictionary':
+    """Train a compression dictionary for a harness.
+
+    Existing chunks are unaffected. Only output values added after training
+    are compressed using the new dictionary.
+
+    Args:
+      session: A database session.
+      harness: The harness.
+      samples: Example output values of the harness.
+      dict_size: The maximum size of the dictionary, in bytes.
+
+    Returns:
+      A ResultOutputDictionary instance.
+    """
+    data = zstandard.train_dictionary(
+        dict_size, [sample.encode('utf-8') for sample in samples]).as_bytes()
+    dictionary = session.query(cls).filter(cls.harness == harness).first()
+    if dictionary:
+      # The old dictionary is kept to decompress the chunks which use it.
+      dictionary.harness = None
+      session.flush()
+    dictionary = cls(harness=harness, data=data)
+    session.add(dictionary)
+    return dictionary
+
+
+# The zstd compression level of result output chunks.
+_COMPRESSION_LEVEL = 3
+
+# Chunk boundaries are placed after lines whose CRC32 has these bits clear.
+_CHUNK_BOUNDARY_MASK = 0x7f
+_CHUNK_MIN_SIZE = 2048
+_CHUNK_MAX_SIZE = 65536
+
+
+def SplitIntoChunks(data: bytes) -> typing.List[bytes]:
+  """Split output into content-defined chunks.
+
+  Chunk boundaries are placed at the ends of lines, chosen by a hash of the
+  line contents. This means that an edit to one part of an output changes
+  only the chunk containing it, so that the other chunks can be shared with
+  similar outputs. Chunks are at least _CHUNK_MIN_SIZE bytes, except for the
+  last, and a boundary is forced at the first line end after
+  _CHUNK_MAX_SIZE bytes.
+
+  Args:
+    data: The output to split.
+
+  Returns:
+    A list of chunks, which concatenate to the input.
+  """
+  if len(data) < 2 * _CHUNK_MIN_SIZE:
+    return [data]
+  chunks = []
+  start = 0
+  end = 0
+  for line in data.splitlines(keepends=True):
+    end += len(line)
+    size = end - start
+    if size >= _CHUNK_MIN_SIZE and (
+        size >= _CHUNK_MAX_SIZE or
+        not zlib.crc32(line) & _CHUNK_BOUNDARY_MASK):
+      chunks.append(data[start:end])
+      start = end
+  if start < len(data):
+    chunks.append(data[start:])
+  return chunks
+
+
+# Compressors and decompressors are not thread-safe, so a new one is created
+# for each use. This is cheap once the dictionary has been prepared.
+def _GetCompressor(
+    dictionary: typing.Optional[ResultOutputDictionary]
+) -> zstandard.ZstdCompressor:
+  if dictionary is None:
+    return zstandard.ZstdCompressor(level=_COMPRESSION_LEVEL)
+  return zstandard.ZstdCompressor(level=_COMPRESSION_LEVEL,
+                                  dict_data=dictionary.compression_dict)
+
+
+def _GetDecompressor(
+    dictionary: typing.Optional[ResultOutputDictionary]
+) -> zstandard.ZstdDecompressor:
+  if dictionary is None:
+    return zstandard.ZstdDecompressor()
+  return zstandard.ZstdDecompressor(dict_data=dictionary.compression_dict)
 
 
 class PendingResult(db.Table):
@@ -1,9 +1,12 @@
 """Tests for //deeplearning/deepsmith:result."""
 import datetime
 import sys
+from concurrent import futures
 
 import pytest
+import zstandard
 from absl import app
+from absl import flags
 
 import deeplearning.deepsmith.client
 import deeplearning.deepsmith.generator
@@ -15,6 +18,9 @@ from deeplearning.deepsmith.proto import deepsmith_pb2
 from labm8 import labdate
 
 
+FLAGS = flags.FLAGS
+
+
 def test_Result_ToProto():
   now = datetime.datetime.now()
 
@@ -380,6 +386,145 @@ def test_duplicate_results_ignored(session):
   assert r3.profiling_events[1].duration_ms == 100
 
 
+def test_ResultOutputValue_GetOrAdd_compressed(session):
+  value = deeplearning.deepsmith.result.ResultOutputValue.GetOrAdd(
+      session, string='Hello, world!', compress=True)
+  session.flush()
+  assert value.truncated_value is None
+  assert len(value.chunks) == 1
+  assert value.string == 'Hello, world!'
+
+
+def test_ResultOutputValue_GetOrAdd_compressed_existing(session):
+  a = deeplearning.deepsmith.result.ResultOutputValue.GetOrAdd(
+      session, string='Hello, world!', compress=True)
+  b = deeplearning.deepsmith.result.ResultOutputValue.GetOrAdd(
+      session, string='Hello, world!', compress=True)
+  session.flush()
+  assert a.id == b.id
+
+
+def test_ResultOutputValue_GetOrAdd_compressed_shares_chunks(session):
+  lines = [f'{i}: {i * i}\n' for i in range(5000)]
+  a = ''.join(lines)
+  lines[2500] = 'changed\n'
+  b = ''.join(lines)
+  a_value = deeplearning.deepsmith.result.ResultOutputValue.GetOrAdd(
+      session, string=a, compress=True)
+  b_value = deeplearning.deepsmith.result.ResultOutputValue.GetOrAdd(
+      session, string=b, compress=True)
+  session.flush()
+  assert a_value.string == a
+  assert b_value.string == b
+  assert len(a_value.chunks) > 1
+  # Only the chunk containing the change differs.
+  a_chunks = {chunk.chunk_id for chunk in a_value.chunks}
+  b_chunks = {chunk.chunk_id for chunk in b_value.chunks}
+  assert len(b_chunks - a_chunks) == 1
+
+
+def test_ResultOutputValue_GetOrAdd_compressed_truncated(session):
+  string = 'a' * (deeplearning.deepsmith.result.ResultOutputValue.max_len + 1)
+  value = deeplearning.deepsmith.result.ResultOutputValue.GetOrAdd(
+      session, string=string, compress=True)
+  session.flush()
+  assert value.truncated
+  assert value.string == string[:-1]
+
+
+def test_ResultOutputValue_GetOrAdd_compressed_then_uncompressed(session):
+  """Test that a value is found regardless of how it was stored."""
+  a = deeplearning.deepsmith.result.ResultOutputValue.GetOrAdd(
+      session, string='Hello, world!', compress=True)
+  session.flush()
+  b = deeplearning.deepsmith.result.ResultOutputValue.GetOrAdd(
+      session, string='Hello, world!', compress=False)
+  c = deeplearning.deepsmith.result.ResultOutputValue.GetOrAdd(
+      session, string='Goodbye, world!', compress=False)
+  session.flush()
+  d = deeplearning.deepsmith.result.ResultOutputValue.GetOrAdd(
+      session, string='Goodbye, world!', compress=True)
+  assert a.id == b.id
+  assert c.id == d.id
+  assert d.truncated_value == 'Goodbye, world!'
+
+
+def _OutputResult(testbed_name: str) -> deepsmith_pb2.Result:
+  return deepsmith_pb2.Result(
+      testcase=deepsmith_pb2.Testcase(
+          toolchain='cpp',
+          generator=deepsmith_pb2.Generator(name='generator'),
+          harness=deepsmith_pb2.Harness(name='harness'),
+          inputs={'src': 'int main() {}'}),
+      testbed=deepsmith_pb2.Testbed(toolchain='cpp', name=testbed_name),
+      returncode=0,
+      outputs={'stdout': 'Hello, world!'},
+      outcome=deepsmith_pb2.Result.PASS)
+
+
+def test_Result_GetOrAdd_toggle_compress_result_outputs(session):
+  """Test adding results with and without --compress_result_outputs."""
+  FLAGS.compress_result_outputs = True
+  try:
+    a = deeplearning.deepsmith.result.Result.GetOrAdd(
+        session, _OutputResult('clang'))
+    session.commit()
+  finally:
+    FLAGS.compress_result_outputs = False
+  b = deeplearning.deepsmith.result.Result.GetOrAdd(
+      session, _OutputResult('gcc'))
+  session.commit()
+  assert session.query(
+      deeplearning.deepsmith.result.ResultOutputValue).count() == 1
+  assert a.outputs == b.outputs == {'stdout': 'Hello, world!'}
+
+
+def test_ResultOutputValue_GetOrAdd_dictionary(session):
+  harness = deeplearning.deepsmith.harness.Harness.GetOrAdd(
+      session, deepsmith_pb2.Harness(name='harness'))
+  samples = [f'Kernel {i} output: ' + ','.join(str(j) for j in range(i, 100))
+             for i in range(1000)]
+  dictionary = deeplearning.deepsmith.result.ResultOutputDictionary.Train(
+      session, harness, samples, dict_size=4096)
+  value = deeplearning.deepsmith.result.ResultOutputValue.GetOrAdd(
+      session, string=samples[0] + '!', compress=True, dictionary=dictionary)
+  session.flush()
+  assert value.chunks[0].chunk.dictionary == dictionary
+  assert value.string == samples[0] + '!'
+
+
+def test_ResultOutputChunk_dictionary_threads():
+  """Test that a dictionary can be shared by threads compressing chunks."""
+  samples = [f'Kernel {i} output: ' + ','.join(str(j) for j in range(i, 100))
+             for i in range(1000)]
+  dictionary = deeplearning.deepsmith.result.ResultOutputDictionary(
+      data=zstandard.train_dictionary(
+          4096, [s.encode('utf-8') for s in samples]).as_bytes())
+
+  def RoundTrip(sample: str) -> bytes:
+    chunk = deeplearning.deepsmith.result.ResultOutputChunk(
+        dictionary=dictionary,
+        data=deeplearning.deepsmith.result._GetCompressor(dictionary).compress(
+            sample.encode('utf-8')))
+    return chunk.Decompress()
+
+  with futures.ThreadPoolExecutor(max_workers=4) as executor:
+    assert list(executor.map(RoundTrip, samples)) == [
+      s.encode('utf-8') for s in samples]
+
+
+def test_SplitIntoChunks_small_output():
+  assert deeplearning.deepsmith.result.SplitIntoChunks(b'a\nb\n') == [
+    b'a\nb\n']
+
+
+def test_SplitIntoChunks_concatenates_to_input():
+  data = ''.join(f'{i}\n' for i in range(100000)).encode('utf-8')
+  chunks = deeplearning.deepsmith.result.SplitIntoChunks(data)
+  assert len(chunks) > 1
+  assert b''.join(chunks) == data
+
+
 def main(argv):  # pylint: disable=missing-docstring
   del argv
   sys.exit(pytest.main([__file__, '-v']))
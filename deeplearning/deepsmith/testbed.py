@@ -1,7 +1,6 @@
 """This file implements testbeds."""
 import binascii
 import datetime
-import hashlib
 import typing
 
 import sqlalchemy as sql
@@ -116,12 +115,10 @@ class Testbed(db.Table):
     toolchain = deeplearning.deepsmith.toolchain.Toolchain.GetOrAdd(session,
                                                                     proto.toolchain)
 
-    # Build the list of options, and md5sum the key value strings.
+    # Build the list of options.
     opts = []
-    md5 = hashlib.md5()
     for proto_opt_name in sorted(proto.opts):
       proto_opt_value = proto.opts[proto_opt_name]
-      md5.update((proto_opt_name + proto_opt_value).encode('utf-8'))
       opt = labm8.sqlutil.GetOrAdd(session, TestbedOpt,
                                    name=TestbedOptName.GetOrAdd(session,
                                                                 proto_opt_name),
@@ -131,7 +128,7 @@ class Testbed(db.Table):
       opts.append(opt)
 
     # Create optset table entries.
-    optset_id = md5.digest()
+    optset_id = db.OptSetId(proto.opts)
     for opt in opts:
       db.GetOrAdd(session, TestbedOptSet, id=optset_id, opt=opt)
 
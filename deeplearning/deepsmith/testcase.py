@@ -81,6 +81,13 @@ class Testcase(db.Table):
   pending_results: typing.List['PendingResult'] = orm.relationship(
       'PendingResult', back_populates='testcase')
 
+  # Constraints.
+  __table_args__ = (
+    # Serves GetTestcases queries, which filter by toolchain and harness and
+    # are ordered by ID.
+    sql.Index('ix_testcases_toolchain_harness_id', 'toolchain_id',
+              'harness_id', 'id'),)
+
   @property
   def inputs(self) -> typing.Dict[str, str]:
     """Get the generator inputs.
@@ -1,7 +1,9 @@
 """A class representing a control flow graph."""
+import functools
 import typing
 
 import networkx as nx
+import numpy as np
 from absl import flags
 
 from experimental.compilers.reachability import reachability_pb2
@@ -50,6 +52,18 @@ class NoExitBlock(InvalidSpecialBlock): pass
 class MultipleExitBlocks(InvalidSpecialBlock): pass
 
 
+def _ResetsReachabilityCache(method):
+  """Decorate a graph-modifying method so that it resets reachability."""
+
+  @functools.wraps(method)
+  def Wrapped(self, *args, **kwargs):
+    self._reachability_matrix = None
+    self._reachability_node_index = None
+    return method(self, *args, **kwargs)
+
+  return Wrapped
+
+
 class ControlFlowGraph(nx.DiGraph, pbutil.ProtoBackedMixin):
   """A control flow graph.
 
@@ -67,17 +81,93 @@ class ControlFlowGraph(nx.DiGraph, pbutil.ProtoBackedMixin):
   proto_t = reachability_pb2.ControlFlowGraph
 
   def __init__(self, name: str = "cfg"):
+    # The cached reachability matrix. This is reset by any method which
+    # modifies the nodes or edges of the graph.
+    self._reachability_matrix: typing.Optional[np.ndarray] = None
+    self._reachability_node_index: typing.Optional[
+      typing.Dict[typing.Any, int]] = None
     super(ControlFlowGraph, self).__init__(name=name)
 
   def IsReachable(self, src, dst) -> bool:
     """Return whether dst node is reachable from src."""
     # TODO(cec): It seems that descendants() does not include self loops, so
     # test for the node in both descendants and self loops.
-    return dst in nx.descendants(self, src)
+    if src not in self:
+      raise nx.NetworkXError(f"The node {src} is not in the graph.")
+    if dst not in self:
+      return False
+    index = self._node_index
+    return bool(self.ReachabilityMatrix()[index[src], index[dst]])
 
   def Reachables(self, src) -> typing.Iterator[bool]:
     """Return whether each node is reachable from the src node."""
-    return (self.IsReachable(src, dst) for dst in self.nodes)
+    if not self.number_of_nodes():
+      return iter([])
+    if src not in self:
+      raise nx.NetworkXError(f"The node {src} is not in the graph.")
+    return iter(self.ReachabilityMatrix()[self._node_index[src]].tolist())
+
+  @property
+  def _node_index(self) -> typing.Dict[typing.Any, int]:
+    """A map from nodes to their position in self.nodes."""
+    if self._reachability_node_index is None:
+      self._reachability_node_index = {
+        node: i for i, node in enumerate(self.nodes)}
+    return self._reachability_node_index
+
+  def AdjacencyMatrix(self) -> np.ndarray:
+    """Return the adjacency matrix of the graph.
+
+    Returns:
+      A square boolean array, where rows and columns are in the order of
+      self.nodes.
+    """
+    n = self.number_of_nodes()
+    matrix = np.zeros((n, n), dtype=np.bool_)
+    if self.number_of_edges():
+      index = self._node_index
+      src, dst = zip(*((index[u], index[v]) for u, v in self.edges))
+      matrix[list(src), list(dst)] = True
+    return matrix
+
+  def ReachabilityMatrix(self) -> np.ndarray:
+    """Return the reachability matrix of the graph.
+
+    Element [i, j] is True if node j is a descendant of node i, where rows and
+    columns are in the order of self.nodes. As with nx.descendants(), a node
+    is never its own descendant.
+
+    The matrix is computed once for all nodes by propagating reachability
+    through the condensation of the graph's strongly connected components in
+    reverse topological order, and is cached until the graph is modified.
+
+    Returns:
+      A square boolean array. Do not modify it.
+    """
+    if self._reachability_matrix is None:
+      index = self._node_index
+      condensation = nx.condensation(self)
+      members = [
+        [index[node] for node in condensation.nodes[component]['members']]
+        for component in condensation.nodes
+      ]
+      # Row c is the set of nodes reachable from the nodes in component c.
+      reachable = np.zeros((len(members), self.number_of_nodes()),
+                           dtype=np.bool_)
+      for component in reversed(list(nx.topological_sort(condensation))):
+        # The nodes of a component are reachable from each other.
+        reachable[component, members[component]] = True
+        for successor in condensation.successors(component):
+          reachable[component] |= reachable[successor]
+      node_components = np.zeros(self.number_of_nodes(), dtype=np.int64)
+      for node, component in condensation.graph['mapping'].items():
+        node_components[index[node]] = component
+      matrix = reachable[node_components]
+      # A node is not its own descendant, even if it is part of a cycle.
+      np.fill_diagonal(matrix, False)
+      matrix.flags.writeable = False
+      self._reachability_matrix = matrix
+    return self._reachability_matrix
 
   def ValidateControlFlowGraph(self, strict: bool = True) -> 'ControlFlowGraph':
     """Return true if the graph is a valid control flow graph.
@@ -263,3 +353,51 @@ class ControlFlowGraph(nx.DiGraph, pbutil.ProtoBackedMixin):
     return hash((tuple(self.nodes), tuple(self.edges),
                  tuple([str(self.nodes[n]) for n in self.nodes]),
                  tuple([str(self.edges[i, j]) for i, j in self.edges])))
+
+
+# Reset the cached reachability of a ControlFlowGraph whenever its nodes or
+# edges are modified.
+for _method_name in ('add_node', 'add_nodes_from', 'remove_node',
+                     'remove_nodes_from', 'add_edge', 'add_edges_from',
+                     'remove_edge', 'remove_edges_from', 'clear'):
+  setattr(ControlFlowGraph, _method_name,
+          _ResetsReachabilityCache(getattr(nx.DiGraph, _method_name)))
+
+
+def ReachabilityMatrices(
+    graphs: typing.Iterable[ControlFlowGraph]) -> typing.List[np.ndarray]:
+  """Compute the reachability matrices of many graphs.
+
+  Graphs with the same number of nodes are processed together, by computing
+  the transitive closure of their stacked adjacency matrices with repeated
+  boolean matrix squaring. The result for each graph is cached, as if
+  ReachabilityMatrix() had been called.
+
+  Args:
+    graphs: The graphs.
+
+  Returns:
+    A list of reachability matrices, in the same order as graphs.
+  """
+  graphs = list(graphs)
+  sizes = {}
+  for i, graph in enumerate(graphs):
+    if graph._reachability_matrix is None:
+      sizes.setdefault(graph.number_of_nodes(), []).append(i)
+
+  for n, indices in sizes.items():
+    closure = np.stack([graphs[i].AdjacencyMatrix() for i in indices])
+    # Each squaring doubles the length of the paths considered, so this
+    # converges after at most log2(n) + 1 iterations.
+    while True:
+      paths = closure.astype(np.float32)
+      updated = closure | (np.matmul(paths, paths) > 0)
+      if np.array_equal(updated, closure):
+        break
+      closure = updated
+    for i, matrix in zip(indices, closure):
+      np.fill_diagonal(matrix, False)
+      matrix.flags.writeable = False
+      graphs[i]._reachability_matrix = matrix
+
+  return [graph.ReachabilityMatrix() for graph in graphs]
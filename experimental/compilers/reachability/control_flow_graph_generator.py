@@ -1,4 +1,5 @@
 """A generator for control flow graphs."""
+import multiprocessing
 import typing
 
 import numpy as np
@@ -71,12 +72,107 @@ class UniqueNameSequence(object):
     return s
 
 
+def AdjacencyMatrixToControlFlowGraph(
+    adjacency_matrix: np.ndarray, name: str = 'cfg') -> cfg.ControlFlowGraph:
+  """Create a control flow graph from an adjacency matrix.
+
+  Node 0 is the entry block, and the last node is the exit block. Nodes are
+  named 'A', 'B', 'C', etc.
+
+  Args:
+    adjacency_matrix: A square boolean array, where element [i, j] is True if
+      there is an edge from node i to node j.
+    name: The name of the graph.
+
+  Returns:
+    A ControlFlowGraph instance.
+  """
+  num_nodes = adjacency_matrix.shape[0]
+  graph = cfg.ControlFlowGraph(name=name)
+  node_name_sequence = UniqueNameSequence('A')
+  graph.add_nodes_from(
+      (i, {'name': next(node_name_sequence)}) for i in range(num_nodes))
+  graph.nodes[0]['entry'] = True
+  graph.nodes[num_nodes - 1]['exit'] = True
+  graph.add_edges_from(
+      (int(i), int(j)) for i, j in zip(*np.nonzero(adjacency_matrix)))
+  return graph
+
+
+def _RandomChoices(rand: np.random.RandomState, allowed: np.ndarray) -> np.ndarray:
+  """Select a random allowed column from each row of a boolean matrix."""
+  scores = rand.rand(*allowed.shape)
+  scores[~allowed] = -1
+  return scores.argmax(axis=-1)
+
+
+def GenerateAdjacencyMatrices(rand: np.random.RandomState, batch_size: int,
+                              num_nodes: int,
+                              edge_density: float) -> np.ndarray:
+  """Generate a batch of random CFG adjacency matrices.
+
+  The constraints of ControlFlowGraph.ValidateControlFlowGraph() are applied
+  to every graph in the batch at once:
+
+   * There are no self loops, and no outputs from the exit block.
+   * Every node other than the exit block has at least one output.
+   * The exit block has at least one input.
+   * For every edge, the source has more than one output or the destination
+     has more than one input (counting the implicit input to the entry block),
+     so that no edges can be fused.
+
+  Args:
+    rand: A random state instance.
+    batch_size: The number of graphs to generate.
+    num_nodes: The number of nodes in each graph. Must be >= 3.
+    edge_density: The probability of each edge in the initial random graph.
+
+  Returns:
+    A boolean array of shape (batch_size, num_nodes, num_nodes).
+  """
+  exit_block = num_nodes - 1
+  graphs = np.arange(batch_size)
+  adjacency = rand.rand(batch_size, num_nodes, num_nodes) < edge_density
+  adjacency[:, np.arange(num_nodes), np.arange(num_nodes)] = False
+  adjacency[:, exit_block, :] = False
+
+  # A node may connect to any node except itself.
+  not_self = ~np.eye(num_nodes, dtype=np.bool_)
+
+  # Give every node other than the exit block at least one output.
+  graph, node = np.nonzero(~adjacency[:, :exit_block, :].any(axis=2))
+  adjacency[graph, node, _RandomChoices(rand, not_self[node])] = True
+
+  # Give the exit block at least one input.
+  graph = graphs[~adjacency[:, :, exit_block].any(axis=1)]
+  src = rand.randint(0, exit_block, size=len(graph))
+  adjacency[graph, src, exit_block] = True
+
+  # Find the edges which could be fused. The source of such an edge has a
+  # single output, so adding a second output to the source fixes the edge.
+  # Adding edges never invalidates an edge, so one pass is enough.
+  out_degrees = adjacency.sum(axis=2)
+  in_degrees = adjacency.sum(axis=1)
+  in_degrees[:, 0] += 1
+  fusible = (adjacency & (out_degrees[:, :, np.newaxis] == 1) &
+             (in_degrees[:, np.newaxis, :] == 1))
+  graph, node, _ = np.nonzero(fusible)
+  allowed = not_self[node] & ~adjacency[graph, node]
+  adjacency[graph, node, _RandomChoices(rand, allowed)] = True
+
+  return adjacency
+
+
 class ControlFlowGraphGenerator(object):
-  """A generator for control flow graphs."""
+  """A generator for control flow graphs.
+
+  Graphs are generated in batches of adjacency matrices, and converted to
+  ControlFlowGraph instances as they are consumed.
+  """
 
   def __init__(self, rand: np.random.RandomState,
                num_nodes_min_max: typing.Tuple[int, int],
-               edge_density: float):
+               edge_density: float, batch_size: int = 256):
     """Instantiate a control flow graph generator.
 
     Args:
@@ -85,19 +181,24 @@ class ControlFlowGraphGenerator(object):
       edge_density: The edge edge_density, in range (0,1], where 1.0 will produce fully
         connected graphs, and lower numbers will produce more sparsely connected
         graphs.
+      batch_size: The number of graphs to generate at a time.
     """
     # Validate inputs.
     if num_nodes_min_max[0] > num_nodes_min_max[1]:
       raise ValueError("Upper bound of num nodes must be >= lower bound")
-    if num_nodes_min_max[0] < 2:
-      raise ValueError("Lower bound for num nodes must be >= 2")
+    # A graph with only entry and exit blocks has a single edge, which can
+    # always be fused.
+    if num_nodes_min_max[0] < 3:
+      raise ValueError("Lower bound for num nodes must be >= 3")
     if not 0 < edge_density <= 1:
       raise ValueError('Edge density must be in range (0,1]')
 
     self._rand = rand
     self._num_nodes_min_max = num_nodes_min_max
     self._edge_density = edge_density
+    self._batch_size = batch_size
     self._graph_name_sequence = UniqueNameSequence('A', prefix='cfg_')
+    self._batch: typing.List[np.ndarray] = []
 
   def __iter__(self):
     return self
@@ -105,95 +206,45 @@ class ControlFlowGraphGenerator(object):
   def __next__(self) -> cfg.ControlFlowGraph:
     return self.GenerateOne()
 
+  def GenerateAdjacencyMatrices(self, n: int) -> typing.List[np.ndarray]:
+    """Generate the adjacency matrices of a batch of random CFGs.
+
+    Args:
+      n: The number of graphs to generate.
+
+    Returns:
+      A list of square boolean arrays, which may have different sizes.
+    """
+    # Sample the number of nodes to put in each graph, unless min == max.
+    if self._num_nodes_min_max[0] == self._num_nodes_min_max[1]:
+      num_nodes = np.full(n, self._num_nodes_min_max[0])
+    else:
+      num_nodes = self._rand.randint(*self._num_nodes_min_max, size=n)
+
+    # Generate the graphs of each size together.
+    matrices = [None] * n
+    for size in np.unique(num_nodes):
+      indices = np.flatnonzero(num_nodes == size)
+      batch = GenerateAdjacencyMatrices(self._rand, len(indices), int(size),
+                                        self._edge_density)
+      for i, matrix in zip(indices, batch):
+        matrices[i] = matrix
+    return matrices
+
   def GenerateOne(self) -> cfg.ControlFlowGraph:
     """Create a random CFG.
 
     Returns:
       A ControlFlowGraph instance.
     """
-    # Sample the number of nodes to put in the graph, unless min == max.
-    if self._num_nodes_min_max[0] == self._num_nodes_min_max[1]:
-      num_nodes = self._num_nodes_min_max[0]
-    else:
-      num_nodes = self._rand.randint(*self._num_nodes_min_max)
-
-    # Generate the graph and create the named nodes.
-    graph = cfg.ControlFlowGraph(name=next(self._graph_name_sequence))
-    node_name_sequence = UniqueNameSequence('A')
-    [graph.add_node(i, name=next(node_name_sequence)) for i in range(num_nodes)]
-
-    # Set the entry and exit blocks.
-    entry_block = 0
-    exit_block = num_nodes - 1
-    graph.nodes[entry_block]['entry'] = True
-    graph.nodes[exit_block]['exit'] = True
-
-    # Generate an adjacency matrix of random binary values.
-    adjacency_matrix = self._rand.rand(num_nodes, num_nodes)
-    adjacency_matrix = np.rint(adjacency_matrix).astype(np.int32)
-
-    # Add the edges to the graph, subject to the contraints of CFGs.
-    def NotSelfLoop(i, j):
-      """Self loops are not allowed in CFGs."""
-      return i != j
-
-    def NotExitNodeOutput(i, j):
-      """Outputs are not allowed from the exit block."""
-      del j
-      return i != exit_block
-
-    def IsEdge(i, j):
-      """Return whether edge is set in adjacency matrix."""
-      return adjacency_matrix[i, j]
-
-    for j, row in enumerate(adjacency_matrix):
-      for i in row:
-        # CFG nodes cannot be connected to themselves.
-        if NotSelfLoop(i, j) and NotExitNodeOutput(i, j) and IsEdge(i, j):
-          graph.add_edge(i, j)
-
-    # Apply finishing touches to the graph to make it a valid CFG.
-    def AddRandomEdge(src):
-      """Add an outgoing edge from src to a random destination."""
-      dst = src
-      while dst == src:
-        dst = self._rand.randint(0, num_nodes)
-      graph.add_edge(src, dst)
-
-    def AddRandomIncomingEdge(dst):
-      """Add an incoming edge to dst from a random source."""
-      src = dst
-      while src == dst or src == exit_block:
-        src = self._rand.randint(0, num_nodes)
-      graph.add_edge(src, dst)
-
-    # Make sure that every node has one output. This will also include
-    modified = True
-    while modified:
-      for node in graph.nodes:
-        if NotExitNodeOutput(node, 0) and not graph.out_degree(node):
-          AddRandomEdge(node)
-          break
-      else:
-        modified = False
-
-    modified = True
-    while modified:
-      for src, dst in graph.edges:
-        if not (graph.out_degree(src) > 1 or graph.in_degree(dst) > 1) and (
-            NotExitNodeOutput(src, dst)):
-          AddRandomEdge(src)
-          break
-      else:
-        # We iterated through all nodes without making any modifications: we're
-        # done.
-        modified = False
-
-    # Make sure the exit block has at least one incoming edge.
-    if not graph.in_degree(exit_block):
-      AddRandomIncomingEdge(exit_block)
-
-    return graph.ValidateControlFlowGraph()
+    return AdjacencyMatrixToControlFlowGraph(
+        self._NextAdjacencyMatrix(), name=next(self._graph_name_sequence))
+
+  def _NextAdjacencyMatrix(self) -> np.ndarray:
+    """Return the next adjacency matrix, generating a new batch if needed."""
+    if not self._batch:
+      self._batch = self.GenerateAdjacencyMatrices(self._batch_size)[::-1]
+    return self._batch.pop()
 
   def Generate(self, n: int) -> typing.Iterator[cfg.ControlFlowGraph]:
     """Generate a sequence of graphs.
@@ -215,10 +266,59 @@ class ControlFlowGraphGenerator(object):
     Returns:
       An iterator of unique graphs, where g0 != g1 != ... != gn.
     """
-    graph_hashes = set()
-    while len(graph_hashes) < n:
-      graph = self.GenerateOne()
-      graph_hash = hash(graph)
-      if graph_hash not in graph_hashes:
-        graph_hashes.add(graph_hash)
-        yield graph
+    # Graphs are compared using their adjacency matrices, so that only unique
+    # graphs are converted to ControlFlowGraph instances.
+    seen = set()
+    while len(seen) < n:
+      matrix = self._NextAdjacencyMatrix()
+      key = (matrix.shape[0], np.packbits(matrix).tobytes())
+      if key not in seen:
+        seen.add(key)
+        yield AdjacencyMatrixToControlFlowGraph(
+            matrix, name=next(self._graph_name_sequence))
+
+
+def _GenerateAdjacencyMatricesWorker(
+    args: typing.Tuple[int, int, typing.Tuple[int, int], float, int]
+) -> typing.List[np.ndarray]:
+  """Generate a batch of adjacency matrices with a per-batch seed."""
+  seed, batch_index, num_nodes_min_max, edge_density, batch_size = args
+  generator = ControlFlowGraphGenerator(
+      np.random.RandomState([seed, batch_index]), num_nodes_min_max,
+      edge_density)
+  return generator.GenerateAdjacencyMatrices(batch_size)
+
+
+def GenerateAdjacencyMatricesInParallel(
+    seed: int, num_nodes_min_max: typing.Tuple[int, int], edge_density: float,
+    num_batches: int, batch_size: int = 1024,
+    pool: typing.Optional[multiprocessing.Pool] = None
+) -> typing.Iterator[np.ndarray]:
+  """Generate random CFG adjacency matrices using a pool of processes.
+
+  Each batch is generated from its own random state, seeded by the seed and
+  the index of the batch, so the output does not depend on the number of
+  processes in the pool.
+
+  Args:
+    seed: The random seed.
+    num_nodes_min_max: The lower and upper bounds on the number of nodes.
+    edge_density: The edge density, in range (0,1].
+    num_batches: The number of batches to generate.
+    batch_size: The number of graphs in each batch.
+    pool: The pool of processes to use. If not provided, a new pool is
+      created.
+
+  Returns:
+    An iterator of adjacency matrices, in a deterministic order. Use
+    AdjacencyMatrixToControlFlowGraph() to convert them to graphs.
+  """
+  args = ((seed, i, num_nodes_min_max, edge_density, batch_size)
+          for i in range(num_batches))
+  if pool:
+    for batch in pool.imap(_GenerateAdjacencyMatricesWorker, args):
+      yield from batch
+  else:
+    with multiprocessing.Pool() as pool:
+      for batch in pool.imap(_GenerateAdjacencyMatricesWorker, args):
+        yield from batch
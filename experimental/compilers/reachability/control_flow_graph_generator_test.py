@@ -1,4 +1,5 @@
 """Unit tests for :control_flow_graph_generator."""
+import multiprocessing
 import sys
 import typing
 
@@ -117,6 +118,47 @@ def test_ControlFlowGraphGenerator_GenerateUnique():
   assert len(set(uniq_graphs)) == 100
 
 
+def test_ControlFlowGraphGenerator_invalid_num_nodes():
+  """Test that graphs with fewer than three nodes are rejected."""
+  with pytest.raises(ValueError):
+    control_flow_graph_generator.ControlFlowGraphGenerator(
+        np.random.RandomState(1), (2, 10), 0.5)
+
+
+@pytest.mark.parametrize('edge_density', [0.01, 0.1, 0.5, 1.0])
+def test_GenerateAdjacencyMatrices_valid_graphs(edge_density: float):
+  """Test that every graph in a batch is a valid CFG."""
+  matrices = control_flow_graph_generator.GenerateAdjacencyMatrices(
+      np.random.RandomState(0), 200, 8, edge_density)
+  assert matrices.shape == (200, 8, 8)
+  for matrix in matrices:
+    graph = control_flow_graph_generator.AdjacencyMatrixToControlFlowGraph(
+        matrix)
+    assert graph.IsValidControlFlowGraph(strict=True)
+
+
+def test_ControlFlowGraphGenerator_variable_num_nodes():
+  """Test that graph sizes are sampled from the range."""
+  generator = control_flow_graph_generator.ControlFlowGraphGenerator(
+      np.random.RandomState(1), (3, 10), 0.2, batch_size=16)
+  graphs = list(generator.Generate(50))
+  assert {g.number_of_nodes() for g in graphs} <= set(range(3, 10))
+  assert len({g.number_of_nodes() for g in graphs}) > 1
+  assert all(g.IsValidControlFlowGraph() for g in graphs)
+
+
+def test_GenerateAdjacencyMatricesInParallel_deterministic():
+  """Test that parallel generation does not depend on the pool size."""
+  with multiprocessing.Pool(1) as pool:
+    a = list(control_flow_graph_generator.GenerateAdjacencyMatricesInParallel(
+        0, (5, 10), 0.3, num_batches=4, batch_size=8, pool=pool))
+  with multiprocessing.Pool(3) as pool:
+    b = list(control_flow_graph_generator.GenerateAdjacencyMatricesInParallel(
+        0, (5, 10), 0.3, num_batches=4, batch_size=8, pool=pool))
+  assert len(a) == 32
+  assert all(np.array_equal(x, y) for x, y in zip(a, b))
+
+
 def main(argv: typing.List[str]):
   """Main entry point."""
   if len(argv) > 1:
@@ -3,6 +3,7 @@ import sys
 import typing
 
 import networkx as nx
+import numpy as np
 import pytest
 from absl import app
 from absl import flags
@@ -82,6 +83,56 @@ def test_ControlFlowGraph_Reachables_back_edge():
   assert list(g.Reachables(2)) == [False, False, False]
 
 
+def _RandomGraph(seed: int, num_nodes: int,
+                 edge_density: float) -> control_flow_graph.ControlFlowGraph:
+  """Generate a random directed graph, which may contain cycles."""
+  rand = np.random.RandomState(seed)
+  g = control_flow_graph.ControlFlowGraph()
+  g.add_nodes_from(range(num_nodes))
+  for src, dst in zip(*np.nonzero(rand.rand(num_nodes, num_nodes) <
+                                  edge_density)):
+    g.add_edge(int(src), int(dst))
+  return g
+
+
+def _NetworkXReachabilityMatrix(g: control_flow_graph.ControlFlowGraph):
+  """Compute a reachability matrix using nx.descendants()."""
+  return np.array([[dst in nx.descendants(g, src) for dst in g.nodes]
+                   for src in g.nodes], dtype=np.bool_)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_ControlFlowGraph_ReachabilityMatrix_equals_networkx(seed: int):
+  """Test that reachability matrix agrees with nx.descendants()."""
+  g = _RandomGraph(seed, num_nodes=20, edge_density=0.1)
+  assert np.array_equal(g.ReachabilityMatrix(),
+                        _NetworkXReachabilityMatrix(g))
+
+
+def test_ControlFlowGraph_ReachabilityMatrix_cache_reset():
+  """Test that modifying the graph resets the cached reachability."""
+  g = control_flow_graph.ControlFlowGraph()
+  g.add_edge(0, 1)
+  g.add_edge(1, 2)
+  assert not g.IsReachable(2, 0)
+  g.add_edge(2, 0)
+  assert g.IsReachable(2, 0)
+  g.remove_edge(1, 2)
+  assert not g.IsReachable(1, 0)
+  g.add_node(3)
+  assert list(g.Reachables(3)) == [False, False, False, False]
+
+
+def test_ReachabilityMatrices_equals_networkx():
+  """Test that batched reachability agrees with nx.descendants()."""
+  graphs = [_RandomGraph(seed, num_nodes=10 + seed % 3, edge_density=0.15)
+            for seed in range(10)]
+  matrices = control_flow_graph.ReachabilityMatrices(graphs)
+  for g, matrix in zip(graphs, matrices):
+    assert matrix is g.ReachabilityMatrix()
+    assert np.array_equal(matrix, _NetworkXReachabilityMatrix(g))
+
+
 def test_ControlFlowGraph_validate_empty_graph():
   """Test that empty graph is invalid."""
   g = control_flow_graph.ControlFlowGraph()
@@ -1,15 +1,19 @@
 """Utility code for working with LLVM."""
 
+import collections
 import multiprocessing
 import pathlib
 import re
 import tempfile
+import time
 import typing
+from concurrent import futures
 
 import pydot
 import pyparsing
 from absl import app
 from absl import flags
+from absl import logging
 
 from compilers.llvm import opt
 from experimental.compilers.reachability import control_flow_graph as cfg
@@ -186,22 +190,23 @@ class ControlFlowGraphFromDotSourceError(ValueError):
     self.error = error
 
 
-def _DotCfgsFromBytecodeToQueue(bytecode: str,
-                                queue: multiprocessing.Queue) -> None:
-  """Process a bytecode and submit the dot source or the exception."""
+def _DotCfgsFromBytecodeOrError(
+    bytecode: str) -> typing.Union[typing.List[str], DotCfgsFromBytecodeError]:
+  """Process a bytecode and return the dot sources or the exception."""
   try:
-    queue.put(list(DotCfgsFromBytecode(bytecode)))
+    return list(DotCfgsFromBytecode(bytecode))
   except Exception as e:
-    queue.put(DotCfgsFromBytecodeError(bytecode, e))
+    return DotCfgsFromBytecodeError(bytecode, e)
 
 
-def _ControlFlowGraphFromDotSourceToQueue(dot: str,
-                                          queue: multiprocessing.Queue) -> None:
-  """Process a dot source and submit the CFG or the exception."""
+def _ControlFlowGraphFromDotSourceOrError(
+    dot: str) -> typing.Union[cfg.ControlFlowGraph,
+                              ControlFlowGraphFromDotSourceError]:
+  """Process a dot source and return the CFG or the exception."""
   try:
-    queue.put(ControlFlowGraphFromDotSource(dot))
+    return ControlFlowGraphFromDotSource(dot)
   except Exception as e:
-    queue.put(ControlFlowGraphFromDotSourceError(dot, e))
+    return ControlFlowGraphFromDotSourceError(dot, e)
 
 
 class ExceptionBuffer(Exception):
@@ -211,45 +216,112 @@ class ExceptionBuffer(Exception):
     self.errors = errors
 
 
+class ControlFlowGraphsFromBytecodesProgress(object):
+  """Progress and error counters for ControlFlowGraphsFromBytecodes()."""
+
+  def __init__(self):
+    self.bytecode_count = 0
+    self.bytecode_error_count = 0
+    self.dot_count = 0
+    self.dot_error_count = 0
+    self.graph_count = 0
+    self.start_time = time.time()
+
+  def __repr__(self) -> str:
+    elapsed = time.time() - self.start_time
+    return (f'{self.bytecode_count} bytecodes '
+            f'({self.bytecode_error_count} errors), '
+            f'{self.dot_count} dot sources ({self.dot_error_count} errors), '
+            f'{self.graph_count} graphs in {elapsed:.1f}s '
+            f'({self.graph_count / max(elapsed, 1e-6):.1f} graphs/s)')
+
+
 def ControlFlowGraphsFromBytecodes(
-    bytecodes: typing.Iterator[str]) -> typing.Iterator[cfg.ControlFlowGraph]:
-  dot_processes = []
-  dot_queue = multiprocessing.Queue()
-  for bytecode in bytecodes:
-    process = multiprocessing.Process(target=_DotCfgsFromBytecodeToQueue,
-                                      args=(bytecode, dot_queue))
-    process.start()
-    dot_processes.append(process)
-
-  cfg_processes = []
-  cfg_queue = multiprocessing.Queue()
+    bytecodes: typing.Iterator[str], num_workers: typing.Optional[int] = None,
+    progress: typing.Optional[ControlFlowGraphsFromBytecodesProgress] = None,
+    progress_interval: float = 10) -> typing.Iterator[cfg.ControlFlowGraph]:
+  """Create control flow graphs from LLVM bytecodes.
+
+  This is a two-stage pipeline which runs on a fixed pool of worker processes.
+  The first stage runs the opt -dot-cfg pass on bytecodes, and the second parses
+  the dot sources into CFGs. The dot sources produced by the first stage are
+  queued, and bytecodes are only read from the input iterator when a worker is
+  free and the queue is empty. At most num_workers bytecodes are processed at a
+  time, so the queue holds at most the dot sources of num_workers bytecodes, and
+  arbitrarily large inputs can be processed in constant memory. Graphs are
+  yielded in the order that they are completed, not the order of the input.
 
-  e = ExceptionBuffer([])
+  Args:
+    bytecodes: An iterator of LLVM bytecodes.
+    num_workers: The number of worker processes. Defaults to the number of
+      CPUs.
+    progress: An optional progress instance to update. Use this to inspect
+      the counters after the pipeline has completed.
+    progress_interval: The number of seconds between progress log messages.
 
-  for _ in range(len(dot_processes)):
-    dots = dot_queue.get()
-    if isinstance(dots, Exception):
-      e.errors.append(dots)
-    else:
-      for dot in dots:
-        process = multiprocessing.Process(
-            target=_ControlFlowGraphFromDotSourceToQueue, args=(dot, cfg_queue))
-        process.start()
-        cfg_processes.append(process)
-
-  # Get the graphs generated by the CFG processes.
-  for _ in range(len(cfg_processes)):
-    graph = cfg_queue.get()
-    if isinstance(graph, Exception):
-      e.errors.append(graph)
-    else:
-      yield graph
-
-  # Make sure that all processes have terminated. They will have, but best to
-  # check.
-  [p.join() for p in dot_processes]
-  [p.join() for p in cfg_processes]
+  Returns:
+    An iterator of ControlFlowGraph instances.
 
+  Raises:
+    ExceptionBuffer: Once all of the graphs have been produced, if any of the
+      bytecodes or dot sources could not be processed. The errors attribute
+      is a list of DotCfgsFromBytecodeError and
+      ControlFlowGraphFromDotSourceError instances.
+  """
+  num_workers = num_workers or multiprocessing.cpu_count()
+  progress = progress or ControlFlowGraphsFromBytecodesProgress()
+  bytecodes = iter(bytecodes)
+  bytecodes_exhausted = False
+  dot_queue = collections.deque()
+  in_flight = set()
+  e = ExceptionBuffer([])
+  last_progress_time = time.time()
+
+  with futures.ProcessPoolExecutor(num_workers) as executor:
+    while True:
+      # Keep every worker busy, favouring the dot parsing stage so that the
+      # queue is drained before more bytecodes are read.
+      while len(in_flight) < num_workers:
+        if dot_queue:
+          in_flight.add(executor.submit(
+              _ControlFlowGraphFromDotSourceOrError, dot_queue.popleft()))
+        elif not bytecodes_exhausted:
+          bytecode = next(bytecodes, None)
+          if bytecode is None:
+            bytecodes_exhausted = True
+            break
+          in_flight.add(executor.submit(_DotCfgsFromBytecodeOrError, bytecode))
+        else:
+          break
+
+      if not in_flight:
+        break
+
+      done, in_flight = futures.wait(
+          in_flight, return_when=futures.FIRST_COMPLETED)
+      for future in done:
+        result = future.result()
+        if isinstance(result, DotCfgsFromBytecodeError):
+          progress.bytecode_count += 1
+          progress.bytecode_error_count += 1
+          e.errors.append(result)
+        elif isinstance(result, ControlFlowGraphFromDotSourceError):
+          progress.dot_count += 1
+          progress.dot_error_count += 1
+          e.errors.append(result)
+        elif isinstance(result, list):
+          progress.bytecode_count += 1
+          dot_queue.extend(result)
+        else:
+          progress.dot_count += 1
+          progress.graph_count += 1
+          yield result
+
+      if time.time() - last_progress_time >= progress_interval:
+        logging.info('%s', progress)
+        last_progress_time = time.time()
+
+  logging.info('%s', progress)
   if e.errors:
     raise e
 
@@ -284,6 +284,42 @@ def test_ControlFlowGraphsFromBytecodes_one_failure():
   assert isinstance(e_ctx.value.errors[0].error, opt.OptException)
 
 
+def test_ControlFlowGraphsFromBytecodes_progress():
+  """Test that progress counters are updated."""
+  progress = llvm_util.ControlFlowGraphsFromBytecodesProgress()
+  generator = llvm_util.ControlFlowGraphsFromBytecodes([
+    SIMPLE_C_BYTECODE,
+    "Invalid bytecode!",
+  ], num_workers=2, progress=progress)
+  with pytest.raises(llvm_util.ExceptionBuffer):
+    list(generator)
+  assert progress.bytecode_count == 2
+  assert progress.bytecode_error_count == 1
+  assert progress.dot_count == 2
+  assert progress.dot_error_count == 0
+  assert progress.graph_count == 2
+
+
+def test_ControlFlowGraphsFromBytecodes_bounded_input():
+  """Test that bytecodes are read lazily from the input iterator."""
+  read_count = 0
+
+  def Bytecodes():
+    nonlocal read_count
+    while True:
+      read_count += 1
+      yield SIMPLE_C_BYTECODE
+
+  generator = llvm_util.ControlFlowGraphsFromBytecodes(
+      Bytecodes(), num_workers=2)
+  graphs = [next(generator) for _ in range(10)]
+  generator.close()
+  assert len(graphs) == 10
+  # Each bytecode produces two graphs, so at most the five bytecodes which
+  # produced the graphs, plus one bytecode per worker, can have been read.
+  assert read_count <= 5 + 2
+
+
 def main(argv):
   """Main entry point."""
   if len(argv) > 1:
@@ -9,6 +9,7 @@ from absl import app
 from absl import flags
 from absl import logging
 
+from experimental.deeplearning.fish import sharded_dataset
 from experimental.deeplearning.fish.proto import fish_pb2
 from labm8 import fs
 from labm8 import pbutil
@@ -19,6 +20,11 @@ FLAGS = flags.FLAGS
 flags.DEFINE_string(
     'export_path', None,
     'Directory to write training dataset to.')
+flags.DEFINE_enum(
+    'export_format', 'pbtxt', ['pbtxt', 'sharded'],
+    'The format to export to. pbtxt writes a proto file per result in a '
+    'directory for each outcome. sharded appends the results to a sharded '
+    'binary dataset.')
 
 
 def _SetIf(out: typing.Dict[str, typing.Any], key: typing.Any,
@@ -33,7 +39,14 @@ def GetClangAssertionStub(assertion_text):
   return ':'.join(assertion_text.split(':')[3:])
 
 
-def ExportOpenCLResults(cursor, start_id, proto_dir):
+def ExportOpenCLResults(
+    cursor, start_id, proto_dir,
+    writer: typing.Optional[sharded_dataset.ShardedDatasetWriter] = None):
+  """Export results with IDs >= start_id.
+
+  If a writer is provided, results are added to it. Else, a proto file is
+  written for each result.
+  """
   batch_size = 1000
   result_id = start_id
   while True:
@@ -82,12 +95,18 @@ LIMIT %s
           assertion_name=(GetClangAssertionStub(assertion_text)
                           if assertion_text else '')
       )
-      pbutil.ToFile(proto, proto_dir / outcome / (str(result_id) + '.pbtxt'))
+      if writer:
+        writer.AddProto(result_id, proto)
+      else:
+        pbutil.ToFile(proto,
+                      proto_dir / outcome / (str(result_id) + '.pbtxt'))
 
     # If we received fewer results than the requested batch size, then we have
     # ran out of data.
     if i < batch_size:
       return
+    # Start the next batch after the last exported result.
+    result_id += 1
 
 
 def GetMySqlCredentials():
@@ -108,9 +127,13 @@ def main(argv):
   if export_path.is_file():
     raise app.UsageError('--export_path must be a directory')
 
-  # Make a directory for each outcome class.
-  for key in fish_pb2.CompilerCrashDiscriminatorTrainingExample.Outcome.keys():
-    (export_path / key.lower()).mkdir(parents=True, exist_ok=True)
+  if FLAGS.export_format == 'pbtxt':
+    # Make a directory for each outcome class.
+    for key in (
+        fish_pb2.CompilerCrashDiscriminatorTrainingExample.Outcome.keys()):
+      (export_path / key.lower()).mkdir(parents=True, exist_ok=True)
+  else:
+    export_path.mkdir(parents=True, exist_ok=True)
 
   logging.info('Connecting to MySQL database')
   credentials = GetMySqlCredentials()
@@ -118,12 +141,19 @@ def main(argv):
                         user=credentials[0], password=credentials[1])
   cursor = cnx.cursor()
   logging.info('Determining last export ID')
-  ids = sorted([
-    int(pathlib.Path(f).stem) for f in fs.lsfiles(
-        export_path, recursive=True, abspaths=True)])
-  last_export_id = ids[-1] if ids else 0
-  logging.info('Exporting results from ID %s', last_export_id)
-  ExportOpenCLResults(cursor, last_export_id, export_path)
+  if FLAGS.export_format == 'pbtxt':
+    ids = sorted([
+      int(pathlib.Path(f).stem) for f in fs.lsfiles(
+          export_path, recursive=True, abspaths=True)])
+    last_export_id = ids[-1] if ids else 0
+    logging.info('Exporting results from ID %s', last_export_id)
+    ExportOpenCLResults(cursor, last_export_id, export_path)
+  else:
+    ids = sharded_dataset.ShardedDataset(export_path).ids
+    last_export_id = int(ids.max()) + 1 if len(ids) else 0
+    logging.info('Exporting results from ID %s', last_export_id)
+    with sharded_dataset.ShardedDatasetWriter(export_path) as writer:
+      ExportOpenCLResults(cursor, last_export_id, export_path, writer)
   cursor.close()
   cnx.close()
   logging.info('Exported training set of %s files to %s',
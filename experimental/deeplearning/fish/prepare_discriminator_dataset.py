@@ -1,7 +1,11 @@
 """Create directories of training, test, and validation data."""
 import collections
+import multiprocessing
 import pathlib
 import random
+import re
+import shutil
+import tempfile
 import typing
 
 import humanize
@@ -9,7 +13,9 @@ import numpy as np
 from absl import app
 from absl import flags
 from absl import logging
+from google.protobuf import text_encoding
 
+from experimental.deeplearning.fish import sharded_dataset
 from experimental.deeplearning.fish.proto import fish_pb2
 from labm8 import labtypes
 from labm8 import pbutil
@@ -20,6 +26,10 @@ FLAGS = flags.FLAGS
 flags.DEFINE_string(
     'export_path', '~/data/experimental/deeplearning/fish/75k',
     'Path to data exported by ./export_clang_opencl_dataset.')
+flags.DEFINE_enum(
+    'dataset_format', 'pbtxt', ['pbtxt', 'sharded'],
+    'The format of the training, validation, and testing data. Use sharded for '
+    'binary datasets which can be memory-mapped by :train_discriminator.')
 flags.DEFINE_string(
     'dataset_root', '~/data/experimental/deeplearning/fish/crash_dataset',
     'Path to export training / validation / testing data to.')
@@ -75,75 +85,308 @@ DatasetSizes = collections.namedtuple(
 TrainingProto = fish_pb2.CompilerCrashDiscriminatorTrainingExample
 
 
-def GetProtos(
-    export_path: pathlib.Path, outcomes: typing.List[str],
-    max_src_len: int) -> typing.List[TrainingProto]:
+class ExampleMetadata(typing.NamedTuple):
+  """The metadata of a training example, used to select examples."""
+  # The path of the example, if the export is a directory of protos.
+  path: typing.Optional[pathlib.Path]
+  src_len: int
+  raised_assertion: bool
+  # The index of the example, if the export is a sharded dataset.
+  index: int = -1
+
+
+# The escape sequences written by text_format for string fields: an octal
+# byte, or a single escaped character.
+_TEXT_FORMAT_ESCAPE_RE = re.compile(r'\\([0-7]{3}|[nrt"\'\\])')
+
+
+def _EscapedStringLength(escaped: str) -> int:
+  """Return the number of characters of a text format string.
+
+  The length is computed from the escape sequences, without unescaping the
+  string.
+
+  Args:
+    escaped: A string field value as written by text_format, without quotes.
+
+  Returns:
+    The number of characters of the unescaped, UTF-8 decoded string.
+  """
+  escapes = _TEXT_FORMAT_ESCAPE_RE.findall(escaped)
+  # Every escape sequence starts with one backslash, and '\\' has two.
+  if escaped.count('\\') != len(escapes) + escapes.count('\\'):
+    return len(text_encoding.CUnescape(escaped).decode('utf-8'))
+  # An escape sequence is one byte. Octal escapes of UTF-8 continuation
+  # bytes, 0o200 to 0o277, are not the start of a character.
+  return (len(escaped) - sum(map(len, escapes)) -
+          sum(len(e) == 3 and e[0] == '2' for e in escapes))
+
+
+def _ReadExampleMetadata(path: pathlib.Path) -> ExampleMetadata:
+  """Read the metadata of a training example, without parsing the proto.
+
+  A training proto in text format has one field per line, so the length of
+  the source and whether it raised an assertion are found by scanning for
+  the lines of those fields. Protos in other formats are parsed.
+  """
+  if path.suffix != '.pbtxt':
+    proto = pbutil.FromFile(path, TrainingProto())
+    return ExampleMetadata(path=path, src_len=len(proto.src),
+                           raised_assertion=proto.raised_assertion)
+  src_len = 0
+  raised_assertion = False
+  with open(path, encoding='utf-8') as f:
+    for line in f:
+      if line.startswith('src: "'):
+        src_len = _EscapedStringLength(
+            line.rstrip('\n')[len('src: "'):-1])
+      elif line.startswith('raised_assertion: '):
+        raised_assertion = line.rstrip() == 'raised_assertion: true'
+  return ExampleMetadata(path=path, src_len=src_len,
+                         raised_assertion=raised_assertion)
+
+
+def GetExampleMetadata(
+    export_path: pathlib.Path, outcomes: typing.List[str], max_src_len: int,
+    pool: typing.Optional[multiprocessing.Pool] = None
+) -> typing.List[ExampleMetadata]:
+  """Read the metadata of the training protos for a set of outcomes.
+
+  Protos are scanned in worker processes, and only their metadata is
+  returned, so the sources of examples which are not selected are never held
+  in memory, and each selected proto is parsed once, by LoadProtos().
+
+  Args:
+    export_path: The path of the exported dataset.
+    outcomes: The outcomes to read.
+    max_src_len: Examples with sources longer than this are ignored.
+    pool: A multiprocessing pool to scan protos on. If not provided, protos
+      are scanned in this process.
+
+  Returns:
+    A list of example metadata, sorted by path.
+  """
   paths = sorted(labtypes.flatten(
       [list((export_path / outcome).iterdir()) for outcome in outcomes]))
-  protos = []
-  for path in paths:
-    proto = pbutil.FromFile(path, TrainingProto())
-    if len(proto.src) > max_src_len:
-      continue
-    protos.append(proto)
-  return protos
-
-
-def LoadPositiveProtos(
-    export_path: pathlib.Path, positive_class_outcomes: typing.List[str],
-    max_src_len: int, max_num: int, assertions_only: bool) -> typing.List[
-  TrainingProto]:
-  """Load positive training protos."""
-  protos = [
-             p for p in
-             GetProtos(export_path, positive_class_outcomes, max_src_len)
-             if (not assertions_only) or p.raised_assertion
-           ][:max_num]
-  logging.info('Loaded %s positive data protos.',
-               humanize.intcomma(len(protos)))
-  return protos
-
-
-def LoadNegativeProtos(
-    export_path: pathlib.Path, positive_protos: typing.List[TrainingProto],
-    negative_class_outcomes: typing.List[str], max_src_len: int,
+  if pool:
+    metadata = pool.imap(_ReadExampleMetadata, paths, chunksize=64)
+  else:
+    metadata = (_ReadExampleMetadata(path) for path in paths)
+  return [m for m in metadata if m.src_len <= max_src_len]
+
+
+def GetShardedExampleMetadata(
+    dataset: sharded_dataset.ShardedDataset, outcomes: typing.List[str],
+    max_src_len: int) -> typing.List[ExampleMetadata]:
+  """Read the metadata of the examples in a sharded dataset for a set of
+  outcomes.
+
+  Args:
+    dataset: The exported dataset.
+    outcomes: The outcomes to read.
+    max_src_len: Examples with sources longer than this are ignored.
+
+  Returns:
+    A list of example metadata, sorted by example ID.
+  """
+  outcome_values = [TrainingProto.Outcome.Value(outcome.upper())
+                    for outcome in outcomes]
+  src_lengths = dataset.src_lengths
+  raised_assertions = dataset.raised_assertions
+  indices, = np.nonzero(np.isin(dataset.outcomes, outcome_values) &
+                        (src_lengths <= max_src_len))
+  indices = indices[np.argsort(dataset.ids[indices], kind='stable')]
+  return [ExampleMetadata(path=None, src_len=int(src_lengths[i]),
+                          raised_assertion=bool(raised_assertions[i]),
+                          index=int(i))
+          for i in indices]
+
+
+def _LoadProto(path: pathlib.Path) -> TrainingProto:
+  return pbutil.FromFile(path, TrainingProto())
+
+
+def LoadProtos(examples: typing.List[ExampleMetadata],
+               pool: typing.Optional[multiprocessing.Pool] = None,
+               dataset: typing.Optional[sharded_dataset.ShardedDataset] = None
+               ) -> typing.List[TrainingProto]:
+  """Load the training protos of a list of examples.
+
+  Args:
+    examples: The examples to load.
+    pool: A multiprocessing pool to parse protos on.
+    dataset: The dataset to read examples from, if the export is a sharded
+      dataset.
+
+  Returns:
+    A list of training protos.
+  """
+  if dataset:
+    return [dataset.GetProto(example.index) for example in examples]
+  paths = [example.path for example in examples]
+  if pool:
+    return pool.map(_LoadProto, paths, chunksize=64)
+  return [_LoadProto(path) for path in paths]
+
+
+def SelectPositiveExamples(
+    examples: typing.List[ExampleMetadata], max_num: int,
+    assertions_only: bool) -> typing.List[ExampleMetadata]:
+  """Select positive training examples."""
+  examples = [
+               e for e in examples
+               if (not assertions_only) or e.raised_assertion
+             ][:max_num]
+  logging.info('Selected %s positive examples.',
+               humanize.intcomma(len(examples)))
+  return examples
+
+
+def _FindAvailable(parent: np.ndarray, i: int) -> int:
+  """Find the nearest available index in a disjoint-set forest.
+
+  Every index points towards the next available index in one direction. Paths
+  are compressed as they are followed, so that removing n indices costs
+  O(n log n) in total.
+  """
+  root = i
+  while parent[root] != root:
+    root = parent[root]
+  while parent[i] != root:
+    parent[i], i = root, parent[i]
+  return root
+
+
+def MatchLengths(positive_lengths: np.ndarray,
+                 negative_lengths: np.ndarray) -> np.ndarray:
+  """Match every positive example to the negative example of closest length.
+
+  Positives are matched greedily in order, and each negative is matched at
+  most once. Ties are broken in favour of the shorter negative. Rather than
+  searching all unmatched negatives for every positive, the negatives are
+  sorted by length, and the nearest unmatched negatives either side of a
+  positive are found using a pair of disjoint-set forests which skip over
+  matched negatives, so matching takes O(n log n) time.
+
+  Args:
+    positive_lengths: The length of each positive example.
+    negative_lengths: The length of each negative example.
+
+  Returns:
+    An array of indices into negative_lengths, one for each positive example
+    which was matched. If there are fewer negatives than positives, only the
+    first len(negative_lengths) positives are matched.
+  """
+  n = len(negative_lengths)
+  order = np.argsort(negative_lengths, kind='stable')
+  sorted_lengths = negative_lengths[order]
+  insertion_points = np.searchsorted(sorted_lengths, positive_lengths)
+
+  # Index i of the forests is sorted_lengths[i - 1], so that 0 and n + 1 are
+  # sentinels meaning "no unmatched negative to the left / right".
+  next_available = np.arange(n + 2)
+  prev_available = np.arange(n + 2)
+
+  matches = []
+  for length, insertion_point in zip(positive_lengths[:n], insertion_points):
+    right = _FindAvailable(next_available, insertion_point + 1)
+    left = _FindAvailable(prev_available, insertion_point)
+    if right > n or (left > 0 and length - sorted_lengths[left - 1] <=
+                     sorted_lengths[right - 1] - length):
+      match = left
+    else:
+      match = right
+    next_available[match] = match + 1
+    prev_available[match] = match - 1
+    matches.append(order[match - 1])
+  return np.array(matches, dtype=np.int64)
+
+
+def SelectNegativeExamples(
+    positive_examples: typing.List[ExampleMetadata],
+    candidate_examples: typing.List[ExampleMetadata],
     balance_class_lengths: bool,
-    balance_class_counts: bool) -> typing.List[TrainingProto]:
-  """Load negative training protos."""
-  candidate_protos = GetProtos(
-      export_path, negative_class_outcomes, max_src_len)
+    balance_class_counts: bool
+) -> typing.Tuple[typing.List[ExampleMetadata], typing.List[ExampleMetadata]]:
+  """Select negative training examples.
 
+  Returns:
+    A tuple of the positive examples and the negative examples. If classes are
+    balanced, positive examples without a matching negative are dropped.
+  """
   if balance_class_lengths:
-    positive_proto_sizes = [len(p.src) for p in positive_protos]
-    logging.info('Loaded %s negative protos. Balancing lengths ...',
-                 humanize.intcomma(len(candidate_protos)))
-    negative_proto_sizes = np.array(
-        [len(p.src) for p in candidate_protos], dtype=np.int32)
-    negative_protos = []
-    for i, positive_proto_size in enumerate(positive_proto_sizes):
-      size_diffs = np.abs(negative_proto_sizes - positive_proto_size)
-      idx_of_closest: int = np.argmin(size_diffs)
-      logging.info('Found negative example of size %s to match positive '
-                   'example of size %s (diff %s)',
-                   humanize.intcomma(negative_proto_sizes[idx_of_closest]),
-                   humanize.intcomma(positive_proto_size),
-                   size_diffs.min())
-      negative_protos.append(candidate_protos[idx_of_closest])
-      negative_proto_sizes = np.delete(negative_proto_sizes, [idx_of_closest])
-      del candidate_protos[idx_of_closest]
-      if not candidate_protos:
-        logging.warning('Ran out of negative examples to choose from!')
-        break
-    positive_protos = positive_protos[:i]
+    logging.info('Read %s negative examples. Balancing lengths ...',
+                 humanize.intcomma(len(candidate_examples)))
+    matches = MatchLengths(
+        np.array([e.src_len for e in positive_examples], dtype=np.int32),
+        np.array([e.src_len for e in candidate_examples], dtype=np.int32))
+    if len(matches) < len(positive_examples):
+      logging.warning('Ran out of negative examples to choose from!')
+    positive_examples = positive_examples[:len(matches)]
+    negative_examples = [candidate_examples[i] for i in matches]
+    if negative_examples:
+      size_diffs = np.abs(
+          np.array([e.src_len for e in positive_examples]) -
+          np.array([e.src_len for e in negative_examples]))
+      logging.info('Matched negative examples with mean length difference '
+                   '%.1f (max %s)', size_diffs.mean(),
+                   humanize.intcomma(size_diffs.max()))
   else:
+    negative_examples = candidate_examples
     if balance_class_counts:
-      min_count = min(len(positive_protos), len(negative_protos))
-      candidate_protos = candidate_protos[:min_count]
-      positive_protos = positive_protos[:min_count]
-    negative_protos = candidate_protos
-  logging.info('Loaded %s negative data protos',
-               humanize.intcomma(len(negative_protos)))
-  return positive_protos, negative_protos
+      min_count = min(len(positive_examples), len(negative_examples))
+      negative_examples = negative_examples[:min_count]
+      positive_examples = positive_examples[:min_count]
+  logging.info('Selected %s negative examples',
+               humanize.intcomma(len(negative_examples)))
+  return positive_examples, negative_examples
+
+
+def WriteSplit(path: pathlib.Path, positive_protos: typing.List[TrainingProto],
+               negative_protos: typing.List[TrainingProto],
+               dataset_format: str) -> None:
+  """Write the positive and negative examples of a dataset split.
+
+  The split is written to a temporary directory which then replaces path, so
+  that no examples of a previous split are kept, and an interrupted write
+  leaves the previous split intact.
+
+  Args:
+    path: The directory to write the split to.
+    positive_protos: The positive examples.
+    negative_protos: The negative examples.
+    dataset_format: Either 'pbtxt', to write a proto file per example, or
+      'sharded', to write a sharded dataset.
+  """
+  path.parent.mkdir(exist_ok=True, parents=True)
+  tmp_path = pathlib.Path(
+      tempfile.mkdtemp(prefix=f'.{path.name}.', dir=path.parent))
+  try:
+    if dataset_format == 'sharded':
+      with sharded_dataset.ShardedDatasetWriter(tmp_path) as writer:
+        for i, proto in enumerate(positive_protos + negative_protos):
+          writer.AddProto(i, proto, label=int(i < len(positive_protos)))
+    else:
+      for i, proto in enumerate(positive_protos):
+        pbutil.ToFile(proto, tmp_path / f'positive-{i:04d}.pbtxt')
+      for i, proto in enumerate(negative_protos):
+        pbutil.ToFile(proto, tmp_path / f'negative-{i:04d}.pbtxt')
+    if path.exists():
+      # A directory cannot be renamed over a non-empty one, so the old split
+      # is moved aside first.
+      old_path = pathlib.Path(
+          tempfile.mkdtemp(prefix=f'.{path.name}.', dir=path.parent))
+      path.rename(old_path / path.name)
+      tmp_path.rename(path)
+      shutil.rmtree(old_path)
+    else:
+      tmp_path.rename(path)
+  finally:
+    if tmp_path.exists():
+      shutil.rmtree(tmp_path)
+  logging.info('Wrote %s %s examples',
+               humanize.intcomma(len(positive_protos) + len(negative_protos)),
+               path.name)
 
 
 def main(argv):
@@ -169,14 +412,32 @@ def main(argv):
       FLAGS.training_ratio, FLAGS.validation_ratio, FLAGS.testing_ratio)
   assert sum(ratios) <= 1
 
-  # Load protos.
-  positive_protos = LoadPositiveProtos(
-      export_path, FLAGS.positive_class_outcomes, FLAGS.max_src_len,
-      FLAGS.max_protos, FLAGS.assertions_only)
-  positive_protos, negative_protos = LoadNegativeProtos(
-      export_path, positive_protos, FLAGS.negative_class_outcomes,
-      FLAGS.max_src_len, FLAGS.balance_class_lengths,
-      FLAGS.balance_class_counts)
+  # Select examples using only their metadata, then load the protos of the
+  # selected examples.
+  dataset = None
+  if sharded_dataset.ShardedDataset.IsShardedDataset(export_path):
+    dataset = sharded_dataset.ShardedDataset(export_path)
+  with multiprocessing.Pool() as pool:
+    if dataset:
+      positive_candidates = GetShardedExampleMetadata(
+          dataset, FLAGS.positive_class_outcomes, FLAGS.max_src_len)
+      negative_candidates = GetShardedExampleMetadata(
+          dataset, FLAGS.negative_class_outcomes, FLAGS.max_src_len)
+    else:
+      positive_candidates = GetExampleMetadata(
+          export_path, FLAGS.positive_class_outcomes, FLAGS.max_src_len, pool)
+      negative_candidates = GetExampleMetadata(
+          export_path, FLAGS.negative_class_outcomes, FLAGS.max_src_len, pool)
+    positive_examples = SelectPositiveExamples(
+        positive_candidates, FLAGS.max_protos, FLAGS.assertions_only)
+    positive_examples, negative_examples = SelectNegativeExamples(
+        positive_examples, negative_candidates, FLAGS.balance_class_lengths,
+        FLAGS.balance_class_counts)
+    positive_protos = LoadProtos(positive_examples, pool, dataset)
+    negative_protos = LoadProtos(negative_examples, pool, dataset)
+  logging.info('Loaded %s positive and %s negative protos',
+               humanize.intcomma(len(positive_protos)),
+               humanize.intcomma(len(negative_protos)))
 
   positive_sizes = DatasetSizes(
       int(len(positive_protos) * FLAGS.training_ratio),
@@ -189,46 +450,17 @@ def main(argv):
       int(len(negative_protos) * FLAGS.testing_ratio),
   )
 
-  # Create output directories.
-  (dataset_root / 'training').mkdir(exist_ok=True, parents=True)
-  (dataset_root / 'validation').mkdir(exist_ok=True, parents=True)
-  (dataset_root / 'testing').mkdir(exist_ok=True, parents=True)
-
   logging.info('Shuffling protos with seed %d', FLAGS.seed)
   random.seed(FLAGS.seed)
   random.shuffle(positive_protos)
   random.shuffle(negative_protos)
 
-  for i, proto in enumerate(positive_protos[:positive_sizes[0]]):
-    pbutil.ToFile(
-        proto, (dataset_root / 'training' / f'positive-{i:04d}.pbtxt'))
-  for i, proto in enumerate(negative_protos[:negative_sizes[0]]):
-    pbutil.ToFile(
-        proto, (dataset_root / 'training' / f'negative-{i:04d}.pbtxt'))
-  logging.info('Wrote %s training examples',
-               humanize.intcomma(positive_sizes[0] + negative_sizes[0]))
-  positive_protos = positive_protos[positive_sizes[0]:]
-  negative_protos = negative_protos[negative_sizes[0]:]
-
-  for i, proto in enumerate(positive_protos[:positive_sizes[1]]):
-    pbutil.ToFile(
-        proto, (dataset_root / 'validation' / f'positive-{i:04d}.pbtxt'))
-  for i, proto in enumerate(negative_protos[:negative_sizes[1]]):
-    pbutil.ToFile(
-        proto, (dataset_root / 'validation' / f'negative-{i:04d}.pbtxt'))
-  logging.info('Wrote %s validation examples',
-               humanize.intcomma(positive_sizes[1] + negative_sizes[1]))
-  positive_protos = positive_protos[positive_sizes[1]:]
-  negative_protos = negative_protos[negative_sizes[1]:]
-
-  for i, proto in enumerate(positive_protos[:positive_sizes[2]]):
-    pbutil.ToFile(
-        proto, (dataset_root / 'testing' / f'positive-{i:04d}.pbtxt'))
-  for i, proto in enumerate(negative_protos[:negative_sizes[2]]):
-    pbutil.ToFile(
-        proto, (dataset_root / 'testing' / f'negative-{i:04d}.pbtxt'))
-  logging.info('Wrote %s testing examples',
-               humanize.intcomma(positive_sizes[2] + negative_sizes[2]))
+  for split, positive_size, negative_size in zip(
+      ['training', 'validation', 'testing'], positive_sizes, negative_sizes):
+    WriteSplit(dataset_root / split, positive_protos[:positive_size],
+               negative_protos[:negative_size], FLAGS.dataset_format)
+    positive_protos = positive_protos[positive_size:]
+    negative_protos = negative_protos[negative_size:]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,187 @@
+"""Unit tests for //experimental/deeplearning/fish:prepare_discriminator_dataset.
+"""
+import pathlib
+import sys
+import tempfile
+
+import numpy as np
+import pytest
+from absl import app
+from absl import flags
+
+from experimental.deeplearning.fish import prepare_discriminator_dataset
+from experimental.deeplearning.fish import sharded_dataset
+from experimental.deeplearning.fish.proto import fish_pb2
+from labm8 import pbutil
+
+
+FLAGS = flags.FLAGS
+
+
+def _GreedyMatch(positive_lengths, negative_lengths):
+  """A quadratic greedy matching, with ties broken by shorter length."""
+  negative_lengths = list(negative_lengths)
+  size_diffs = []
+  for length in positive_lengths:
+    if not negative_lengths:
+      break
+    idx = min(range(len(negative_lengths)),
+              key=lambda i: (abs(negative_lengths[i] - length),
+                             negative_lengths[i]))
+    size_diffs.append(abs(negative_lengths[idx] - length))
+    del negative_lengths[idx]
+  return size_diffs
+
+
+def test_MatchLengths_exact_matches():
+  matches = prepare_discriminator_dataset.MatchLengths(
+      np.array([5, 1, 3]), np.array([1, 2, 3, 4, 5]))
+  assert list(matches) == [4, 0, 2]
+
+
+def test_MatchLengths_negative_used_once():
+  matches = prepare_discriminator_dataset.MatchLengths(
+      np.array([3, 3, 3]), np.array([1, 3, 10]))
+  assert list(matches) == [1, 0, 2]
+
+
+def test_MatchLengths_ran_out_of_negatives():
+  matches = prepare_discriminator_dataset.MatchLengths(
+      np.array([1, 2, 3]), np.array([2, 3]))
+  assert list(matches) == [0, 1]
+
+
+def test_MatchLengths_no_negatives():
+  matches = prepare_discriminator_dataset.MatchLengths(
+      np.array([1, 2, 3]), np.array([], dtype=np.int32))
+  assert not len(matches)
+
+
+def test_MatchLengths_equivalent_to_greedy_search():
+  """Test that length differences are the same as a greedy search."""
+  rand = np.random.RandomState(0)
+  for _ in range(20):
+    positive_lengths = rand.randint(0, 100, size=rand.randint(1, 100))
+    negative_lengths = rand.randint(0, 100, size=rand.randint(1, 100))
+    matches = prepare_discriminator_dataset.MatchLengths(
+        positive_lengths, negative_lengths)
+    assert len(set(matches)) == len(matches)
+    size_diffs = np.abs(positive_lengths[:len(matches)] -
+                        negative_lengths[matches])
+    assert list(size_diffs) == _GreedyMatch(positive_lengths,
+                                            negative_lengths)
+
+
+def _Example(path: str, src_len: int, raised_assertion: bool = False):
+  return prepare_discriminator_dataset.ExampleMetadata(
+      path=pathlib.Path(path), src_len=src_len,
+      raised_assertion=raised_assertion)
+
+
+def test_SelectPositiveExamples_assertions_only():
+  examples = [_Example('a', 1, True), _Example('b', 1, False),
+              _Example('c', 1, True)]
+  selected = prepare_discriminator_dataset.SelectPositiveExamples(
+      examples, max_num=10, assertions_only=True)
+  assert [e.path.name for e in selected] == ['a', 'c']
+
+
+def test_SelectNegativeExamples_balance_class_lengths():
+  positives = [_Example('p1', 10), _Example('p2', 20), _Example('p3', 30)]
+  candidates = [_Example('n1', 29), _Example('n2', 11)]
+  positives, negatives = prepare_discriminator_dataset.SelectNegativeExamples(
+      positives, candidates, balance_class_lengths=True,
+      balance_class_counts=False)
+  assert [e.path.name for e in positives] == ['p1', 'p2']
+  assert [e.path.name for e in negatives] == ['n2', 'n1']
+
+
+def test_SelectNegativeExamples_balance_class_counts():
+  positives = [_Example('p1', 10), _Example('p2', 20), _Example('p3', 30)]
+  candidates = [_Example('n1', 29), _Example('n2', 11)]
+  positives, negatives = prepare_discriminator_dataset.SelectNegativeExamples(
+      positives, candidates, balance_class_lengths=False,
+      balance_class_counts=True)
+  assert len(positives) == 2
+  assert len(negatives) == 2
+
+
+def test_GetExampleMetadata_LoadProtos():
+  with tempfile.TemporaryDirectory() as d:
+    export_path = pathlib.Path(d)
+    (export_path / 'pass').mkdir()
+    for i, src in enumerate(['a', 'abc', 'abcdef']):
+      pbutil.ToFile(fish_pb2.CompilerCrashDiscriminatorTrainingExample(
+          src=src, raised_assertion=bool(i)),
+          export_path / 'pass' / f'{i}.pbtxt')
+    examples = prepare_discriminator_dataset.GetExampleMetadata(
+        export_path, ['pass'], max_src_len=3)
+    assert [(e.path.name, e.src_len, e.raised_assertion)
+            for e in examples] == [('0.pbtxt', 1, False),
+                                   ('1.pbtxt', 3, True)]
+    protos = prepare_discriminator_dataset.LoadProtos(examples)
+    assert [p.src for p in protos] == ['a', 'abc']
+
+
+def test_GetExampleMetadata_escaped_sources():
+  """Test that source lengths are read from escaped text format strings."""
+  srcs = ['', 'a"b\\c\n\t', 'é中🙂', 'src: "x"\nraised_assertion: true']
+  with tempfile.TemporaryDirectory() as d:
+    export_path = pathlib.Path(d)
+    (export_path / 'pass').mkdir()
+    for i, src in enumerate(srcs):
+      pbutil.ToFile(fish_pb2.CompilerCrashDiscriminatorTrainingExample(
+          src=src, outcome=fish_pb2.CompilerCrashDiscriminatorTrainingExample.
+          PASS, assertion_name='src: "y"'), export_path / 'pass' / f'{i}.pbtxt')
+    examples = prepare_discriminator_dataset.GetExampleMetadata(
+        export_path, ['pass'], max_src_len=100)
+  assert [e.src_len for e in examples] == [len(src) for src in srcs]
+  assert not any(e.raised_assertion for e in examples)
+
+
+def test_WriteSplit_sharded_replaces_split():
+  """Test that writing a split again replaces the previous examples."""
+  protos = [fish_pb2.CompilerCrashDiscriminatorTrainingExample(src=str(i))
+            for i in range(5)]
+  with tempfile.TemporaryDirectory() as d:
+    path = pathlib.Path(d) / 'training'
+    prepare_discriminator_dataset.WriteSplit(
+        path, protos[:3], protos[3:], 'sharded')
+    prepare_discriminator_dataset.WriteSplit(
+        path, protos[:1], protos[1:2], 'sharded')
+    dataset = sharded_dataset.ShardedDataset(path)
+    assert len(dataset) == 2
+    assert list(dataset.labels) == [1, 0]
+    assert [p.name for p in pathlib.Path(d).iterdir()] == ['training']
+
+
+def test_EscapedStringLength():
+  """Test that lengths match those of the unescaped strings."""
+  assert prepare_discriminator_dataset._EscapedStringLength('') == 0
+  assert prepare_discriminator_dataset._EscapedStringLength('a\\"\\n') == 3
+  # 'é' as UTF-8 octal escapes, and a backslash followed by digits.
+  assert prepare_discriminator_dataset._EscapedStringLength(
+      '\\303\\251\\\\123') == 5
+  # An escape which text_format does not write.
+  assert prepare_discriminator_dataset._EscapedStringLength('\\x41') == 1
+
+
+def test_benchmark_MatchLengths(benchmark):
+  """Benchmark matching a dataset of 75k examples."""
+  rand = np.random.RandomState(0)
+  positive_lengths = rand.randint(0, 10000, size=25000)
+  negative_lengths = rand.randint(0, 10000, size=50000)
+  benchmark(prepare_discriminator_dataset.MatchLengths, positive_lengths,
+            negative_lengths)
+
+
+def main(argv):
+  """Main entry point."""
+  if len(argv) > 1:
+    raise app.UsageError("Unknown arguments: '{}'.".format(' '.join(argv[1:])))
+  sys.exit(pytest.main([__file__, '-vv']))
+
+
+if __name__ == '__main__':
+  flags.FLAGS(['argv[0]'])
+  app.run(main)
@@ -0,0 +1,257 @@
+"""A sharded binary format for discriminator datasets.
+
+A dataset is a directory of shards. Each shard is a directory of .npy arrays,
+so that shards can be memory-mapped and examples read without parsing:
+
+    shard-00000/
+      ids.npy                # int64, the ID of each example.
+      outcomes.npy           # int8, the Outcome enum value of each example.
+      raised_assertions.npy  # bool, whether each example raised an assertion.
+      labels.npy             # int8, 1 for positive examples, 0 for negative
+                             #   examples, or UNLABELLED.
+      offsets.npy            # int64, the offset of each example's source in
+                             #   chars.npy, followed by the length of
+                             #   chars.npy.
+      chars.npy              # The Unicode code points of every source,
+                             #   concatenated. The dtype is the smallest
+                             #   unsigned integer type which holds the largest
+                             #   code point.
+
+Shards are written to a temporary directory and renamed, so a dataset can be
+appended to incrementally by adding shards, and a partially written shard is
+never read.
+"""
+import pathlib
+import shutil
+import typing
+
+import numpy as np
+
+from experimental.deeplearning.fish.proto import fish_pb2
+
+
+# The label of examples which are neither positive nor negative.
+UNLABELLED = -1
+
+# The arrays of a shard, other than the sources.
+_FIELDS = ['ids', 'outcomes', 'raised_assertions', 'labels']
+_FIELD_DTYPES = {
+  'ids': np.int64,
+  'outcomes': np.int8,
+  'raised_assertions': np.bool_,
+  'labels': np.int8,
+}
+
+
+def _EncodeChars(srcs: typing.List[str]) -> typing.Tuple[np.ndarray,
+                                                         np.ndarray]:
+  """Encode source strings as concatenated code points and offsets."""
+  chars = np.frombuffer(''.join(srcs).encode('utf-32-le'), dtype=np.uint32)
+  offsets = np.zeros(len(srcs) + 1, dtype=np.int64)
+  np.cumsum([len(src) for src in srcs], out=offsets[1:])
+  max_char = int(chars.max()) if len(chars) else 0
+  if max_char < 2 ** 8:
+    chars = chars.astype(np.uint8)
+  elif max_char < 2 ** 16:
+    chars = chars.astype(np.uint16)
+  return chars, offsets
+
+
+class ShardedDatasetWriter(object):
+  """Append examples to a sharded dataset.
+
+  Examples are buffered in memory, and a shard is written once shard_size
+  examples have been added, or when the writer is closed.
+  """
+
+  def __init__(self, path: pathlib.Path, shard_size: int = 10000):
+    self.path = path
+    self.shard_size = shard_size
+    self.path.mkdir(parents=True, exist_ok=True)
+    self._buffer = {field: [] for field in _FIELDS}
+    self._srcs = []
+
+  def Add(self, example_id: int, src: str, outcome: int,
+          raised_assertion: bool, label: int = UNLABELLED) -> None:
+    """Add an example to the dataset."""
+    self._buffer['ids'].append(example_id)
+    self._buffer['outcomes'].append(outcome)
+    self._buffer['raised_assertions'].append(raised_assertion)
+    self._buffer['labels'].append(label)
+    self._srcs.append(src)
+    if len(self._srcs) >= self.shard_size:
+      self.Flush()
+
+  def AddProto(self, example_id: int,
+               proto: fish_pb2.CompilerCrashDiscriminatorTrainingExample,
+               label: int = UNLABELLED) -> None:
+    """Add an example from a training proto."""
+    self.Add(example_id, proto.src, proto.outcome, proto.raised_assertion,
+             label)
+
+  def Flush(self) -> None:
+    """Write the buffered examples to a new shard."""
+    if not self._srcs:
+      return
+    shard_paths = _ShardPaths(self.path)
+    shard_num = 0
+    if shard_paths:
+      shard_num = int(shard_paths[-1].name.split('-')[1]) + 1
+    shard_path = self.path / f'shard-{shard_num:05d}'
+    tmp_path = self.path / f'.{shard_path.name}.tmp'
+    if tmp_path.is_dir():
+      shutil.rmtree(tmp_path)
+    tmp_path.mkdir()
+
+    for field in _FIELDS:
+      np.save(tmp_path / f'{field}.npy',
+              np.array(self._buffer[field], dtype=_FIELD_DTYPES[field]))
+    chars, offsets = _EncodeChars(self._srcs)
+    np.save(tmp_path / 'chars.npy', chars)
+    np.save(tmp_path / 'offsets.npy', offsets)
+    tmp_path.rename(shard_path)
+
+    self._buffer = {field: [] for field in _FIELDS}
+    self._srcs = []
+
+  def __enter__(self) -> 'ShardedDatasetWriter':
+    return self
+
+  def __exit__(self, exc_type, *args) -> None:
+    if not exc_type:
+      self.Flush()
+
+
+def _ShardPaths(path: pathlib.Path) -> typing.List[pathlib.Path]:
+  return sorted(p for p in path.iterdir()
+                if p.is_dir() and p.name.startswith('shard-'))
+
+
+class _Shard(object):
+  """The memory-mapped arrays of a shard."""
+
+  def __init__(self, path: pathlib.Path):
+    for field in _FIELDS + ['chars', 'offsets']:
+      setattr(self, field, np.load(path / f'{field}.npy', mmap_mode='r'))
+
+
+class ShardedDataset(object):
+  """A read-only view of a sharded dataset.
+
+  The arrays of all shards are memory-mapped. Per-example fields are
+  concatenated across shards, and examples are indexed from zero in shard
+  order.
+  """
+
+  def __init__(self, path: pathlib.Path):
+    self.path = path
+    self.shards = [_Shard(p) for p in _ShardPaths(path)]
+    # The index of the first example of each shard, followed by the number of
+    # examples.
+    self._shard_starts = np.zeros(len(self.shards) + 1, dtype=np.int64)
+    np.cumsum([len(s.ids) for s in self.shards], out=self._shard_starts[1:])
+
+  @staticmethod
+  def IsShardedDataset(path: pathlib.Path) -> bool:
+    """Return whether a path is a sharded dataset."""
+    return path.is_dir() and bool(_ShardPaths(path))
+
+  def __len__(self) -> int:
+    return int(self._shard_starts[-1])
+
+  def _Concatenate(self, field: str) -> np.ndarray:
+    if not self.shards:
+      return np.array([], dtype=_FIELD_DTYPES[field])
+    return np.concatenate([getattr(s, field) for s in self.shards])
+
+  @property
+  def ids(self) -> np.ndarray:
+    return self._Concatenate('ids')
+
+  @property
+  def outcomes(self) -> np.ndarray:
+    return self._Concatenate('outcomes')
+
+  @property
+  def raised_assertions(self) -> np.ndarray:
+    return self._Concatenate('raised_assertions')
+
+  @property
+  def labels(self) -> np.ndarray:
+    return self._Concatenate('labels')
+
+  @property
+  def src_lengths(self) -> np.ndarray:
+    """The number of characters in each example's source."""
+    if not self.shards:
+      return np.array([], dtype=np.int64)
+    return np.concatenate([np.diff(s.offsets) for s in self.shards])
+
+  def _Locate(self, index: int) -> typing.Tuple[_Shard, int]:
+    shard_num = int(
+        np.searchsorted(self._shard_starts, index, side='right')) - 1
+    return self.shards[shard_num], index - int(self._shard_starts[shard_num])
+
+  def GetSrc(self, index: int) -> str:
+    """Return the source of an example."""
+    shard, i = self._Locate(index)
+    chars = shard.chars[shard.offsets[i]:shard.offsets[i + 1]]
+    return chars.astype(np.uint32).tobytes().decode('utf-32-le')
+
+  def GetProto(self, index: int
+               ) -> fish_pb2.CompilerCrashDiscriminatorTrainingExample:
+    """Return an example as a training proto."""
+    shard, i = self._Locate(index)
+    return fish_pb2.CompilerCrashDiscriminatorTrainingExample(
+        src=self.GetSrc(index), outcome=int(shard.outcomes[i]),
+        raised_assertion=bool(shard.raised_assertions[i]))
+
+  def CharCounts(self) -> np.ndarray:
+    """Count the occurrences of every code point in the dataset's sources.
+
+    Returns:
+      An array indexed by code point.
+    """
+    counts = np.zeros(0, dtype=np.int64)
+    for shard in self.shards:
+      shard_counts = np.bincount(shard.chars)
+      if len(shard_counts) > len(counts):
+        counts = np.pad(counts, (0, len(shard_counts) - len(counts)),
+                        'constant')
+      counts[:len(shard_counts)] += shard_counts
+    return counts
+
+  def EncodeAndPad(self, lookup: np.ndarray, padded_length: int,
+                   pad_value: int, batch_size: int = 1024) -> np.ndarray:
+    """Encode and pad the sources of every example.
+
+    Sources are padded and truncated at the start, as by
+    keras.preprocessing.sequence.pad_sequences() with default arguments.
+
+    Args:
+      lookup: An array which maps a code point to its encoded value.
+      padded_length: The length of the encoded sequences.
+      pad_value: The value used to pad sequences shorter than padded_length.
+      batch_size: The number of sources to gather at a time, which bounds the
+        size of the temporary index arrays.
+
+    Returns:
+      An int32 array of shape (len(self), padded_length).
+    """
+    encoded = np.full((len(self), padded_length), pad_value, dtype=np.int32)
+    positions = np.arange(padded_length, dtype=np.int64)
+    for shard, start in zip(self.shards, self._shard_starts):
+      if not len(shard.chars):
+        continue
+      offsets = np.asarray(shard.offsets)
+      for i in range(0, len(offsets) - 1, batch_size):
+        begins = offsets[i:i + batch_size]
+        ends = offsets[i + 1:i + batch_size + 1]
+        begins = begins[:len(ends)]
+        # Right-align the last padded_length chars of each source.
+        char_indices = ends[:, np.newaxis] - padded_length + positions
+        valid = char_indices >= begins[:, np.newaxis]
+        chars = np.asarray(shard.chars)[np.where(valid, char_indices, 0)]
+        rows = encoded[start + i:start + i + len(ends)]
+        rows[valid] = lookup[chars[valid]]
+    return encoded
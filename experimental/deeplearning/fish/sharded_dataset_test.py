@@ -0,0 +1,144 @@
+"""Unit tests for //experimental/deeplearning/fish:sharded_dataset."""
+import pathlib
+import sys
+import tempfile
+
+import numpy as np
+import pytest
+from absl import app
+from absl import flags
+
+from experimental.deeplearning.fish import sharded_dataset
+from experimental.deeplearning.fish.proto import fish_pb2
+
+
+FLAGS = flags.FLAGS
+
+
+@pytest.fixture(scope='function')
+def tempdir() -> pathlib.Path:
+  with tempfile.TemporaryDirectory() as d:
+    yield pathlib.Path(d)
+
+
+def _PadSequences(seqs, maxlen, value):
+  """Reference implementation of keras' pad_sequences() default behaviour."""
+  padded = np.full((len(seqs), maxlen), value, dtype=np.int32)
+  for i, seq in enumerate(seqs):
+    seq = seq[-maxlen:]
+    if len(seq):
+      padded[i, -len(seq):] = seq
+  return padded
+
+
+def test_ShardedDataset_empty(tempdir: pathlib.Path):
+  assert not sharded_dataset.ShardedDataset.IsShardedDataset(tempdir)
+  dataset = sharded_dataset.ShardedDataset(tempdir)
+  assert len(dataset) == 0
+  assert not len(dataset.ids)
+  assert not len(dataset.src_lengths)
+
+
+def test_ShardedDatasetWriter_round_trip(tempdir: pathlib.Path):
+  srcs = ['kernel void A() {}', '', 'kernel void B(global int* a) {}']
+  with sharded_dataset.ShardedDatasetWriter(tempdir, shard_size=2) as writer:
+    for i, src in enumerate(srcs):
+      writer.Add(i + 10, src, outcome=fish_pb2.
+                 CompilerCrashDiscriminatorTrainingExample.BUILD_CRASH,
+                 raised_assertion=bool(i % 2), label=i % 2)
+  assert sharded_dataset.ShardedDataset.IsShardedDataset(tempdir)
+  dataset = sharded_dataset.ShardedDataset(tempdir)
+  assert len(dataset.shards) == 2
+  assert len(dataset) == 3
+  assert list(dataset.ids) == [10, 11, 12]
+  assert list(dataset.labels) == [0, 1, 0]
+  assert list(dataset.raised_assertions) == [False, True, False]
+  assert list(dataset.src_lengths) == [len(s) for s in srcs]
+  assert [dataset.GetSrc(i) for i in range(3)] == srcs
+  assert dataset.GetProto(1).raised_assertion
+
+
+def test_ShardedDatasetWriter_append(tempdir: pathlib.Path):
+  """Test that a dataset can be appended to by a new writer."""
+  with sharded_dataset.ShardedDatasetWriter(tempdir) as writer:
+    writer.AddProto(0, fish_pb2.CompilerCrashDiscriminatorTrainingExample(
+        src='a'))
+  with sharded_dataset.ShardedDatasetWriter(tempdir) as writer:
+    writer.AddProto(1, fish_pb2.CompilerCrashDiscriminatorTrainingExample(
+        src='b'))
+  dataset = sharded_dataset.ShardedDataset(tempdir)
+  assert len(dataset.shards) == 2
+  assert list(dataset.ids) == [0, 1]
+  assert list(dataset.labels) == [sharded_dataset.UNLABELLED] * 2
+
+
+def test_ShardedDatasetWriter_error_discards_buffer(tempdir: pathlib.Path):
+  with pytest.raises(ValueError):
+    with sharded_dataset.ShardedDatasetWriter(tempdir) as writer:
+      writer.Add(0, 'a', 0, False)
+      raise ValueError
+  assert len(sharded_dataset.ShardedDataset(tempdir)) == 0
+
+
+def test_ShardedDataset_unicode(tempdir: pathlib.Path):
+  srcs = ['ascii', 'café', '中文', '\U0001f600']
+  with sharded_dataset.ShardedDatasetWriter(tempdir) as writer:
+    for i, src in enumerate(srcs):
+      writer.Add(i, src, 0, False)
+  dataset = sharded_dataset.ShardedDataset(tempdir)
+  assert dataset.shards[0].chars.dtype == np.uint32
+  assert [dataset.GetSrc(i) for i in range(len(srcs))] == srcs
+
+
+def test_ShardedDataset_CharCounts(tempdir: pathlib.Path):
+  with sharded_dataset.ShardedDatasetWriter(tempdir, shard_size=1) as writer:
+    writer.Add(0, 'aab', 0, False)
+    writer.Add(1, 'éa', 0, False)
+  counts = sharded_dataset.ShardedDataset(tempdir).CharCounts()
+  assert counts[ord('a')] == 3
+  assert counts[ord('b')] == 1
+  assert counts[ord('é')] == 1
+  assert counts.sum() == 5
+
+
+def test_ShardedDataset_EncodeAndPad(tempdir: pathlib.Path):
+  rand = np.random.RandomState(0)
+  srcs = [''.join(rand.choice(list('abcdef'), size=rand.randint(0, 20)))
+          for _ in range(50)]
+  with sharded_dataset.ShardedDatasetWriter(tempdir, shard_size=7) as writer:
+    for i, src in enumerate(srcs):
+      writer.Add(i, src, 0, False)
+  dataset = sharded_dataset.ShardedDataset(tempdir)
+  lookup = np.zeros(128, dtype=np.int32)
+  for i, c in enumerate('abcdef'):
+    lookup[ord(c)] = i
+  encoded = dataset.EncodeAndPad(lookup, padded_length=10, pad_value=6,
+                                 batch_size=3)
+  expected = _PadSequences([[lookup[ord(c)] for c in src] for src in srcs],
+                           maxlen=10, value=6)
+  np.testing.assert_array_equal(encoded, expected)
+
+
+def test_benchmark_ShardedDataset_EncodeAndPad(benchmark, tempdir):
+  """Benchmark encoding a dataset of 10k examples."""
+  rand = np.random.RandomState(0)
+  chars = rand.randint(ord('a'), ord('z'), size=10000 * 1000, dtype=np.uint8)
+  text = chars.tobytes().decode('ascii')
+  with sharded_dataset.ShardedDatasetWriter(tempdir) as writer:
+    for i in range(10000):
+      writer.Add(i, text[i * 1000:(i + 1) * 1000], 0, False)
+  dataset = sharded_dataset.ShardedDataset(tempdir)
+  lookup = np.arange(128, dtype=np.int32)
+  benchmark(dataset.EncodeAndPad, lookup, 1024, 0)
+
+
+def main(argv):
+  """Main entry point."""
+  if len(argv) > 1:
+    raise app.UsageError("Unknown arguments: '{}'.".format(' '.join(argv[1:])))
+  sys.exit(pytest.main([__file__, '-vv']))
+
+
+if __name__ == '__main__':
+  flags.FLAGS(['argv[0]'])
+  app.run(main)
@@ -14,6 +14,7 @@ from keras.preprocessing import sequence
 
 from deeplearning.clgen import telemetry
 from deeplearning.clgen.corpuses import atomizers
+from experimental.deeplearning.fish import sharded_dataset
 from experimental.deeplearning.fish.proto import fish_pb2
 from labm8 import pbutil
 
@@ -23,7 +24,8 @@ FLAGS = flags.FLAGS
 flags.DEFINE_string(
     'dataset_root', None,
     'Directory to read training data from, as generated by '
-    ':prepare_discriminator_dataset.')
+    ':prepare_discriminator_dataset. Both the pbtxt and sharded dataset '
+    'formats are supported.')
 flags.DEFINE_string(
     'model_path', None,
     'Directory to save model files to.')
@@ -99,15 +101,16 @@ def BuildKerasModel(
 
 def LoadPositiveNegativeProtos(path: pathlib.Path) -> PositiveNegativeDataset:
   """Load positive and negative training protos from a directory."""
+  paths = list(path.iterdir())
   positive_protos = [
     pbutil.FromFile(p, fish_pb2.CompilerCrashDiscriminatorTrainingExample())
-    for p in path.iterdir() if p.name.startswith('positive-')
+    for p in paths if p.name.startswith('positive-')
   ]
   logging.info(
       'Loaded %s positive protos', humanize.intcomma(len(positive_protos)))
   negative_protos = [
     pbutil.FromFile(p, fish_pb2.CompilerCrashDiscriminatorTrainingExample())
-    for p in path.iterdir() if p.name.startswith('negative-')
+    for p in paths if p.name.startswith('negative-')
   ]
   logging.info(
       'Loaded %s negative protos', humanize.intcomma(len(negative_protos)))
@@ -126,6 +129,96 @@ def ProtosToModelData(protos: PositiveNegativeDataset,
   return x, y
 
 
+def AtomizerFromCharCounts(
+    char_counts: np.ndarray
+) -> typing.Tuple[atomizers.AsciiCharacterAtomizer, np.ndarray]:
+  """Derive an atomizer from the counts of code points in a corpus.
+
+  Like AsciiCharacterAtomizer.FromText(), the most frequent characters have
+  the smallest indices.
+
+  Args:
+    char_counts: An array of counts indexed by code point, as returned by
+      ShardedDataset.CharCounts().
+
+  Returns:
+    A tuple of the atomizer, and an array which maps code points to atomizer
+    indices.
+  """
+  chars, = np.nonzero(char_counts)
+  chars = chars[np.argsort(-char_counts[chars], kind='stable')]
+  atomizer = atomizers.AsciiCharacterAtomizer(
+      {chr(c): i for i, c in enumerate(chars)})
+  lookup = np.zeros(len(char_counts), dtype=np.int32)
+  lookup[chars] = np.arange(len(chars), dtype=np.int32)
+  return atomizer, lookup
+
+
+def ShardedDatasetToModelData(dataset: sharded_dataset.ShardedDataset,
+                              sequence_length: int,
+                              atomizer: atomizers.AtomizerBase,
+                              lookup: np.ndarray):
+  """Encode a sharded dataset for training.
+
+  Args:
+    dataset: The dataset to encode.
+    sequence_length: The length of encoded sequences.
+    atomizer: The atomizer.
+    lookup: An array which maps code points to atomizer indices.
+
+  Returns:
+    A tuple of the encoded sequences and their labels.
+  """
+  x = dataset.EncodeAndPad(lookup, sequence_length, atomizer.vocab_size)
+  y = (dataset.labels == 1).astype(np.float64)
+  return x, y
+
+
+def LoadShardedModelData(
+    dataset_root: pathlib.Path, sequence_length: int, model_path: pathlib.Path):
+  """Load and encode the training, validation, and testing data of a sharded
+  dataset.
+
+  The datasets are memory-mapped, and the atomizer is derived from the counts
+  of characters, so that sources are never decoded to strings.
+
+  Returns:
+    A tuple of the atomizer and the (x, y) data of the training, validation,
+    and testing splits. The validation data is None if there are no
+    validation examples.
+  """
+  datasets = [sharded_dataset.ShardedDataset(dataset_root / split)
+              for split in ['training', 'validation', 'testing']]
+  for split, dataset in zip(['training', 'validation', 'testing'], datasets):
+    logging.info('Number of %s examples: %s.', split,
+                 humanize.intcomma(len(dataset)))
+
+  char_counts = [dataset.CharCounts() for dataset in datasets]
+  counts = np.zeros(max(len(c) for c in char_counts), dtype=np.int64)
+  for c in char_counts:
+    counts[:len(c)] += c
+  logging.info('Deriving atomizer from %s chars.',
+               humanize.intcomma(counts.sum()))
+  atomizer, lookup = AtomizerFromCharCounts(counts)
+  logging.info('Vocabulary size: %s.', humanize.intcomma(len(atomizer.vocab)))
+  logging.info('Pickled atomizer to %s.', model_path / 'atomizer.pkl')
+  with open(model_path / 'atomizer.pkl', 'wb') as f:
+    pickle.dump(atomizer, f)
+
+  training, validation, testing = datasets
+  logging.info('Encoding corpus')
+  validation_data = None
+  if len(validation):
+    validation_data = ShardedDatasetToModelData(
+        validation, sequence_length, atomizer, lookup)
+  return (atomizer,
+          ShardedDatasetToModelData(training, sequence_length, atomizer,
+                                    lookup),
+          validation_data,
+          ShardedDatasetToModelData(testing, sequence_length, atomizer,
+                                    lookup))
+
+
 def main(argv):
   """Main entry point."""
   if len(argv) > 1:
@@ -144,47 +237,54 @@ def main(argv):
   model_path = pathlib.Path(FLAGS.model_path)
   model_path.mkdir(parents=True, exist_ok=True)
 
-  training_protos = LoadPositiveNegativeProtos(
-      dataset_root / 'training')
-  validation_protos = LoadPositiveNegativeProtos(
-      dataset_root / 'validation')
-  testing_protos = LoadPositiveNegativeProtos(
-      dataset_root / 'testing')
-  logging.info('Number of training examples: %s.',
-               humanize.intcomma(len(training_protos.positive) +
-                                 len(training_protos.negative)))
-  logging.info('Number of validation examples: %s.',
-               humanize.intcomma(len(validation_protos.positive) +
-                                 len(validation_protos.negative)))
-  logging.info('Number of testing examples: %s.',
-               humanize.intcomma(len(testing_protos.positive) +
-                                 len(testing_protos.negative)))
-
   sequence_length = FLAGS.sequence_length
-  text = '\n\n'.join([
-    p.src for p in
-    training_protos.positive + training_protos.negative +
-    validation_protos.positive + validation_protos.negative +
-    testing_protos.positive + testing_protos.negative
-  ])
-  logging.info('Deriving atomizer from %s chars.', humanize.intcomma(len(text)))
-  atomizer = atomizers.AsciiCharacterAtomizer.FromText(text)
-  logging.info('Vocabulary size: %s.', humanize.intcomma(len(atomizer.vocab)))
-  logging.info('Pickled atomizer to %s.', model_path / 'atomizer.pkl')
-  with open(model_path / 'atomizer.pkl', 'wb') as f:
-    pickle.dump(atomizer, f)
+  if sharded_dataset.ShardedDataset.IsShardedDataset(dataset_root / 'training'):
+    atomizer, (x, y), validation_data, (test_x, test_y) = (
+        LoadShardedModelData(dataset_root, sequence_length, model_path))
+  else:
+    training_protos = LoadPositiveNegativeProtos(
+        dataset_root / 'training')
+    validation_protos = LoadPositiveNegativeProtos(
+        dataset_root / 'validation')
+    testing_protos = LoadPositiveNegativeProtos(
+        dataset_root / 'testing')
+    logging.info('Number of training examples: %s.',
+                 humanize.intcomma(len(training_protos.positive) +
+                                   len(training_protos.negative)))
+    logging.info('Number of validation examples: %s.',
+                 humanize.intcomma(len(validation_protos.positive) +
+                                   len(validation_protos.negative)))
+    logging.info('Number of testing examples: %s.',
+                 humanize.intcomma(len(testing_protos.positive) +
+                                   len(testing_protos.negative)))
 
-  logging.info('Encoding training corpus')
-  x, y = ProtosToModelData(training_protos, sequence_length, atomizer)
+    text = '\n\n'.join([
+      p.src for p in
+      training_protos.positive + training_protos.negative +
+      validation_protos.positive + validation_protos.negative +
+      testing_protos.positive + testing_protos.negative
+    ])
+    logging.info('Deriving atomizer from %s chars.',
+                 humanize.intcomma(len(text)))
+    atomizer = atomizers.AsciiCharacterAtomizer.FromText(text)
+    logging.info('Vocabulary size: %s.',
+                 humanize.intcomma(len(atomizer.vocab)))
+    logging.info('Pickled atomizer to %s.', model_path / 'atomizer.pkl')
+    with open(model_path / 'atomizer.pkl', 'wb') as f:
+      pickle.dump(atomizer, f)
 
-  validation_data = None
-  if validation_protos.positive:
-    logging.info('Encoding validation corpus')
-    validation_data = ProtosToModelData(
-        validation_protos, sequence_length, atomizer)
+    logging.info('Encoding training corpus')
+    x, y = ProtosToModelData(training_protos, sequence_length, atomizer)
+
+    validation_data = None
+    if validation_protos.positive:
+      logging.info('Encoding validation corpus')
+      validation_data = ProtosToModelData(
+          validation_protos, sequence_length, atomizer)
 
-  logging.info('Encoding test corpus')
-  test_x, test_y = ProtosToModelData(testing_protos, sequence_length, atomizer)
+    logging.info('Encoding test corpus')
+    test_x, test_y = ProtosToModelData(
+        testing_protos, sequence_length, atomizer)
 
   np.random.seed(FLAGS.seed)
   logging.info('Building Keras model')
@@ -1,7 +1,8 @@
 """Run a baseline."""
-import collections
+import os
 import pathlib
 import random
+import sys
 import time
 
 import humanize
@@ -15,6 +16,7 @@ from deeplearning.clgen.corpuses import corpuses
 from deeplearning.clgen.proto import clgen_pb2
 from deeplearning.clgen.proto import corpus_pb2
 from deeplearning.clgen.proto import model_pb2
+from experimental.deeplearning.polyglot import scheduler
 from labm8 import crypto
 from labm8 import lockfile
 from labm8 import pbutil
@@ -27,6 +29,13 @@ flags.DEFINE_integer('output_corpus_size', 10000,
                      'corpus.')
 flags.DEFINE_string('instances', None,
                     'Path to a clgen.Instances proto')
+flags.DEFINE_integer('max_concurrent_instances', os.cpu_count(),
+                     'The maximum number of instances to train and sample '
+                     'concurrently.')
+flags.DEFINE_float('instance_memory_gb', 4,
+                   'The estimated peak memory of an instance, in gigabytes. An '
+                   'instance is not started unless this much memory is '
+                   'available.')
 
 # A mapping from language name to a list of CLgen pre-processor functions.
 # These pre-processors are used as rejection samplers on the sample corpuses.
@@ -52,26 +61,42 @@ def IsEligible(instance: clgen.Instance) -> bool:
   return True
 
 
-def SampleModel(instance: clgen.Instance) -> None:
-  """Take --output_corpus_size samples from model."""
+def CountSamples(sample_dir: pathlib.Path) -> int:
+  """Return the number of samples in a sampler cache."""
+  with os.scandir(sample_dir) as it:
+    return sum(1 for entry in it if entry.name.endswith('.pbtxt'))
+
+
+def SampleModel(instance: clgen.Instance,
+                report_progress: scheduler.ProgressCallback) -> None:
+  """Take --output_corpus_size samples from model.
+
+  The samples in the sampler cache are counted once. After that, the count is
+  updated as new samples are written.
+  """
   logging.info('Training and sampling the CLgen model ...')
   target_samples = FLAGS.output_corpus_size
   sample_dir = instance.model.SamplerCache(instance.sampler)
-  sample_dir.mkdir(exist_ok=True)
-  num_samples = len(list(sample_dir.iterdir()))
+  sample_dir.mkdir(parents=True, exist_ok=True)
+  num_samples = CountSamples(sample_dir)
   logging.info('Need to generate %d samples in %s',
                max(target_samples - num_samples, 0), sample_dir)
   if num_samples < target_samples:
     sample_lock = lockfile.LockFile(sample_dir / 'LOCK')
     with sample_lock.acquire(replace_stale=True, block=True):
-      num_samples = len(list(sample_dir.iterdir()))
+      # Another process may have added samples while we waited for the lock.
+      num_samples = CountSamples(sample_dir)
       while num_samples < target_samples:
         samples = instance.model.SampleFast(
             instance.sampler, target_samples - num_samples)
         for sample in samples:
           sample_id = crypto.sha256_str(sample.text)
-          pbutil.ToFile(sample, sample_dir / f'{sample_id}.pbtxt')
-        num_samples = len(list(sample_dir.iterdir()))
+          sample_path = sample_dir / f'{sample_id}.pbtxt'
+          # Duplicate samples overwrite an existing file.
+          if not sample_path.is_file():
+            num_samples += 1
+          pbutil.ToFile(sample, sample_path)
+        report_progress(f'{num_samples} of {target_samples} samples')
 
 
 def PostprocessSampleCorpus(instance: clgen.Instance):
@@ -79,14 +104,22 @@ def PostprocessSampleCorpus(instance: clgen.Instance):
   sample_dir = instance.model.SamplerCache(instance.sampler)
 
   # Read the sample protos and write them to a directory of content files.
+  # Only samples which have not already been written are read.
   contentfiles_dir = pathlib.Path(str(sample_dir) + '.contentfiles')
   contentfiles_dir.mkdir(exist_ok=True)
-  logging.info('Writing output contentfiles to %s', contentfiles_dir)
-  if len(list(contentfiles_dir.iterdir())) != len(list(sample_dir.iterdir())):
-    for proto_path in sample_dir.iterdir():
-      sample = pbutil.FromFile(proto_path, model_pb2.Sample())
-      with open(contentfiles_dir / proto_path.name, 'w') as f:
-        f.write(sample.text)
+  exported = set(os.listdir(contentfiles_dir))
+  to_export = [name for name in os.listdir(sample_dir)
+               if name.endswith('.pbtxt') and name not in exported]
+  logging.info('Writing %s output contentfiles to %s',
+               humanize.intcomma(len(to_export)), contentfiles_dir)
+  for name in to_export:
+    sample = pbutil.FromFile(sample_dir / name, model_pb2.Sample())
+    # Write to a temporary file so that an interrupted write is not mistaken
+    # for an exported sample.
+    tmp_path = contentfiles_dir / f'.{name}.tmp'
+    with open(tmp_path, 'w') as f:
+      f.write(sample.text)
+    os.rename(tmp_path, contentfiles_dir / name)
 
   logging.info('Creating output corpus')
   output_corpus_config = corpus_pb2.Corpus()
@@ -95,8 +128,8 @@ def PostprocessSampleCorpus(instance: clgen.Instance):
   # We derive the programming language name from the input corpus directory.
   # This depends on corpuses being in directories named after their language,
   # e.g. ~/corpuses/opencl, or ~/corpuses/java.A
-  preprocessed_dir = instance.model.corpus.preprocessed.url[
-                     len('sqlite:///'):].parent
+  preprocessed_dir = pathlib.Path(instance.model.corpus.preprocessed.url[
+                                  len('sqlite:///'):]).parent
   language = (preprocessed_dir / 'contentfiles').resolve().name
   output_corpus_config.preprocessor[:] = POSTPROCESSORS[language]
   output_corpus = corpuses.Corpus(output_corpus_config)
@@ -107,32 +140,53 @@ def PostprocessSampleCorpus(instance: clgen.Instance):
   return output_corpus
 
 
+def RunInstance(report_progress: scheduler.ProgressCallback,
+                serialized_config: bytes) -> None:
+  """Sample and postprocess an instance. This is run in a worker process."""
+  instance = clgen.Instance(clgen_pb2.Instance.FromString(serialized_config))
+  with instance.Session():
+    SampleModel(instance, report_progress)
+    report_progress('postprocessing samples')
+    PostprocessSampleCorpus(instance)
+
+
 def main(argv):
   """Main entry point."""
   if len(argv) > 1:
     raise app.UsageError("Unknown arguments: '{}'.".format(' '.join(argv[1:])))
 
   start_time = time.time()
-  instances = [
-    clgen.Instance(p) for p in
-    pbutil.FromFile(pathlib.Path(FLAGS.instances),
-                    clgen_pb2.Instances()).instance]
-  random.shuffle(instances)
-  candidate_instances = collections.deque(instances)
-  logging.info('Loaded %d instances in %s ms', len(candidate_instances),
+  configs = list(pbutil.FromFile(pathlib.Path(FLAGS.instances),
+                                 clgen_pb2.Instances()).instance)
+  random.shuffle(configs)
+  instances = {}
+  jobs = []
+  for config in configs:
+    instance = clgen.Instance(config)
+    name = f'{instance.model.hash}/{instance.sampler.hash}'
+    instances[name] = instance
+    # Instances which share a model are run one at a time, since training and
+    # sampling require exclusive access to the model.
+    jobs.append(scheduler.Job(name=name, key=instance.model.hash,
+                              args=(config.SerializeToString(),)))
+  logging.info('Loaded %d instances in %s ms', len(jobs),
                humanize.intcomma(int((time.time() - start_time) * 1000)))
 
-  while candidate_instances:
-    instance = candidate_instances.popleft()
+  def InstanceIsEligible(job: scheduler.Job) -> bool:
+    instance = instances[job.name]
     with instance.Session():
-      if IsEligible(instance):
-        logging.info('Found an eligible candidate to work on')
-        SampleModel(instance)
-        PostprocessSampleCorpus(instance)
-      else:
-        logging.info('Candidate is ineligible')
-        candidate_instances.append(instance)
-        time.sleep(1)
+      return IsEligible(instance)
+
+  instance_scheduler = scheduler.Scheduler(
+      RunInstance, FLAGS.max_concurrent_instances,
+      job_memory_bytes=int(FLAGS.instance_memory_gb * 1024 ** 3),
+      is_eligible=InstanceIsEligible)
+  exit_codes = instance_scheduler.Run(jobs)
+  failed = [name for name, exit_code in exit_codes.items() if exit_code]
+  if failed:
+    logging.error('%d of %d instances failed: %s', len(failed), len(jobs),
+                  ', '.join(sorted(failed)))
+    sys.exit(1)
 
   logging.info('Done.')
 
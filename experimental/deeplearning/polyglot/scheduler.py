@@ -0,0 +1,172 @@
+"""Run jobs concurrently in worker processes, limited by CPU and memory."""
+import collections
+import multiprocessing
+import os
+import queue
+import time
+import typing
+
+import humanize
+from absl import logging
+
+
+class Job(typing.NamedTuple):
+  """A unit of work for a worker process."""
+  # A unique name for the job, used in progress reports.
+  name: str
+  # Jobs with the same key are never run concurrently, e.g. because they
+  # require exclusive access to the same model.
+  key: str
+  # The arguments to the worker function.
+  args: typing.Tuple[typing.Any, ...] = ()
+
+
+# A function which a worker calls to report the progress of its job.
+ProgressCallback = typing.Callable[[str], None]
+
+
+def AvailableMemoryBytes() -> int:
+  """Return the amount of memory available to start new processes.
+
+  This is MemAvailable from /proc/meminfo where supported, which accounts
+  for reclaimable page cache. Else, the number of free physical pages.
+  """
+  try:
+    with open('/proc/meminfo') as f:
+      for line in f:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+  return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def _RunJob(worker: typing.Callable[..., None], job: Job,
+            progress_queue: multiprocessing.Queue) -> None:
+  """The entry point of a worker process."""
+
+  def ReportProgress(message: str) -> None:
+    progress_queue.put((job.name, message))
+
+  worker(ReportProgress, *job.args)
+
+
+class Scheduler(object):
+  """Run jobs in concurrent worker processes.
+
+  A job is started when there is a free worker slot, no running job has the
+  same key, the job is eligible, and there is enough available memory. If no
+  job is running, a job is started regardless of available memory, so that
+  jobs always make progress.
+
+  Workers report progress through a callback, which the scheduler logs and
+  records in the progress attribute, so that the state of every job is known
+  without inspecting its outputs.
+  """
+
+  def __init__(
+      self, worker: typing.Callable[..., None], max_concurrent_jobs: int,
+      job_memory_bytes: int = 0,
+      is_eligible: typing.Optional[typing.Callable[[Job], bool]] = None,
+      poll_interval: float = 1.0):
+    """Constructor.
+
+    Args:
+      worker: The function to run a job. It is called in a new process with a
+        ProgressCallback, followed by the job's args.
+      max_concurrent_jobs: The maximum number of jobs to run at a time.
+      job_memory_bytes: The estimated peak memory of a job. A job is not
+        started unless this much memory is available, in addition to the
+        estimated peak of each running job.
+      is_eligible: An optional function which returns whether a job may be
+        started, e.g. to check for locks held by other processes. Ineligible
+        jobs are retried later.
+      poll_interval: The number of seconds to wait for progress before
+        rechecking the eligibility of waiting jobs.
+    """
+    self.worker = worker
+    self.max_concurrent_jobs = max(max_concurrent_jobs, 1)
+    self.job_memory_bytes = job_memory_bytes
+    self.is_eligible = is_eligible or (lambda job: True)
+    self.poll_interval = poll_interval
+    # The most recent progress report of each job.
+    self.progress: typing.Dict[str, str] = {}
+
+  def _CanStart(self, job: Job, running: typing.Dict[str, typing.Tuple[
+    multiprocessing.Process, Job]]) -> bool:
+    if any(job.key == j.key for _, j in running.values()):
+      return False
+    # Running jobs may not yet have allocated their memory, so the estimated
+    # peak of each is reserved.
+    if running and (AvailableMemoryBytes() -
+                    len(running) * self.job_memory_bytes <
+                    self.job_memory_bytes):
+      return False
+    return self.is_eligible(job)
+
+  def Run(self, jobs: typing.Iterable[Job]) -> typing.Dict[str, int]:
+    """Run jobs until they have all completed.
+
+    Args:
+      jobs: The jobs to run, in order of preference.
+
+    Returns:
+      A map from job name to the exit code of its worker process.
+    """
+    pending = collections.deque(jobs)
+    running: typing.Dict[str, typing.Tuple[multiprocessing.Process, Job]] = {}
+    exit_codes: typing.Dict[str, int] = {}
+    progress_queue = multiprocessing.Queue()
+    start_time = time.time()
+
+    while pending or running:
+      # Start as many waiting jobs as the limits allow, in order.
+      for _ in range(len(pending)):
+        if len(running) >= self.max_concurrent_jobs:
+          break
+        job = pending.popleft()
+        if not self._CanStart(job, running):
+          pending.append(job)
+          continue
+        process = multiprocessing.Process(
+            target=_RunJob, args=(self.worker, job, progress_queue))
+        process.start()
+        running[job.name] = (process, job)
+        self.progress[job.name] = 'started'
+        logging.info('Started job %s (%d running, %d waiting)', job.name,
+                     len(running), len(pending))
+
+      # Block until a progress report arrives, or the poll interval elapses.
+      try:
+        name, message = progress_queue.get(timeout=self.poll_interval)
+        if name in running:
+          self.progress[name] = message
+        logging.info('Job %s: %s', name, message)
+      except queue.Empty:
+        pass
+
+      for name, (process, job) in list(running.items()):
+        if process.exitcode is None:
+          continue
+        process.join()
+        del running[name]
+        exit_codes[name] = process.exitcode
+        if process.exitcode:
+          self.progress[name] = f'failed with exit code {process.exitcode}'
+          logging.error('Job %s failed with exit code %d', name,
+                        process.exitcode)
+        else:
+          self.progress[name] = 'done'
+          logging.info('Job %s done. %d of %d jobs completed in %s', name,
+                       len(exit_codes), len(exit_codes) + len(running) +
+                       len(pending),
+                       humanize.naturaldelta(time.time() - start_time))
+
+    # Log any reports which arrived after their job ended.
+    while True:
+      try:
+        name, message = progress_queue.get_nowait()
+      except queue.Empty:
+        break
+      logging.info('Job %s: %s', name, message)
+    return exit_codes
@@ -0,0 +1,178 @@
+"""Unit tests for //experimental/deeplearning/polyglot:scheduler."""
+import pathlib
+import sys
+import tempfile
+import time
+import typing
+
+import pytest
+from absl import app
+from absl import flags
+
+from experimental.deeplearning.polyglot import scheduler
+
+
+FLAGS = flags.FLAGS
+
+
+@pytest.fixture(scope='function')
+def tempdir() -> pathlib.Path:
+  with tempfile.TemporaryDirectory() as d:
+    yield pathlib.Path(d)
+
+
+def _WriteFileWorker(report_progress, path: str, text: str) -> None:
+  report_progress('writing')
+  with open(path, 'w') as f:
+    f.write(text)
+
+
+def _RecordIntervalWorker(report_progress, log_dir: str, name: str,
+                          key: str) -> None:
+  """Record the key of the job and the interval during which it ran."""
+  start = time.time()
+  time.sleep(.3)
+  (pathlib.Path(log_dir) / name).write_text(f'{key} {start} {time.time()}')
+
+
+def _ReadIntervals(
+    log_dir: pathlib.Path) -> typing.List[typing.Tuple[str, float, float]]:
+  """Read the <key, start, end> intervals of jobs."""
+  intervals = []
+  for path in log_dir.iterdir():
+    key, start, end = path.read_text().split()
+    intervals.append((key, float(start), float(end)))
+  return intervals
+
+
+def _OverlappingKeys(
+    intervals: typing.List[typing.Tuple[str, float, float]]
+) -> typing.List[typing.Tuple[str, str]]:
+  """Return the key pairs of the jobs which ran concurrently."""
+  return [(a[0], b[0]) for i, a in enumerate(intervals)
+          for b in intervals[i + 1:] if a[1] < b[2] and b[1] < a[2]]
+
+
+def _MaxConcurrency(
+    intervals: typing.List[typing.Tuple[str, float, float]]) -> int:
+  """Return the maximum number of jobs which ran at the same time."""
+  return max(sum(1 for _, start, end in intervals if start <= t < end)
+             for _, t, _ in intervals)
+
+
+def _FailingWorker(report_progress) -> None:
+  sys.exit(3)
+
+
+def test_Scheduler_runs_all_jobs(tempdir: pathlib.Path):
+  jobs = [scheduler.Job(name=str(i), key=str(i),
+                        args=(str(tempdir / str(i)), f'job {i}'))
+          for i in range(5)]
+  s = scheduler.Scheduler(_WriteFileWorker, max_concurrent_jobs=2,
+                          poll_interval=.05)
+  exit_codes = s.Run(jobs)
+  assert exit_codes == {str(i): 0 for i in range(5)}
+  assert s.progress == {str(i): 'done' for i in range(5)}
+  for i in range(5):
+    assert (tempdir / str(i)).read_text() == f'job {i}'
+
+
+def test_Scheduler_runs_jobs_concurrently(tempdir: pathlib.Path):
+  jobs = [scheduler.Job(name=str(i), key=str(i),
+                        args=(str(tempdir), str(i), str(i)))
+          for i in range(4)]
+  scheduler.Scheduler(_RecordIntervalWorker, max_concurrent_jobs=4,
+                      poll_interval=.05).Run(jobs)
+  assert _OverlappingKeys(_ReadIntervals(tempdir))
+
+
+def test_Scheduler_max_concurrent_jobs(tempdir: pathlib.Path):
+  jobs = [scheduler.Job(name=str(i), key=str(i),
+                        args=(str(tempdir), str(i), str(i)))
+          for i in range(4)]
+  scheduler.Scheduler(_RecordIntervalWorker, max_concurrent_jobs=1,
+                      poll_interval=.05).Run(jobs)
+  intervals = _ReadIntervals(tempdir)
+  assert len(intervals) == 4
+  assert not _OverlappingKeys(intervals)
+
+
+def test_Scheduler_jobs_with_same_key_not_concurrent(tempdir: pathlib.Path):
+  jobs = [scheduler.Job(name=str(i), key=str(i % 2),
+                        args=(str(tempdir), str(i), str(i % 2)))
+          for i in range(4)]
+  scheduler.Scheduler(_RecordIntervalWorker, max_concurrent_jobs=4,
+                      poll_interval=.05).Run(jobs)
+  intervals = _ReadIntervals(tempdir)
+  assert len(intervals) == 4
+  assert all(a != b for a, b in _OverlappingKeys(intervals))
+
+
+def test_Scheduler_ineligible_jobs_are_retried(tempdir: pathlib.Path):
+  checks = []
+
+  def IsEligible(job: scheduler.Job) -> bool:
+    checks.append(job.name)
+    # Job 'a' becomes eligible on its third check.
+    return job.name != 'a' or checks.count('a') >= 3
+
+  jobs = [scheduler.Job(name=name, key=name,
+                        args=(str(tempdir / name), name))
+          for name in ['a', 'b']]
+  exit_codes = scheduler.Scheduler(
+      _WriteFileWorker, max_concurrent_jobs=2, is_eligible=IsEligible,
+      poll_interval=.05).Run(jobs)
+  assert exit_codes == {'a': 0, 'b': 0}
+  assert checks.count('a') == 3
+  assert (tempdir / 'a').is_file()
+
+
+def test_Scheduler_memory_limit(tempdir: pathlib.Path):
+  """Test that a job is started without enough memory if none are running."""
+  jobs = [scheduler.Job(name=str(i), key=str(i),
+                        args=(str(tempdir), str(i), str(i)))
+          for i in range(2)]
+  scheduler.Scheduler(_RecordIntervalWorker, max_concurrent_jobs=2,
+                      job_memory_bytes=2 ** 60, poll_interval=.05).Run(jobs)
+  intervals = _ReadIntervals(tempdir)
+  assert len(intervals) == 2
+  assert not _OverlappingKeys(intervals)
+
+
+def test_Scheduler_memory_reserved_for_running_jobs(
+    tempdir: pathlib.Path, monkeypatch):
+  """Test that only as many jobs start as the available memory allows."""
+  # Running jobs have not allocated their memory, so the available memory
+  # does not change as jobs start.
+  monkeypatch.setattr(scheduler, 'AvailableMemoryBytes', lambda: 250)
+  jobs = [scheduler.Job(name=str(i), key=str(i),
+                        args=(str(tempdir), str(i), str(i)))
+          for i in range(4)]
+  scheduler.Scheduler(_RecordIntervalWorker, max_concurrent_jobs=4,
+                      job_memory_bytes=100, poll_interval=.05).Run(jobs)
+  intervals = _ReadIntervals(tempdir)
+  assert len(intervals) == 4
+  assert _MaxConcurrency(intervals) == 2
+
+
+def test_Scheduler_failed_job():
+  s = scheduler.Scheduler(_FailingWorker, max_concurrent_jobs=1,
+                          poll_interval=.05)
+  assert s.Run([scheduler.Job(name='a', key='a')]) == {'a': 3}
+  assert s.progress['a'] == 'failed with exit code 3'
+
+
+def test_AvailableMemoryBytes():
+  assert scheduler.AvailableMemoryBytes() > 0
+
+
+def main(argv):
+  """Main entry point."""
+  if len(argv) > 1:
+    raise app.UsageError("Unknown arguments: '{}'.".format(' '.join(argv[1:])))
+  sys.exit(pytest.main([__file__, '-vv']))
+
+
+if __name__ == '__main__':
+  flags.FLAGS(['argv[0]'])
+  app.run(main)
@@ -18,7 +18,9 @@
 """
 Differential test OpenCL results.
 """
+import numpy as np
 
+from deeplearning.deepsmith.difftests import matrix
 from experimental.dsmith.opencl.db import *
 
 
@@ -36,39 +38,10 @@ def create_results_metas(s: session_t):
   """
   Create total time and cumulative time for each test case evaluated on each
   testbed using each harness.
-  """
-
-  class Worker(threading.Thread):
-    """ worker thread to run testcases asynchronously """
-
-    def __init__(self, testbeds_harnesses: List[
-      Tuple['Testbed.id_t', 'Harnesses.column_t']]):
-      self.ndone = 0
-      self.testbeds_harnesses = testbeds_harnesses
-      super(Worker, self).__init__()
-
-    def run(self):
-      """ main loop"""
-      with Session() as s:
-        for testbed_id, harness in self.testbeds_harnesses:
-          self.ndone += 1
-          testbed = s.query(Testbed).filter(Testbed.id == testbed_id).scalar()
-
-          # FIXME: @cumtime variable is not supported by SQLite.
-          s.execute(f"""
-INSERT INTO {ResultMeta.__tablename__} (id, total_time, cumtime)
-SELECT  results.id,
-        results.runtime + programs.generation_time AS total_time,
-        @cumtime := @cumtime + results.runtime + programs.generation_time AS cumtime
-FROM {Result.__tablename__} results
-INNER JOIN {Testcase.__tablename__} testcases ON results.testcase_id = testcases.id
-INNER JOIN {Program.__tablename__} programs ON testcases.program_id = programs.id
-JOIN (SELECT @cumtime := 0) r
-WHERE results.testbed_id = {testbed.id}
-AND testcases.harness = {harness}
-ORDER BY programs.date, testcases.threads_id""")
-          s.commit()
 
+  Cumulative times are computed with NumPy, which unlike the MySQL @cumtime
+  variable works on any database engine.
+  """
   # break early if we can
   num_results = s.query(func.count(Result.id)).scalar()
   num_metas = s.query(func.count(ResultMeta.id)).scalar()
@@ -77,25 +50,52 @@ ORDER BY programs.date, testcases.threads_id""")
 
   print("creating results metas ...")
   s.execute(f"DELETE FROM {ResultMeta.__tablename__}")
-  testbeds_harnesses = s.query(Result.testbed_id, Testcase.harness) \
+  rows = s.query(Result.id, Result.testbed_id, Testcase.harness,
+                 Result.runtime + Program.generation_time) \
     .join(Testcase) \
-    .group_by(Result.testbed_id, Testcase.harness) \
-    .order_by(Testcase.harness, Result.testbed_id) \
+    .join(Program) \
+    .order_by(Result.testbed_id, Testcase.harness, Program.date,
+              Testcase.threads_id) \
     .all()
+  if not rows:
+    return
+  ids, testbed_ids, harnesses, total_times = (np.array(x) for x in zip(*rows))
+
+  # Restart the cumulative sum at the start of each <testbed, harness> group.
+  cumtimes = np.cumsum(total_times)
+  starts = np.flatnonzero(np.concatenate((
+    [True], (testbed_ids[1:] != testbed_ids[:-1]) |
+            (harnesses[1:] != harnesses[:-1]))))
+  offsets = np.concatenate(([0], cumtimes[starts[1:] - 1]))
+  cumtimes -= np.repeat(offsets, np.diff(np.append(starts, len(ids))))
+
+  s.bulk_insert_mappings(ResultMeta, [
+    {"id": int(id), "total_time": float(total_time), "cumtime": float(cumtime)}
+    for id, total_time, cumtime in zip(ids, total_times, cumtimes)])
+  s.commit()
 
-  bar = progressbar.ProgressBar(initial_value=0,
-                                max_value=len(testbeds_harnesses),
-                                redirect_stdout=True)
-  worker = Worker(testbeds_harnesses)
-  worker.start()
-  while worker.is_alive():
-    bar.update(min(worker.ndone, len(testbeds_harnesses)))
-    worker.join(0.5)
+
+def load_results(s: session_t) -> Tuple[np.ndarray, ...]:
+  """
+  Load the results as flat arrays of result IDs, testcase IDs, testbed IDs,
+  outcomes, and stdout IDs.
+  """
+  rows = s.query(Result.id, Result.testcase_id, Result.testbed_id,
+                 Result.outcome, Result.stdout_id).all()
+  if not rows:
+    return tuple(np.array([], dtype=np.int64) for _ in range(5))
+  return tuple(np.array(x, dtype=np.int64) for x in zip(*rows))
 
 
 def create_majorities(s: session_t) -> None:
   """
   Majority vote on testcase outcomes and outputs.
+
+  Results are loaded into (testcase x testbed) outcome and stdout matrices,
+  and the majorities of each row are computed with NumPy. Ties in the
+  majority outcome or output are broken in favour of the smallest value,
+  so that e.g. an even split of '1' (build failure) and '6' (pass) outcomes
+  has majority outcome '1'. Results with outcome TODO do not vote.
   """
   # We require at least this many results in order for there to be a majority:
   min_results_for_majority = 3
@@ -103,124 +103,76 @@ def create_majorities(s: session_t) -> None:
   print("voting on test case majorities ...")
   s.execute(f"DELETE FROM {Majority.__tablename__}")
 
-  # Note we have to insert ignore here because there may be ties in the
-  # majority outcome or output. E.g. there could be a test case with an even
-  # split of 5 '1' outcomes and 5 '3' outcomes. Since there is only a single
-  # majority outcome, we order results by outcome number, so that '1' (build
-  # failure) will over-rule '6' (pass).
-  insert_ignore = "INSERT IGNORE" if dsmith.DB_ENGINE == "mysql" else "INSERT OR IGNORE"
-  s.execute(f"""
-{insert_ignore} INTO {Majority.__tablename__}
-    (id, num_results, maj_outcome, outcome_majsize, maj_stdout_id, stdout_majsize)
-SELECT  result_counts.testcase_id,
-        result_counts.num_results,
-        outcome_majs.maj_outcome,
-        outcome_majs.outcome_majsize,
-        stdout_majs.maj_stdout_id,
-        stdout_majs.stdout_majsize
-FROM (
-    SELECT testcase_id, num_results FROM (
-        SELECT testcase_id, COUNT(*) AS num_results
-        FROM {Result.__tablename__}
-        GROUP BY testcase_id
-    ) s
-    WHERE num_results >= {min_results_for_majority}
-) result_counts
-JOIN (
-    SELECT l.testcase_id, s.outcome as maj_outcome, s.outcome_count AS outcome_majsize
-    FROM (
-        SELECT testcase_id, MAX(outcome_count) as max_count
-        FROM (
-            SELECT testcase_id,COUNT(*) as outcome_count
-            FROM {Result.__tablename__}
-            GROUP BY testcase_id, outcome
-        ) r
-        GROUP BY testcase_id
-    ) l
-    INNER JOIN (
-        SELECT testcase_id, outcome, COUNT(*) as outcome_count
-        FROM {Result.__tablename__}
-        GROUP BY testcase_id, outcome
-    ) s ON l.testcase_id = s.testcase_id AND l.max_count = s.outcome_count
-) outcome_majs ON result_counts.testcase_id = outcome_majs.testcase_id
-JOIN (
-    SELECT l.testcase_id, s.stdout_id as maj_stdout_id, s.stdout_count AS stdout_majsize
-    FROM (
-        SELECT testcase_id, MAX(stdout_count) as max_count
-        FROM (
-            SELECT testcase_id, COUNT(*) as stdout_count
-            FROM {Result.__tablename__}
-            GROUP BY testcase_id, stdout_id
-        ) r
-        GROUP BY testcase_id
-    ) l
-    INNER JOIN (
-        SELECT testcase_id, stdout_id, COUNT(*) as stdout_count
-        FROM {Result.__tablename__}
-        GROUP BY testcase_id, stdout_id
-    ) s ON l.testcase_id = s.testcase_id AND l.max_count = s.stdout_count
-) stdout_majs ON outcome_majs.testcase_id = stdout_majs.testcase_id
-ORDER BY outcome_majs.maj_outcome DESC
-""")
+  ids, testcase_ids, testbed_ids, outcomes, stdout_ids = load_results(s)
+  testcases, _, id_matrix, outcome_matrix, stdout_matrix = \
+    matrix.ResultMatrices(testcase_ids, testbed_ids, ids, outcomes, stdout_ids)
+
+  num_results = np.sum(id_matrix != matrix.MISSING, axis=1)
+  maj_outcomes, outcome_majsizes = matrix.MajorityVote(outcome_matrix)
+  maj_stdout_ids, stdout_majsizes = matrix.MajorityVote(stdout_matrix)
+
+  rows = np.flatnonzero((num_results >= min_results_for_majority) &
+                        (outcome_majsizes > 0))
+  s.bulk_insert_mappings(Majority, [
+    {
+      "id": int(testcases[i]),
+      "num_results": int(num_results[i]),
+      "maj_outcome": int(maj_outcomes[i]),
+      "outcome_majsize": int(outcome_majsizes[i]),
+      "maj_stdout_id": int(maj_stdout_ids[i]),
+      "stdout_majsize": int(stdout_majsizes[i]),
+    } for i in rows])
   s.commit()
 
 
 def create_classifications(s: session_t) -> None:
   """
   Determine anomalous results.
+
+  Each result is compared against the majority of its testcase with
+  vectorized comparisons, and the classifications are inserted in bulk.
   """
   s.execute(f"DELETE FROM {Classification.__tablename__}")
 
   min_majsize = 7
 
-  print("creating {bc,bto} classifications ...")
-  s.execute(f"""
-INSERT INTO {Classification.__tablename__}
-SELECT results.id, {Classifications.BC}
-FROM {Result.__tablename__} results
-WHERE outcome = {Outcomes.BC}
-""")
-  s.execute(f"""
-INSERT INTO {Classification.__tablename__}
-SELECT results.id, {Classifications.BTO}
-FROM {Result.__tablename__} results
-WHERE outcome = {Outcomes.BTO}
-""")
-
-  print("determining anomalous build-failures ...")
-  s.execute(f"""
-INSERT INTO {Classification.__tablename__}
-SELECT results.id, {Classifications.ABF}
-FROM {Result.__tablename__} results
-INNER JOIN {Majority.__tablename__} majorities ON results.testcase_id = majorities.id
-WHERE outcome = {Outcomes.BF}
-AND outcome_majsize >= {min_majsize}
-AND maj_outcome = {Outcomes.PASS}
-""")
-
-  print("determining anomalous runtime crashes ...")
-  s.execute(f"""
-INSERT INTO {Classification.__tablename__}
-SELECT {Result.__tablename__}.id, {Classifications.ARC}
-FROM {Result.__tablename__}
-INNER JOIN {Majority.__tablename__} majorities ON results.testcase_id = majorities.id
-WHERE outcome = {Outcomes.RC}
-AND outcome_majsize >= {min_majsize}
-AND maj_outcome = {Outcomes.PASS}
-""")
-
-  print("determining anomylous wrong output classifications ...")
-  s.execute(f"""
-INSERT INTO {Classification.__tablename__}
-SELECT results.id, {Classifications.AWO}
-FROM {Result.__tablename__} results
-INNER JOIN {Majority.__tablename__} majorities ON results.testcase_id = majorities.id
-WHERE outcome = {Outcomes.PASS}
-AND maj_outcome = {Outcomes.PASS}
-AND outcome_majsize >= {min_majsize}
-AND stdout_majsize >= CEILING(2 * outcome_majsize / 3)
-AND stdout_id <> maj_stdout_id
-""")
+  print("determining classifications ...")
+  ids, testcase_ids, _, outcomes, stdout_ids = load_results(s)
+
+  majorities = np.array(
+      s.query(Majority.id, Majority.maj_outcome, Majority.outcome_majsize,
+              Majority.maj_stdout_id, Majority.stdout_majsize)
+        .order_by(Majority.id)
+        .all(), dtype=np.int64).reshape(-1, 5)
+
+  # Look up the majority of each result's testcase. Results without a
+  # majority get a row of zeros, which never passes the majority checks.
+  i = np.searchsorted(majorities[:, 0], testcase_ids)
+  has_majority = i < len(majorities)
+  has_majority[has_majority] = \
+    majorities[i[has_majority], 0] == testcase_ids[has_majority]
+  result_majorities = np.zeros((len(ids), 5), dtype=np.int64)
+  result_majorities[has_majority] = majorities[i[has_majority]]
+  _, maj_outcome, outcome_majsize, maj_stdout_id, stdout_majsize = \
+    result_majorities.T
+
+  majority_passes = (maj_outcome == Outcomes.PASS) & \
+                    (outcome_majsize >= min_majsize)
+  classifications = np.zeros(len(ids), dtype=np.int64)
+  classifications[outcomes == Outcomes.BC] = Classifications.BC
+  classifications[outcomes == Outcomes.BTO] = Classifications.BTO
+  classifications[majority_passes & (outcomes == Outcomes.BF)] = \
+    Classifications.ABF
+  classifications[majority_passes & (outcomes == Outcomes.RC)] = \
+    Classifications.ARC
+  classifications[majority_passes & (outcomes == Outcomes.PASS) &
+                  (stdout_majsize >= np.ceil(2 * outcome_majsize / 3)) &
+                  (stdout_ids != maj_stdout_id)] = Classifications.AWO
+
+  classified = np.flatnonzero(classifications)
+  s.bulk_insert_mappings(Classification, [
+    {"id": int(ids[j]), "classification": int(classifications[j])}
+    for j in classified])
   s.commit()
 
 
@@ -1,4 +1,7 @@
 -- Merge contents of an attached database called "rhs".
+--
+-- The rhs.runtime_stats table must be populated from rhs.runtimes
+-- before running this script.
 
 -------------
 -- KERNELS --
@@ -58,15 +61,36 @@ INSERT OR IGNORE INTO params SELECT * FROM rhs.params;
 -- Runtimes table
 INSERT INTO runtimes SELECT * FROM rhs.runtimes;
 
+-- Scenarios with new runtimes, used to update the derived tables
+CREATE TEMP TABLE IF NOT EXISTS merged_scenarios (
+    scenario                        CHAR(40),
+    PRIMARY KEY (scenario)
+);
+
+INSERT OR IGNORE INTO merged_scenarios
+SELECT DISTINCT scenario FROM rhs.runtime_stats;
+
 -- Runtime stats table
-DELETE FROM rhs.runtime_stats;
-INSERT INTO rhs.runtime_stats
+INSERT OR REPLACE INTO runtime_stats
 SELECT
-    scenario,
-    params,
-    Count(runtime),
-    MIN(runtime),
-    AVG(runtime),
-    MAX(runtime)
-FROM rhs.runtimes
-GROUP BY scenario,params;
+    rhs_stats.scenario,
+    rhs_stats.params,
+    IFNULL(lhs_stats.num_samples, 0) + rhs_stats.num_samples,
+    CASE WHEN lhs_stats.scenario IS NULL
+        THEN rhs_stats.min
+        ELSE merge_min(lhs_stats.min, rhs_stats.min)
+    END,
+    CASE WHEN lhs_stats.scenario IS NULL
+        THEN rhs_stats.mean
+        ELSE merge_mean(lhs_stats.mean, lhs_stats.num_samples,
+                        rhs_stats.mean, rhs_stats.num_samples)
+    END,
+    CASE WHEN lhs_stats.scenario IS NULL
+        THEN rhs_stats.max
+        ELSE merge_max(lhs_stats.max, rhs_stats.max)
+    END
+FROM rhs.runtime_stats AS rhs_stats
+LEFT JOIN runtime_stats AS lhs_stats
+ON
+    lhs_stats.scenario=rhs_stats.scenario AND
+    lhs_stats.params=rhs_stats.params;
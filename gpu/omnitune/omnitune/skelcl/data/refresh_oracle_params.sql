@@ -0,0 +1,22 @@
+-- Update oracle params for the scenarios in "merged_scenarios".
+--
+DELETE FROM oracle_params
+WHERE scenario IN (SELECT scenario FROM merged_scenarios);
+
+INSERT INTO oracle_params
+SELECT
+    stats.scenario,
+    stats.params,
+    stats.mean AS runtime
+FROM runtime_stats AS stats
+INNER JOIN (
+    SELECT
+        scenario,
+        MIN(mean) AS runtime
+    FROM runtime_stats
+    WHERE scenario IN (SELECT scenario FROM merged_scenarios)
+    GROUP BY scenario
+) AS oracle
+ON
+    stats.scenario=oracle.scenario AND
+    stats.mean=oracle.runtime;
@@ -0,0 +1,44 @@
+-- Update scenario stats for the scenarios in "merged_scenarios".
+--
+INSERT OR REPLACE INTO scenario_stats
+SELECT
+    scenarios.scenario AS scenario,
+    (
+        SELECT Count(*)
+        FROM runtime_stats
+        WHERE scenario=scenarios.scenario
+    ) AS num_params,
+    (
+        SELECT params
+        FROM runtime_stats
+        WHERE
+            scenario=scenarios.scenario AND
+            mean=(SELECT MIN(mean) FROM runtime_stats WHERE scenario=scenarios.scenario)
+    ) AS oracle_param,
+    (
+        SELECT mean
+        FROM runtime_stats
+        WHERE
+            scenario=scenarios.scenario AND
+            mean=(SELECT MIN(mean) FROM runtime_stats WHERE scenario=scenarios.scenario)
+    ) AS oracle_runtime,
+    (
+        SELECT params
+        FROM runtime_stats
+        WHERE
+            scenario=scenarios.scenario AND
+            mean=(SELECT MAX(mean) FROM runtime_stats WHERE scenario=scenarios.scenario)
+    ) AS worst_param,
+    (
+        SELECT mean
+        FROM runtime_stats
+        WHERE
+            scenario=scenarios.scenario AND
+            mean=(SELECT MAX(mean) FROM runtime_stats WHERE scenario=scenarios.scenario)
+    ) AS worst_runtime,
+    (
+        SELECT AVG(mean)
+        FROM runtime_stats
+        WHERE scenario=scenarios.scenario
+    ) AS mean_runtime
+FROM merged_scenarios AS scenarios;
@@ -3,7 +3,9 @@ from __future__ import print_function
 
 import csv
 import json
+import multiprocessing
 import random
+import sqlite3
 import subprocess
 
 import omnitune
@@ -79,6 +81,28 @@ def sql_command(name):
   return resource_string(__name__, "data/" + name + ".sql")
 
 
+def _stage_rhs(path):
+  """
+  Populate the runtime_stats table of a database prior to merging.
+
+  This is executed in a worker process, so that the databases to be
+  merged can be staged in parallel.
+
+  Arguments:
+
+      path (str): Path to the database.
+
+  Returns:
+
+      str: The path to the database.
+  """
+  connection = sqlite3.connect(path)
+  connection.executescript(sql_command("populate_runtime_stats"))
+  connection.commit()
+  connection.close()
+  return path
+
+
 def _merge_min(lhs, rhs):
   return min(lhs, rhs)
 
@@ -805,69 +829,59 @@ class Database(db.Database):
     return id
 
   def _merge_rhs(self, rhs):
-    io.info("Merging", rhs.path)
-    self.attach(rhs.path, "rhs")
+    """
+    Merge the contents of a staged database into this.
 
-    # Import runtimes,features,datasets tables.
-    # Populate rhs runtime_stats table.
-    self.run("merge_rhs")
+    The rhs runtime_stats table must already have been populated, see
+    _stage_rhs(). Lookup tables and runtimes are merged using set-based
+    INSERT ... SELECT statements, and runtime_stats are merged in a
+    single statement using the merge_min(), merge_mean() and merge_max()
+    functions. The scenarios touched by the merge are recorded in the
+    temporary "merged_scenarios" table.
 
-    rows = [row for row in
-            self.execute("SELECT * FROM rhs.runtime_stats")]
-    total = len(rows)
-
-    # Insert or merge the contents of the rhs.runtime_stats table.
-    # TODO: This could probably be implemented using an SQL
-    # query, if I had the time and the know-how.
-    for i, row in enumerate(rows):
-      self._progress_report("runtime_stats", i, 1000, total)
-      scenario, params, rhs_count, rhs_min, rhs_mean, rhs_max = row
-      lhs = self.execute("SELECT num_samples,min,mean,max\n"
-                         "FROM runtime_stats\n"
-                         "WHERE scenario=? AND params=?",
-                         (scenario, params)).fetchone()
-      if lhs:
-        # Prior value, so update the existing value.
-        lhs_count, lhs_min, lhs_mean, lhs_max = lhs
-
-        new_count = lhs_count + rhs_count
-        new_min = min(lhs_min, rhs_min)
-        new_mean = ((lhs_mean * lhs_count + rhs_mean * rhs_count)
-                    / new_count)
-        new_max = max(lhs_max, rhs_max)
-
-        self.execute("UPDATE runtime_stats\n"
-                     "SET num_samples=?,min=?,mean=?,max=?\n"
-                     "WHERE scenario=? AND params=?",
-                     (new_count, new_min, new_mean, new_max,
-                      scenario, params))
-      else:
-        # No prior value, so just add a new row.
-        self.execute("INSERT INTO runtime_stats\n"
-                     "VALUES (?,?,?,?,?,?)",
-                     (scenario, params, rhs_count,
-                      rhs_min, rhs_mean, rhs_max))
+    Arguments:
 
+        rhs (Database): Database instance to merge into this.
+    """
+    io.info("Merging", rhs.path)
+    prof.start("merged " + rhs.path)
+    self.attach(rhs.path, "rhs")
+    self.run("merge_rhs")
     self.commit()
     self.detach("rhs")
+    prof.stop("merged " + rhs.path)
 
-  def merge(self, dbs):
+  def merge(self, dbs, nproc=None):
     """
     Merge the contents of the given databases.
 
+    The runtime_stats tables of the databases are populated in
+    parallel, and each database is merged into this as soon as it
+    is ready. Derived tables are then updated only for the scenarios
+    which have new data.
+
     Arguments:
 
         dbs (list of Database objects): Database instances to
           merge into this.
+        nproc (int, optional): Number of worker processes to use
+          for staging. If not set, use one per CPU.
     """
-    for db in dbs:
-      self._merge_rhs(db)
+    dbs = {db.path: db for db in dbs}
+    pool = multiprocessing.Pool(nproc)
+    try:
+      for path in pool.imap_unordered(_stage_rhs, dbs.keys()):
+        self._merge_rhs(dbs[path])
+    finally:
+      pool.close()
+      pool.join()
 
     io.info("Updating oracle tables ...")
-    self.execute("DELETE FROM oracle_params")
-    self.populate_oracle_params_table()
-    self.populate_scenario_stats_table()
+    self.run("refresh_oracle_params")
+    self.run("refresh_scenario_stats")
     self.populate_param_stats_table()
+    self.execute("DROP TABLE IF EXISTS merged_scenarios")
+    self.commit()
 
     io.debug("Compacting database ...")
     self.execute("VACUUM")
@@ -18,10 +18,19 @@ def _checksum_list(hash_fn, *elems):
   return _checksum_str(hash_fn, string)
 
 
+# The number of bytes to read from a file at a time when computing checksums.
+_FILE_CHUNK_SIZE = 1 << 20
+
+
 def _checksum_file(hash_fn, path: typing.Union[str, pathlib.Path]):
+  # Files are read in chunks so that large files are not read into memory.
+  # hashlib releases the GIL while hashing large chunks, so files may be
+  # hashed concurrently on threads.
+  hasher = hash_fn()
   with open(path, 'rb') as infile:
-    ret = _checksum(hash_fn, infile.read())
-  return ret
+    for chunk in iter(lambda: infile.read(_FILE_CHUNK_SIZE), b''):
+      hasher.update(chunk)
+  return hasher.hexdigest()
 
 
 def sha1(data):
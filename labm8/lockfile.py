@@ -5,11 +5,13 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import datetime
+import fcntl
 import os
 import pathlib
 import sys
 import time
 import typing
+import uuid
 
 from absl import logging
 
@@ -19,6 +21,21 @@ from labm8 import system
 from labm8.proto import lockfile_pb2
 
 
+# The minimum and maximum interval between checks of a lock which is held by
+# a process which we cannot wait on, e.g. a process on a different host.
+_MIN_POLL_INTERVAL = 0.01
+_MAX_POLL_INTERVAL = 1.0
+
+# Open file descriptors of the locks held by this process, keyed by lock path.
+# Every held lock file is kept open with an exclusive POSIX record lock on it,
+# so that processes which are blocked on the lock are woken when it is
+# released, or when the owning process dies. Record locks are not inherited by
+# child processes, but they are dropped when the owning process closes *any*
+# descriptor of the file, so the lock file must only be read through this
+# descriptor while it is held.
+_HELD_LOCK_FDS: typing.Dict[pathlib.Path, int] = {}
+
+
 class Error(Exception):
   pass
 
@@ -153,40 +170,132 @@ class LockFile:
       UnableToAcquireLockError: If the lock is already claimed
         (not raised if force option is used).
     """
-
-    def _create_lock():
-      lockfile = lockfile_pb2.LockFile(
-          owner_process_id=os.getpid() if pid is None else pid,
-          owner_process_argv=' '.join(sys.argv),
-          date_acquired_utc_epoch_ms=labdate.MillisecondsTimestamp(
-              labdate.GetUtcMillisecondsNow()),
-          owner_hostname=system.HOSTNAME,
-          owner_user=system.USERNAME)
-      pbutil.ToFile(lockfile, self.path, assume_filename='LOCK.pbtxt')
-
+    lockfile = lockfile_pb2.LockFile(
+        owner_process_id=os.getpid() if pid is None else pid,
+        owner_process_argv=' '.join(sys.argv),
+        date_acquired_utc_epoch_ms=labdate.MillisecondsTimestamp(
+            labdate.GetUtcMillisecondsNow()),
+        owner_hostname=system.HOSTNAME,
+        owner_user=system.USERNAME)
+
+    poll_interval = _MIN_POLL_INTERVAL
+    logged_blocking = False
     while True:
-      if self.islocked:
-        lock_owner_pid = self.pid
-        if self.owned_by_self:
-          pass  # don't replace existing lock
-          break
-        elif force:
-          _create_lock()
-          break
-        elif (replace_stale and self.hostname == system.HOSTNAME and
-              not system.isprocess(lock_owner_pid)):
-          _create_lock()
+      if self._create(lockfile, replace=False):
+        break
+      owner = self.read(self.path)
+      if not owner.ListFields() and not self.islocked:
+        continue  # The lock was released since we tried to create it.
+      lock_owner_pid = (owner.owner_process_id
+                        if owner.HasField('owner_process_id') else None)
+      if (owner.owner_hostname == system.HOSTNAME and
+          lock_owner_pid == os.getpid()):
+        pass  # don't replace existing lock
+        break
+      elif force:
+        self._create(lockfile, replace=True)
+        break
+      elif (replace_stale and owner.owner_hostname == system.HOSTNAME and
+            lock_owner_pid is not None and
+            not system.isprocess(lock_owner_pid)):
+        if self._replace_stale(lockfile, lock_owner_pid):
           break
-        elif not block:
-          raise UnableToAcquireLockError(self)
-        # Block and try again later.
+        continue
+      elif not block:
+        raise UnableToAcquireLockError(self)
+      # Block until the lock is released, and try again.
+      if not logged_blocking:
         logging.info('Blocking on lockfile %s', self.path)
-        time.sleep(10.0)
-      else:  # new lock
-        _create_lock()
-        break
+        logged_blocking = True
+      if self._wait_for_release():
+        poll_interval = _MIN_POLL_INTERVAL
+      else:
+        time.sleep(poll_interval)
+        poll_interval = min(poll_interval * 2, _MAX_POLL_INTERVAL)
     return self
 
+  def _create(self, lockfile: lockfile_pb2.LockFile, replace: bool) -> bool:
+    """Atomically create the lock file.
+
+    The lock file is written to a temporary path and then hard linked into
+    place, which fails if the lock file exists. This means that the lock can
+    only be acquired by one process, and that the lock file is never seen in
+    a partially written state.
+
+    Args:
+      lockfile: The contents of the lock file.
+      replace: If True, replace any existing lock file.
+
+    Returns:
+      True if the lock was created, False if it already exists.
+    """
+    tmp_path = self.path.parent / f'.{self.path.name}.{uuid.uuid4().hex}.tmp'
+    pbutil.ToFile(lockfile, tmp_path, assume_filename='LOCK.pbtxt')
+    try:
+      if replace:
+        os.replace(tmp_path, self.path)
+      else:
+        os.link(tmp_path, self.path)
+    except FileExistsError:
+      return False
+    finally:
+      if tmp_path.is_file():
+        os.unlink(tmp_path)
+    self._hold()
+    return True
+
+  def _hold(self) -> None:
+    """Hold an exclusive record lock on the lock file until it is released."""
+    fd = os.open(self.path, os.O_RDWR)
+    fcntl.lockf(fd, fcntl.LOCK_EX)
+    if self.path in _HELD_LOCK_FDS:
+      os.close(_HELD_LOCK_FDS[self.path])
+    _HELD_LOCK_FDS[self.path] = fd
+
+  def _replace_stale(self, lockfile: lockfile_pb2.LockFile,
+                     stale_pid: int) -> bool:
+    """Replace a lock owned by a dead process.
+
+    Processes which replace a stale lock are serialized by an advisory lock on
+    the lock's directory, and the owner is checked again once that is held, so
+    that two processes cannot both replace the same stale lock.
+
+    Returns:
+      True if the lock was replaced, False if it changed owner in the meantime.
+    """
+    fd = os.open(self.path.parent, os.O_RDONLY)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      if self.pid != stale_pid or self.hostname != system.HOSTNAME:
+        return False
+      self._create(lockfile, replace=True)
+      return True
+    finally:
+      os.close(fd)
+
+  def _wait_for_release(self) -> bool:
+    """Block until the process holding the lock releases it.
+
+    Returns:
+      True if the lock file was released. False if the lock file is not held
+      open by a process which we can wait on, e.g. because it was acquired by
+      a process on another host, or by a process which has since died. The
+      caller must poll such locks.
+    """
+    try:
+      fd = os.open(self.path, os.O_RDONLY)
+    except FileNotFoundError:
+      return True
+    try:
+      inode = os.fstat(fd).st_ino
+      fcntl.lockf(fd, fcntl.LOCK_SH)
+      try:
+        return os.stat(self.path).st_ino != inode
+      except FileNotFoundError:
+        return True
+    finally:
+      os.close(fd)
+
   def release(self, force=False):
     """Release lock.
 
@@ -205,6 +314,10 @@ class LockFile:
 
     if self.owned_by_self or force:
       os.remove(self.path)
+      # Closing the file releases the record lock, waking any processes which
+      # are blocked on it.
+      if self.path in _HELD_LOCK_FDS:
+        os.close(_HELD_LOCK_FDS.pop(self.path))
     else:
       raise UnableToReleaseLockError(self)
 
@@ -228,8 +341,15 @@ class LockFile:
       A LockFile proto.
     """
     path = pathlib.Path(path)
-    if path.is_file():
+    fd = _HELD_LOCK_FDS.get(path)
+    try:
+      if fd is not None and os.fstat(fd).st_ino == os.stat(path).st_ino:
+        # Opening and closing the file would drop our lock, so read it through
+        # the held descriptor.
+        return pbutil.FromString(
+            os.pread(fd, os.fstat(fd).st_size, 0).decode('utf-8'),
+            lockfile_pb2.LockFile())
       return pbutil.FromFile(path, lockfile_pb2.LockFile(),
                              assume_filename='LOCK.pbtxt')
-    else:
+    except FileNotFoundError:
       return lockfile_pb2.LockFile()
@@ -1,7 +1,9 @@
 """Unit tests for //labm8:latex."""
+import multiprocessing
 import pathlib
 import sys
 import tempfile
+import time
 
 import pytest
 from absl import app
@@ -141,6 +143,77 @@ def test_LockFile_force_replace_stale():
     assert not fs.exists(lock.path)
 
 
+def test_LockFile_acquire_fails_if_created_concurrently():
+  """Test that only one process can create a lock file."""
+  with tempfile.TemporaryDirectory() as d:
+    path = pathlib.Path(d) / 'LOCK'
+    lock = lockfile.LockFile(path)
+    lock.acquire(pid=1)
+    assert not lock._create(lockfile_pb2.LockFile(owner_process_id=2),
+                            replace=False)
+    assert lock.pid == 1
+    lock.release(force=True)
+    assert not list(pathlib.Path(d).iterdir())
+
+
+def _AcquireReleaseInChildProcess(path: pathlib.Path, hold_time: float) -> None:
+  lock = lockfile.LockFile(path)
+  lock.acquire()
+  time.sleep(hold_time)
+  lock.release()
+
+
+def test_LockFile_block_wakes_on_release():
+  """Test that a blocked acquire() returns promptly when the lock is released."""
+  with tempfile.TemporaryDirectory() as d:
+    path = pathlib.Path(d) / 'LOCK'
+    process = multiprocessing.Process(
+        target=_AcquireReleaseInChildProcess, args=(path, 0.5))
+    process.start()
+    while not path.is_file():
+      time.sleep(0.01)
+    start_time = time.time()
+    lock = lockfile.LockFile(path).acquire(block=True)
+    assert lock.owned_by_self
+    assert time.time() - start_time < 2
+    lock.release()
+    process.join()
+
+
+def _IncrementCounterInChildProcess(lock_path: pathlib.Path,
+                                    counter_path: pathlib.Path,
+                                    n: int) -> None:
+  lock = lockfile.LockFile(lock_path)
+  for _ in range(n):
+    lock.acquire(block=True)
+    with open(counter_path) as f:
+      count = int(f.read())
+    with open(counter_path, 'w') as f:
+      f.write(str(count + 1))
+    lock.release()
+
+
+def _ContendedIncrements(d: pathlib.Path, num_processes: int, n: int) -> int:
+  with open(d / 'counter', 'w') as f:
+    f.write('0')
+  processes = [
+    multiprocessing.Process(target=_IncrementCounterInChildProcess,
+                            args=(d / 'LOCK', d / 'counter', n))
+    for _ in range(num_processes)]
+  for process in processes:
+    process.start()
+  for process in processes:
+    process.join()
+  with open(d / 'counter') as f:
+    return int(f.read())
+
+
+def test_benchmark_LockFile_contention(benchmark):
+  """Benchmark multiple processes contending for a lock."""
+  with tempfile.TemporaryDirectory() as d:
+    assert benchmark(_ContendedIncrements, pathlib.Path(d), 4, 25) == 100
+
+
 def main(argv):  # pylint: disable=missing-docstring
   del argv
   sys.exit(pytest.main([__file__, '-v']))
@@ -1,31 +1,328 @@
 """Profiling API for timing critical paths in code.
+
+Code is profiled using spans, which time the execution of a block:
+
+    with prof.Span('preprocess'):
+      ...
+
+Spans may be nested, and may be used from multiple threads and processes.
+Each thread has its own stack of open spans. When profiling is disabled,
+Span() returns a shared no-op object, so leaving spans in hot code is cheap.
+
+Completed spans are aggregated into per-name statistics, see Stats() and
+PrintStats(), and can be exported in the Chrome trace event format, see
+ExportChromeTrace(). Load the exported file in chrome://tracing or Perfetto to
+inspect a run.
+
+Profiling is enabled if the PROFILE environment variable is set when this
+module is imported, or by calling enable().
 """
 from __future__ import absolute_import
 from __future__ import print_function
 
+import collections
+import functools
 import inspect
+import json
 import os
+import pathlib
+import random
 import sys
-from time import time
+import threading
+import time
+import typing
 
 from labm8 import labtypes
 
 
+# Whether profiling is enabled. This is read from the environment once, rather
+# than on every span.
+_ENABLED = os.environ.get("PROFILE") is not None
+
+# Completed spans, as (name, start_us, duration_us, thread_id, args) tuples.
+_EVENTS = []
+# The maximum number of events to record for trace export. Once reached,
+# spans are still aggregated in Stats(), but are not exported.
+MAX_EVENTS = 1000000
+# The maximum number of durations to sample for each span name. Beyond this,
+# percentiles are estimated from a uniform sample of the durations.
+MAX_DURATION_SAMPLES = 10000
+# Durations of completed spans in seconds, keyed by name.
+_DURATIONS = collections.defaultdict(lambda: _Durations())
+# The process which recorded _EVENTS and _DURATIONS. If a process forks, the
+# child discards the records inherited from the parent.
+_PID = os.getpid()
+_LOCK = threading.Lock()
+_THREAD_LOCAL = threading.local()
+
+# Start times of the legacy start() / stop() timers, keyed by name.
 __TIMERS = {}
 
 
 def is_enabled():
-  return os.environ.get("PROFILE") is not None
+  return _ENABLED
 
 
 def enable():
+  global _ENABLED
+  _ENABLED = True
+  # Set the environment variable so that profiling is enabled in child
+  # processes.
   os.environ["PROFILE"] = "1"
 
 
 def disable():
+  global _ENABLED
+  _ENABLED = False
   os.environ.pop("PROFILE", None)
 
 
+def _Now() -> float:
+  """Return a timestamp in seconds which is comparable across processes."""
+  return time.perf_counter()
+
+
+def _SpanStack() -> typing.List['_Span']:
+  """Return the stack of open spans of the current thread."""
+  try:
+    return _THREAD_LOCAL.stack
+  except AttributeError:
+    _THREAD_LOCAL.stack = []
+    return _THREAD_LOCAL.stack
+
+
+class _Durations(object):
+  """The durations of the completed spans with the same name.
+
+  The count, total, and maximum are exact. Percentiles are computed from a
+  reservoir sample of at most MAX_DURATION_SAMPLES durations, so that memory
+  use is bounded in long-running processes.
+  """
+
+  __slots__ = ['count', 'total', 'max', 'samples']
+
+  def __init__(self):
+    self.count = 0
+    self.total = 0
+    self.max = 0
+    self.samples = []
+
+  def Add(self, duration: float) -> None:
+    self.count += 1
+    self.total += duration
+    self.max = max(self.max, duration)
+    if len(self.samples) < MAX_DURATION_SAMPLES:
+      self.samples.append(duration)
+    else:
+      # Replace a sample with probability MAX_DURATION_SAMPLES / count.
+      i = random.randrange(self.count)
+      if i < len(self.samples):
+        self.samples[i] = duration
+
+
+def _Record(name: str, start: float, end: float,
+            args: typing.Optional[typing.Dict[str, typing.Any]]) -> None:
+  """Record a completed span."""
+  global _PID
+  with _LOCK:
+    if os.getpid() != _PID:
+      _EVENTS.clear()
+      _DURATIONS.clear()
+      _PID = os.getpid()
+    _DURATIONS[name].Add(end - start)
+    if len(_EVENTS) < MAX_EVENTS:
+      _EVENTS.append((name, start * 1e6, (end - start) * 1e6,
+                      threading.get_ident(), args))
+
+
+class _NullSpan(object):
+  """A span which does nothing, returned when profiling is disabled."""
+
+  def __enter__(self) -> '_NullSpan':
+    return self
+
+  def __exit__(self, *args) -> None:
+    pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+  """A timed span of execution."""
+
+  __slots__ = ['name', 'args', 'start']
+
+  def __init__(self, name: str, args: typing.Dict[str, typing.Any]):
+    self.name = name
+    self.args = args
+    self.start = None
+
+  def __enter__(self) -> '_Span':
+    _SpanStack().append(self)
+    self.start = _Now()
+    return self
+
+  def __exit__(self, *args) -> None:
+    end = _Now()
+    stack = _SpanStack()
+    if stack and stack[-1] is self:
+      stack.pop()
+    _Record(self.name, self.start, end, self.args or None)
+
+
+def Span(name: str, **args) -> typing.Union[_Span, _NullSpan]:
+  """Create a span which times the execution of a with block.
+
+  Args:
+    name: The name of the span. Statistics are aggregated by name.
+    args: Optional values to attach to the span in trace exports.
+
+  Returns:
+    A context manager.
+  """
+  if not _ENABLED:
+    return _NULL_SPAN
+  return _Span(name, args)
+
+
+def CurrentSpanNames() -> typing.List[str]:
+  """Return the names of the current thread's open spans, outermost first."""
+  return [span.name for span in _SpanStack()]
+
+
+def Profiled(name: typing.Optional[str] = None):
+  """A decorator which profiles every call to a function.
+
+  Args:
+    name: The name of the span. Defaults to the qualified name of the function.
+
+  Returns:
+    A decorator.
+  """
+
+  def Decorator(fun):
+    span_name = name or f'{fun.__module__}.{fun.__qualname__}'
+
+    @functools.wraps(fun)
+    def Wrapper(*args, **kwargs):
+      if not _ENABLED:
+        return fun(*args, **kwargs)
+      with _Span(span_name, {}):
+        return fun(*args, **kwargs)
+
+    return Wrapper
+
+  return Decorator
+
+
+SpanStats = collections.namedtuple(
+    'SpanStats', ['count', 'total', 'mean', 'p50', 'p99', 'max'])
+
+
+def _Percentile(sorted_values: typing.List[float], p: float) -> float:
+  """Nearest-rank percentile of a sorted list."""
+  return sorted_values[min(len(sorted_values) - 1,
+                           int(p / 100 * len(sorted_values)))]
+
+
+def Stats() -> typing.Dict[str, SpanStats]:
+  """Return aggregate statistics of the spans recorded by this process.
+
+  Percentiles are estimates if more than MAX_DURATION_SAMPLES spans with the
+  same name were recorded.
+
+  Returns:
+    A map from span name to a SpanStats tuple. All times are in seconds.
+  """
+  with _LOCK:
+    if os.getpid() != _PID:
+      return {}
+    durations = {name: (d.count, d.total, d.max, sorted(d.samples))
+                 for name, d in _DURATIONS.items()}
+  return {
+    name: SpanStats(count=count, total=total, mean=total / count,
+                    p50=_Percentile(samples, 50), p99=_Percentile(samples, 99),
+                    max=max_)
+    for name, (count, total, max_, samples) in durations.items()
+  }
+
+
+def _FormatElapsed(elapsed: float) -> str:
+  if elapsed > 60:
+    return '{:.1f} m'.format(elapsed / 60)
+  elif elapsed > 1:
+    return '{:.1f} s'.format(elapsed)
+  else:
+    return '{:.1f} ms'.format(elapsed * 1000)
+
+
+def PrintStats(file=sys.stderr) -> None:
+  """Print a table of span statistics, most expensive first."""
+  stats = sorted(Stats().items(), key=lambda x: -x[1].total)
+  if not stats:
+    return
+  width = max(len(name) for name, _ in stats)
+  print(f'[prof] {"span":<{width}} {"count":>8} {"total":>10} {"p50":>10} '
+        f'{"p99":>10} {"max":>10}', file=file)
+  for name, s in stats:
+    print(f'[prof] {name:<{width}} {s.count:>8} '
+          f'{_FormatElapsed(s.total):>10} {_FormatElapsed(s.p50):>10} '
+          f'{_FormatElapsed(s.p99):>10} {_FormatElapsed(s.max):>10}',
+          file=file)
+
+
+def ChromeTraceEvents() -> typing.List[typing.Dict[str, typing.Any]]:
+  """Return the spans recorded by this process as Chrome trace events."""
+  pid = os.getpid()
+  with _LOCK:
+    events = list(_EVENTS) if pid == _PID else []
+  trace_events = []
+  for name, start_us, duration_us, thread_id, args in events:
+    event = {'name': name, 'cat': 'prof', 'ph': 'X', 'ts': start_us,
+             'dur': duration_us, 'pid': pid, 'tid': thread_id}
+    if args:
+      event['args'] = {k: str(v) for k, v in args.items()}
+    trace_events.append(event)
+  return trace_events
+
+
+def ExportChromeTrace(path: typing.Union[str, pathlib.Path]) -> None:
+  """Write the spans recorded by this process to a Chrome trace file.
+
+  For a multi-process pipeline, export a trace from every process and combine
+  them with MergeChromeTraces().
+
+  Args:
+    path: The path of the JSON file to write.
+  """
+  with open(path, 'w') as f:
+    json.dump({'traceEvents': ChromeTraceEvents()}, f)
+
+
+def MergeChromeTraces(paths: typing.Iterable[typing.Union[str, pathlib.Path]],
+                      output_path: typing.Union[str, pathlib.Path]) -> None:
+  """Merge Chrome trace files into a single trace.
+
+  Args:
+    paths: The paths of the trace files to merge.
+    output_path: The path of the merged trace file to write.
+  """
+  events = []
+  for path in paths:
+    with open(path) as f:
+      events += json.load(f)['traceEvents']
+  with open(output_path, 'w') as f:
+    json.dump({'traceEvents': events}, f)
+
+
+def Reset() -> None:
+  """Discard all recorded spans."""
+  with _LOCK:
+    _EVENTS.clear()
+    _DURATIONS.clear()
+
+
 def isrunning(name):
   """
   Check if a timer is running.
@@ -38,7 +335,7 @@ def isrunning(name):
 
       bool: True if timer is running, else False.
   """
-  return name in _timers
+  return name in __TIMERS
 
 
 def start(name):
@@ -58,15 +355,17 @@ def start(name):
 
       bool: Whether or not profiling is enabled.
   """
-  if is_enabled():
-    __TIMERS[name] = time()
-  return is_enabled()
+  if _ENABLED:
+    __TIMERS[name] = _Now()
+  return _ENABLED
 
 
 def stop(name, file=sys.stderr):
   """
   Stop a profiling timer.
 
+  The elapsed time is printed, and recorded as a span.
+
   Arguments:
 
       name (str): The name of the timer to stop. If no name is given, stop
@@ -80,18 +379,12 @@ def stop(name, file=sys.stderr):
 
       KeyError: If the named timer does not exist.
   """
-  if is_enabled():
-    elapsed = (time() - __TIMERS[name])
-    if elapsed > 60:
-      elapsed_str = '{:.1f} m'.format(elapsed / 60)
-    elif elapsed > 1:
-      elapsed_str = '{:.1f} s'.format(elapsed)
-    else:
-      elapsed_str = '{:.1f} ms'.format(elapsed * 1000)
-
-    del __TIMERS[name]
-    print("[prof]", name, elapsed_str, file=file)
-  return is_enabled()
+  if _ENABLED:
+    end = _Now()
+    start_time = __TIMERS.pop(name)
+    _Record(name, start_time, end, None)
+    print("[prof]", name, _FormatElapsed(end - start_time), file=file)
+  return _ENABLED
 
 
 def profile(fun, *args, **kwargs):
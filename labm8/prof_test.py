@@ -1,7 +1,10 @@
 """Unit tests for //labm8:prof."""
-import os
+import json
+import multiprocessing
 import re
 import sys
+import tempfile
+import threading
 
 import pytest
 from absl import app
@@ -26,10 +29,11 @@ def profiling_env() -> None:
     A Session instance.
   """
   try:
-    os.environ['PROFILE'] = '1'
+    prof.enable()
+    prof.Reset()
     yield None
   finally:
-    os.environ['PROFILE'] = ''
+    prof.disable()
 
 
 def test_enable_disable():
@@ -97,6 +101,125 @@ def test_timers(profiling_env):
   assert len(list(prof.timers())) == x
 
 
+def test_Span_disabled():
+  """Test that spans are not recorded when profiling is disabled."""
+  prof.Reset()
+  with prof.Span('foo'):
+    pass
+  assert not prof.Stats()
+
+
+def test_Span_nested(profiling_env):
+  """Test that nested spans are recorded."""
+  with prof.Span('outer'):
+    with prof.Span('inner', n=1):
+      assert prof.CurrentSpanNames() == ['outer', 'inner']
+    with prof.Span('inner'):
+      pass
+  assert prof.CurrentSpanNames() == []
+  stats = prof.Stats()
+  assert stats['outer'].count == 1
+  assert stats['inner'].count == 2
+  assert stats['outer'].total >= stats['inner'].total
+
+
+def test_Span_threads(profiling_env):
+  """Test that spans can be recorded from multiple threads."""
+
+  def Work():
+    for _ in range(100):
+      with prof.Span('work'):
+        assert prof.CurrentSpanNames() == ['work']
+
+  threads = [threading.Thread(target=Work) for _ in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert prof.Stats()['work'].count == 400
+
+
+def test_Profiled(profiling_env):
+  """Test the function decorator."""
+
+  @prof.Profiled()
+  def Add(x, y):
+    return x + y
+
+  assert Add(1, 2) == 3
+  [name] = prof.Stats().keys()
+  assert name.endswith('Add')
+
+
+def test_Stats_percentiles(profiling_env):
+  """Test that percentiles are computed from recorded spans."""
+  for i in range(1, 101):
+    prof._Record('foo', 0, i, None)
+  stats = prof.Stats()['foo']
+  assert stats.count == 100
+  assert stats.p50 == 51
+  assert stats.p99 == 100
+  assert stats.max == 100
+
+
+def test_Stats_bounded_samples(profiling_env, monkeypatch):
+  """Test that the number of durations kept for percentiles is bounded."""
+  monkeypatch.setattr(prof, 'MAX_DURATION_SAMPLES', 10)
+  for i in range(1, 1001):
+    prof._Record('foo', 0, i, None)
+  assert len(prof._DURATIONS['foo'].samples) == 10
+  stats = prof.Stats()['foo']
+  assert stats.count == 1000
+  assert stats.total == sum(range(1, 1001))
+  assert stats.max == 1000
+  assert 1 <= stats.p50 <= 1000
+
+
+def test_PrintStats(profiling_env):
+  buf = StringIO()
+  with prof.Span('foo'):
+    pass
+  prof.PrintStats(file=buf)
+  assert re.search(r'\[prof\] foo +1 ', buf.getvalue())
+
+
+def _SpanInChildProcess(path: str) -> None:
+  with prof.Span('child'):
+    pass
+  prof.ExportChromeTrace(path)
+
+
+def test_ExportChromeTrace_multiple_processes(profiling_env):
+  """Test exporting and merging traces from multiple processes."""
+  with prof.Span('parent'):
+    pass
+  with tempfile.TemporaryDirectory() as d:
+    process = multiprocessing.Process(target=_SpanInChildProcess,
+                                      args=(f'{d}/child.json',))
+    process.start()
+    process.join()
+    prof.ExportChromeTrace(f'{d}/parent.json')
+    prof.MergeChromeTraces([f'{d}/parent.json', f'{d}/child.json'],
+                           f'{d}/trace.json')
+    with open(f'{d}/trace.json') as f:
+      events = json.load(f)['traceEvents']
+  # The child discards the spans inherited from the parent.
+  assert [e['name'] for e in events] == ['parent', 'child']
+  assert events[0]['pid'] != events[1]['pid']
+  assert all(e['ph'] == 'X' for e in events)
+
+
+def test_benchmark_Span_disabled(benchmark):
+  """Benchmark the overhead of a span when profiling is disabled."""
+
+  def Spans():
+    for _ in range(1000):
+      with prof.Span('foo'):
+        pass
+
+  benchmark(Spans)
+
+
 def main(argv):  # pylint: disable=missing-docstring
   del argv
   sys.exit(pytest.main([__file__, '-v']))
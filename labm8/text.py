@@ -63,14 +63,89 @@ def truncate(string, maxchar):
     return string[:maxchar - 3] + "..."
 
 
-def levenshtein(s1, s2):
+def _levenshtein_pattern(pattern):
+  """
+  Build the match vectors of a pattern for bit-parallel edit distance.
+
+  Arguments:
+
+      pattern (str): The pattern string.
+
+  Returns:
+
+      dict: A map from character to an integer bitmask, where bit i is set if
+          pattern[i] is that character.
+  """
+  peq = {}
+  for i, c in enumerate(pattern):
+    peq[c] = peq.get(c, 0) | (1 << i)
+  return peq
+
+
+def _levenshtein_bitparallel(peq, m, s, max_distance):
+  """
+  Compute the Levenshtein distance between a pattern and a string.
+
+  This is the bit-parallel algorithm of Myers (1999), in the formulation of
+  Hyyro (2003) for global edit distance. A column of the dynamic programming
+  matrix is encoded as vertical deltas packed into the bits of an integer, so
+  each character of s costs a constant number of integer operations. Python
+  integers are arbitrary-precision, so a pattern of any length is handled by
+  a single "word".
+
+  Arguments:
+
+      peq (dict): The match vectors of the pattern, from _levenshtein_pattern().
+      m (int): The length of the pattern.
+      s (str): The string to compare against.
+      max_distance (int or None): If not None, stop once the distance is
+          known to exceed this value.
+
+  Returns:
+
+      int: The distance, or max_distance + 1 if it exceeds max_distance.
+  """
+  n = len(s)
+  if max_distance is not None and abs(m - n) > max_distance:
+    return max_distance + 1
+  if not m:
+    return n
+
+  mask = (1 << m) - 1
+  high = 1 << (m - 1)
+  pv = mask
+  mv = 0
+  score = m
+  for j, c in enumerate(s):
+    eq = peq.get(c, 0)
+    xv = eq | mv
+    xh = (((eq & pv) + pv) ^ pv) | eq
+    ph = mv | (~(xh | pv) & mask)
+    mh = pv & xh
+    if ph & high:
+      score += 1
+    elif mh & high:
+      score -= 1
+    # The distance can decrease by at most one per remaining character.
+    if max_distance is not None and score - (n - j - 1) > max_distance:
+      return max_distance + 1
+    ph = ((ph << 1) | 1) & mask
+    mh = (mh << 1) & mask
+    pv = mh | (~(xv | ph) & mask)
+    mv = ph & xv
+  if max_distance is not None and score > max_distance:
+    return max_distance + 1
+  return score
+
+
+def levenshtein(s1, s2, max_distance=None):
   """
   Return the Levenshtein distance between two strings.
 
   Implementation of Levenshtein distance, one of a family of edit
-  distance metrics.
-
-  Based on: https://en.wikibooks.org/wiki/Algorithm_Implementation/Strings/Levenshtein_distance#Python
+  distance metrics. The distance is computed using a bit-parallel
+  algorithm, which takes O(len(s1) * len(s2) / w) time for machine word
+  size w.
 
   Examples:
 
@@ -86,34 +161,55 @@ def levenshtein(s1, s2):
       >>> text.levensthein("1234", "1 34")
       1
 
+      >>> text.levensthein("foo", "barbaz", max_distance=2)
+      3
+
   Arguments:
 
       s1 (str): Argument A.
       s2 (str): Argument B.
+      max_distance (int, optional): If provided, return as soon as the
+          distance is known to exceed this value. Strings whose lengths
+          differ by more than max_distance are not compared at all.
 
   Returns:
 
-      int: Levenshtein distance between the two strings.
+      int: Levenshtein distance between the two strings. If max_distance is
+          provided and the distance exceeds it, max_distance + 1.
+  """
+  # Use the shorter string as the pattern, to minimize the integer width.
+  if len(s1) > len(s2):
+    s1, s2 = s2, s1
+  return _levenshtein_bitparallel(
+      _levenshtein_pattern(s1), len(s1), s2, max_distance)
+
+
+def levenshtein_many(s, others, max_distance=None):
   """
-  # Left string must be >= right string.
-  if len(s1) < len(s2):
-    return levenshtein(s2, s1)
+  Return the Levenshtein distances between a string and many others.
 
-  # Distance is length of s1 if s2 is empty.
-  if len(s2) == 0:
-    return len(s1)
+  This is equivalent to [levenshtein(s, o) for o in others], but the
+  preprocessing of s is shared between all comparisons.
 
-  previous_row = range(len(s2) + 1)
-  for i, c1 in enumerate(s1):
-    current_row = [i + 1]
-    for j, c2 in enumerate(s2):
-      insertions = previous_row[j + 1] + 1
-      deletions = current_row[j] + 1
-      substitutions = previous_row[j] + (c1 != c2)
-      current_row.append(min(insertions, deletions, substitutions))
-    previous_row = current_row
+  Examples:
+
+      >>> text.levenshtein_many("foo", ["foo", "fooo", ""])
+      [0, 1, 3]
+
+  Arguments:
 
-  return previous_row[-1]
+      s (str): The string to compare against.
+      others (iterable of str): The strings to compare.
+      max_distance (int, optional): If provided, return max_distance + 1 for
+          any string whose distance exceeds this value. See levenshtein().
+
+  Returns:
+
+      list of int: The distance between s and each of the others.
+  """
+  peq = _levenshtein_pattern(s)
+  return [_levenshtein_bitparallel(peq, len(s), other, max_distance)
+          for other in others]
 
 
 def diff(s1, s2):
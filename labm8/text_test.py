@@ -1,4 +1,5 @@
 """Unit tests for //labm8:text."""
+import random
 import sys
 
 import pytest
@@ -38,6 +39,89 @@ def test_levenshtein():
   assert 1 == text.levenshtein("123", "1 3")
 
 
+def _levenshtein_reference(s1, s2):
+  """Textbook O(n*m) Levenshtein distance, to check against."""
+  previous_row = list(range(len(s2) + 1))
+  for i, c1 in enumerate(s1):
+    current_row = [i + 1]
+    for j, c2 in enumerate(s2):
+      current_row.append(min(previous_row[j + 1] + 1, current_row[j] + 1,
+                             previous_row[j] + (c1 != c2)))
+    previous_row = current_row
+  return previous_row[-1]
+
+
+def _RandomString(rand, alphabet, max_length):
+  return ''.join(rand.choice(alphabet)
+                 for _ in range(rand.randint(0, max_length)))
+
+
+@pytest.mark.parametrize('alphabet', ['ab', 'abcdef', 'abcdefghijklmnopqrstu'])
+def test_levenshtein_matches_reference(alphabet):
+  rand = random.Random(0)
+  for _ in range(500):
+    s1 = _RandomString(rand, alphabet, 80)
+    s2 = _RandomString(rand, alphabet, 80)
+    assert _levenshtein_reference(s1, s2) == text.levenshtein(s1, s2)
+
+
+def test_levenshtein_long_strings():
+  """Test strings longer than a machine word."""
+  rand = random.Random(0)
+  s1 = _RandomString(rand, 'abc \n', 500)
+  s2 = s1[:100] + 'xyz' + s1[150:]
+  assert _levenshtein_reference(s1, s2) == text.levenshtein(s1, s2)
+
+
+def test_levenshtein_max_distance():
+  assert 0 == text.levenshtein("foo", "foo", max_distance=0)
+  assert 1 == text.levenshtein("foo", "fooo", max_distance=1)
+  assert 1 == text.levenshtein("foo", "fooo", max_distance=0)
+  assert 3 == text.levenshtein("foo", "barbaz", max_distance=2)
+  assert 3 == text.levenshtein("foo", "", max_distance=10)
+
+
+def test_levenshtein_max_distance_matches_reference():
+  rand = random.Random(0)
+  for _ in range(500):
+    s1 = _RandomString(rand, 'abc', 30)
+    s2 = _RandomString(rand, 'abc', 30)
+    max_distance = rand.randint(0, 20)
+    expected = min(_levenshtein_reference(s1, s2), max_distance + 1)
+    assert expected == text.levenshtein(s1, s2, max_distance=max_distance)
+
+
+# levenshtein_many()
+def test_levenshtein_many():
+  assert [0, 1, 3, 1] == text.levenshtein_many(
+      "foo", ["foo", "fooo", "", "fo"])
+  assert [] == text.levenshtein_many("foo", [])
+  assert [0, 2] == text.levenshtein_many("", ["", "ab"])
+
+
+def test_levenshtein_many_max_distance():
+  assert [0, 2, 2] == text.levenshtein_many(
+      "foo", ["foo", "barbaz", "bar"], max_distance=1)
+
+
+def test_levenshtein_many_matches_levenshtein():
+  rand = random.Random(0)
+  s = _RandomString(rand, 'abcd', 100)
+  others = [_RandomString(rand, 'abcd', 100) for _ in range(100)]
+  assert [text.levenshtein(s, o) for o in others] == text.levenshtein_many(
+      s, others)
+
+
+def test_benchmark_levenshtein_many(benchmark):
+  """Benchmark comparing a corpus-sized program against many others."""
+  rand = random.Random(0)
+  alphabet = 'abcdefghijklmnopqrstuvwxyz0123456789(){};=+-*/ \n'
+  s = ''.join(rand.choice(alphabet) for _ in range(3000))
+  others = [''.join(rand.choice(alphabet) for _ in range(3000))
+            for _ in range(20)]
+  benchmark(text.levenshtein_many, s, others)
+
+
 # diff()
 def test_diff():
   assert 0 == text.diff("foo", "foo")
@@ -5,11 +5,15 @@ each of the files within the directory. Use dpack to create consistent and well
 documented collections of data files.
 """
 import fnmatch
+import json
 import os
 import pathlib
+import re
 import sys
 import tarfile
+import tempfile
 import typing
+from concurrent import futures
 
 from absl import app
 from absl import flags
@@ -40,6 +44,15 @@ flags.DEFINE_bool('update', False,
                   'If no MANIFEST.pbtxt exists, it is created.')
 flags.DEFINE_bool('pack', False,
                   'If set, create the package archive.')
+flags.DEFINE_integer('hash_threads', 8,
+                     'The number of threads used to compute file checksums.')
+flags.DEFINE_string('verification_cache', '~/.cache/dpack/verified.json',
+                    'The path of a local cache of file checksums. The cache is '
+                    'updated whenever files are hashed.')
+flags.DEFINE_bool('fast_verify', False,
+                  'If set, files whose size and modification time match the '
+                  '--verification_cache are not rehashed, and their cached '
+                  'checksums are used. Otherwise, every file is rehashed.')
 
 
 def _IsPackage(path: pathlib.Path) -> bool:
@@ -85,6 +98,20 @@ ALWAYS_EXCLUDE_PATTERNS = [
 ]
 
 
+def CompileExcludePatterns(
+    exclude_patterns: typing.List[str]) -> typing.Pattern[str]:
+  """Compile a list of UNIX-style glob patterns into a single regex.
+
+  Args:
+    exclude_patterns: A list of patterns, as accepted by fnmatch.
+
+  Returns:
+    A compiled regex which matches a path if any pattern matches it.
+  """
+  return re.compile('|'.join(
+      fnmatch.translate(pattern) for pattern in sorted(set(exclude_patterns))))
+
+
 def GetFilesInDirectory(
     directory: pathlib.Path,
     exclude_patterns: typing.List[str]) -> typing.List[pathlib.Path]:
@@ -100,47 +127,28 @@ def GetFilesInDirectory(
   Returns:
     A list of paths.
   """
-  exclude_patterns = set(exclude_patterns + ALWAYS_EXCLUDE_PATTERNS)
+  exclude = CompileExcludePatterns(exclude_patterns + ALWAYS_EXCLUDE_PATTERNS)
   files = []
   for path in sorted(fs.lsfiles(directory, recursive=True)):
-    for pattern in exclude_patterns:
-      if fnmatch.fnmatch(path, pattern):
-        logging.info('- %s', path)
-        break
+    if exclude.match(path):
+      logging.info('- %s', path)
     else:
       logging.info('+ %s', path)
       files.append(pathlib.Path(path))
   return files
 
 
-def SetDataPackageFileAttributes(package_root: pathlib.Path,
-                                 relpath: pathlib.Path,
-                                 f: dpack_pb2.DataPackageFile) -> None:
-  """Set the file attributes of a DataPackageFile message.
+def _GetChecksumFunction(
+    checksum_hash: int
+) -> typing.Optional[typing.Callable[[pathlib.Path], str]]:
+  """Return the function which computes a checksum, or None if unknown."""
+  hash_fn = dpack_pb2.ChecksumHash.Name(checksum_hash).lower()
+  return getattr(crypto, hash_fn + '_file', None)
 
-  Args:
-    package_root: The root of the package.
-    relpath: The path to the file, relative to package_root.
-    f: A DataPackageFile instance.
-  """
-  abspath = package_root / relpath
-  f.relative_path = str(relpath)
-  f.size_in_bytes = abspath.stat().st_size
-  f.checksum = crypto.sha256_file(abspath)
-  f.checksum_hash = dpack_pb2.SHA256
 
-
-def DataPackageFileAttributesAreValid(package_root: pathlib.Path,
-                                      f: dpack_pb2.DataPackageFile) -> bool:
-  """Check that the values in a DataPackageFile match the real file.
-
-  Args:
-    package_root: The root of the package.
-    f: A DataPackageFile instance.
-
-  Returns:
-    True if the DataPackageFile fields match what is found in the filesystem.
-  """
+def _DataPackageFileSizeIsValid(package_root: pathlib.Path,
+                                f: dpack_pb2.DataPackageFile) -> bool:
+  """Check the attributes of a DataPackageFile which do not need hashing."""
   abspath = package_root / f.relative_path
   if not abspath.is_file():
     logging.warning("'%s' has vanished", f.relative_path)
@@ -151,23 +159,122 @@ def DataPackageFileAttributesAreValid(package_root: pathlib.Path,
     logging.warning("the contents of '%s' has changed", f.relative_path)
     return False
 
-  hash_fn = dpack_pb2.ChecksumHash.Name(f.checksum_hash).lower()
-  try:
-    checksum_fn = getattr(crypto, hash_fn + '_file')
-  except AttributeError:
+  if not _GetChecksumFunction(f.checksum_hash):
     logging.warning("unknown value for field checksum_hash in '%s'",
                     f.relative_path)
     return False
 
-  checksum = checksum_fn(abspath)
+  return True
+
+
+def _ChecksumIsValid(f: dpack_pb2.DataPackageFile, checksum: str) -> bool:
   if f.checksum != checksum:
     logging.warning("the contents of '%s' have changed but the size remains "
                     "the same", f.relative_path)
     return False
-
   return True
 
 
+class VerificationCache(object):
+  """A local cache of the checksums of files.
+
+  Entries are keyed by absolute path, and record the size and modification
+  time of a file when it was hashed. A cached checksum is only used while the
+  size and modification time of the file are unchanged. The cache is kept
+  outside of packages, so that read-only packages can be verified.
+  """
+
+  def __init__(self, path: typing.Optional[pathlib.Path] = None):
+    """Constructor.
+
+    Args:
+      path: The path of the JSON file which stores the cache. If not provided,
+        the cache is not persisted.
+    """
+    self.path = path
+    self._entries: typing.Dict[str, typing.List[typing.Union[int, str]]] = {}
+    if path and path.is_file():
+      try:
+        with open(path) as f:
+          self._entries = json.load(f)
+      except ValueError:
+        logging.warning('Ignoring corrupt verification cache %s', path)
+
+  @staticmethod
+  def _Key(abspath: pathlib.Path, checksum_hash: int) -> str:
+    return f'{checksum_hash}:{abspath.absolute()}'
+
+  def Get(self, abspath: pathlib.Path, stat: os.stat_result,
+          checksum_hash: int) -> typing.Optional[str]:
+    """Return the cached checksum of a file, or None if it has changed."""
+    entry = self._entries.get(self._Key(abspath, checksum_hash))
+    if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+      return entry[2]
+    return None
+
+  def Set(self, abspath: pathlib.Path, stat: os.stat_result,
+          checksum_hash: int, checksum: str) -> None:
+    """Record the checksum of a file."""
+    self._entries[self._Key(abspath, checksum_hash)] = [
+      stat.st_size, stat.st_mtime_ns, checksum]
+
+  def Write(self) -> None:
+    """Write the cache to file, if it has a path."""
+    if not self.path:
+      return
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    # Each writer uses its own temporary file, so that concurrent writers
+    # cannot interleave their output.
+    with tempfile.NamedTemporaryFile(
+        'w', dir=self.path.parent, prefix=f'.{self.path.name}.',
+        delete=False) as f:
+      try:
+        json.dump(self._entries, f)
+      except:
+        os.unlink(f.name)
+        raise
+    os.rename(f.name, self.path)
+
+
+def ComputeChecksums(
+    package_root: pathlib.Path, files: typing.List[dpack_pb2.DataPackageFile],
+    num_threads: int = 8, cache: typing.Optional[VerificationCache] = None,
+    fast_verify: bool = False) -> typing.List[str]:
+  """Compute the checksums of files on a pool of threads.
+
+  Args:
+    package_root: The root of the package.
+    files: The files to hash, using the function declared in their
+      checksum_hash fields.
+    num_threads: The number of files to hash concurrently.
+    cache: A verification cache, which is updated with every checksum that is
+      computed.
+    fast_verify: If True, return the cached checksums of unchanged files
+      rather than rehashing them.
+
+  Returns:
+    The checksum of each file.
+  """
+  abspaths = [package_root / f.relative_path for f in files]
+  stats = [abspath.stat() for abspath in abspaths]
+  checksums = [None] * len(files)
+  if cache and fast_verify:
+    for i, (f, abspath, stat) in enumerate(zip(files, abspaths, stats)):
+      checksums[i] = cache.Get(abspath, stat, f.checksum_hash)
+  to_hash = [i for i, checksum in enumerate(checksums) if checksum is None]
+  logging.info('Hashing %d of %d files', len(to_hash), len(files))
+
+  def Hash(i: int) -> str:
+    return _GetChecksumFunction(files[i].checksum_hash)(abspaths[i])
+
+  with futures.ThreadPoolExecutor(max(num_threads, 1)) as executor:
+    for i, checksum in zip(to_hash, executor.map(Hash, to_hash)):
+      checksums[i] = checksum
+      if cache:
+        cache.Set(abspaths[i], stats[i], files[i].checksum_hash, checksum)
+  return checksums
+
+
 def MergeManifests(new: dpack_pb2.DataPackage,
                    old: dpack_pb2.DataPackage) -> None:
   """Transfer non-file attribute fields from old to new manifests.
@@ -189,12 +296,17 @@ def MergeManifests(new: dpack_pb2.DataPackage,
 
 def CreatePackageManifest(
     package_root: pathlib.Path,
-    contents: typing.List[pathlib.Path]) -> dpack_pb2.DataPackage:
+    contents: typing.List[pathlib.Path], num_threads: int = 8,
+    cache: typing.Optional[VerificationCache] = None,
+    fast_verify: bool = False) -> dpack_pb2.DataPackage:
   """Create a DataPackage message for the contents of a package.
 
   Args:
     package_root: The root of the package.
     contents: A list of relative paths to files to include.
+    num_threads: The number of files to hash concurrently.
+    cache: A verification cache, see ComputeChecksums().
+    fast_verify: If True, use the cached checksums of unchanged files.
 
   Returns:
     A DataPackage instance with attributes set.
@@ -205,24 +317,44 @@ def CreatePackageManifest(
       labdate.GetUtcMillisecondsNow())
   for path in contents:
     f = manifest.file.add()
-    SetDataPackageFileAttributes(package_root, path, f)
+    f.relative_path = str(path)
+    f.size_in_bytes = (package_root / path).stat().st_size
+    f.checksum_hash = dpack_pb2.SHA256
     f.comment = f.comment or ''
+  checksums = ComputeChecksums(package_root, list(manifest.file), num_threads,
+                               cache, fast_verify)
+  for f, checksum in zip(manifest.file, checksums):
+    f.checksum = checksum
   return manifest
 
 
 def PackageManifestIsValid(package_root: pathlib.Path,
-                           manifest: dpack_pb2.DataPackage) -> bool:
+                           manifest: dpack_pb2.DataPackage,
+                           num_threads: int = 8,
+                           cache: typing.Optional[VerificationCache] = None,
+                           fast_verify: bool = False) -> bool:
   """Check that the package manifest is correct.
 
+  The sizes of all files are checked first, and only the files whose size is
+  correct are hashed.
+
   Args:
     package_root: The root of the package.
     manifest: A DataPackage instance describing the package.
+    num_threads: The number of files to hash concurrently.
+    cache: A verification cache, see ComputeChecksums().
+    fast_verify: If True, use the cached checksums of unchanged files.
 
   Returns:
     True if the manifest matches the contents of the file system, else False.
   """
-  return all(DataPackageFileAttributesAreValid(package_root, f)
-             for f in manifest.file)
+  files = [f for f in manifest.file
+           if _DataPackageFileSizeIsValid(package_root, f)]
+  checksums = ComputeChecksums(package_root, files, num_threads, cache,
+                               fast_verify)
+  valid = [_ChecksumIsValid(f, checksum)
+           for f, checksum in zip(files, checksums)]
+  return len(files) == len(manifest.file) and all(valid)
 
 
 def CreatePackageArchive(package_dir: pathlib.Path,
@@ -292,7 +424,7 @@ def PackDataPackage(package_dir: pathlib.Path) -> None:
   """Create an archive and sidecar of a package."""
   manifest = pbutil.FromFile(
       package_dir / 'MANIFEST.pbtxt', dpack_pb2.DataPackage())
-  PackageManifestIsValid(package_dir, manifest)
+  PackageManifestIsValid(package_dir, manifest, FLAGS.hash_threads)
   archive_path = (
       package_dir / f'../{package_dir.name}.dpack.tar.bz2').resolve()
   sidecar_path = (package_dir / f'../{package_dir.name}.dpack.pbtxt').resolve()
@@ -300,10 +432,20 @@ def PackDataPackage(package_dir: pathlib.Path) -> None:
   CreatePackageArchiveSidecar(archive_path, manifest, sidecar_path)
 
 
+def _VerificationCacheFromFlags() -> VerificationCache:
+  if not FLAGS.verification_cache:
+    return VerificationCache()
+  return VerificationCache(
+      pathlib.Path(FLAGS.verification_cache).expanduser())
+
+
 def InitManifest(package_dir: pathlib.Path, contents: typing.List[pathlib.Path],
                  update: bool) -> None:
   """Write the MANIFEST.pbtxt file for a package."""
-  manifest = CreatePackageManifest(package_dir, contents)
+  cache = _VerificationCacheFromFlags()
+  manifest = CreatePackageManifest(package_dir, contents, FLAGS.hash_threads,
+                                   cache, FLAGS.fast_verify)
+  cache.Write()
   manifest_path = package_dir / 'MANIFEST.pbtxt'
   if update and pbutil.ProtoIsReadable(manifest_path, dpack_pb2.DataPackage()):
     old = pbutil.FromFile(manifest_path, dpack_pb2.DataPackage())
@@ -321,7 +463,11 @@ def VerifyManifest(package_dir: pathlib.Path) -> bool:
     return False
   manifest = pbutil.FromFile(
       package_dir / 'MANIFEST.pbtxt', dpack_pb2.DataPackage())
-  if not PackageManifestIsValid(package_dir, manifest):
+  cache = _VerificationCacheFromFlags()
+  valid = PackageManifestIsValid(package_dir, manifest, FLAGS.hash_threads,
+                                 cache, FLAGS.fast_verify)
+  cache.Write()
+  if not valid:
     logging.error('Package %s contains errors.', package_dir)
     return False
   logging.info('%s verified. No changes to files in the manifest.', package_dir)
@@ -1,4 +1,6 @@
 """Unit tests for //lib/dpack:dpack."""
+import fnmatch
+import os
 import pathlib
 import sys
 import tempfile
@@ -6,6 +8,7 @@ import tempfile
 import pytest
 from absl import app
 
+from labm8 import crypto
 from system.dpack import dpack
 from system.dpack.proto import dpack_pb2
 
@@ -107,64 +110,55 @@ def test_GetFilesInDirectory_exclude_subdir(tempdir: pathlib.Path):
   }
 
 
-def test_SetDataPackageFileAttributes_empty_file(tempdir: pathlib.Path):
-  """Test that file attributes are set."""
-  df = dpack_pb2.DataPackageFile()
-  (tempdir / 'a').touch()
-  dpack.SetDataPackageFileAttributes(tempdir, 'a', df)
-
-  assert df.relative_path == 'a'
-  assert not df.size_in_bytes
-  assert df.checksum_hash == dpack_pb2.SHA256
-  assert df.checksum == SHA256_EMPTY_FILE
+def _Manifest(df: dpack_pb2.DataPackageFile) -> dpack_pb2.DataPackage:
+  manifest = dpack_pb2.DataPackage()
+  manifest.file.extend([df])
+  return manifest
 
 
-def test_DataPackageFileAttributesAreValid_missing_file(tempdir: pathlib.Path):
-  """If a file does not exist, attributes are not valid."""
+def test_PackageManifestIsValid_missing_file(tempdir: pathlib.Path):
+  """If a file does not exist, the manifest is not valid."""
   df = dpack_pb2.DataPackageFile()
   df.relative_path = 'a'
-  assert not dpack.DataPackageFileAttributesAreValid(tempdir, df)
+  assert not dpack.PackageManifestIsValid(tempdir, _Manifest(df))
 
 
-def test_DataPackageFileAttributesAreValid_unknown_checksum_hash(
-    tempdir: pathlib.Path):
-  """If no checksum hash is declared, attributes are not valid."""
+def test_PackageManifestIsValid_unknown_checksum_hash(tempdir: pathlib.Path):
+  """If no checksum hash is declared, the manifest is not valid."""
   df = dpack_pb2.DataPackageFile()
   df.relative_path = 'a'
   (tempdir / 'a').touch()
-  assert not dpack.DataPackageFileAttributesAreValid(tempdir, df)
+  assert not dpack.PackageManifestIsValid(tempdir, _Manifest(df))
 
 
-def test_DataPackageFileAttributesAreValid_different_checksum(
-    tempdir: pathlib.Path):
-  """If checksum of file differs, attributes are not valid."""
+def test_PackageManifestIsValid_different_checksum(tempdir: pathlib.Path):
+  """If checksum of file differs, the manifest is not valid."""
   df = dpack_pb2.DataPackageFile()
   df.relative_path = 'a'
   df.checksum_hash = dpack_pb2.SHA256
   (tempdir / 'a').touch()
-  assert not dpack.DataPackageFileAttributesAreValid(tempdir, df)
+  assert not dpack.PackageManifestIsValid(tempdir, _Manifest(df))
 
 
-def test_DataPackageFileAttributesAreValid_different_size(
-    tempdir: pathlib.Path):
-  """If the size of a file is incorect, attributes are not valid."""
+def test_PackageManifestIsValid_different_size(tempdir: pathlib.Path):
+  """If the size of a file is incorect, the manifest is not valid."""
   df = dpack_pb2.DataPackageFile()
   df.relative_path = 'a'
   df.checksum_hash = dpack_pb2.SHA256
   df.checksum = SHA256_EMPTY_FILE
   df.size_in_bytes = 10  # An empty file has size 0
   (tempdir / 'a').touch()
-  assert not dpack.DataPackageFileAttributesAreValid(tempdir, df)
+  assert not dpack.PackageManifestIsValid(tempdir, _Manifest(df))
 
 
-def test_DataPackageFileAttributesAreValid_match(tempdir: pathlib.Path):
+def test_PackageManifestIsValid_match(tempdir: pathlib.Path):
   """Test that file attributes can be correct."""
   df = dpack_pb2.DataPackageFile()
   df.relative_path = 'a'
   df.checksum_hash = dpack_pb2.SHA256
   df.checksum = SHA256_EMPTY_FILE
   (tempdir / 'a').touch()
-  assert dpack.DataPackageFileAttributesAreValid(tempdir, df)
+  assert dpack.PackageManifestIsValid(tempdir, _Manifest(df))
 
 
 def test_MergeManifests_comments():
@@ -236,6 +230,94 @@ def test_CreatePackageManifest(tempdir: pathlib.Path):
   assert m.file[0].checksum == SHA256_EMPTY_FILE
 
 
+def test_CompileExcludePatterns_fnmatch_equivalence():
+  """Test that the compiled patterns match the same paths as fnmatch."""
+  patterns = ['foo', '*/foo*', 'a?c', '[!x]yz', '*.pbtxt']
+  paths = ['foo', 'sub/foo', 'sub/foobar', 'abc', 'ayz', 'xyz', 'a.pbtxt',
+           'sub/a.pbtxt', 'bar', 'foo/bar']
+  exclude = dpack.CompileExcludePatterns(patterns)
+  for path in paths:
+    assert bool(exclude.match(path)) == any(
+        fnmatch.fnmatch(path, pattern) for pattern in patterns)
+
+
+def _CreateManifest(tempdir: pathlib.Path,
+                    **kwargs) -> dpack_pb2.DataPackage:
+  for name in 'abcdefgh':
+    (tempdir / name).write_text(name * 100)
+  return dpack.CreatePackageManifest(
+      tempdir, [pathlib.Path(name) for name in 'abcdefgh'], **kwargs)
+
+
+def test_ComputeChecksums_matches_sha256_file(tempdir: pathlib.Path):
+  """Test that checksums computed on threads are in order."""
+  manifest = _CreateManifest(tempdir, num_threads=3)
+  assert [f.checksum for f in manifest.file] == [
+    crypto.sha256_file(tempdir / name) for name in 'abcdefgh']
+
+
+def test_PackageManifestIsValid_reports_all_files(tempdir: pathlib.Path):
+  """Test that a manifest is invalid if any file is missing or changed."""
+  manifest = _CreateManifest(tempdir)
+  assert dpack.PackageManifestIsValid(tempdir, manifest)
+  (tempdir / 'a').unlink()
+  (tempdir / 'b').write_text('B' * 100)
+  assert not dpack.PackageManifestIsValid(tempdir, manifest)
+
+
+def test_PackageManifestIsValid_fast_verify(tempdir: pathlib.Path):
+  """Test that fast verification trusts the checksums of unchanged files."""
+  cache = dpack.VerificationCache(tempdir / 'cache' / 'verified.json')
+  manifest = _CreateManifest(tempdir, cache=cache)
+  cache.Write()
+  cache = dpack.VerificationCache(tempdir / 'cache' / 'verified.json')
+
+  # Change the contents of a file without changing its size or mtime.
+  stat = (tempdir / 'a').stat()
+  (tempdir / 'a').write_text('A' * 100)
+  os.utime(tempdir / 'a', ns=(stat.st_atime_ns, stat.st_mtime_ns))
+  assert dpack.PackageManifestIsValid(tempdir, manifest, cache=cache,
+                                      fast_verify=True)
+  # A full rehash detects the change, and updates the cache.
+  assert not dpack.PackageManifestIsValid(tempdir, manifest, cache=cache)
+  assert not dpack.PackageManifestIsValid(tempdir, manifest, cache=cache,
+                                          fast_verify=True)
+
+
+def test_PackageManifestIsValid_fast_verify_modified_file(
+    tempdir: pathlib.Path):
+  """Test that fast verification rehashes files with a new mtime."""
+  cache = dpack.VerificationCache()
+  manifest = _CreateManifest(tempdir, cache=cache)
+  stat = (tempdir / 'a').stat()
+  (tempdir / 'a').write_text('A' * 100)
+  os.utime(tempdir / 'a', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+  assert not dpack.PackageManifestIsValid(tempdir, manifest, cache=cache,
+                                          fast_verify=True)
+
+
+def test_VerificationCache_Write(tempdir: pathlib.Path):
+  """Test that a written cache is read back, leaving no temporary files."""
+  (tempdir / 'a').touch()
+  stat = (tempdir / 'a').stat()
+  cache = dpack.VerificationCache(tempdir / 'cache' / 'verified.json')
+  cache.Set(tempdir / 'a', stat, dpack_pb2.SHA256, SHA256_EMPTY_FILE)
+  cache.Write()
+  cache.Write()
+  assert [p.name for p in (tempdir / 'cache').iterdir()] == ['verified.json']
+  cache = dpack.VerificationCache(tempdir / 'cache' / 'verified.json')
+  assert cache.Get(tempdir / 'a', stat, dpack_pb2.SHA256) == SHA256_EMPTY_FILE
+
+
+def test_VerificationCache_corrupt_file(tempdir: pathlib.Path):
+  """Test that a corrupt cache file is ignored."""
+  (tempdir / 'verified.json').write_text('not json')
+  cache = dpack.VerificationCache(tempdir / 'verified.json')
+  (tempdir / 'a').touch()
+  assert cache.Get(tempdir / 'a', (tempdir / 'a').stat(),
+                   dpack_pb2.SHA256) is None
+
+
 def main(argv):  # pylint: disable=missing-docstring
   """Main entry point."""
   if len(argv) > 1:
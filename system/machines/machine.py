@@ -6,12 +6,14 @@ mirrored directories.
 import pathlib
 import subprocess
 import typing
+from concurrent import futures
 
 from absl import app
 from absl import flags
 from absl import logging
 
 from labm8 import pbutil
+from system.machines import sync
 from system.machines.mirrored_directory import MirroredDirectory
 from system.machines.proto import machine_spec_pb2
 
@@ -25,6 +27,9 @@ flags.DEFINE_bool('dry_run', True, 'Whether to run ops without making changes.')
 flags.DEFINE_bool('delete', False, 'Whether to delete files during push/pull'
                                    'mirroring.')
 flags.DEFINE_bool('progress', False, 'Show progress during file transfers.')
+flags.DEFINE_integer('max_parallel_transfers', 4,
+                     'The maximum number of mirrored directories to transfer '
+                     'concurrently.')
 
 
 def RespondsToPing(host: str) -> typing.Optional[str]:
@@ -47,8 +52,9 @@ def ResolveHost(
     hosts: typing.List[machine_spec_pb2.Host]) -> machine_spec_pb2.Host:
   """Resolve the host from a list.
 
-  Iterate through the list, seeing if any of the hosts respond to ping. If none
-  of them do, the last item of the list is returned.
+  All of the hosts are pinged concurrently. The first host in the list which
+  responds to ping is returned. If none of them do, the last item of the list
+  is returned.
 
   Args:
     hosts: The list of hosts to ping.
@@ -56,12 +62,16 @@ def ResolveHost(
   Returns:
     A Host message instance.
   """
-  for host in hosts[:-1]:
-    if RespondsToPing(host.host):
-      logging.info('Resolved host %s', host.host)
-      return host
-    else:
-      logging.debug('Failed to resolve host %s', host.host)
+  if len(hosts) > 1:
+    with futures.ThreadPoolExecutor(len(hosts) - 1) as executor:
+      responses = list(executor.map(RespondsToPing,
+                                    [host.host for host in hosts[:-1]]))
+    for host, response in zip(hosts[:-1], responses):
+      if response:
+        logging.info('Resolved host %s', host.host)
+        return host
+      else:
+        logging.debug('Failed to resolve host %s', host.host)
   return hosts[-1]
 
 
@@ -118,17 +128,17 @@ def main(argv):
     raise app.UsageError(f"Cannot find --machine proto '{machine_proto_path}'")
   machine = Machine.FromFile(machine_proto_path)
 
-  for mirrored_dir_name in FLAGS.pull:
-    mirrored_dir = machine.MirroredDirectory(mirrored_dir_name)
-    mirrored_dir.PullFromRemoteToLocal(
-        dry_run=FLAGS.dry_run, verbose=True, delete=FLAGS.delete,
-        progress=FLAGS.progress)
-
-  for mirrored_dir_name in FLAGS.push:
-    mirrored_dir = machine.MirroredDirectory(mirrored_dir_name)
-    mirrored_dir.PushFromLocalToRemote(
-        dry_run=FLAGS.dry_run, verbose=True, delete=FLAGS.delete,
-        progress=FLAGS.progress)
+  pull = [machine.MirroredDirectory(name) for name in FLAGS.pull]
+  push = [machine.MirroredDirectory(name) for name in FLAGS.push]
+  if not pull and not push:
+    return
+
+  # All transfers share a single multiplexed ssh connection.
+  with sync.SshControlMaster(machine.host) as target:
+    sync.Sync(target, pull=pull, push=push,
+              max_parallel_transfers=FLAGS.max_parallel_transfers,
+              dry_run=FLAGS.dry_run, delete=FLAGS.delete, verbose=True,
+              progress=FLAGS.progress)
 
 
 if __name__ == '__main__':
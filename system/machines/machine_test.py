@@ -1,6 +1,7 @@
 """Unit tests for //system/machines:machine.py."""
 import sys
 import tempfile
+import threading
 import typing
 
 import pytest
@@ -51,6 +52,36 @@ def test_MirroredDirectory_not_found(test_machine: machine.Machine):
   assert str(e_ctx.value) == "Cannot find mirrored directory 'not_found'"
 
 
+def test_ResolveHost_first_responding_host(monkeypatch):
+  """Test that the first host in the list to respond is returned."""
+  monkeypatch.setattr(machine, 'RespondsToPing',
+                      lambda host: host if host in {'b', 'c'} else None)
+  hosts = [machine_spec_pb2.Host(host=h) for h in ['a', 'b', 'c', 'd']]
+  assert machine.ResolveHost(hosts).host == 'b'
+
+
+def test_ResolveHost_no_responding_host(monkeypatch):
+  """Test that the last host is returned if no other host responds."""
+  monkeypatch.setattr(machine, 'RespondsToPing', lambda host: None)
+  hosts = [machine_spec_pb2.Host(host=h) for h in ['a', 'b', 'c']]
+  assert machine.ResolveHost(hosts).host == 'c'
+
+
+def test_ResolveHost_concurrent(monkeypatch):
+  """Test that hosts are pinged concurrently."""
+  # Each ping blocks until every host has been pinged, so this would
+  # deadlock if hosts were pinged one at a time.
+  barrier = threading.Barrier(3, timeout=10)
+
+  def RespondsToPing(host):
+    barrier.wait()
+    return host
+
+  monkeypatch.setattr(machine, 'RespondsToPing', RespondsToPing)
+  hosts = [machine_spec_pb2.Host(host=h) for h in ['a', 'b', 'c', 'd']]
+  assert machine.ResolveHost(hosts).host == 'a'
+
+
 def main(argv: typing.List[str]):
   """Main entry point."""
   if len(argv) > 1:
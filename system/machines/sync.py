@@ -0,0 +1,254 @@
+"""Synchronize the mirrored directories of a machine in parallel.
+
+A sync opens a single multiplexed ssh connection to the machine, which every
+rsync transfer reuses, so that the cost of connecting and authenticating is
+paid once rather than once per directory. Transfers run concurrently, up to a
+limit, and the number of files and bytes transferred by each directory, and
+the time it took, are reported.
+
+This library depends on 'rsync' and 'ssh' being on the system path.
+"""
+import re
+import subprocess
+import tempfile
+import time
+import typing
+from concurrent import futures
+
+import humanize
+from absl import logging
+
+from labm8 import labtypes
+from system.machines.mirrored_directory import MirroredDirectory
+from system.machines.proto import machine_spec_pb2
+
+
+class TransferStats(typing.NamedTuple):
+  """The outcome of transferring a mirrored directory."""
+  name: str
+  # Either 'push' or 'pull'.
+  direction: str
+  files_transferred: int
+  bytes_transferred: int
+  elapsed_seconds: float
+
+
+class SshControlMaster(object):
+  """A multiplexed ssh connection to a host.
+
+  While the context manager is entered, a master connection runs in the
+  background, and ssh sessions started with remote_shell reuse it.
+  """
+
+  def __init__(self, host: machine_spec_pb2.Host):
+    self.host = host
+    self._tempdir = None
+    self.control_path = None
+
+  @property
+  def remote_shell(self) -> str:
+    """The ssh command for rsync to connect through the master connection."""
+    return f'ssh -p {self.host.port} -o ControlPath={self.control_path}'
+
+  def RemotePath(self, path: str) -> str:
+    """Return the rsync path of a path on the host."""
+    return f'{self.host.host}:{path}'
+
+  def __enter__(self) -> 'SshControlMaster':
+    # Unix socket paths are limited to ~100 characters, so the socket is
+    # created in a new short-named directory.
+    self._tempdir = tempfile.TemporaryDirectory(prefix='phd_ssh_')
+    self.control_path = f'{self._tempdir.name}/control'
+    cmd = ['ssh', '-p', str(self.host.port), '-o',
+           f'ControlPath={self.control_path}', '-M', '-N', '-f',
+           self.host.host]
+    logging.info(' '.join(cmd))
+    try:
+      subprocess.check_call(cmd)
+    except subprocess.CalledProcessError:
+      self._tempdir.cleanup()
+      raise
+    return self
+
+  def __exit__(self, *args) -> None:
+    subprocess.call(['ssh', '-o', f'ControlPath={self.control_path}', '-O',
+                     'exit', self.host.host], stderr=subprocess.DEVNULL)
+    self._tempdir.cleanup()
+
+
+class LocalTarget(object):
+  """A sync target whose remote paths are on the local filesystem.
+
+  Transfers use a local rsync, without ssh. This is used for testing.
+  """
+
+  remote_shell = None
+
+  @staticmethod
+  def RemotePath(path: str) -> str:
+    return path
+
+  def __enter__(self) -> 'LocalTarget':
+    return self
+
+  def __exit__(self, *args) -> None:
+    pass
+
+
+Target = typing.Union[SshControlMaster, LocalTarget]
+
+
+def RsyncCommand(src: str, dst: str, excludes: typing.List[str],
+                 remote_shell: typing.Optional[str], dry_run: bool,
+                 verbose: bool, delete: bool,
+                 progress: bool) -> typing.List[str]:
+  """Build an rsync command which prints transfer statistics."""
+  cmd = ['rsync', '-a', '--stats', src, dst]
+  if remote_shell:
+    cmd += ['-e', remote_shell]
+  cmd += labtypes.flatten([['--exclude', p] for p in excludes])
+  if dry_run:
+    cmd.append('--dry-run')
+  if verbose:
+    cmd.append('--verbose')
+  if delete:
+    cmd.append('--delete')
+  if progress:
+    cmd.append('--progress')
+  return cmd
+
+
+# Older versions of rsync report 'files', newer versions 'regular files'.
+_FILES_TRANSFERRED_RE = re.compile(
+    r'^Number of (?:regular )?files transferred: ([\d,]+)', re.MULTILINE)
+_BYTES_TRANSFERRED_RE = re.compile(
+    r'^Total transferred file size: ([\d,]+) bytes', re.MULTILINE)
+
+
+def ParseRsyncStats(output: str) -> typing.Tuple[int, int]:
+  """Parse the output of rsync --stats.
+
+  Args:
+    output: The output of rsync.
+
+  Returns:
+    The number of files and bytes transferred.
+
+  Raises:
+    ValueError: If the output does not contain statistics.
+  """
+  files = _FILES_TRANSFERRED_RE.search(output)
+  bytes_ = _BYTES_TRANSFERRED_RE.search(output)
+  if not files or not bytes_:
+    raise ValueError('rsync output does not contain --stats')
+  return (int(files.group(1).replace(',', '')),
+          int(bytes_.group(1).replace(',', '')))
+
+
+def Transfer(directory: MirroredDirectory, direction: str, target: Target,
+             dry_run: bool = False, delete: bool = True, verbose: bool = False,
+             progress: bool = False) -> TransferStats:
+  """Transfer a mirrored directory.
+
+  Args:
+    directory: The mirrored directory to transfer.
+    direction: Either 'push', to transfer from local to remote, or 'pull'.
+    target: The target to transfer to or from.
+    dry_run: Whether to run rsync without making changes.
+    delete: Whether to delete files which do not exist in the source.
+    verbose: Whether to log the files transferred by rsync.
+    progress: Whether rsync reports the progress of each file.
+
+  Returns:
+    The statistics of the transfer.
+
+  Raises:
+    SubprocessError: If rsync fails.
+  """
+  remote = target.RemotePath(directory.remote_path)
+  if direction == 'push':
+    src, dst = directory.local_path, remote
+  elif direction == 'pull':
+    src, dst = remote, directory.local_path
+  else:
+    raise ValueError(f"Unknown direction '{direction}'")
+  cmd = RsyncCommand(src, dst, directory.spec.rsync_exclude,
+                     target.remote_shell, dry_run, verbose, delete,
+                     progress)
+  logging.info(' '.join(cmd))
+
+  start_time = time.time()
+  process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                             universal_newlines=True)
+  # Output is logged line by line, prefixed with the directory name, so that
+  # the output of concurrent transfers can be told apart.
+  output = []
+  for line in process.stdout:
+    output.append(line)
+    if verbose or progress:
+      logging.info('%s: %s', directory.name, line.rstrip())
+  process.wait()
+  if process.returncode:
+    raise subprocess.SubprocessError(
+        f'rsync of {directory.name} failed with returncode '
+        f'{process.returncode}')
+  files, bytes_ = ParseRsyncStats(''.join(output))
+  return TransferStats(name=directory.name, direction=direction,
+                       files_transferred=files, bytes_transferred=bytes_,
+                       elapsed_seconds=time.time() - start_time)
+
+
+def Sync(target: Target, pull: typing.List[MirroredDirectory] = None,
+         push: typing.List[MirroredDirectory] = None,
+         max_parallel_transfers: int = 4, dry_run: bool = False,
+         delete: bool = True, verbose: bool = False,
+         progress: bool = False) -> typing.List[TransferStats]:
+  """Pull and push mirrored directories in parallel.
+
+  All pulls complete before any push begins. A failed transfer does not stop
+  the others.
+
+  Args:
+    target: The target to transfer to and from.
+    pull: The directories to pull from the target.
+    push: The directories to push to the target.
+    max_parallel_transfers: The maximum number of concurrent transfers.
+    dry_run: Whether to run rsync without making changes.
+    delete: Whether to delete files which do not exist in the source.
+    verbose: Whether to log the files transferred by rsync.
+    progress: Whether rsync reports the progress of each file.
+
+  Returns:
+    The statistics of each transfer, in order of pulls then pushes.
+
+  Raises:
+    SubprocessError: If any transfer fails, once all transfers have finished.
+  """
+  stats = []
+  failed = []
+  with futures.ThreadPoolExecutor(max(max_parallel_transfers, 1)) as executor:
+    for direction, directories in [('pull', pull or []), ('push', push or [])]:
+      transfers = [
+        executor.submit(Transfer, directory, direction, target, dry_run,
+                        delete, verbose, progress)
+        for directory in directories]
+      for directory, transfer in zip(directories, transfers):
+        try:
+          stats.append(transfer.result())
+          LogTransferStats(stats[-1])
+        except subprocess.SubprocessError as e:
+          logging.error('%s', e)
+          failed.append(directory.name)
+  if failed:
+    raise subprocess.SubprocessError(
+        f"Failed to transfer: {', '.join(failed)}")
+  return stats
+
+
+def LogTransferStats(stats: TransferStats) -> None:
+  """Log the statistics of a transfer."""
+  rate = stats.bytes_transferred / max(stats.elapsed_seconds, 1e-6)
+  logging.info('%s %s: %s files, %s in %.1f s (%s/s)', stats.direction,
+               stats.name, humanize.intcomma(stats.files_transferred),
+               humanize.naturalsize(stats.bytes_transferred),
+               stats.elapsed_seconds, humanize.naturalsize(rate))
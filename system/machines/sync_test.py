@@ -0,0 +1,155 @@
+"""Unit tests for //system/machines:sync.py."""
+import pathlib
+import subprocess
+import sys
+import tempfile
+import typing
+
+import pytest
+from absl import app
+from absl import flags
+
+from system.machines import sync
+from system.machines.mirrored_directory import MirroredDirectory
+from system.machines.proto import machine_spec_pb2
+
+
+FLAGS = flags.FLAGS
+
+# Abridged output of rsync 3.1 --stats.
+RSYNC_STATS_OUTPUT = """\
+sending incremental file list
+
+Number of files: 1,205 (reg: 1,103, dir: 102)
+Number of created files: 1,204 (reg: 1,103, dir: 101)
+Number of deleted files: 0
+Number of regular files transferred: 1,103
+Total file size: 12,345,678 bytes
+Total transferred file size: 2,345,678 bytes
+Literal data: 2,345,678 bytes
+Matched data: 0 bytes
+
+sent 2,361,120 bytes  received 21,300 bytes  4,764,840.00 bytes/sec
+total size is 12,345,678  speedup is 5.18
+"""
+
+
+@pytest.fixture(scope='function')
+def tempdir() -> pathlib.Path:
+  with tempfile.TemporaryDirectory(prefix='phd_system_machines_sync_') as d:
+    yield pathlib.Path(d)
+
+
+def _MirroredDirectories(
+    tempdir: pathlib.Path, n: int) -> typing.List[MirroredDirectory]:
+  """Create n mirrored directories with local and "remote" paths."""
+  directories = []
+  for i in range(n):
+    (tempdir / f'local_{i}').mkdir()
+    (tempdir / f'remote_{i}').mkdir()
+    directories.append(MirroredDirectory(
+        machine_spec_pb2.Host(host='localhost', port=22),
+        machine_spec_pb2.MirroredDirectory(
+            name=f'dir_{i}', local_path=str(tempdir / f'local_{i}'),
+            remote_path=str(tempdir / f'remote_{i}'),
+            rsync_exclude=['*.excluded'])))
+  return directories
+
+
+def test_ParseRsyncStats():
+  """Test that files and bytes are parsed from rsync output."""
+  assert sync.ParseRsyncStats(RSYNC_STATS_OUTPUT) == (1103, 2345678)
+
+
+def test_ParseRsyncStats_old_rsync():
+  """Test parsing the output of rsync versions before 3.1."""
+  output = ('Number of files transferred: 3\n'
+            'Total transferred file size: 1024 bytes\n')
+  assert sync.ParseRsyncStats(output) == (3, 1024)
+
+
+def test_ParseRsyncStats_no_stats():
+  """Test that output without statistics raises an error."""
+  with pytest.raises(ValueError):
+    sync.ParseRsyncStats('sending incremental file list\n')
+
+
+def test_RsyncCommand_remote_shell():
+  """Test that the remote shell is passed to rsync."""
+  cmd = sync.RsyncCommand('a/', 'host:b/', ['*.pyc'], 'ssh -p 22',
+                          dry_run=True, verbose=False, delete=True,
+                          progress=False)
+  assert cmd == ['rsync', '-a', '--stats', 'a/', 'host:b/', '-e', 'ssh -p 22',
+                 '--exclude', '*.pyc', '--dry-run', '--delete']
+
+
+def test_RsyncCommand_local_target():
+  """Test that no remote shell is used for a local target."""
+  cmd = sync.RsyncCommand('a/', 'b/', [], sync.LocalTarget.remote_shell,
+                          dry_run=False, verbose=False, delete=False,
+                          progress=False)
+  assert cmd == ['rsync', '-a', '--stats', 'a/', 'b/']
+
+
+def test_SshControlMaster_remote_shell():
+  """Test that remote paths and the shell use the host and control path."""
+  master = sync.SshControlMaster(
+      machine_spec_pb2.Host(host='example.com', port=65335))
+  master.control_path = '/tmp/control'
+  assert master.remote_shell == 'ssh -p 65335 -o ControlPath=/tmp/control'
+  assert master.RemotePath('/foo/') == 'example.com:/foo/'
+
+
+def test_Sync_push_pull(tempdir: pathlib.Path):
+  """Test pushing and pulling several directories concurrently."""
+  directories = _MirroredDirectories(tempdir, 3)
+  for i in range(3):
+    (tempdir / f'local_{i}' / 'a').write_text('a' * (i + 1))
+    (tempdir / f'local_{i}' / 'b.excluded').write_text('b')
+  stats = sync.Sync(sync.LocalTarget(), push=directories,
+                    max_parallel_transfers=2)
+  assert [s.name for s in stats] == ['dir_0', 'dir_1', 'dir_2']
+  assert [s.direction for s in stats] == ['push'] * 3
+  assert [s.files_transferred for s in stats] == [1, 1, 1]
+  assert [s.bytes_transferred for s in stats] == [1, 2, 3]
+  for i in range(3):
+    assert (tempdir / f'remote_{i}' / 'a').read_text() == 'a' * (i + 1)
+    assert not (tempdir / f'remote_{i}' / 'b.excluded').exists()
+
+  (tempdir / 'remote_0' / 'c').write_text('c')
+  stats = sync.Sync(sync.LocalTarget(), pull=directories[:1])
+  assert [(s.name, s.direction, s.files_transferred, s.bytes_transferred)
+          for s in stats] == [('dir_0', 'pull', 1, 1)]
+  assert (tempdir / 'local_0' / 'c').read_text() == 'c'
+
+
+def test_Sync_dry_run(tempdir: pathlib.Path):
+  """Test that a dry run reports, but does not make, changes."""
+  directories = _MirroredDirectories(tempdir, 1)
+  (tempdir / 'local_0' / 'a').write_text('a')
+  stats = sync.Sync(sync.LocalTarget(), push=directories, dry_run=True)
+  assert stats[0].files_transferred == 1
+  assert not (tempdir / 'remote_0' / 'a').exists()
+
+
+def test_Sync_failed_transfer(tempdir: pathlib.Path):
+  """Test that a failed transfer does not prevent the others."""
+  directories = _MirroredDirectories(tempdir, 2)
+  (tempdir / 'remote_0').rmdir()
+  (tempdir / 'remote_1' / 'a').write_text('a')
+  with pytest.raises(subprocess.SubprocessError) as e_ctx:
+    sync.Sync(sync.LocalTarget(), pull=directories)
+  assert str(e_ctx.value) == 'Failed to transfer: dir_0'
+  assert (tempdir / 'local_1' / 'a').read_text() == 'a'
+
+
+def main(argv: typing.List[str]):
+  """Main entry point."""
+  if len(argv) > 1:
+    raise app.UsageError("Unknown arguments: '{}'.".format(' '.join(argv[1:])))
+  sys.exit(pytest.main([__file__, '-vv']))
+
+
+if __name__ == '__main__':
+  flags.FLAGS(['argv[0]', '-v=1'])
+  app.run(main)
@@ -0,0 +1 @@
+"""This file is intentionally empty."""
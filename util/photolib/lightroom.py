@@ -1,5 +1,6 @@
 """Functions for working with Lightroom."""
 import datetime
+import multiprocessing
 import os
 import typing
 
@@ -29,6 +30,18 @@ ENGINE = None
 MAKE_SESSION = None
 SESSION = None
 
+# An in-memory copy of the keywords cache, mapping relpath md5s to
+# <mtime, keywords> tuples.
+CACHE: typing.Dict[bytes, typing.Tuple[int, typing.FrozenSet[str]]] = {}
+# The relpath md5s of cache entries which have been checked against the file
+# mtime during this run.
+VALIDATED: typing.Set[bytes] = set()
+# Cache entries which have not yet been written to the database.
+PENDING: typing.Dict[bytes, typing.Tuple[int, typing.FrozenSet[str]]] = {}
+
+# The maximum number of bound variables in a single SQLite statement.
+_MAX_SQL_VARIABLES = 999
+
 
 class Keywords(Base):
   """A set of image keywords."""
@@ -81,6 +94,17 @@ def InitializeKeywordsCache(workspace_abspath: str) -> None:
   MAKE_SESSION = orm.sessionmaker(bind=ENGINE)
   SESSION = MAKE_SESSION()
 
+  # Load the entire cache into memory.
+  query = SESSION.query(KeywordCacheEntry.relpath_md5, KeywordCacheEntry.mtime,
+                        Keywords.keywords) \
+    .join(Keywords)
+  keywords_sets = {}
+  for relpath_md5, mtime, keywords in query:
+    if keywords not in keywords_sets:
+      keywords_sets[keywords] = frozenset(keywords.split(","))
+    CACHE[relpath_md5] = (mtime, keywords_sets[keywords])
+  logging.debug("Loaded %d keyword cache entries", len(CACHE))
+
 
 def GetOrAdd(session, model, defaults: typing.Dict[str, typing.Any] = None,
              **kwargs) -> object:
@@ -102,26 +126,6 @@ def GetOrAdd(session, model, defaults: typing.Dict[str, typing.Any] = None,
   return instance
 
 
-def _AddKeywordsToCache(relpath_md5: str, mtime: float,
-                        keywords: typing.Set[str]) -> None:
-  """
-  Add a new database entry for the given values.
-
-  Args:
-    relpath_md5: The md5sum of the workspace relpath to the file.
-    mtime: Seconds since the epoch that the file was last modified.
-    keywords: The set of keywords to record.
-  """
-  keywords_ = GetOrAdd(SESSION, Keywords, keywords=",".join(keywords))
-  entry = KeywordCacheEntry(
-      relpath_md5=relpath_md5,
-      mtime=int(mtime),
-      keywords=keywords_,
-  )
-  SESSION.add(entry)
-  SESSION.commit()
-
-
 def _ReadKeywordsFromFile(abspath: str) -> typing.Set[str]:
   """
   Read the lightroom keywords for a file.
@@ -142,6 +146,61 @@ def _ReadKeywordsFromFile(abspath: str) -> typing.Set[str]:
     return set()
 
 
+def _CacheKeywords(relpath_md5: bytes, mtime: int,
+                   keywords: typing.Set[str]) -> typing.FrozenSet[str]:
+  """
+  Record keywords in the in-memory cache, and queue them to be written.
+
+  Args:
+    relpath_md5: The md5sum of the workspace relpath to the file.
+    mtime: Seconds since the epoch that the file was last modified.
+    keywords: The set of keywords to record.
+
+  Returns:
+    The cached keywords.
+  """
+  keywords = frozenset(keywords)
+  CACHE[relpath_md5] = (mtime, keywords)
+  VALIDATED.add(relpath_md5)
+  PENDING[relpath_md5] = (mtime, keywords)
+  return keywords
+
+
+def PrefetchLightroomKeywords(
+    files: typing.List[typing.Tuple[str, str, int]],
+    pool: typing.Optional[multiprocessing.Pool] = None) -> None:
+  """Validate the cached keywords for a batch of files.
+
+  Files which miss the cache have their XMP metadata read, in parallel if a
+  pool is provided. Subsequent calls to GetLightroomKeywords() for these
+  files do not touch the filesystem.
+
+  Args:
+    files: A list of <abspath, relpath, mtime> tuples.
+    pool: A process pool to read XMP metadata with.
+  """
+  misses = []
+  for abspath, relpath, mtime in files:
+    relpath_md5 = common.Md5String(relpath).digest()
+    entry = CACHE.get(relpath_md5)
+    if entry and entry[0] == mtime:
+      VALIDATED.add(relpath_md5)
+    else:
+      misses.append((abspath, relpath_md5, mtime))
+
+  if not misses:
+    return
+
+  paths = [miss[0] for miss in misses]
+  if pool:
+    keywords = pool.imap(_ReadKeywordsFromFile, paths, chunksize=16)
+  else:
+    keywords = (_ReadKeywordsFromFile(path) for path in paths)
+  for (_, relpath_md5, mtime), keywords_ in zip(misses, keywords):
+    _CacheKeywords(relpath_md5, mtime, keywords_)
+  logging.debug("read keywords of %d files", len(misses))
+
+
 def GetLightroomKeywords(abspath: str, relpath: str) -> typing.Set[str]:
   """Fetch the lightroom keywords for the given file.
 
@@ -155,23 +214,51 @@ def GetLightroomKeywords(abspath: str, relpath: str) -> typing.Set[str]:
     A set of lightroom keywords. An empty set is returned on failure.
   """
   relpath_md5 = common.Md5String(relpath).digest()
-  mtime = int(os.path.getmtime(abspath))
-  entry = SESSION \
-    .query(KeywordCacheEntry) \
-    .filter(KeywordCacheEntry.relpath_md5 == relpath_md5) \
-    .first()
-
-  if entry and entry.mtime == mtime:
-    # logging.debug("keywords cache hit %s", relpath)
-    keywords = set(entry.keywords.keywords.split(","))
-  elif entry and entry.mtime != mtime and not abspath.endswith('.mov'):
-    SESSION.delete(entry)
-    keywords = _ReadKeywordsFromFile(abspath)
-    _AddKeywordsToCache(relpath_md5, mtime, keywords)
-    logging.debug("refreshed keywords cache %s", relpath)
-  else:
-    keywords = _ReadKeywordsFromFile(abspath)
-    _AddKeywordsToCache(relpath_md5, mtime, keywords)
-    logging.debug("cached keywords %s", relpath)
+  if relpath_md5 in VALIDATED:
+    return CACHE[relpath_md5][1]
 
+  mtime = int(os.path.getmtime(abspath))
+  entry = CACHE.get(relpath_md5)
+  if entry and entry[0] == mtime:
+    VALIDATED.add(relpath_md5)
+    return entry[1]
+
+  keywords = _CacheKeywords(
+      relpath_md5, mtime, _ReadKeywordsFromFile(abspath))
+  logging.debug("cached keywords %s", relpath)
   return keywords
+
+
+def FlushKeywordsCache() -> None:
+  """Write the queued keyword cache updates in a single transaction."""
+  if not PENDING:
+    return
+
+  # Get or add the keyword sets.
+  keywords_strings = set(",".join(sorted(keywords))
+                         for _, keywords in PENDING.values())
+  keywords_ids = dict(
+      SESSION.query(Keywords.keywords, Keywords.id)
+      .filter(Keywords.keywords.in_(keywords_strings)))
+  new_keywords = [Keywords(keywords=keywords_string)
+                  for keywords_string in keywords_strings
+                  if keywords_string not in keywords_ids]
+  SESSION.add_all(new_keywords)
+  SESSION.flush()
+  keywords_ids.update((k.keywords, k.id) for k in new_keywords)
+
+  # Replace the stale entries.
+  relpath_md5s = list(PENDING.keys())
+  for i in range(0, len(relpath_md5s), _MAX_SQL_VARIABLES):
+    SESSION.query(KeywordCacheEntry) \
+      .filter(KeywordCacheEntry.relpath_md5.in_(
+        relpath_md5s[i:i + _MAX_SQL_VARIABLES])) \
+      .delete(synchronize_session=False)
+  SESSION.bulk_insert_mappings(KeywordCacheEntry, [{
+    "relpath_md5": relpath_md5,
+    "mtime": mtime,
+    "keywords_id": keywords_ids[",".join(sorted(keywords))],
+  } for relpath_md5, (mtime, keywords) in PENDING.items()])
+  SESSION.commit()
+  logging.debug("wrote %d keyword cache entries", len(PENDING))
+  PENDING.clear()
@@ -34,6 +34,18 @@ ENGINE = None
 MAKE_SESSION = None
 SESSION = None
 
+# An in-memory copy of the cache, mapping directory relpath md5s to checksums
+# and cached errors.
+DIRECTORIES: typing.Dict[bytes, bytes] = {}
+ERRORS: typing.Dict[bytes, typing.List['CachedError']] = {}
+# Cache updates which have not yet been written to the database.
+STALE_DIRECTORIES: typing.Set[bytes] = set()
+PENDING_DIRECTORIES: typing.List['CacheLookupResult'] = []
+PENDING_ERRORS: typing.List[typing.Dict[str, str]] = []
+
+# The maximum number of bound variables in a single SQLite statement.
+_MAX_SQL_VARIABLES = 999
+
 
 class Meta(Base):
   __tablename__ = "meta"
@@ -108,6 +120,13 @@ def InitializeErrorsCache(workspace_abspath: str) -> None:
   SESSION = MAKE_SESSION()
   RefreshLintersVersion()
 
+  # Load the entire cache into memory.
+  DIRECTORIES.update(
+      SESSION.query(Directory.relpath_md5, Directory.checksum))
+  for error in SESSION.query(CachedError):
+    ERRORS.setdefault(error.dir, []).append(error)
+  logging.debug("Loaded %d directory cache entries", len(DIRECTORIES))
+
 
 def RefreshLintersVersion():
   """Check that """
@@ -147,25 +166,56 @@ class CacheLookupResult(object):
 
 def AddLinterErrors(entry: CacheLookupResult,
                     errors: typing.List[str]) -> None:
-  """Record linter errors in the cache."""
-  # Create a directory cache entry.
-  directory = Directory(relpath_md5=entry.relpath_md5, checksum=entry.checksum)
-  SESSION.add(directory)
-
-  # Create entries for the errors.
-  errors_ = [CachedError(
-      dir=directory.relpath_md5,
-      relpath=e.relpath,
-      category=e.category,
-      message=e.message,
-      fix_it=e.fix_it or ""
-  ) for e in errors]
-  if errors_:
-    SESSION.bulk_save_objects(errors_)
-  SESSION.commit()
+  """Record linter errors in the cache.
+
+  The errors are not written to the database until FlushErrorsCache() is
+  called.
+  """
+  PENDING_DIRECTORIES.append(entry)
+  PENDING_ERRORS.extend({
+    "dir": entry.relpath_md5,
+    "relpath": e.relpath,
+    "category": e.category,
+    "message": e.message,
+    "fix_it": e.fix_it or "",
+  } for e in errors)
   logging.debug("cached directory %s", entry.relpath)
 
 
+def FlushErrorsCache() -> None:
+  """Write the queued cache updates in a single transaction."""
+  if not (STALE_DIRECTORIES or PENDING_DIRECTORIES):
+    return
+
+  # Delete stale cache entries.
+  stale = list(STALE_DIRECTORIES)
+  for i in range(0, len(stale), _MAX_SQL_VARIABLES):
+    batch = stale[i:i + _MAX_SQL_VARIABLES]
+    SESSION.query(CachedError) \
+      .filter(CachedError.dir.in_(batch)) \
+      .delete(synchronize_session=False)
+    SESSION.query(Directory) \
+      .filter(Directory.relpath_md5.in_(batch)) \
+      .delete(synchronize_session=False)
+
+  SESSION.bulk_insert_mappings(Directory, [{
+    "relpath_md5": entry.relpath_md5,
+    "checksum": entry.checksum,
+  } for entry in PENDING_DIRECTORIES])
+  SESSION.bulk_insert_mappings(CachedError, PENDING_ERRORS)
+  SESSION.commit()
+  logging.debug("wrote %d directory cache entries", len(PENDING_DIRECTORIES))
+
+  for entry in PENDING_DIRECTORIES:
+    DIRECTORIES[entry.relpath_md5] = entry.checksum
+    ERRORS[entry.relpath_md5] = []
+  for error in PENDING_ERRORS:
+    ERRORS[error["dir"]].append(CachedError(**error))
+  STALE_DIRECTORIES.clear()
+  PENDING_DIRECTORIES.clear()
+  PENDING_ERRORS.clear()
+
+
 def GetDirectoryMTime(abspath) -> int:
   """Get the timestamp of the most recently modified file/dir in directory.
 
@@ -183,32 +233,53 @@ def GetDirectoryMTime(abspath) -> int:
     return 0
 
 
-def GetDirectoryChecksum(abspath: pathlib.Path) -> str:
+def GetDirectoryChecksum(
+    abspath: pathlib.Path,
+    entries: typing.Optional[typing.List[os.DirEntry]] = None) -> str:
   """Compute a checksum to determine the contents and status of the directory.
 
-  The checksum is computed
+  The checksum is computed from the most recent modification time of the
+  directory contents, and the paths of the files in the directory.
 
   Params:
-    abspath:
-  :return:
+    abspath: The absolute path to the directory.
+    entries: The result of os.scandir() on the directory, if already known.
+
+  Returns:
+    The hash instance.
   """
   hash = hashlib.md5()
-  paths = [os.path.join(abspath, filename) for filename in os.listdir(abspath)]
-  if paths:
-    directory_mtime = int(max(os.path.getmtime(path) for path in paths))
+  if entries is None:
+    with os.scandir(abspath) as it:
+      entries = list(it)
+  if entries:
+    directory_mtime = int(max(
+        entry.stat(follow_symlinks=True).st_mtime for entry in entries))
     hash.update(str(directory_mtime).encode('utf-8'))
-    for path in paths:
-      if os.path.isfile(path):
-        hash.update(str(path).encode('utf-8'))
+    for entry in entries:
+      if entry.is_file():
+        hash.update(str(os.path.join(abspath, entry.name)).encode('utf-8'))
   return hash
 
 
-def GetLinterErrors(abspath: str, relpath: str) -> CacheLookupResult:
-  """Looks up the given directory and returns cached results (if any)."""
+def GetLinterErrors(abspath: str, relpath: str,
+                    checksum: typing.Optional[bytes] = None
+                    ) -> CacheLookupResult:
+  """Looks up the given directory and returns cached results (if any).
+
+  Args:
+    abspath: The absolute path to the directory.
+    relpath: The workspace-relative path to the directory.
+    checksum: The directory checksum, if already known.
+
+  Returns:
+    A CacheLookupResult.
+  """
   relpath_md5 = common.Md5String(relpath).digest()
 
   # Get the time of the most-recently modified file in the directory.
-  checksum = GetDirectoryChecksum(abspath).digest()
+  if checksum is None:
+    checksum = GetDirectoryChecksum(abspath).digest()
 
   ret = CacheLookupResult(
       exists=False,
@@ -218,25 +289,15 @@ def GetLinterErrors(abspath: str, relpath: str) -> CacheLookupResult:
       errors=[]
   )
 
-  directory = SESSION \
-    .query(Directory) \
-    .filter(Directory.relpath_md5 == ret.relpath_md5) \
-    .first()
-
-  if directory and directory.checksum == ret.checksum:
+  cached_checksum = DIRECTORIES.get(relpath_md5)
+  if cached_checksum == checksum:
     ret.exists = True
-    ret.errors = SESSION \
-      .query(CachedError) \
-      .filter(CachedError.dir == ret.relpath_md5)
+    ret.errors = ERRORS.get(relpath_md5, [])
     logging.debug("cache hit %s", relpath)
-  elif directory:
+  elif cached_checksum:
     logging.debug("removing stale directory cache %s", relpath)
-
-    # Delete all existing cache entries.
-    SESSION.delete(directory)
-    SESSION \
-      .query(CachedError) \
-      .filter(CachedError.dir == ret.relpath_md5) \
-      .delete()
+    del DIRECTORIES[relpath_md5]
+    ERRORS.pop(relpath_md5, None)
+    STALE_DIRECTORIES.add(relpath_md5)
 
   return ret
@@ -1,8 +1,11 @@
 """A linter for ensuring that a Photo Library is organized correctly."""
+import collections
+import multiprocessing
 import os
 import sys
 import time
 import typing
+from concurrent import futures
 
 from absl import app
 from absl import flags
@@ -18,6 +21,14 @@ from util.photolib import workspace
 FLAGS = flags.FLAGS
 flags.DEFINE_string("workspace", os.getcwd(), "Path to workspace root")
 flags.DEFINE_boolean("profile", False, "Print profiling timers on completion.")
+flags.DEFINE_integer("scan_threads", 16,
+                     "The number of threads used to scan directories.")
+flags.DEFINE_integer("xmp_processes", os.cpu_count(),
+                     "The number of processes used to read XMP metadata. If "
+                     "1, metadata is read in the main process.")
+flags.DEFINE_integer("lint_batch_size", 64,
+                     "The number of directories which are scanned and linted "
+                     "together. Cache updates are written once per batch.")
 
 
 class Timers(object):
@@ -30,16 +41,55 @@ class Timers(object):
 TIMERS = Timers()
 
 
+class ScannedDirectory(typing.NamedTuple):
+  """The contents of a directory."""
+  abspath: str
+  dirnames: typing.List[str]
+  filenames: typing.List[str]
+  # The modification time of each file.
+  mtimes: typing.Dict[str, int]
+  # The subdirectories to descend into. As with os.walk(), symlinks to
+  # directories are listed but not followed.
+  subdirs: typing.List[str]
+  checksum: bytes
+
+
+def ScanDirectory(abspath: str) -> ScannedDirectory:
+  """Scan a directory, stat-ing each entry only once.
+
+  Args:
+    abspath: The absolute path to the directory.
+
+  Returns:
+    A ScannedDirectory.
+  """
+  with os.scandir(abspath) as it:
+    entries = list(it)
+  dirs = [entry for entry in entries if entry.is_dir()]
+  files = [entry for entry in entries if not entry.is_dir()]
+  return ScannedDirectory(
+      abspath=abspath,
+      dirnames=[entry.name for entry in dirs],
+      filenames=[entry.name for entry in files],
+      mtimes={entry.name: int(entry.stat().st_mtime) for entry in files},
+      subdirs=[entry.name for entry in dirs if not entry.is_symlink()],
+      checksum=lintercache.GetDirectoryChecksum(abspath, entries).digest())
+
+
 class ToplevelLinter(linters.Linter):
   """A linter for top level directories."""
   __cost__ = 1
 
   def __init__(self, workspace_abspath: str, toplevel_dir: str,
                dirlinters: typing.List[linters.DirLinter],
-               filelinters: typing.List[linters.FileLinter]):
+               filelinters: typing.List[linters.FileLinter],
+               scan_pool: futures.Executor,
+               xmp_pool: typing.Optional[multiprocessing.Pool] = None):
     super(ToplevelLinter, self).__init__()
     self.workspace = workspace_abspath
     self.toplevel_dir = toplevel_dir
+    self.scan_pool = scan_pool
+    self.xmp_pool = xmp_pool
     self.dirlinters = linters.GetLinters(dirlinters)
     self.filelinters = linters.GetLinters(filelinters)
 
@@ -69,32 +119,67 @@ class ToplevelLinter(linters.Linter):
 
     return errors
 
-  def __call__(self, *args, **kwargs):
-    start_ = time.time()
-
-    working_dir = os.path.join(self.workspace, self.toplevel_dir)
-    for abspath, dirnames, filenames in os.walk(working_dir):
-      _start = time.time()
-      relpath = workspace.get_workspace_relpath(self.workspace, abspath)
+  def _PrintCachedErrors(self, cache_entry: lintercache.CacheLookupResult):
+    """Report the cached errors for a directory."""
+    for error in cache_entry.errors:
+      linters.ERROR_COUNTS[error.category] += 1
+      if not FLAGS.counts:
+        print(error, file=sys.stderr)
+    sys.stderr.flush()
 
-      cache_entry = lintercache.GetLinterErrors(abspath, relpath)
+    if FLAGS.counts:
+      linters.PrintErrorCounts()
 
-      if cache_entry.exists:
-        for error in cache_entry.errors:
-          linters.ERROR_COUNTS[error.category] += 1
-          if not FLAGS.counts:
-            print(error, file=sys.stderr)
-        sys.stderr.flush()
+  def __call__(self, *args, **kwargs):
+    start_ = time.time()
 
-        if FLAGS.counts:
-          linters.PrintErrorCounts()
+    # Directories are scanned in batches on the thread pool. The XMP metadata
+    # of the files in directories which miss the cache is read on the process
+    # pool before linting, and cache updates are written once per batch.
+    queue = collections.deque([os.path.join(self.workspace,
+                                            self.toplevel_dir)])
+    while queue:
+      batch = [queue.popleft()
+               for _ in range(min(len(queue), FLAGS.lint_batch_size))]
+
+      misses = []
+      for directory in self.scan_pool.map(ScanDirectory, batch):
+        _start = time.time()
+        queue.extend(os.path.join(directory.abspath, subdir)
+                     for subdir in directory.subdirs)
+        relpath = workspace.get_workspace_relpath(
+            self.workspace, directory.abspath)
+
+        cache_entry = lintercache.GetLinterErrors(
+            directory.abspath, relpath, directory.checksum)
+
+        if cache_entry.exists:
+          self._PrintCachedErrors(cache_entry)
+          TIMERS.cached_seconds += time.time() - _start
+        else:
+          misses.append((directory, relpath, cache_entry))
+
+      if not misses:
+        continue
 
-        TIMERS.cached_seconds += time.time() - _start
-      else:
+      _start = time.time()
+      lightroom.PrefetchLightroomKeywords([
+        (f"{directory.abspath}/{filename}", f"{relpath}/{filename}",
+         directory.mtimes[filename])
+        for directory, relpath, _ in misses
+        for filename in directory.filenames
+        if filename not in common.IGNORED_FILES
+      ], self.xmp_pool)
+
+      for directory, relpath, cache_entry in misses:
         errors = self._LintThisDirectory(
-            abspath, relpath, dirnames, filenames)
+            directory.abspath, relpath, directory.dirnames,
+            directory.filenames)
         lintercache.AddLinterErrors(cache_entry, errors)
-        TIMERS.linting_seconds += time.time() - _start
+
+      lintercache.FlushErrorsCache()
+      lightroom.FlushKeywordsCache()
+      TIMERS.linting_seconds += time.time() - _start
 
     TIMERS.total_seconds += time.time() - start_
 
@@ -103,20 +188,25 @@ class WorkspaceLinter(linters.Linter):
   """The master linter for the photolib workspace."""
   __cost__ = 1
 
-  def __init__(self, abspath: str):
+  def __init__(self, abspath: str,
+               xmp_pool: typing.Optional[multiprocessing.Pool] = None):
     super(WorkspaceLinter, self).__init__()
     self.workspace = abspath
+    self.xmp_pool = xmp_pool
 
   def __call__(self, *args, **kwargs):
-    photolib_linter = ToplevelLinter(
-        self.workspace, "photos",
-        linters.PhotolibDirLinter, linters.PhotolibFileLinter)
-    gallery_linter = ToplevelLinter(
-        self.workspace, "gallery",
-        linters.GalleryDirLinter, linters.GalleryFileLinter)
+    with futures.ThreadPoolExecutor(FLAGS.scan_threads) as scan_pool:
+      photolib_linter = ToplevelLinter(
+          self.workspace, "photos",
+          linters.PhotolibDirLinter, linters.PhotolibFileLinter,
+          scan_pool, self.xmp_pool)
+      gallery_linter = ToplevelLinter(
+          self.workspace, "gallery",
+          linters.GalleryDirLinter, linters.GalleryFileLinter,
+          scan_pool, self.xmp_pool)
 
-    photolib_linter()
-    gallery_linter()
+      photolib_linter()
+      gallery_linter()
 
 
 def main(argv):  # pylint: disable=missing-docstring
@@ -127,10 +217,18 @@ def main(argv):  # pylint: disable=missing-docstring
     print(f"Cannot find workspace in '{FLAGS.workspace}'", file=sys.stderr)
     sys.exit(1)
 
+  # Fork the XMP readers before loading the caches into memory.
+  xmp_pool = (multiprocessing.Pool(FLAGS.xmp_processes)
+              if FLAGS.xmp_processes > 1 else None)
+
   lightroom.InitializeKeywordsCache(abspath)
   lintercache.InitializeErrorsCache(abspath)
 
-  WorkspaceLinter(abspath)()
+  try:
+    WorkspaceLinter(abspath, xmp_pool)()
+  finally:
+    if xmp_pool:
+      xmp_pool.close()
 
   # Print the carriage return once we've done updating the counts line.
   if FLAGS.counts and linters.ERROR_COUNTS:
@@ -40,6 +40,15 @@ flags.DEFINE_bool(
     'Whether to gzip individual files in chunks. Files are only stored in gzip '
     'form if it is smaller than the original file. For compressed image formats '
     'like JPGs, gzip rarely offers a reduction in file size.')
+flags.DEFINE_string(
+    'previous_chunks_dir', None,
+    'The root directory of a previous set of chunks. The checksums recorded in '
+    'their manifests are reused for files whose size and modification time '
+    'are unchanged, rather than re-hashing the file.')
+flags.DEFINE_integer(
+    'num_threads', None,
+    'The number of threads to hash and copy files with. Defaults to a value '
+    'based on the number of CPUs.')
 
 
 def main(argv):
@@ -63,10 +72,19 @@ def main(argv):
   if '/' in chunk_prefix:
     raise app.UsageError("--chunk_prefix cannot contain '/' character.")
 
+  checksum_cache = None
+  if FLAGS.previous_chunks_dir:
+    previous_chunks_dir = pathlib.Path(FLAGS.previous_chunks_dir)
+    if not previous_chunks_dir.is_dir():
+      raise app.UsageError('--previous_chunks_dir not found')
+    checksum_cache = shutterbug.ChecksumCache.FromChunksDir(
+        previous_chunks_dir)
+
   shutterbug.MakeChunks(
       [src_dir], chunks_dir, size_in_bytes, prefix=chunk_prefix,
       shuffle=FLAGS.random_ordering, seed=FLAGS.random_ordering_seed,
-      gzip=FLAGS.gzip_files)
+      gzip=FLAGS.gzip_files, checksum_cache=checksum_cache,
+      num_threads=FLAGS.num_threads)
 
 
 if __name__ == '__main__':
@@ -2,15 +2,18 @@
 
 Shutterbug is a library for creating DVD backups of photo libraries.
 """
-import gzip
+import gzip as gzip_lib
 import os
 import pathlib
 import random
 import sys
+import threading
+import time
 import typing
+from concurrent import futures
 from datetime import datetime
 from hashlib import md5
-from shutil import copy, copyfileobj
+from shutil import copyfileobj
 
 from absl import flags
 
@@ -19,19 +22,69 @@ FLAGS = flags.FLAGS
 
 # Metadata used in README.txt files.
 __author__ = 'Chris Cummins'
-__version__ = '0.0.4'
+__version__ = '0.0.5'
 __email__ = 'chrisc.101@gmail.com'
 
+# The size of blocks read when streaming files.
+_BLOCK_SIZE = 1024 * 1024
+
 
 def md5sum(path):
   m = md5()
   with open(path, 'rb') as infile:
-    m.update(infile.read())
+    for block in iter(lambda: infile.read(_BLOCK_SIZE), b''):
+      m.update(block)
+  return m.hexdigest()
+
+
+def _copy_and_md5sum(infile, outfile) -> str:
+  """Copy a file object, computing the md5sum of the data as it is read."""
+  m = md5()
+  for block in iter(lambda: infile.read(_BLOCK_SIZE), b''):
+    m.update(block)
+    outfile.write(block)
   return m.hexdigest()
 
 
+class ChecksumCache(object):
+  """A cache of file checksums, read from the manifests of existing chunks.
+
+  A file's cached checksum is used if its size and modification time are
+  unchanged, saving the cost of hashing it.
+  """
+
+  def __init__(self):
+    self.checksums: typing.Dict[typing.Tuple[str, int, int], str] = {}
+
+  def Add(self, path: str, size: int, mtime_ns: int, checksum: str) -> None:
+    self.checksums[(path, size, mtime_ns)] = checksum
+
+  def Get(self, path: str, size: int, mtime_ns: int) -> typing.Optional[str]:
+    return self.checksums.get((path, size, mtime_ns))
+
+  @classmethod
+  def FromChunksDir(cls, chunks_dir: pathlib.Path) -> 'ChecksumCache':
+    """Read the manifests of all chunks in a directory.
+
+    Manifests created by versions of shutterbug which did not record file
+    modification times are ignored.
+    """
+    cache = cls()
+    for manifest in sorted(chunks_dir.glob('*/MANIFEST.txt')):
+      for row in read_manifest(manifest) or []:
+        columns = row.split('\t')
+        if len(columns) != 5:
+          continue
+        _, checksum, size, path, mtime_ns = columns
+        try:
+          cache.Add(path, int(size), int(mtime_ns), checksum)
+        except ValueError:
+          continue
+    return cache
+
+
 def chunk_files(paths, outdir, maxsize, prefix='chunk_', shuffle=True,
-                seed=None, gzip=False):
+                seed=None, gzip=False, checksum_cache=None, num_threads=None):
   """Create chunk files.
 
   Split a set of file paths into chunks, whereby the cumulative size of files
@@ -48,16 +101,23 @@ def chunk_files(paths, outdir, maxsize, prefix='chunk_', shuffle=True,
   help minimize the number of chunks required in case there are groups of
   large files.
 
+  If a checksum_cache is provided, the checksums of files which are found in
+  the cache are not recomputed. Files are hashed and copied (or compressed) in
+  a single pass, on a pool of num_threads threads.
+
   Returns a list of tuples, where each tuple consists of a path to a chunk,
   and its size in bytes.
   """
+  # Output paths which have been claimed by a file, but may not yet exist.
+  claimed_outpaths = set()
+  claimed_outpaths_lock = threading.Lock()
 
   def chunk_meta(chunk_path, chunk, chunksize, maxsize):
     manifestpath = os.path.join(chunk_path, 'MANIFEST.txt')
     with open(manifestpath, 'w') as outfile:
-      for outpath, path, size, checksum in sorted(chunk,
-                                                  key=lambda x: x[0]):
-        print(outpath, checksum, size, path, file=outfile, sep='\t')
+      for outpath, path, size, checksum, mtime_ns in sorted(chunk,
+                                                            key=lambda x: x[0]):
+        print(outpath, checksum, size, path, mtime_ns, file=outfile, sep='\t')
     print('Wrote', manifestpath)
 
     readmepath = os.path.join(chunk_path, 'README.txt')
@@ -72,8 +132,8 @@ Version: {version}
 Date: {date}
 
 The MANIFEST.txt file contains a tab separated list of filenames, MD5 checksums,
-file sizes, and original file paths. To restore the original files, for each
-line in the manifest file:
+file sizes, original file paths, and original file modification times in
+nanoseconds. To restore the original files, for each line in the manifest file:
   1. Copy (or unzip if file ends with .gz) the file path of the first column to
      the output file path in the fourth column.
   2. Compare the output file md5sum against the checksum in the second column.
@@ -88,8 +148,7 @@ line in the manifest file:
           '({chunksize_perc:.1f}% of maximum size)'.format(**vars()))
     print()
 
-  def get_outpath(chunk_path, path, gzip=False):
-    checksum = md5sum(path)
+  def get_outpath(chunk_path, path, checksum, gzip=False):
     ext = os.path.splitext(path)[1]  # file extension
 
     if ext == '.gz':  # prevent double-zipping
@@ -101,29 +160,48 @@ line in the manifest file:
       outpath = os.path.join(chunk_path, checksum + ext)
 
     # generate a unique file name
-    if os.path.exists(outpath):
-      i = 2
-      while True:
-        outpath = os.path.join(chunk_path, checksum + '-' + str(i) + ext)
-        if not os.path.exists(outpath):
-          return checksum, outpath
-        i += 1
-    else:
+    with claimed_outpaths_lock:
+      if outpath in claimed_outpaths or os.path.exists(outpath):
+        i = 2
+        while True:
+          outpath = os.path.join(chunk_path, checksum + '-' + str(i) + ext)
+          if not (outpath in claimed_outpaths or os.path.exists(outpath)):
+            break
+          i += 1
+      claimed_outpaths.add(outpath)
+    return outpath
+
+  def stream_to_outpath(chunk_path, path, checksum, write, gzip=False):
+    """Write a file to its output path, hashing it as it is read if the
+    checksum is not known."""
+    if checksum:
+      outpath = get_outpath(chunk_path, path, checksum, gzip=gzip)
+      with open(path, 'rb') as infile:
+        with write(outpath) as outfile:
+          copyfileobj(infile, outfile, _BLOCK_SIZE)
       return checksum, outpath
 
-  def cp(path, size, chunk_path):
-    checksum, outpath = get_outpath(chunk_path, path)
-
-    copy(path, outpath)
+    # The output path depends on the checksum, so write to a temporary file
+    # and rename it once the checksum is known.
+    temppath = os.path.join(
+        chunk_path, f'.{os.path.basename(path)}.{threading.get_ident()}.tmp')
+    with open(path, 'rb') as infile:
+      with write(temppath) as outfile:
+        checksum = _copy_and_md5sum(infile, outfile)
+    outpath = get_outpath(chunk_path, path, checksum, gzip=gzip)
+    os.rename(temppath, outpath)
+    return checksum, outpath
+
+  def cp(path, size, chunk_path, checksum):
+    checksum, outpath = stream_to_outpath(
+        chunk_path, path, checksum, lambda p: open(p, 'wb'))
     print(outpath, '{:.2f}MB'.format(size / 1000 ** 2))
     return os.path.basename(outpath), checksum
 
-  def gz(path, size, chunk_path):
-    checksum, outpath = get_outpath(chunk_path, path, gzip=True)
-
-    with open(path, 'rb') as infile:
-      with gzip.open(outpath, 'wb') as outfile:
-        copyfileobj(infile, outfile)
+  def gz(path, size, chunk_path, checksum):
+    checksum, outpath = stream_to_outpath(
+        chunk_path, path, checksum, lambda p: gzip_lib.open(p, 'wb'),
+        gzip=True)
     outsize = os.stat(outpath).st_size
 
     if outsize <= size:
@@ -135,7 +213,14 @@ line in the manifest file:
     else:
       # if not, replace it with the original file
       os.remove(outpath)
-      return cp(path, size, chunk_path)
+      return cp(path, size, chunk_path, checksum)
+
+  def pack_file(path, root, stat, chunk_path):
+    relpath = os.path.relpath(path, root)
+    checksum = (checksum_cache.Get(relpath, stat.st_size, stat.st_mtime_ns)
+                if checksum_cache else None)
+    outname, checksum = cp_fn(path, stat.st_size, chunk_path, checksum)
+    return outname, relpath, stat.st_size, checksum, stat.st_mtime_ns
 
   def _init_chunk(outdir, prefix, chunk_count):
     chunk_path = os.path.join(
@@ -154,45 +239,48 @@ line in the manifest file:
       random.seed(seed)
     random.shuffle(paths)
 
-  chunk_count = 0
-  init_chunk = lambda: _init_chunk(outdir, prefix, chunk_count)
-  chunk_path = init_chunk()
-
-  i = 0
+  # Assign files to chunks. A file which is larger than the maximum size is
+  # placed in a chunk of its own.
+  planned_chunks = []
   chunk = []
-  chunks = []
   size = 0
+  i = 0
   while i < len(paths):
     path, root = paths[i]
-    pathsize = os.stat(path).st_size
+    stat = os.stat(path)
+    pathsize = stat.st_size
 
     if size == 0 and pathsize > maxsize:
-      outname, checksum = cp_fn(path, pathsize, chunk_path)
-      chunk_meta(chunk_path,
-                 [(outname, os.path.relpath(path, root), pathsize, checksum)],
-                 pathsize, maxsize)
-      chunks.append((chunk_path, pathsize))
-      chunk_count += 1
-      chunk_path = init_chunk()
-
+      planned_chunks.append(([(path, root, stat)], pathsize))
       i += 1
     elif size + pathsize <= maxsize:
-      outname, checksum = cp_fn(path, pathsize, chunk_path)
-      chunk.append((outname, os.path.relpath(path, root), pathsize, checksum))
+      chunk.append((path, root, stat))
       i += 1
       size += pathsize
     else:
-      chunk_meta(chunk_path, chunk, size, maxsize)
-      chunks.append((chunk_path, size))
+      planned_chunks.append((chunk, size))
       size = 0
       chunk = []
 
-      chunk_count += 1
-      chunk_path = init_chunk()
-
   # spit out any leftovers
-  chunk_meta(chunk_path, chunk, size, maxsize)
-  chunks.append((chunk_path, size))
+  planned_chunks.append((chunk, size))
+
+  # Pack the files of all chunks on the thread pool, and write the metadata
+  # of each chunk once its files are packed.
+  chunks = []
+  with futures.ThreadPoolExecutor(num_threads) as executor:
+    pending = []
+    for chunk_count, (chunk, size) in enumerate(planned_chunks):
+      chunk_path = _init_chunk(outdir, prefix, chunk_count)
+      pending.append((chunk_path, size, [
+        executor.submit(pack_file, path, root, stat, chunk_path)
+        for path, root, stat in chunk
+      ]))
+
+    for chunk_path, size, packed_files in pending:
+      chunk_meta(chunk_path, [f.result() for f in packed_files],
+                 size, maxsize)
+      chunks.append((chunk_path, size))
 
   return chunks
 
@@ -222,6 +310,13 @@ def PathTuplesToChunk(src_dirs: typing.List[pathlib.Path]):
   return files
 
 
+def _PrintThroughput(verb: str, size_in_bytes: int, seconds: float) -> None:
+  """Print the throughput of an operation."""
+  size_mb = size_in_bytes / 1000 ** 2
+  throughput = size_mb / max(seconds, 1e-6)
+  print(f'{verb} {size_mb:.2f} MB in {seconds:.1f}s ({throughput:.2f} MB/s)')
+
+
 def MakeChunks(src_dirs: typing.List[pathlib.Path],
                chunks_dir: pathlib.Path, chunk_size_in_bytes: int,
                **kwargs) -> None:
@@ -239,7 +334,9 @@ def MakeChunks(src_dirs: typing.List[pathlib.Path],
     print(f'fatal: {e}', file=sys.stderr)
     sys.exit(1)
 
+  start_time = time.time()
   chunks = chunk_files(files, chunks_dir, chunk_size_in_bytes, **kwargs)
+  elapsed = time.time() - start_time
 
   chunksizes_mb = [chunk[1] / 1000 ** 2 for chunk in chunks]
   totalsize_mb = sum(chunksizes_mb)
@@ -250,20 +347,31 @@ def MakeChunks(src_dirs: typing.List[pathlib.Path],
   print(f'{num_chunks} chunks of avg size {avgchunksize_mb:.2f} MB '
         f'(min: {minchunksize_mb:.2f} MB, max: {maxchunksize_mb:.2f} MB)')
   print(f'total size of chunks {totalsize_mb:.2f} MB')
+  _PrintThroughput('packed', sum(chunk[1] for chunk in chunks), elapsed)
 
 
 def unchunk_file(chunk_path, outdir, manifest_entry, lineno):
+  """Unpack and validate a file from a chunk.
+
+  Returns:
+    The size of the unpacked file in bytes.
+  """
+
   def deflate(src, dst):
     print(src, '->', dst)
-    with gzip.open(src, 'rb') as infile:
+    with gzip_lib.open(src, 'rb') as infile:
       with open(dst, 'wb') as outfile:
-        copyfileobj(infile, outfile)
+        return _copy_and_md5sum(infile, outfile)
 
   def cp(src, dst):
     print(src, '->', dst)
-    copy(src, dst)
+    with open(src, 'rb') as infile:
+      with open(dst, 'wb') as outfile:
+        return _copy_and_md5sum(infile, outfile)
 
-  inpath, checksum, size, outpath = manifest_entry.split('\t')
+  # Manifests created by newer versions of shutterbug have an additional
+  # column for the file modification time.
+  inpath, checksum, size, outpath = manifest_entry.split('\t')[:4]
 
   inpath = os.path.join(chunk_path, inpath)
   outpath = os.path.join(outdir, outpath)
@@ -281,13 +389,13 @@ def unchunk_file(chunk_path, outdir, manifest_entry, lineno):
   # determine whether file is compressed
   unpack_fn = deflate if ext == '.gz' else cp
 
-  # if file is compressed, unpack it
-  unpack_fn(inpath, outpath)
+  # if file is compressed, unpack it, computing the checksum as it is written
+  actualchecksum = unpack_fn(inpath, outpath)
 
   # validate file size
+  actualsize = os.stat(outpath).st_size
   try:
     size = int(size)
-    actualsize = os.stat(outpath).st_size
     if size != actualsize:
       print('warning[{lineno}]: expected file size {size} does not match'
             'actual size {actualsize}. File is corrupt', outpath,
@@ -297,11 +405,12 @@ def unchunk_file(chunk_path, outdir, manifest_entry, lineno):
           .format(**vars()), file=sys.stderr)
 
   # validate checksum
-  actualchecksum = md5sum(outpath)
   if checksum != actualchecksum:
     print('warning[{lineno}]: checksum validation failed. File is corrupt',
           outpath, file=sys.stderr)
 
+  return actualsize
+
 
 def read_manifest(manifestpath):
   # read manifest file
@@ -312,19 +421,36 @@ def read_manifest(manifestpath):
     print('fatal: unable to read manifest file', manifestpath)
 
 
-def unchunk_chunk(chunk_path, out_path):
-  chunk = read_manifest(os.path.join(chunk_path, 'MANIFEST.txt'))
+def unchunk_chunk(chunk_path, out_path, executor=None):
+  """Unpack and validate the files of a chunk.
 
-  for i, row in enumerate(chunk):
+  If an executor is provided, files are unpacked in parallel.
+
+  Returns:
+    The total size of the unpacked files in bytes.
+  """
+  chunk = read_manifest(os.path.join(chunk_path, 'MANIFEST.txt')) or []
+
+  def _unchunk_file(row, lineno):
     try:
-      lineno = i + 1
-      unchunk_file(chunk_path, out_path, row, lineno)
+      return unchunk_file(chunk_path, out_path, row, lineno)
     except Exception as e:
       print('error[{lineno}]: {e}'.format(**vars()),
             file=sys.stderr)
+      return 0
+
+  if executor:
+    sizes = executor.map(_unchunk_file, chunk, range(1, len(chunk) + 1))
+  else:
+    sizes = map(_unchunk_file, chunk, range(1, len(chunk) + 1))
+  return sum(sizes)
 
 
-def unchunk(chunks_dir: pathlib.Path, out_dir: pathlib.Path):
+def unchunk(chunks_dir: pathlib.Path, out_dir: pathlib.Path,
+            num_threads: typing.Optional[int] = None):
+  start_time = time.time()
   chunk_dirs = [d.absolute() for d in chunks_dir.iterdir() if d.is_dir()]
-  for directory in chunk_dirs:
-    unchunk_chunk(directory, out_dir)
+  with futures.ThreadPoolExecutor(num_threads) as executor:
+    size = sum(unchunk_chunk(directory, out_dir, executor)
+               for directory in chunk_dirs)
+  _PrintThroughput('unpacked', size, time.time() - start_time)
@@ -90,6 +90,38 @@ def test_end_to_end(tempdir: pathlib.Path, photodir: pathlib.Path):
     _AssertIsPhotoDir(out_dir)
 
 
+def test_end_to_end_gzip(tempdir: pathlib.Path, photodir: pathlib.Path):
+  """Test end to end packing and unpacking with gzip compression."""
+  shutterbug.MakeChunks([photodir], tempdir, int(1e6), gzip=True,
+                        num_threads=2)
+  with tempfile.TemporaryDirectory(prefix='phd_') as d:
+    out_dir = pathlib.Path(d)
+    shutterbug.unchunk(tempdir, out_dir, num_threads=2)
+    _AssertIsPhotoDir(out_dir)
+
+
+def test_ChecksumCache_FromChunksDir(tempdir: pathlib.Path,
+                                     photodir: pathlib.Path):
+  """Test that checksums are read from chunk manifests."""
+  shutterbug.MakeChunks([photodir], tempdir, int(1e6))
+  cache = shutterbug.ChecksumCache.FromChunksDir(tempdir)
+  stat = (photodir / 'a.jpg').stat()
+  assert cache.Get('a.jpg', stat.st_size, stat.st_mtime_ns) == (
+    shutterbug.md5sum(photodir / 'a.jpg'))
+  # A changed modification time misses the cache.
+  assert not cache.Get('a.jpg', stat.st_size, stat.st_mtime_ns + 1)
+
+
+def test_MakeChunks_checksum_cache(tempdir: pathlib.Path,
+                                   photodir: pathlib.Path):
+  """Test that cached checksums are used rather than re-hashing files."""
+  cache = shutterbug.ChecksumCache()
+  stat = (photodir / 'a.jpg').stat()
+  cache.Add('a.jpg', stat.st_size, stat.st_mtime_ns, 'cached')
+  shutterbug.MakeChunks([photodir], tempdir, int(1e6), checksum_cache=cache)
+  assert (tempdir / 'chunk_001' / 'cached.jpg').is_file()
+
+
 def main(argv: typing.List[str]):
   """Main entry point."""
   if len(argv) > 1:
@@ -17,6 +17,10 @@ flags.DEFINE_string(
     'out_dir', None,
     'The directory to write the unpacked chunks to. Each chunk contains files '
     'which are unpacked to a path relative to this directory.')
+flags.DEFINE_integer(
+    'num_threads', None,
+    'The number of threads to unpack and validate files with. Defaults to a '
+    'value based on the number of CPUs.')
 
 
 def main(argv):
@@ -32,7 +36,7 @@ def main(argv):
   if not out_dir.is_dir():
     raise app.UsageError('--out_dir not found')
 
-  shutterbug.unchunk(chunks_dir, out_dir)
+  shutterbug.unchunk(chunks_dir, out_dir, num_threads=FLAGS.num_threads)
 
 
 if __name__ == '__main__':
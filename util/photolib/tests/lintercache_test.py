@@ -0,0 +1,88 @@
+"""Unit tests for lintercache.py."""
+import os
+import pathlib
+import sys
+import tempfile
+
+import pytest
+from absl import app
+
+from util.photolib import lintercache
+from util.photolib import linters
+
+
+@pytest.fixture(scope="module")
+def workspace() -> str:
+  """A workspace with an initialized errors cache."""
+  with tempfile.TemporaryDirectory() as tmpdir:
+    lintercache.InitializeErrorsCache(tmpdir)
+    yield tmpdir
+
+
+def test_GetDirectoryChecksum_changes_with_files(workspace):
+  """A new file changes the checksum."""
+  path = pathlib.Path(workspace) / "checksum"
+  path.mkdir()
+  checksum = lintercache.GetDirectoryChecksum(path).digest()
+  assert lintercache.GetDirectoryChecksum(path).digest() == checksum
+  (path / "a.jpg").touch()
+  assert lintercache.GetDirectoryChecksum(path).digest() != checksum
+
+
+def test_GetDirectoryChecksum_entries(workspace):
+  """Passing the scandir() entries does not change the checksum."""
+  path = pathlib.Path(workspace) / "entries"
+  path.mkdir()
+  (path / "a.jpg").touch()
+  with os.scandir(path) as it:
+    entries = list(it)
+  assert (lintercache.GetDirectoryChecksum(path, entries).digest() ==
+          lintercache.GetDirectoryChecksum(path).digest())
+
+
+def test_AddLinterErrors_FlushErrorsCache(workspace):
+  """Errors are returned from the cache once flushed."""
+  path = os.path.join(workspace, "errors")
+  os.mkdir(path)
+  entry = lintercache.GetLinterErrors(path, "//errors")
+  assert not entry.exists
+
+  error = linters.Error("//errors/a.jpg", "file/name", "invalid file name")
+  lintercache.AddLinterErrors(entry, [error])
+  lintercache.FlushErrorsCache()
+  assert not lintercache.PENDING_ERRORS
+
+  entry = lintercache.GetLinterErrors(path, "//errors")
+  assert entry.exists
+  assert [(e.relpath, e.category, e.message) for e in entry.errors] == [
+    ("//errors/a.jpg", "file/name", "invalid file name")]
+
+  # The error was written to the database.
+  assert lintercache.SESSION.query(lintercache.CachedError) \
+           .filter(lintercache.CachedError.dir == entry.relpath_md5) \
+           .one().message == "invalid file name"
+
+
+def test_GetLinterErrors_stale(workspace):
+  """Modifying a directory invalidates its cache entry."""
+  path = os.path.join(workspace, "stale")
+  os.mkdir(path)
+  entry = lintercache.GetLinterErrors(path, "//stale")
+  lintercache.AddLinterErrors(entry, [])
+  lintercache.FlushErrorsCache()
+
+  pathlib.Path(path, "a.jpg").touch()
+  entry = lintercache.GetLinterErrors(path, "//stale")
+  assert not entry.exists
+  lintercache.AddLinterErrors(entry, [])
+  lintercache.FlushErrorsCache()
+  assert lintercache.GetLinterErrors(path, "//stale").exists
+
+
+def main(argv):  # pylint: disable=missing-docstring
+  del argv
+  sys.exit(pytest.main([__file__, "-v"]))
+
+
+if __name__ == "__main__":
+  app.run(main)